@@ -0,0 +1,233 @@
+"""
+Benchmark of the lookups of unread chat messages: scanning the send states of the
+message history (the way it was done before the unread counters were introduced)
+versus reading the precomputed counters of `chat_unread`.
+
+Two lookups are compared:
+- the unread messages of a single user, as done on socket.io `authenticate`
+- the number of unread messages and rooms per user of the last 24 hours,
+  as done by the nightly mail job
+
+The benchmark seeds a separate database (`MONGODB_DB_NAME`, defaults to
+"ve-collab-benchmark"), which is dropped afterwards. Run it from the backend
+directory against a real mongodb (configured by the same environment variables
+as the platform itself)::
+
+    python -m benchmarks.chat_unread --rooms=10000 --messages=1000000
+
+"""
+
+import datetime
+import os
+import random
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from bson import ObjectId
+import pymongo
+from tornado.options import define, options, parse_command_line
+
+import global_vars
+from resources.indexes import reconcile_indexes
+from resources.network.chat import Chat
+import util
+
+define("rooms", default=10000, type=int, help="number of chatrooms to seed")
+define("messages", default=1000000, type=int, help="number of messages to seed")
+define("users", default=2000, type=int, help="number of users to seed")
+define(
+    "unread_ratio",
+    default=0.02,
+    type=float,
+    help="fraction of the send states that are not acknowledged",
+)
+define("days", default=30, type=int, help="time span the messages are spread over")
+define("samples", default=200, type=int, help="number of users to look up")
+define("keep", default=False, type=bool, help="don't drop the database afterwards")
+
+BATCH_SIZE = 10000
+
+
+def seed(db) -> None:
+    usernames = ["user{}".format(i) for i in range(options.users)]
+    now = datetime.datetime.now()
+
+    rooms = [
+        {
+            "_id": ObjectId(),
+            "name": None,
+            "members": random.sample(usernames, random.randint(2, 5)),
+            "last_message": None,
+        }
+        for _ in range(options.rooms)
+    ]
+    db.chatrooms.insert_many(rooms)
+
+    batch = []
+    for _ in range(options.messages):
+        room = random.choice(rooms)
+        sender = random.choice(room["members"])
+        batch.append(
+            {
+                "_id": ObjectId(),
+                "room_id": room["_id"],
+                "message": "benchmark",
+                "sender": sender,
+                "creation_date": now
+                - datetime.timedelta(seconds=random.randint(0, options.days * 86400)),
+                "send_states": [
+                    {
+                        "username": member,
+                        "send_state": (
+                            "acknowledged"
+                            if member == sender
+                            or random.random() >= options.unread_ratio
+                            else "sent"
+                        ),
+                    }
+                    for member in room["members"]
+                ],
+            }
+        )
+        if len(batch) >= BATCH_SIZE:
+            db.messages.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        db.messages.insert_many(batch, ordered=False)
+
+
+def unread_messages_of_user_by_scan(db, username: str) -> List[Dict]:
+    """
+    the unread messages of a user without counters, i.e. by matching the send states
+    of the whole message history of the user
+    """
+
+    return list(
+        db.messages.find(
+            {
+                "send_states": {
+                    "$elemMatch": {
+                        "username": username,
+                        "send_state": {"$ne": "acknowledged"},
+                    }
+                }
+            },
+            sort=[("creation_date", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+        )
+    )
+
+
+def unread_counts_since_by_scan(db, since: datetime.datetime) -> Dict[str, Dict]:
+    """
+    the unread messages and rooms per user without counters, i.e. by fetching all
+    unacknowledged messages of rooms with recent unacknowledged messages and counting
+    their send states in python
+    """
+
+    unacknowledged_filter = {
+        "send_states": {"$elemMatch": {"send_state": {"$ne": "acknowledged"}}}
+    }
+    room_ids = db.messages.distinct(
+        "room_id", {"creation_date": {"$gte": since}, **unacknowledged_filter}
+    )
+
+    counts = {}
+    for message in db.messages.find(
+        {"room_id": {"$in": room_ids}, **unacknowledged_filter}
+    ):
+        for send_state in message["send_states"]:
+            if send_state["send_state"] != "acknowledged":
+                entry = counts.setdefault(
+                    send_state["username"], {"messages": 0, "rooms": set()}
+                )
+                entry["messages"] += 1
+                entry["rooms"].add(message["room_id"])
+
+    return {
+        username: {"messages": entry["messages"], "rooms": len(entry["rooms"])}
+        for username, entry in counts.items()
+    }
+
+
+def measure(func: Callable, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def report(name: str, durations: List[float]) -> None:
+    durations = sorted(durations)
+    print(
+        "{:<40} median {:>9.2f} ms   p95 {:>9.2f} ms   max {:>9.2f} ms".format(
+            name,
+            statistics.median(durations),
+            durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+            durations[-1],
+        )
+    )
+
+
+def main():
+    parse_command_line()
+
+    global_vars.mongodb_host = os.getenv("MONGODB_HOST", "localhost")
+    global_vars.mongodb_port = int(os.getenv("MONGODB_PORT", "27017"))
+    global_vars.mongodb_username = os.getenv("MONGODB_USERNAME")
+    global_vars.mongodb_password = os.getenv("MONGODB_PASSWORD")
+    global_vars.mongodb_db_name = os.getenv("MONGODB_DB_NAME", "ve-collab-benchmark")
+
+    with util.get_mongodb() as db:
+        util.get_mongodb_client().drop_database(global_vars.mongodb_db_name)
+        reconcile_indexes(db)
+
+        print(
+            "seeding {} rooms, {} messages, {} users...".format(
+                options.rooms, options.messages, options.users
+            )
+        )
+        seed(db)
+
+        chat_manager = Chat(db)
+        print(
+            "building unread counters: {:.2f} ms".format(
+                measure(chat_manager.rebuild_unread_counters)
+            )
+        )
+
+        usernames = random.sample(
+            ["user{}".format(i) for i in range(options.users)],
+            min(options.samples, options.users),
+        )
+        report(
+            "unread messages of user (scan)",
+            [measure(unread_messages_of_user_by_scan, db, u) for u in usernames],
+        )
+        report(
+            "unread messages of user (counters)",
+            [
+                measure(chat_manager.get_rooms_with_unacknowledged_messages_for_user, u)
+                for u in usernames
+            ],
+        )
+        report(
+            "unread counts of user (counters only)",
+            [measure(chat_manager.get_unread_counts_for_user, u) for u in usernames],
+        )
+
+        since = datetime.datetime.now() - datetime.timedelta(days=1)
+        report(
+            "nightly unread summary (scan)",
+            [measure(unread_counts_since_by_scan, db, since) for _ in range(3)],
+        )
+        report(
+            "nightly unread summary (counters)",
+            [measure(chat_manager.get_unread_counts_since, since) for _ in range(3)],
+        )
+
+        if not options.keep:
+            util.get_mongodb_client().drop_database(global_vars.mongodb_db_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Benchmark of the flattening of nested documents into a single string before they
+are replicated to (or matched against) Elasticsearch: the previous recursive
+implementation, which concatenated the string on every value, versus the
+iterative `ElasticsearchConnector._dict_or_list_values_to_str()`.
+
+The documents are the good practise plans from `assets/default_good_practise_plans.json`
+and profiles shaped like the ones of the platform. To show how both implementations
+scale, the plans are additionally measured with their steps repeated `--scale` times.
+No database is needed, run it from the backend directory::
+
+    python -m benchmarks.elasticsearch_flatten --iterations=200 --scale=20
+
+"""
+
+import json
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from bson import ObjectId
+import bson.json_util
+from tornado.options import define, options, parse_command_line
+
+import util  # noqa: F401 (resolves the import cycle of the resources)
+from resources.elasticsearch_integration import ElasticsearchConnector
+
+define("iterations", default=200, type=int, help="number of repetitions per document")
+define(
+    "scale", default=20, type=int, help="factor the steps of the plans are repeated by"
+)
+
+
+def recursive_values_to_str(doc: dict | list) -> str:
+    """
+    the previous implementation of `_dict_or_list_values_to_str()`
+    """
+
+    result_str = ""
+    if isinstance(doc, str):
+        result_str = doc
+    elif isinstance(doc, ObjectId):
+        result_str = str(doc)
+    elif isinstance(doc, int):
+        result_str = str(doc)
+    elif isinstance(doc, float):
+        result_str = str(doc)
+    elif isinstance(doc, list):
+        for elem in doc:
+            result_str = " ".join([result_str, recursive_values_to_str(elem)])
+    elif isinstance(doc, dict):
+        for value in doc.values():
+            result_str = " ".join([result_str, recursive_values_to_str(value)])
+    elif isinstance(doc, object):
+        result_str = " ".join([result_str, recursive_values_to_str(doc.__dict__)])
+
+    return result_str.strip()
+
+
+def without_none(doc):
+    """
+    drop None values and stringify dates, the previous implementation
+    could not handle them
+    """
+
+    if isinstance(doc, dict):
+        return {
+            key: without_none(value) for key, value in doc.items() if value is not None
+        }
+    if isinstance(doc, list):
+        return [without_none(value) for value in doc if value is not None]
+    if isinstance(doc, (str, int, float, ObjectId)):
+        return doc
+    return str(doc)
+
+
+def load_plans() -> List[Dict]:
+    with open("assets/default_good_practise_plans.json", "r") as f:
+        plans = json.load(f)["good_practise_plans"]
+    return [without_none(bson.json_util.loads(json.dumps(plan))) for plan in plans]
+
+
+def make_profile(i: int) -> Dict:
+    return {
+        "username": "user{}".format(i),
+        "bio": "Lecturer for intercultural communication " * 5,
+        "institutions": [
+            {
+                "name": "University {}".format(j),
+                "school_type": "Hochschule",
+                "country": "Deutschland",
+                "department": "Faculty of Arts",
+            }
+            for j in range(3)
+        ],
+        "expertise": "Linguistics",
+        "languages": ["Deutsch", "Englisch", "Französisch"],
+        "ve_interests": ["digital learning", "COIL", "language learning"],
+        "ve_goals": ["intercultural competence", "language skills"],
+        "preferred_format": "hybrid",
+        "research_tags": ["tandem", "virtual exchange", "telecollaboration"],
+        "courses": [
+            {
+                "title": "Course {}".format(j),
+                "academic_course": "B.A.",
+                "semester": "WS",
+            }
+            for j in range(4)
+        ],
+        "educations": [
+            {
+                "institution": "University",
+                "degree": "M.A.",
+                "department": "Linguistics",
+                "timestamp_from": "2010-10-01",
+                "timestamp_to": "2013-09-30",
+                "additional_info": "",
+            }
+            for _ in range(2)
+        ],
+        "work_experience": [
+            {
+                "position": "Lecturer",
+                "institution": "University",
+                "department": "Faculty of Arts",
+                "timestamp_from": "2014-01-01",
+                "timestamp_to": "",
+                "city": "Leipzig",
+                "country": "Deutschland",
+                "additional_info": "",
+            }
+            for _ in range(3)
+        ],
+        "ve_window": [
+            {"plan_id": str(ObjectId()), "title": "VE", "description": "good practise"}
+        ],
+    }
+
+
+def measure(func: Callable, documents: List[Dict]) -> List[float]:
+    """
+    flatten the nested fields of the documents the way `_prepare_document()` does
+    and return the durations per document in microseconds
+    """
+
+    durations = []
+    for document in documents:
+        nested = [
+            value for value in document.values() if isinstance(value, (dict, list))
+        ]
+        start = time.perf_counter()
+        for _ in range(options.iterations):
+            for value in nested:
+                func(value)
+        durations.append((time.perf_counter() - start) / options.iterations * 1e6)
+    return durations
+
+
+def report(name: str, old: List[float], new: List[float]) -> None:
+    print(
+        "{:<28} recursive {:>10.1f} us   iterative {:>10.1f} us   speedup {:>5.1f}x".format(
+            name,
+            statistics.median(old),
+            statistics.median(new),
+            statistics.median(old) / statistics.median(new),
+        )
+    )
+
+
+def main():
+    parse_command_line()
+
+    connector = ElasticsearchConnector()
+    plans = load_plans()
+    profiles = [make_profile(i) for i in range(20)]
+    large_plans = [{**plan, "steps": plan["steps"] * options.scale} for plan in plans]
+
+    # both implementations have to agree on the documents
+    # (up to the whitespace the previous one left behind for empty values)
+    for document in plans + profiles:
+        for value in document.values():
+            if isinstance(value, (dict, list)):
+                assert (
+                    recursive_values_to_str(value).split()
+                    == connector._dict_or_list_values_to_str(value).split()
+                )
+
+    for name, documents in [
+        ("profiles", profiles),
+        ("good practise plans", plans),
+        ("plans, steps x{}".format(options.scale), large_plans),
+    ]:
+        report(
+            name,
+            measure(recursive_values_to_str, documents),
+            measure(connector._dict_or_list_values_to_str, documents),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Benchmark of the JSON encoding of large responses: the previous way of
+transforming the whole response in place by `util.json_serialize_response()` and
+dumping it afterwards (the way `self.write(dict)` of tornado does), versus encoding
+it directly by `util.json_dumps()` with the standard library json and with orjson
+(if it is installed).
+
+The responses are a timeline of `--posts` posts shaped like the ones of the
+platform and `--plans` plans built from the good practise plans in
+`assets/default_good_practise_plans.json`. No database is needed, run it from the
+backend directory::
+
+    python -m benchmarks.json_responses --posts=1000 --plans=100
+
+"""
+
+import copy
+from datetime import datetime, timedelta
+import json
+import random
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from bson import ObjectId
+import bson.json_util
+from tornado.options import define, options, parse_command_line
+
+import util
+
+define("posts", default=1000, type=int, help="number of posts in the timeline")
+define("plans", default=100, type=int, help="number of plans in the response")
+define("repetitions", default=10, type=int, help="number of measurements")
+
+
+def previous_json_serialize_response(dictionary: dict) -> dict:
+    """
+    the previous implementation of `util.json_serialize_response()`
+    """
+
+    for key in dictionary:
+        if isinstance(dictionary[key], ObjectId):
+            dictionary[key] = str(dictionary[key])
+        elif isinstance(dictionary[key], datetime):
+            dictionary[key] = dictionary[key].isoformat()
+        elif isinstance(dictionary[key], dict):
+            dictionary[key] = previous_json_serialize_response(dictionary[key])
+        elif isinstance(dictionary[key], list):
+            for elem in dictionary[key]:
+                if isinstance(elem, ObjectId):
+                    dictionary[key][dictionary[key].index(elem)] = str(elem)
+                elif isinstance(elem, dict):
+                    elem = previous_json_serialize_response(elem)
+
+    return dictionary
+
+
+def make_timeline() -> Dict:
+    now = datetime.now()
+    usernames = ["user{}".format(i) for i in range(500)]
+    space_ids = [ObjectId() for _ in range(50)]
+
+    def snippet(username: str) -> Dict:
+        return {
+            "username": username,
+            "first_name": "Max",
+            "last_name": "Mustermann",
+            "profile_pic": ObjectId(),
+            "institution": "Universität Leipzig",
+        }
+
+    posts = []
+    for i in range(options.posts):
+        author = random.choice(usernames)
+        posts.append(
+            {
+                "_id": ObjectId(),
+                "author": snippet(author),
+                "creation_date": now - timedelta(minutes=i),
+                "text": "<p>" + "Lorem ipsum dolor sit amet. " * 10 + "</p>",
+                "space": random.choice(space_ids),
+                "pinned": False,
+                "isRepost": False,
+                "wordpress_post_id": None,
+                "tags": ["tag1", "tag2"],
+                "plans": [ObjectId() for _ in range(random.randint(0, 3))],
+                "files": [
+                    {
+                        "file_id": ObjectId(),
+                        "file_name": "document.pdf",
+                        "file_type": "application/pdf",
+                        "author": author,
+                    }
+                    for _ in range(random.randint(0, 2))
+                ],
+                "comments": [
+                    {
+                        "_id": ObjectId(),
+                        "author": snippet(random.choice(usernames)),
+                        "creation_date": now,
+                        "text": "Great idea!",
+                        "pinned": False,
+                    }
+                    for _ in range(random.randint(0, 5))
+                ],
+                "likers": random.sample(usernames, random.randint(0, 20)),
+            }
+        )
+    # the ids of the posts of the page, e.g. to mark the unread ones
+    return {
+        "success": True,
+        "posts": posts,
+        "post_ids": [post["_id"] for post in posts],
+    }
+
+
+def make_plans() -> Dict:
+    with open("assets/default_good_practise_plans.json", "r") as f:
+        plans = [
+            bson.json_util.loads(json.dumps(plan))
+            for plan in json.load(f)["good_practise_plans"]
+        ]
+
+    response_plans = []
+    for i in range(options.plans):
+        plan = copy.deepcopy(plans[i % len(plans)])
+        plan["_id"] = ObjectId()
+        response_plans.append(plan)
+    return {"success": True, "plans": response_plans}
+
+
+def measure(func: Callable, response: Dict, copy_first: bool) -> List[float]:
+    durations = []
+    for _ in range(options.repetitions):
+        # the previous way mutates the response, so every run needs a fresh copy
+        # (which is not measured)
+        payload = copy.deepcopy(response) if copy_first else response
+        start = time.perf_counter()
+        func(payload)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def report(name: str, durations: List[float]) -> None:
+    print(
+        "{:<48} median {:>9.2f} ms   max {:>9.2f} ms".format(
+            name, statistics.median(durations), max(durations)
+        )
+    )
+
+
+def main():
+    parse_command_line()
+
+    def previous(response: Dict) -> str:
+        return json.dumps(previous_json_serialize_response(response))
+
+    def standard_library(response: Dict) -> str:
+        return json.dumps(response, cls=util.ResponseEncoder, separators=(",", ":"))
+
+    for name, response in [
+        ("timeline, {} posts".format(options.posts), make_timeline()),
+        ("plans, {} plans".format(options.plans), make_plans()),
+    ]:
+        # all ways have to produce the same documents
+        expected = json.loads(previous(copy.deepcopy(response)))
+        assert json.loads(standard_library(response)) == expected
+        assert json.loads(util.json_dumps(response)) == expected
+
+        report(
+            "{}: serialize in place + json".format(name),
+            measure(previous, response, copy_first=True),
+        )
+        report(
+            "{}: ResponseEncoder".format(name),
+            measure(standard_library, response, copy_first=False),
+        )
+        if util.orjson is not None:
+            report(
+                "{}: orjson".format(name),
+                measure(util.json_dumps, response, copy_first=False),
+            )
+
+
+if __name__ == "__main__":
+    main()
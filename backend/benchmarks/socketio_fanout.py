@@ -0,0 +1,184 @@
+"""
+Load test of the socket.io fan-out with thousands of simulated clients, each user
+being online with `--devices` sessions that are all in the room of the user
+(see `handlers.socket_io.user_room()`). Measured is the latency from the start
+of an emit until the event has been handed to the transport of every addressed
+session, for:
+
+- a notification to a single user, emitted once per session versus once to the
+  room of the user
+- a chat message to the `--room_size` members of a chatroom, emitted once per
+  member room versus once to the list of member rooms (as `Chat.send_message` does)
+- a mass notification to all users, emitted concurrently to the room of every user
+  (as `NotificationResource.bulk_send_notifications` does)
+
+The clients are simulated on the engine.io layer, i.e. the measurement covers
+the room lookups, the packet encoding and the hand-over to every session, but not
+the network. No database is needed. Run it from the backend directory::
+
+    python -m benchmarks.socketio_fanout --users=5000 --devices=2
+
+"""
+
+import asyncio
+import random
+import statistics
+import time
+from typing import Awaitable, Callable, List
+
+import socketio
+from tornado.options import define, options, parse_command_line
+
+from util import SocketIOJSON
+
+define("users", default=5000, type=int, help="number of simulated users")
+define("devices", default=2, type=int, help="number of sessions per user")
+define("room_size", default=20, type=int, help="number of members of a chatroom")
+define("samples", default=500, type=int, help="number of emits per scenario")
+
+NAMESPACE = "/"
+
+PAYLOAD = {
+    "type": "achievement_level_up",
+    "receive_state": "sent",
+    "payload": {"achievement_type": "social", "level": 3},
+}
+
+
+def user_room(username: str) -> str:
+    # same naming as `handlers.socket_io.user_room()`, which can't be imported
+    # without setting up the whole application
+    return "user:" + username
+
+
+class SimulatedClients:
+    """
+    connects `--users` x `--devices` simulated sessions to the socket.io server
+    and counts the packets handed to them by the server
+    """
+
+    def __init__(self, server: socketio.AsyncServer):
+        self.server = server
+        self.sids = {}
+        self.delivered = 0
+        server.eio.send_packet = self._send_packet
+
+    async def _send_packet(self, eio_sid: str, pkt) -> None:
+        self.delivered += 1
+
+    async def connect(self) -> None:
+        for i in range(options.users):
+            username = "user{}".format(i)
+            self.sids[username] = []
+            for device in range(options.devices):
+                sid = await self.server.manager.connect(
+                    "{}-{}".format(username, device), NAMESPACE
+                )
+                await self.server.manager.enter_room(
+                    sid, NAMESPACE, user_room(username)
+                )
+                self.sids[username].append(sid)
+
+
+async def measure(
+    clients: SimulatedClients, emit: Callable[[List[str]], Awaitable], recipients: int
+) -> List[float]:
+    """
+    Returns the duration of every sample emit in ms, checking that each one
+    reached all sessions of its `recipients` random users
+    """
+
+    usernames = list(clients.sids)
+    durations = []
+    for _ in range(options.samples):
+        targets = random.sample(usernames, recipients)
+        delivered = clients.delivered
+        start = time.perf_counter()
+        await emit(targets)
+        durations.append((time.perf_counter() - start) * 1000)
+        assert clients.delivered - delivered == recipients * options.devices
+    return durations
+
+
+def report(name: str, durations: List[float], sessions: int) -> None:
+    durations = sorted(durations)
+    print(
+        "{:<48} median {:>9.3f} ms   p99 {:>9.3f} ms   {:>10.0f} sessions/s".format(
+            name,
+            statistics.median(durations),
+            durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+            sessions / (statistics.mean(durations) / 1000),
+        )
+    )
+
+
+async def run() -> None:
+    server = socketio.AsyncServer(async_mode="asgi", json=SocketIOJSON)
+    clients = SimulatedClients(server)
+    await clients.connect()
+    print("{} users with {} sessions each\n".format(options.users, options.devices))
+
+    async def emit_per_session(usernames: List[str]) -> None:
+        for username in usernames:
+            for sid in clients.sids[username]:
+                await server.emit("notification", PAYLOAD, room=sid)
+
+    async def emit_per_user_room(usernames: List[str]) -> None:
+        for username in usernames:
+            await server.emit("notification", PAYLOAD, room=user_room(username))
+
+    async def emit_to_room_list(usernames: List[str]) -> None:
+        await server.emit(
+            "message",
+            PAYLOAD,
+            room=[user_room(username) for username in usernames],
+        )
+
+    report(
+        "notification, one emit per session",
+        await measure(clients, emit_per_session, 1),
+        options.devices,
+    )
+    report(
+        "notification, one emit to the user room",
+        await measure(clients, emit_per_user_room, 1),
+        options.devices,
+    )
+    report(
+        "chat message, one emit per member room",
+        await measure(clients, emit_per_user_room, options.room_size),
+        options.room_size * options.devices,
+    )
+    report(
+        "chat message, one emit to all member rooms",
+        await measure(clients, emit_to_room_list, options.room_size),
+        options.room_size * options.devices,
+    )
+
+    # mass notification to every user at once
+    delivered = clients.delivered
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            server.emit("notification", PAYLOAD, room=user_room(username))
+            for username in clients.sids
+        )
+    )
+    duration = time.perf_counter() - start
+    assert clients.delivered - delivered == options.users * options.devices
+    print(
+        "\nmass notification to all {} sessions: {:.1f} ms, {:.0f} sessions/s".format(
+            options.users * options.devices,
+            duration * 1000,
+            options.users * options.devices / duration,
+        )
+    )
+
+
+def main():
+    parse_command_line()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Benchmark of the memory used by concurrent file uploads into the space repositories,
+i.e. `--uploads` clients that upload a file of `--file_size` MB at the same time.
+Measured are the peak RSS of the server process and the throughput, for:
+
+- buffered uploads, where tornado reads the whole request body into memory and
+  parses the files out of it, before they are stored in GridFS (the way it was
+  done before `handlers.streaming_upload.StreamingUploadHandler`)
+- streamed uploads (`handlers.network.space.SpaceFileUploadHandler`), that write
+  the files into GridFS while the body arrives
+
+Every scenario runs in a fresh process, so that the peak RSS of one scenario
+isn't hidden by the one before. The clients stream their bodies, so they hardly
+add to the RSS. The benchmark uploads into a separate database (`MONGODB_DB_NAME`,
+defaults to "ve-collab-benchmark"), which is dropped afterwards. Run it from the
+backend directory against a real mongodb (configured by the same environment
+variables as the platform itself)::
+
+    python -m benchmarks.streaming_uploads --uploads=20 --file_size=100
+
+"""
+
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Callable, Tuple
+
+from bson import ObjectId
+import gridfs
+import tornado.httpclient
+import tornado.httpserver
+import tornado.web
+from tornado.options import define, options, parse_command_line
+from tornado.testing import bind_unused_port
+
+import global_vars
+from handlers.base_handler import BaseHandler
+from handlers.network.space import SpaceFileUploadHandler
+from model import User
+from resources.network.space import Spaces
+import util
+
+define("uploads", default=20, type=int, help="number of concurrent uploads")
+define("file_size", default=100, type=int, help="size of an uploaded file in MB")
+define(
+    "scenario",
+    default="",
+    type=str,
+    help="run only this scenario (buffered or streaming) in this process",
+)
+define("keep", default=False, type=bool, help="don't drop the database afterwards")
+
+SPACE_ID = ObjectId("000000000000000000000001")
+BOUNDARY = b"benchmarkboundary"
+BLOCK_SIZE = 64 * 1024
+
+
+class FixedUserHandler(BaseHandler):
+    """
+    replaces the authentication by Keycloak by a fixed logged in user
+    """
+
+    async def prepare(self):
+        self.current_user = User(
+            "benchmark", "aaaaaaaa-bbbb-0000-cccc-dddddddddddd", "benchmark@mail.de"
+        )
+
+
+class BufferedUploadHandler(FixedUserHandler):
+    """
+    the buffered upload into the space repository, as it was done before
+    """
+
+    def post(self):
+        file_obj = self.request.files["file"][0]
+        with util.get_mongodb() as db:
+            Spaces(db).add_new_repo_file(
+                SPACE_ID,
+                file_obj["filename"],
+                file_obj["body"],
+                file_obj["content_type"],
+                self.current_user.username,
+            )
+        self.write({"success": True})
+
+
+class BenchmarkSpaceFileUploadHandler(SpaceFileUploadHandler, FixedUserHandler):
+    """
+    `SpaceFileUploadHandler` without the membership and permission checks.
+    `FixedUserHandler` comes before `BaseHandler` in the MRO, so it is the one that
+    sets the user in the `prepare()` of the `StreamingUploadHandler`.
+    """
+
+    def authorize_upload(self) -> bool:
+        self.space_id = SPACE_ID
+        return True
+
+
+def body_producer(block: bytes, i: int) -> Tuple[Callable, int]:
+    """
+    the multipart/form-data body of an upload, written in blocks
+    by the client instead of being held in memory, and its length
+    """
+
+    head = (
+        b"--" + BOUNDARY + b"\r\n"
+        b'Content-Disposition: form-data; name="file"; '
+        b'filename="upload' + str(i).encode() + b'.bin"\r\n'
+        b"Content-Type: application/octet-stream\r\n\r\n"
+    )
+    tail = b"\r\n--" + BOUNDARY + b"--\r\n"
+    file_size = options.file_size * 1000 * 1000
+
+    async def produce(write: Callable) -> None:
+        await write(head)
+        for offset in range(0, file_size, len(block)):
+            await write(block[: min(len(block), file_size - offset)])
+        await write(tail)
+
+    return produce, len(head) + file_size + len(tail)
+
+
+async def upload_all(base_url: str) -> float:
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=options.uploads)
+    block = os.urandom(BLOCK_SIZE)
+
+    async def upload(i: int) -> None:
+        produce, length = body_producer(block, i)
+        response = await client.fetch(
+            base_url,
+            method="POST",
+            headers={
+                "Content-Type": "multipart/form-data; boundary=" + BOUNDARY.decode(),
+                "Content-Length": str(length),
+            },
+            body_producer=produce,
+            request_timeout=3600,
+        )
+        assert response.code == 200, response.code
+
+    start = time.perf_counter()
+    await asyncio.gather(*(upload(i) for i in range(options.uploads)))
+    return time.perf_counter() - start
+
+
+async def run_scenario(name: str) -> None:
+    handler = (
+        BufferedUploadHandler if name == "buffered" else BenchmarkSpaceFileUploadHandler
+    )
+    max_size = options.file_size * 1000 * 1000 + 1024 * 1024
+    global_vars.max_upload_size = max_size
+
+    sock, port = bind_unused_port()
+    server = tornado.httpserver.HTTPServer(
+        tornado.web.Application(
+            [(r"/spaceadministration/put_file", handler)],
+            # no access log of every request
+            log_function=lambda handler: None,
+        ),
+        max_body_size=max_size,
+        max_buffer_size=max_size,
+    )
+    server.add_sockets([sock])
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    duration = await upload_all(
+        "http://127.0.0.1:{}/spaceadministration/put_file".format(port)
+    )
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    server.stop()
+
+    # ru_maxrss is in KB on linux
+    print(
+        "{:<10} peak RSS {:>8.1f} MB (+{:>8.1f} MB)   {:>7.2f} s   {:>8.1f} MB/s".format(
+            name,
+            peak / 1024,
+            (peak - baseline) / 1024,
+            duration,
+            options.uploads * options.file_size / duration,
+        )
+    )
+
+    with util.get_mongodb() as db:
+        fs = gridfs.GridFS(db)
+        for file in db.spaces.find_one({"_id": SPACE_ID})["files"]:
+            fs.delete(file["file_id"])
+        db.spaces.update_one({"_id": SPACE_ID}, {"$set": {"files": []}})
+
+
+def main():
+    parse_command_line()
+
+    global_vars.mongodb_host = os.getenv("MONGODB_HOST", "localhost")
+    global_vars.mongodb_port = int(os.getenv("MONGODB_PORT", "27017"))
+    global_vars.mongodb_username = os.getenv("MONGODB_USERNAME")
+    global_vars.mongodb_password = os.getenv("MONGODB_PASSWORD")
+    global_vars.mongodb_db_name = os.getenv("MONGODB_DB_NAME", "ve-collab-benchmark")
+
+    if options.scenario:
+        asyncio.run(run_scenario(options.scenario))
+        return
+
+    with util.get_mongodb() as db:
+        util.get_mongodb_client().drop_database(global_vars.mongodb_db_name)
+        db.spaces.insert_one({"_id": SPACE_ID, "name": "benchmark", "files": []})
+
+    print("{} concurrent uploads of {} MB\n".format(options.uploads, options.file_size))
+    for scenario in ("buffered", "streaming"):
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.streaming_uploads",
+                "--scenario=" + scenario,
+                "--uploads={}".format(options.uploads),
+                "--file_size={}".format(options.file_size),
+            ],
+            check=True,
+        )
+
+    if not options.keep:
+        util.get_mongodb_client().drop_database(global_vars.mongodb_db_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark of the authentication overhead per request: `KeycloakOpenID.decode_token()`,
+which retrieves the public key of the realm from Keycloak on every call (simulated
+by a blocking delay of `--keycloak_latency` ms), versus the
+`resources.token_verification.TokenVerifier` with its cached signing keys, once for
+tokens it hasn't seen before (signature verification) and once for tokens it has
+already verified (cache hit).
+
+No Keycloak is needed, the tokens are signed by a locally generated key.
+Run it from the backend directory::
+
+    python -m benchmarks.token_verification --requests=2000 --keycloak_latency=5
+
+"""
+
+import asyncio
+import json
+import statistics
+import time
+from typing import Callable, List
+
+from jwcrypto import jwk, jwt
+from keycloak import KeycloakOpenID
+from tornado.options import define, options, parse_command_line
+
+from resources.token_verification import TokenVerifier
+
+define("requests", default=2000, type=int, help="number of requests to authenticate")
+define("users", default=100, type=int, help="number of distinct tokens to reuse")
+define(
+    "keycloak_latency",
+    default=5.0,
+    type=float,
+    help="simulated round trip to Keycloak in ms",
+)
+
+
+class LocalKeycloakOpenID(KeycloakOpenID):
+    """
+    `KeycloakOpenID` that serves the public key and the JWKS of a local key,
+    delaying the responses like a request to Keycloak would
+    """
+
+    def __init__(self, key: jwk.JWK):
+        super().__init__("http://localhost", realm_name="benchmark", client_id="x")
+        self.key = key
+
+    def public_key(self) -> str:
+        time.sleep(options.keycloak_latency / 1000)
+        pem = self.key.export_to_pem(private_key=False, password=None).decode("utf-8")
+        return "".join(pem.strip().splitlines()[1:-1])
+
+    def certs(self) -> dict:
+        time.sleep(options.keycloak_latency / 1000)
+        key_set = jwk.JWKSet()
+        key_set.add(self.key)
+        return json.loads(key_set.export(private_keys=False))
+
+
+def make_tokens(key: jwk.JWK, count: int) -> List[str]:
+    tokens = []
+    for i in range(count):
+        token = jwt.JWT(
+            header={"alg": "RS256", "kid": key.key_id},
+            claims={
+                "exp": int(time.time()) + 3600,
+                "sub": str(i),
+                "preferred_username": "user{}".format(i),
+                "email": "user{}@mail.de".format(i),
+            },
+        )
+        token.make_signed_token(key)
+        tokens.append(token.serialize())
+    return tokens
+
+
+async def measure(verify: Callable, tokens: List[str]) -> List[float]:
+    durations = []
+    for i in range(options.requests):
+        start = time.perf_counter()
+        result = verify(tokens[i % len(tokens)])
+        if asyncio.iscoroutine(result):
+            await result
+        durations.append((time.perf_counter() - start) * 1e6)
+    return durations
+
+
+def report(name: str, durations: List[float]) -> None:
+    durations = sorted(durations)
+    print(
+        "{:<44} median {:>10.1f} us   p99 {:>10.1f} us".format(
+            name,
+            statistics.median(durations),
+            durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+        )
+    )
+
+
+async def run() -> None:
+    key = jwk.JWK.generate(kty="RSA", size=2048, kid="benchmark", alg="RS256")
+    keycloak_openid = LocalKeycloakOpenID(key)
+    tokens = make_tokens(key, options.users)
+
+    report(
+        "decode_token (key from Keycloak per request)",
+        await measure(keycloak_openid.decode_token, tokens),
+    )
+
+    verifier = TokenVerifier(keycloak_openid)
+    await verifier.keys.refresh()
+
+    # every token is new to the verifier, i.e. only the keys are cached
+    report(
+        "TokenVerifier, signature verification",
+        await measure(verifier.verify, make_tokens(key, options.requests)),
+    )
+
+    report(
+        "TokenVerifier, verified-token cache", await measure(verifier.verify, tokens)
+    )
+
+
+def main():
+    parse_command_line()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
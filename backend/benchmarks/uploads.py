@@ -0,0 +1,197 @@
+"""
+Benchmark of serving uploads (`handlers.db_static_files.GridFSStaticFileHandler`)
+on avatar-heavy pages, e.g. a timeline or a member list, which request the
+profile pictures of `--avatars` users at once. Measured are pages/s and
+requests/s, for:
+
+- every file read from GridFS (upload cache disabled)
+- small files served from the warm upload cache
+- revalidation by browsers that already have the files (`If-None-Match`, 304)
+
+The benchmark seeds `--users` avatars into the GridFS of a separate database
+(`MONGODB_DB_NAME`, defaults to "ve-collab-benchmark"), which is dropped afterwards,
+and serves them by a local tornado server. Run it from the backend directory against
+a real mongodb (configured by the same environment variables as the platform
+itself)::
+
+    python -m benchmarks.uploads --users=1000 --avatars=50 --avatar_size=20000
+
+"""
+
+import asyncio
+import os
+import random
+import statistics
+import time
+from typing import Dict, List
+
+import gridfs
+import tornado.httpclient
+import tornado.httpserver
+import tornado.web
+from tornado.options import define, options, parse_command_line
+from tornado.testing import bind_unused_port
+
+import global_vars
+from handlers.db_static_files import GridFSStaticFileHandler
+from model import User
+from resources.upload_cache import UploadCache
+import util
+
+define("users", default=1000, type=int, help="number of avatars to seed")
+define("avatars", default=50, type=int, help="number of avatars on a page")
+define("avatar_size", default=20000, type=int, help="size of an avatar in bytes")
+define("pages", default=200, type=int, help="number of page loads per scenario")
+define(
+    "concurrency",
+    default=6,
+    type=int,
+    help="number of parallel requests of a page load, like a browser",
+)
+define("keep", default=False, type=bool, help="don't drop the database afterwards")
+
+
+class BenchmarkFileHandler(GridFSStaticFileHandler):
+    """
+    `GridFSStaticFileHandler` with a fixed logged in user instead of
+    the authentication by Keycloak
+    """
+
+    async def prepare(self):
+        self.current_user = User(
+            "benchmark", "aaaaaaaa-bbbb-0000-cccc-dddddddddddd", "benchmark@mail.de"
+        )
+
+
+def seed(db) -> List[str]:
+    fs = gridfs.GridFS(db)
+    return [
+        str(
+            fs.put(
+                os.urandom(options.avatar_size),
+                content_type="image/jpg",
+                metadata={"uploader": "user{}".format(i)},
+            )
+        )
+        for i in range(options.users)
+    ]
+
+
+async def load_page(
+    client: tornado.httpclient.AsyncHTTPClient,
+    base_url: str,
+    file_ids: List[str],
+    etags: Dict[str, str],
+) -> float:
+    """
+    request the avatars of a page with `--concurrency` parallel requests and
+    return the duration in ms. If `etags` are given, the requests are conditional.
+    """
+
+    queue = list(file_ids)
+
+    async def worker() -> None:
+        while queue:
+            file_id = queue.pop()
+            headers = {"If-None-Match": etags[file_id]} if etags else {}
+            response = await client.fetch(
+                base_url + file_id, headers=headers, raise_error=False
+            )
+            assert response.code == (304 if etags else 200), response.code
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(options.concurrency)))
+    return (time.perf_counter() - start) * 1000
+
+
+async def measure(
+    client: tornado.httpclient.AsyncHTTPClient,
+    base_url: str,
+    file_ids: List[str],
+    etags: Dict[str, str] = None,
+) -> List[float]:
+    durations = []
+    for _ in range(options.pages):
+        page = random.sample(file_ids, options.avatars)
+        durations.append(await load_page(client, base_url, page, etags))
+    return durations
+
+
+def report(name: str, durations: List[float]) -> None:
+    durations = sorted(durations)
+    pages_per_second = 1000 / statistics.mean(durations)
+    print(
+        "{:<28} median {:>8.2f} ms   p99 {:>8.2f} ms   "
+        "{:>7.1f} pages/s   {:>8.0f} req/s".format(
+            name,
+            statistics.median(durations),
+            durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+            pages_per_second,
+            pages_per_second * options.avatars,
+        )
+    )
+
+
+async def run(file_ids: List[str]) -> None:
+    sock, port = bind_unused_port()
+    server = tornado.httpserver.HTTPServer(
+        tornado.web.Application(
+            [(r"/uploads/(.*)", BenchmarkFileHandler, {"path": ""})],
+            # no access log of every request
+            log_function=lambda handler: None,
+        )
+    )
+    server.add_sockets([sock])
+    base_url = "http://127.0.0.1:{}/uploads/".format(port)
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=options.concurrency)
+
+    # files of any size are read from gridfs
+    global_vars.upload_cache = UploadCache(max_file_size=0)
+    report("gridfs, no upload cache", await measure(client, base_url, file_ids))
+
+    global_vars.upload_cache = UploadCache()
+    for file_id in file_ids:
+        await client.fetch(base_url + file_id)
+    report("warm upload cache", await measure(client, base_url, file_ids))
+
+    etags = {}
+    for file_id in file_ids:
+        etags[file_id] = (await client.fetch(base_url + file_id)).headers["Etag"]
+    report("revalidation (304)", await measure(client, base_url, file_ids, etags))
+
+    print("\nupload cache: {}".format(global_vars.upload_cache.get_metrics()))
+    server.stop()
+
+
+def main():
+    parse_command_line()
+
+    global_vars.mongodb_host = os.getenv("MONGODB_HOST", "localhost")
+    global_vars.mongodb_port = int(os.getenv("MONGODB_PORT", "27017"))
+    global_vars.mongodb_username = os.getenv("MONGODB_USERNAME")
+    global_vars.mongodb_password = os.getenv("MONGODB_PASSWORD")
+    global_vars.mongodb_db_name = os.getenv("MONGODB_DB_NAME", "ve-collab-benchmark")
+
+    with util.get_mongodb() as db:
+        util.get_mongodb_client().drop_database(global_vars.mongodb_db_name)
+
+        print(
+            "seeding {} avatars of {} bytes...".format(
+                options.users, options.avatar_size
+            )
+        )
+        file_ids = seed(db)
+
+    print(
+        "{} avatars per page, {} parallel requests\n".format(
+            options.avatars, options.concurrency
+        )
+    )
+    asyncio.run(run(file_ids))
+
+    if not options.keep:
+        util.get_mongodb_client().drop_database(global_vars.mongodb_db_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+command line tool to maintain the Elasticsearch mirror of the MongoDB collections,
+see `resources.elasticsearch_mirror.ElasticsearchMirror`. It is configured by
+the same environment variables (or .env file) as the platform itself,
+see `main.set_global_vars()`.
+
+report the drift between MongoDB and Elasticsearch::
+
+    python elasticsearch_mirror.py --diff
+
+report and repair the drift of the plans only::
+
+    python elasticsearch_mirror.py --diff --repair --indexes=plans
+
+rebuild all indexes into fresh versioned indexes and swap their aliases::
+
+    python elasticsearch_mirror.py --reindex
+
+"""
+
+import json
+import logging
+
+from tornado.options import define, options, parse_command_line
+
+from main import set_global_vars
+from resources.elasticsearch_mirror import ElasticsearchMirror
+import util
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    define(
+        "indexes",
+        default="profiles,spaces,plans",
+        type=str,
+        help="comma-separated list of the indexes to process",
+    )
+    define(
+        "reindex",
+        default=False,
+        type=bool,
+        help="rebuild the indexes into fresh versioned indexes and swap their aliases",
+    )
+    define(
+        "keep_old_indexes",
+        default=False,
+        type=bool,
+        help="don't delete the previous indexes after a reindex",
+    )
+    define(
+        "diff",
+        default=False,
+        type=bool,
+        help="compare the documents in MongoDB and Elasticsearch and report the drift",
+    )
+    define(
+        "repair",
+        default=False,
+        type=bool,
+        help="replicate the drift found by --diff to Elasticsearch",
+    )
+
+    parse_command_line()
+
+    if not options.reindex and not options.diff:
+        raise SystemExit("nothing to do, specify --reindex or --diff")
+
+    set_global_vars()
+    util.init_mongodb_client()
+
+    with util.get_mongodb() as db:
+        mirror = ElasticsearchMirror(db)
+
+        for name in options.indexes.split(","):
+            name = name.strip()
+            if name not in mirror.MIRRORED_INDEXES:
+                raise SystemExit("unknown index {}".format(name))
+
+            if options.reindex:
+                report = mirror.reindex(name, keep_old_indexes=options.keep_old_indexes)
+            else:
+                report = mirror.diff(name, repair=options.repair)
+
+            print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
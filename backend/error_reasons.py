@@ -9,10 +9,13 @@ USER_DOESNT_EXIST = "user_doesnt_exist"
 INVITATION_DOESNT_EXIST = "invitation_doesnt_exist"
 USER_NOT_ADMIN = "user_not_admin"
 ROOM_DOESNT_EXIST = "room_doesnt_exist"
+MESSAGE_DOESNT_EXIST = "message_doesnt_exist"
 UNAUTHENTICATED = "unauthenticated"
 SPACE_DOESNT_EXIST = "space_doesnt_exist"
 POST_DOESNT_EXIST = "post_doesnt_exist"
 PLAN_LOCKED = "plan_locked"
 MAXIMUM_FILES_EXCEEDED = "maximum_files_exceeded"
 FILE_DOESNT_EXIST = "file_doesnt_exist"
-REPORT_DOESNT_EXIST = "report_doesnt_exist"
\ No newline at end of file
+REPORT_DOESNT_EXIST = "report_doesnt_exist"
+FILE_TOO_LARGE = "file_too_large"
+MALFORMED_UPLOAD = "malformed_multipart_body"
@@ -133,6 +133,18 @@ class NoWriteAccessError(Exception):
     pass
 
 
+class UploadTooLargeError(Exception):
+    """an uploaded file exceeds the maximum size of uploads"""
+
+    pass
+
+
+class MalformedUploadError(Exception):
+    """the body of an upload is no valid multipart/form-data"""
+
+    pass
+
+
 class InvitationDoesntExistError(Exception):
     """The requested ve invitation doesn't exist"""
 
@@ -204,3 +216,7 @@ class MbrAPIConflictError(MbrAPIError):
 
     def __init__(self, message, response=None) -> None:
         super().__init__(message, response)
+
+
+class InvalidTokenError(Exception):
+    pass
@@ -1,12 +1,17 @@
 # do not change any of those values manually, they will be overridden on application startup
 
-from typing import Dict
-from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set
 from jinja2 import Environment
 from keycloak import KeycloakOpenID, KeycloakAdmin
+from pymongo import MongoClient
 import socketio
 
 keycloak = KeycloakOpenID
+token_verifier = None  # resources.token_verification.TokenVerifier of this process
+acl_cache = None  # resources.network.acl.ACLCache of this process
+profile_snippet_cache = None  # see resources.network.profile_snippet_cache
+upload_cache = None  # see resources.upload_cache
 keycloak_admin = KeycloakAdmin
 keycloak_base_url: str = ""
 keycloak_realm: str = ""
@@ -15,6 +20,7 @@ keycloak_client_secret: str = ""
 keycloak_admin_username: str = ""
 keycloak_admin_password: str = ""
 port: int = 0
+processes: int = 1  # number of forked worker processes, 0 for one per core
 cookie_secret: str = ""
 wordpress_url: str = ""
 mongodb_host: str = ""
@@ -22,11 +28,23 @@ mongodb_port: int = 0
 mongodb_username: str = ""
 mongodb_password: str = ""
 mongodb_db_name: str = ""
+mongodb_max_pool_size: int = 100
+mongodb_min_pool_size: int = 0
+mongodb_max_idle_time_ms: int | None = None
+mongodb_wait_queue_timeout_ms: int | None = None
+mongodb_client: MongoClient | None = None  # process-wide pooled client, see util.get_mongodb()
+mongodb_pool_metrics = None  # util.MongoPoolMetrics of the pooled client
+mongodb_executor_workers: int = 16
+mongodb_executor: ThreadPoolExecutor | None = None  # runs the async resource variants, see util.run_in_mongodb_executor()
+image_derivative_workers: int = 2
+image_derivative_executor: ThreadPoolExecutor | None = None  # see resources.image_derivatives
+max_upload_size: int = 100 * 1024 * 1024  # bytes per uploaded file, see handlers.streaming_upload
 etherpad_base_url: str = ""
 etherpad_api_key: str = ""
 elasticsearch_base_url: str = ""
 elasticsearch_username: str = ""
 elasticsearch_password: str = ""
+elasticsearch_replication_queue = None  # resources.elasticsearch_replication.ElasticsearchReplicationQueue of this process
 dummy_personas_passcode: str = ""
 mbr_token_endpoint: str = ""
 mbr_client_id: str = ""
@@ -37,7 +55,10 @@ smtp_host: str = ""
 smtp_port: int = 0
 smtp_username: str = ""
 smtp_password: str = ""
+smtp_max_per_minute: int = 0  # 0 for no limit
+mail_queue = None  # resources.mail_outbox.MailQueue of this process
 socket_io = socketio.AsyncServer
-username_sid_map: Dict[str, str] = {} # username -> sid
-plan_write_lock_map: Dict[ObjectId, Dict] = {} # plan_id -> {"username": username, "expires": datetime.datetime}
+username_sid_map: Dict[str, Set[str]] = {} # username -> sids of the sessions of the user
+state_backend: str = "memory"  # "memory" or "mongodb", see resources.shared_state
+state_backend_instance = None  # resources.shared_state.StateBackend of this process
 email_template_env: Environment
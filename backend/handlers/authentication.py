@@ -6,6 +6,7 @@ import tornado.web
 import global_vars
 from handlers.base_handler import BaseHandler
 from resources.network.profile import Profiles
+from resources.user_directory import sync_user_from_token
 import util
 
 
@@ -57,6 +58,9 @@ class LoginCallbackHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
                 token_info["family_name"],
             )
 
+        # remember email and name of the user for the notifications
+        await util.run_in_mongodb_executor(sync_user_from_token, token_info)
+
         # dump token dict to str and store it in a secure cookie (BaseHandler will decode it later to validate a user is logged in)
         self.set_secure_cookie("access_token", json.dumps(token["access_token"]))
 
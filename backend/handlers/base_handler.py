@@ -1,14 +1,18 @@
 import functools
+import json
 import logging
 from typing import Awaitable, Callable, Dict, List, Optional
 
-from keycloak.exceptions import KeycloakError
+from keycloak.exceptions import KeycloakError, KeycloakGetError
 from tornado.options import options
 import tornado.web
 
 import global_vars
 from model import User
-from resources.network.profile import ProfileDoesntExistException, Profiles
+from resources.hydration import Loaders
+from resources.network.acl import get_acl_cache
+from resources.token_verification import get_token_verifier
+from resources.user_directory import UserDirectory, sync_user_from_token
 import util
 
 logger = logging.getLogger()
@@ -69,7 +73,7 @@ class BaseHandler(tornado.web.RequestHandler):
         # otherwise, set the current user as per the content of the
         # token
         try:
-            token_info = global_vars.keycloak.decode_token(bearer_token)
+            token_info = await get_token_verifier().verify(bearer_token)
         except Exception as e:
             self.current_user = None
             self._access_token = None
@@ -81,6 +85,13 @@ class BaseHandler(tornado.web.RequestHandler):
             token_info["email"],
         )
 
+        # keep the email and name of the user in the user directory up to date,
+        # so notifications can be mailed without asking keycloak
+        try:
+            await util.run_in_mongodb_executor(sync_user_from_token, token_info)
+        except Exception as e:
+            logger.warning("Could not update the user directory: {}".format(e))
+
         # if the user was authenticated via ORCiD,
         # or atleast has their ORCiD account linked,
         # set their id for use within the handlers
@@ -90,6 +101,18 @@ class BaseHandler(tornado.web.RequestHandler):
         self._access_token = bearer_token
         return
 
+    @property
+    def loaders(self) -> Loaders:
+        """
+        the batching loaders of this request (see `resources.hydration.Loaders`),
+        created on first use, so that every entity type is fetched at most once
+        per round of hydration of the response.
+        """
+
+        if not hasattr(self, "_loaders"):
+            self._loaders = Loaders()
+        return self._loaders
+
     def set_default_headers(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header(
@@ -113,18 +136,22 @@ class BaseHandler(tornado.web.RequestHandler):
         return util.json_serialize_response(dictionary)
 
     def serialize_and_write(self, response: dict) -> None:
-        self.write(self.json_serialize_response(response))
+        """
+        write the response as JSON, encoding `ObjectId`s, datetimes and timedeltas
+        on the fly, see `util.json_dumps()`.
+        """
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        # same escaping as tornado applies when writing dicts
+        self.write(util.json_dumps(response).replace("</", "<\\/"))
 
     def get_current_user_role(self):
         if not self.current_user:
             return None  # TODO could also raise exception?
 
+        # the role is cached alongside the ACL, see `resources.network.acl.ACLCache`
         with util.get_mongodb() as db:
-            profile_manager = Profiles(db)
-            try:
-                return profile_manager.get_role(self.current_user.username)
-            except ProfileDoesntExistException:
-                return None
+            return get_acl_cache().get_role(db, self.current_user.username)
 
     def is_current_user_lionet_admin(self):
         return bool(self.get_current_user_role() == "admin")
@@ -143,19 +170,32 @@ class BaseHandler(tornado.web.RequestHandler):
                 "username": "test_user",
             }
 
+        # look up the user data in the user directory, which only requests it
+        # from keycloak if the user is not known yet
         try:
-            # refresh the token to keycloak admin portal, because it might have timed out (resulting in the following requests not succeeding)
-            global_vars.keycloak_admin.connection.refresh_token()
-
-            # request user data from keycloak
-            user_id = global_vars.keycloak_admin.get_user_id(username)
-            return global_vars.keycloak_admin.get_user(user_id)
+            with util.get_mongodb() as db:
+                user = UserDirectory(db).lookup(username)
         except KeycloakError as e:
             logger.warn(
                 "Keycloak Error occured while trying to request user data: {}".format(e)
             )
             raise
 
+        if user is None:
+            # same error as keycloak raises for unknown users
+            raise KeycloakGetError(
+                error_message=json.dumps({"error": "User not found"}).encode(),
+                response_code=404,
+            )
+
+        return {
+            "id": user["user_id"],
+            "email": user["email"],
+            "username": user["username"],
+            "firstName": user["first_name"],
+            "lastName": user["last_name"],
+        }
+
     def get_keycloak_user_list(self) -> List[Dict]:
         """
         get a list of user from keycloak. if we are in test mode,
@@ -210,8 +250,8 @@ class BaseHandler(tornado.web.RequestHandler):
             ]
         else:
             try:
-                # refresh the token to keycloak admin portal, because it might have timed out (resulting in the following requests not succeeding)
-                global_vars.keycloak_admin.connection.refresh_token()
+                # the admin token is reused and only refreshed shortly before
+                # it expires by the keycloak admin connection itself
                 return global_vars.keycloak_admin.get_users()
             except KeycloakError as e:
                 logger.warn(
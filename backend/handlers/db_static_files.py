@@ -1,15 +1,26 @@
 import datetime
+import time
 from typing import Generator, Optional
 
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
 import gridfs
-import pymongo
 import tornado.web
 import tornado.ioloop
 
-import global_vars
 from handlers.base_handler import BaseHandler
+from resources.image_derivatives import (
+    DERIVATIVE_SIZES,
+    find_derivative,
+    get_or_create_derivative_async,
+    has_derivatives,
+)
+from resources.upload_cache import get_upload_cache
+from resources.upload_urls import verify_file_url
+import util
+
+# one year, the longest lifetime a response should be cached for
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
 
 
 class GridFSStaticFileHandler(tornado.web.StaticFileHandler, BaseHandler):
@@ -20,69 +31,156 @@ class GridFSStaticFileHandler(tornado.web.StaticFileHandler, BaseHandler):
     absolutely no use
     """
 
+    # the requested file, and if a derivative of it is requested (see `get`),
+    # the requested size and the derivative
+    original: Optional[gridfs.GridOut] = None
+    size: Optional[int] = None
+    derivative: Optional[gridfs.GridOut] = None
+
     def options(self, slug):
         # no body
         self.set_status(200)
         self.finish()
 
-    @classmethod
+    async def get(self, path: str, include_body: bool = True) -> None:
+        """
+        overridden
+        if a derivative of an image is requested by the query param "size"
+        (one of `resources.image_derivatives.DERIVATIVE_SIZES`, 400 otherwise), it is
+        served instead of the image, as WebP if the client accepts it, as JPEG
+        otherwise. Derivatives that don't exist yet are generated on demand in the
+        derivative executor and stored in gridfs for the following requests.
+        Files that are no images (by their content type) or too large are served
+        as they are (see `resources.image_derivatives.has_derivatives()`).
+        """
+
+        size = self.get_argument("size", None)
+        if size is not None:
+            try:
+                self.size = int(size)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            if self.size not in DERIVATIVE_SIZES:
+                raise tornado.web.HTTPError(400)
+
+            if "image/webp" in self.request.headers.get("Accept", ""):
+                format = "webp"
+            else:
+                format = "jpeg"
+            # so that caches don't serve the WebP derivative to other clients
+            self.set_header("Vary", "Accept")
+
+            # check the session and fetch the original, `super().get()` validates
+            # again, but reuses the original instead of fetching it again
+            self.validate_absolute_path(
+                self.root, self.get_absolute_path(self.root, self.parse_url_path(path))
+            )
+            if has_derivatives(self.original):
+                with util.get_mongodb() as db:
+                    self.derivative = find_derivative(
+                        db, self.original, self.size, format
+                    )
+                if self.derivative is None:
+                    self.derivative = await get_or_create_derivative_async(
+                        self.original, self.size, format
+                    )
+
+        await super().get(path, include_body)
+
     def get_content(
-        cls, abspath: str, start: Optional[int] = None, end: Optional[int] = None
-    ) -> Generator[bytes, None, None]:
+        self, abspath: str, start: Optional[int] = None, end: Optional[int] = None
+    ) -> bytes | Generator[bytes, None, None]:
         """
         overridden
-        because this is a classmethod, content has to be queried from mongo again,
-        making this an instance method crashes caching,
+        no classmethod like in the base class, because the content isn't hashed
+        for the ETag (see `compute_etag`), so the file that `validate_absolute_path`
+        has already fetched can be read directly. Small files are served from the
+        upload cache of this process instead of being read from GridFS again.
         permissions need no to be checked again, because `validate_absolute_path` has
         already done that
         """
 
-        # default pictures have no ObjectId as _id, but their names
-        # so we have to make an exception if they are requested
-        if (
-            abspath == "default_profile_pic.jpg"
-            or abspath == "default_group_pic.jpg"
-            or abspath == "logo.png"
-        ):
-            pass
-        else:
-            abspath = ObjectId(abspath)
-
-        with pymongo.MongoClient(
-            global_vars.mongodb_host,
-            global_vars.mongodb_port,
-            username=global_vars.mongodb_username,
-            password=global_vars.mongodb_password,
-        ) as client:
-            db = client[global_vars.mongodb_db_name]
-            fs = gridfs.GridFS(db)
-
-            # get file from gridfs
-            try:
-                file = fs.get(abspath)
-            except gridfs.NoFile:
-                raise tornado.web.HTTPError(404)
+        cache = get_upload_cache()
+        if not cache.is_cacheable(self.file.length):
+            return self._read_chunks(start, end)
+
+        content = cache.get(self.file._id, self.file.upload_date)
+        if content is None:
+            content = self.file.read()
+            cache.put(self.file._id, self.file.upload_date, content)
+        return content[start:end]
 
-            # chunk it if desired by parameters
-            if start is not None:
-                file.seek(start)
-            if end is not None:
-                remaining = end - (start or 0)
+    def _read_chunks(
+        self, start: Optional[int] = None, end: Optional[int] = None
+    ) -> Generator[bytes, None, None]:
+        """
+        read the file from gridfs in chunks of 64KB,
+        limited to the range given by the parameters
+        """
+
+        if start is not None:
+            self.file.seek(start)
+        if end is not None:
+            remaining = end - (start or 0)
+        else:
+            remaining = None
+        while True:
+            chunk_size = 64 * 1024
+            if remaining is not None and remaining < chunk_size:
+                chunk_size = remaining
+            chunk = self.file.read(chunk_size)
+            if chunk:
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
             else:
-                remaining = None
-            while True:
-                chunk_size = 64 * 1024
-                if remaining is not None and remaining < chunk_size:
-                    chunk_size = remaining
-                chunk = file.read(chunk_size)
-                if chunk:
-                    if remaining is not None:
-                        remaining -= len(chunk)
-                    yield chunk
-                else:
-                    if remaining is not None:
-                        assert remaining == 0
-                    return
+                if remaining is not None:
+                    assert remaining == 0
+                return
+
+    def compute_etag(self) -> Optional[str]:
+        """
+        overridden
+        strong ETag from the md5 of the file, if GridFS has stored one, or from its
+        _id and upload time otherwise (the content of a file never changes, the
+        default pictures can only be replaced by uploading them again).
+        Unlike in the base class, the content isn't hashed, so answering a
+        conditional request with 304 needs no read of the file at all
+        """
+
+        if self.file.md5:
+            return '"{}"'.format(self.file.md5)
+        return '"{}-{}"'.format(
+            self.file._id, int(self.file.upload_date.timestamp() * 1000)
+        )
+
+    def get_cache_time(
+        self, path: str, modified: Optional[datetime.datetime], mime_type: str
+    ) -> int:
+        """
+        overridden
+        no Expires header, Cache-Control is set by `set_extra_headers`
+        """
+
+        return 0
+
+    def set_extra_headers(self, path: str) -> None:
+        """
+        overridden
+        uploads are content-addressed by their ObjectId, i.e. a URL always serves
+        the same content, so browsers may cache them forever without revalidation.
+        The default pictures can be replaced under their name and have to be
+        revalidated (which usually is answered with 304).
+        Responses are private, because files are only served to logged in users.
+        """
+
+        if isinstance(self.absolute_path, ObjectId):
+            self.set_header(
+                "Cache-Control",
+                "private, max-age={}, immutable".format(IMMUTABLE_MAX_AGE),
+            )
+        else:
+            self.set_header("Cache-Control", "private, no-cache")
 
     def get_content_size(self) -> int:
         """
@@ -123,6 +221,14 @@ class GridFSStaticFileHandler(tornado.web.StaticFileHandler, BaseHandler):
         if not self.current_user:
             raise tornado.web.HTTPError(401)
 
+        return self._fetch_file(absolute_path)
+
+    def _fetch_file(self, absolute_path: str) -> ObjectId | str:
+        """
+        fetch the file from gridfs (404 if it doesn't exist) and set it, or its
+        requested derivative, as instance attribute, returns its _id
+        """
+
         if (
             absolute_path == "default_profile_pic.jpg"
             or absolute_path == "default_group_pic.jpg"
@@ -135,20 +241,17 @@ class GridFSStaticFileHandler(tornado.web.StaticFileHandler, BaseHandler):
             except InvalidId:
                 raise tornado.web.HTTPError(404)
 
-        with pymongo.MongoClient(
-            global_vars.mongodb_host,
-            global_vars.mongodb_port,
-            username=global_vars.mongodb_username,
-            password=global_vars.mongodb_password,
-        ) as client:
-            db = client[global_vars.mongodb_db_name]
-            fs = gridfs.GridFS(db)
+        if self.original is None or self.original._id != absolute_path:
+            with util.get_mongodb() as db:
+                fs = gridfs.GridFS(db)
 
-            try:
-                self.file = fs.get(absolute_path)
-                return absolute_path
-            except gridfs.NoFile:
-                raise tornado.web.HTTPError(404)
+                try:
+                    self.original = fs.get(absolute_path)
+                except gridfs.NoFile:
+                    raise tornado.web.HTTPError(404)
+
+        self.file = self.original if self.derivative is None else self.derivative
+        return absolute_path
 
     def get_content_type(self) -> str:
         """
@@ -159,3 +262,70 @@ class GridFSStaticFileHandler(tornado.web.StaticFileHandler, BaseHandler):
         """
 
         return self.file.content_type
+
+
+class SignedGridFSStaticFileHandler(GridFSStaticFileHandler):
+    """
+    serves files by the signed, expiring URLs handed out by
+    `resources.upload_urls.sign_file_url()`:
+    /uploads/signed/<file_id>?expires=<int>&signature=<str>(&viewer=<username>)
+
+    The signature proves that the URL was handed out by the backend, so no session
+    is needed, unless the URL is scoped to a viewer. That way the files can be
+    embedded by `<img>` tags and the responses may be cached by browsers and shared
+    proxies until the URL expires.
+    """
+
+    async def prepare(self):
+        # only URLs scoped to a viewer need to know the current user,
+        # all others skip the authentication
+        if self.get_argument("viewer", None) is not None:
+            await super().prepare()
+        else:
+            self.current_user = None
+
+    def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
+        """
+        overridden
+        validate the signature and expiry of the URL (403 if invalid or expired),
+        and if it is scoped to a viewer, that the current user is the viewer,
+        before fetching the file (see `GridFSStaticFileHandler._fetch_file()`)
+        """
+
+        try:
+            self.expires = int(self.get_argument("expires"))
+        except (tornado.web.MissingArgumentError, ValueError):
+            raise tornado.web.HTTPError(403)
+        self.viewer = self.get_argument("viewer", None)
+
+        if not verify_file_url(
+            absolute_path,
+            self.expires,
+            self.get_argument("signature", ""),
+            viewer=self.viewer,
+        ):
+            raise tornado.web.HTTPError(403)
+
+        if self.viewer is not None:
+            if not self.current_user:
+                raise tornado.web.HTTPError(401)
+            if self.current_user.username != self.viewer:
+                raise tornado.web.HTTPError(403)
+
+        return self._fetch_file(absolute_path)
+
+    def set_extra_headers(self, path: str) -> None:
+        """
+        overridden
+        like in `GridFSStaticFileHandler`, but uploads may only be cached until the
+        URL expires, and unless the URL is scoped to a viewer, also by shared caches
+        """
+
+        scope = "public" if self.viewer is None else "private"
+        if isinstance(self.absolute_path, ObjectId):
+            max_age = min(max(self.expires - int(time.time()), 0), IMMUTABLE_MAX_AGE)
+            self.set_header(
+                "Cache-Control", "{}, max-age={}, immutable".format(scope, max_age)
+            )
+        else:
+            self.set_header("Cache-Control", "{}, no-cache".format(scope))
@@ -1,5 +1,15 @@
 import tornado.web
 
+from error_reasons import INSUFFICIENT_PERMISSIONS
+from handlers.base_handler import BaseHandler, auth_needed
+from resources.elasticsearch_replication import get_replication_metrics
+from resources.mail_outbox import get_mail_metrics
+from resources.network.acl import get_acl_cache_metrics
+from resources.network.profile_snippet_cache import get_profile_snippet_cache_metrics
+from resources.token_verification import get_token_verification_metrics
+from resources.upload_cache import get_upload_cache_metrics
+import util
+
 
 class HealthCheckHandler(tornado.web.RequestHandler):
     """
@@ -13,3 +23,107 @@ class HealthCheckHandler(tornado.web.RequestHandler):
 
         self.set_status(200)
         self.write({"status": 200, "success": True})
+
+
+class MetricsHandler(BaseHandler):
+    """
+    runtime metrics of the process to be able to size pools, queues and caches
+    """
+
+    @auth_needed
+    def get(self):
+        """
+        GET /metrics
+            Retrieve runtime metrics of this process. Requires global admin privileges.
+
+            returns:
+                200 OK,
+                {"success": True,
+                 "mongodb_pool": {
+                    "open_connections": <int>,
+                    "checked_out": <int>,
+                    "max_checked_out": <int>,
+                    "checkouts": <int>,
+                    "checkout_failures": <int>,
+                    "avg_wait_time_ms": <float>,
+                    "max_wait_time_ms": <float>
+                 },
+                 "elasticsearch_replication": {
+                    "depth": <int>, (number of changes waiting to be replicated)
+                    "failed": <int>, (number of changes that were given up)
+                    "lag_seconds": <float>, (age of the oldest waiting change)
+                    "running": <bool>,
+                    "replicated": <int>,
+                    "retried": <int>,
+                    "last_flush": <str|None>
+                 },
+                 "token_verification": {
+                    "cached_tokens": <int>,
+                    "cache_hits": <int>,
+                    "cache_misses": <int>,
+                    "verifications": <int>, (signature verifications)
+                    "known_keys": <int>,
+                    "key_refreshes": <int>
+                 },
+                 "mail_queue": {
+                    "depth": <int>, (number of emails waiting to be sent)
+                    "failed": <int>, (number of emails that were given up)
+                    "lag_seconds": <float>, (age of the oldest waiting email)
+                    "running": <bool>,
+                    "sent": <int>,
+                    "retried": <int>,
+                    "rejected": <int>, (emails rejected permanently by the mail server)
+                    "sessions_opened": <int>, (smtp sessions opened)
+                    "max_per_minute": <int>, (0 for no limit)
+                    "last_flush": <str|None>
+                 },
+                 "profile_snippet_cache": {
+                    "cached_snippets": <int>,
+                    "hits": <int>,
+                    "misses": <int>,
+                    "stale": <int>, (misses because the profile has changed)
+                    "evictions": <int>,
+                    "hit_rate": <float>
+                 },
+                 "acl_cache": {
+                    "cached_roles": <int>,
+                    "cached_global_acl": <bool>,
+                    "cached_space_acl": <int>, (cached (user, space) entries)
+                    "hits": <int>,
+                    "misses": <int>,
+                    "invalidations": <int>
+                 },
+                 "upload_cache": {
+                    "cached_files": <int>,
+                    "cached_bytes": <int>,
+                    "hits": <int>,
+                    "misses": <int>,
+                    "evictions": <int>,
+                    "hit_rate": <float>
+                 }}
+
+                401 Unauthorized
+                {"success": False, "reason": "no_logged_in_user"}
+
+                403 Forbidden
+                {"success": False, "reason": "insufficient_permission"}
+        """
+
+        if not self.is_current_user_lionet_admin():
+            self.set_status(403)
+            self.write({"success": False, "reason": INSUFFICIENT_PERMISSIONS})
+            return
+
+        self.set_status(200)
+        self.write(
+            {
+                "success": True,
+                "mongodb_pool": util.get_mongodb_pool_metrics(),
+                "elasticsearch_replication": get_replication_metrics(),
+                "token_verification": get_token_verification_metrics(),
+                "mail_queue": get_mail_metrics(),
+                "profile_snippet_cache": get_profile_snippet_cache_metrics(),
+                "acl_cache": get_acl_cache_metrics(),
+                "upload_cache": get_upload_cache_metrics(),
+            }
+        )
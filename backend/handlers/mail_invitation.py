@@ -9,6 +9,7 @@ from error_reasons import (
 from exceptions import InvitationDoesntExistError
 from handlers.base_handler import BaseHandler, auth_needed
 from resources.mail_invitation import MailInvitation
+from resources.mail_outbox import send_email
 from resources.planner.ve_plan import VEPlanResource
 from resources.notifications import NotificationResource
 
@@ -210,7 +211,7 @@ class EmailInvitationHandler(BaseHandler):
                     self.write({"success": False, "reason": INSUFFICIENT_PERMISSIONS})
                     return
 
-                util.send_email(
+                send_email(
                     recipient_name,
                     recipient_mail,
                     "Einladung zum VE bei VE-Collab!",
@@ -225,7 +226,7 @@ class EmailInvitationHandler(BaseHandler):
                     },
                 )
             else:
-                util.send_email(
+                send_email(
                     recipient_name,
                     recipient_mail,
                     "Tritt VE-Collab bei!",
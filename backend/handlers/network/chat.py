@@ -2,10 +2,11 @@ import json
 from typing import List
 
 import tornado.web
-from exceptions import RoomDoesntExistError
+from exceptions import MessageDoesntExistError, RoomDoesntExistError
 
 from error_reasons import (
     INSUFFICIENT_PERMISSIONS,
+    MESSAGE_DOESNT_EXIST,
     MISSING_KEY_IN_HTTP_BODY_SLUG,
     MISSING_KEY_SLUG,
     ROOM_DOESNT_EXIST,
@@ -39,7 +40,8 @@ class RoomHandler(BaseHandler):
             get all rooms of current user (i.e. those where he/she is a member)
 
             query params:
-                None
+                include_profiles: "true" to also get the profile snippets of the members
+                                  of all rooms at once, default: "false"
 
             http body:
                 None
@@ -66,10 +68,26 @@ class RoomHandler(BaseHandler):
                                     },
                                     ...
                                 ],
-                            }
+                            },
+                            "unread_count": int
                         },
                         {...}
-                    ]
+                    ],
+                    // only if include_profiles is "true", members
+                    // without a profile are omitted
+                    "profiles": {
+                        "<username>": {
+                            "username": str,
+                            "first_name": str,
+                            "last_name": str,
+                            "institution": str,
+                            "profile_pic": str,
+                            "profile_pic_url": str | None,
+                            "chosen_achievement": {...} | None,
+                            "ve_ready": bool
+                        },
+                        ...
+                    }
                 }
 
                 401 Unauthorized
@@ -78,20 +96,27 @@ class RoomHandler(BaseHandler):
                  "reason": "no_logged_in_user"}
 
         GET /chatroom/get_messages
-            get all messages of a room
+            get the messages of a room, oldest first. Without the `limit` parameter,
+            all messages are returned. To paginate, supply a `limit` and to scroll
+            further back, use the `next_cursor` of the response as the `before` parameter
+            of the next request.
 
             query params:
                 room_id: str, the _id of the room
+                limit: int, optional, only get the newest n messages (before the cursor)
+                before: str, optional, the _id of a message (the cursor), only
+                        messages older than this one are returned
 
             http body:
                 None
 
             returns:
                 200 OK
-                (contains all messages of this room)
+                (contains the (requested page of) messages of this room)
                 {
                     "success": True,
                     "room_id": str,
+                    "next_cursor": str|None, (None if there are no older messages)
                     "messages": [
                         {
                             "_id": str,
@@ -129,6 +154,11 @@ class RoomHandler(BaseHandler):
                 {"success": False,
                  "reason": "room_doesnt_exist"}
 
+                409 Conflict
+                (the cursor message does not exist in this room)
+                {"success": False,
+                 "reason": "message_doesnt_exist"}
+
         GET /chatroom/get_messages_after
             Get a number of messages that are older then the message with the given message id.
             Useful to determine the messages that have to be requested on scroll up by specifying
@@ -147,7 +177,21 @@ class RoomHandler(BaseHandler):
                 rooms = chat_manager.get_room_snippets_for_user(
                     self.current_user.username
                 )
-                self.serialize_and_write({"success": True, "rooms": rooms})
+                response = {"success": True, "rooms": rooms}
+
+                # the profiles of the members of all rooms are fetched at once,
+                # sparing the client a request per room
+                if self.get_argument("include_profiles", "false") == "true":
+                    members = {member for room in rooms for member in room["members"]}
+                    self.loaders.profiles.want(members)
+                    self.loaders.load(db)
+                    response["profiles"] = {
+                        member: snippet
+                        for member in members
+                        if (snippet := self.loaders.profiles.get(member)) is not None
+                    }
+
+                self.serialize_and_write(response)
 
         elif slug == "get_messages":
             try:
@@ -157,7 +201,11 @@ class RoomHandler(BaseHandler):
                 self.write({"success": False, "reason": MISSING_KEY_SLUG + "room_id"})
                 return
 
-            self.get_messages(room_id)
+            limit = self.get_argument("limit", None)
+            limit = int(limit) if limit is not None else None
+            before = self.get_argument("before", None)
+
+            self.get_messages(room_id, before, limit)
             return
 
         elif slug == "get_messages_after":
@@ -237,14 +285,17 @@ class RoomHandler(BaseHandler):
         else:
             self.set_status(404)
 
-    def get_messages(self, room_id: str) -> None:
+    def get_messages(
+        self, room_id: str, before: str = None, limit: int = None
+    ) -> None:
         """
-        Request all messages of a room.
+        Request the messages of a room, either all of them or a page of `limit`
+        messages older than the message given by `before`.
 
         Returns:
-            200 OK -> contains all messages of the room
+            200 OK -> contains the (requested page of) messages of the room
             403 Forbidden -> the current user is not a member of the room
-            409 Conflict -> the room does not exist
+            409 Conflict -> the room or the cursor message does not exist
         """
 
         with util.get_mongodb() as db:
@@ -262,9 +313,31 @@ class RoomHandler(BaseHandler):
                 self.write({"success": False, "reason": ROOM_DOESNT_EXIST})
                 return
 
-            messages = chat_manager.get_all_messages_of_room(room_id)
+            if limit is None:
+                messages = chat_manager.get_all_messages_of_room(room_id)
+                next_cursor = None
+            else:
+                try:
+                    messages = chat_manager.get_messages_of_room(
+                        room_id, before, limit
+                    )
+                except MessageDoesntExistError:
+                    self.set_status(409)
+                    self.write({"success": False, "reason": MESSAGE_DOESNT_EXIST})
+                    return
+
+                # a full page means there might be older messages
+                next_cursor = (
+                    messages[0]["_id"] if messages and len(messages) == limit else None
+                )
+
             self.serialize_and_write(
-                {"success": True, "room_id": room_id, "messages": messages}
+                {
+                    "success": True,
+                    "room_id": room_id,
+                    "next_cursor": next_cursor,
+                    "messages": messages,
+                }
             )
 
     def create_or_get_room_id(self, members: List[str], name: str = None):
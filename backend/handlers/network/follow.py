@@ -41,10 +41,8 @@ class FollowHandler(BaseHandler):
             follows = profile_manager.get_follows(username)
 
         self.set_status(200)
-        self.write(
-            self.json_serialize_response(
-                {"success": True, "user": username, "follows": follows}
-            )
+        self.serialize_and_write(
+            {"success": True, "user": username, "follows": follows}
         )
 
     @auth_needed
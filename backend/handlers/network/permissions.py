@@ -59,9 +59,7 @@ class RoleHandler(BaseHandler):
                     ret_list = profile_manager.get_all_roles(user_list_kc)
 
                 self.set_status(200)
-                self.write(
-                    self.json_serialize_response({"success": True, "users": ret_list})
-                )
+                self.serialize_and_write({"success": True, "users": ret_list})
             else:
                 self.set_status(403)
                 self.write(
@@ -74,11 +72,7 @@ class RoleHandler(BaseHandler):
                     profile_manager = Profiles(db)
                     roles = profile_manager.get_distinct_roles()
                 self.set_status(200)
-                self.write(
-                    self.json_serialize_response(
-                        {"success": True, "existing_roles": roles}
-                    )
-                )
+                self.serialize_and_write({"success": True, "existing_roles": roles})
 
             else:
                 self.set_status(403)
@@ -261,10 +255,8 @@ class GlobalACLHandler(BaseHandler):
                     acl_entry = self.resolve_inconsistency(current_user_role)
 
                 self.set_status(200)
-                self.write(
-                    self.json_serialize_response(
-                        {"status": 200, "success": True, "acl_entry": acl_entry}
-                    )
+                self.serialize_and_write(
+                    {"status": 200, "success": True, "acl_entry": acl_entry}
                 )
             else:
                 self.set_status(409)
@@ -290,10 +282,8 @@ class GlobalACLHandler(BaseHandler):
                     entries = acl.global_acl.get_all()
 
                 self.set_status(200)
-                self.write(
-                    self.json_serialize_response(
-                        {"status": 200, "success": True, "acl_entries": entries}
-                    )
+                self.serialize_and_write(
+                    {"status": 200, "success": True, "acl_entries": entries}
                 )
             else:
                 self.set_status(403)
@@ -540,10 +530,8 @@ class SpaceACLHandler(BaseHandler):
                     acl_entry = self.resolve_inconsistency(username_to_query, space_id)
 
                 self.set_status(200)
-                self.write(
-                    self.json_serialize_response(
-                        {"status": 200, "success": True, "acl_entry": acl_entry}
-                    )
+                self.serialize_and_write(
+                    {"status": 200, "success": True, "acl_entry": acl_entry}
                 )
 
         elif slug == "get_all":
@@ -582,10 +570,8 @@ class SpaceACLHandler(BaseHandler):
                 entries = acl.space_acl.get_all(space_id)
 
                 self.set_status(200)
-                self.write(
-                    self.json_serialize_response(
-                        {"status": 200, "success": True, "acl_entries": entries}
-                    )
+                self.serialize_and_write(
+                    {"status": 200, "success": True, "acl_entries": entries}
                 )
 
         else:
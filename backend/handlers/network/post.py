@@ -20,7 +20,6 @@ from resources.network.post import (
     Posts,
     PostNotExistingException,
 )
-from model import VEPlan
 from resources.planner.ve_plan import VEPlanResource
 from resources.network.profile import Profiles
 from resources.network.space import (
@@ -329,32 +328,10 @@ class PostHandler(BaseTimelineHandler):
 
                 post["_id"] = post_id
 
-                # enhance author with profile information
-                profile_manager = Profiles(db)
-                author_profile_snippet = profile_manager.get_profile_snippets([author])[
-                    0
-                ]
-                post["author"] = author_profile_snippet
-
-                # enhance the post with the full plan objects
-                if post["plans"]:
-                    plan_ids = []
-
-                    for plan_id in post["plans"]:
-                        if plan_id not in plan_ids:
-                            plan_ids.append(plan_id)
-
-                    plan_manager = VEPlanResource(db)
-                    plans = plan_manager.get_bulk_plans(plan_ids)
-
-                    # replace the plan_ids with the full plan objects
-                    # post_plan_ids_copy = post["plans"].copy()
-                    post["plans"] = []
-                    for plan_id in plan_ids:
-                        plan = self._filter_from_plan_objects(plan_id, plans)
-                        if isinstance(plan, VEPlan):
-                            plan = plan.to_dict()
-                        post["plans"].append(plan)
+                # enhance author with profile information and the post with the
+                # full plan objects, attaching every plan only once
+                post["plans"] = list(dict.fromkeys(post["plans"]))
+                self.hydrate_posts([post])
 
                 self.set_status(200)
                 self.serialize_and_write(
@@ -1286,20 +1263,10 @@ class RepostHandler(BaseHandler):
                 post["_id"] = repost_id
 
                 # ennhance original author and repost author with profile details to return
-                profile_manager = Profiles(db)
-                author_profile_snippets = profile_manager.get_profile_snippets(
-                    [post["author"], post["repostAuthor"]]
-                )
-                post["author"] = [
-                    author_profile_snippet
-                    for author_profile_snippet in author_profile_snippets
-                    if author_profile_snippet["username"] == post["author"]
-                ][0]
-                post["repostAuthor"] = [
-                    author_profile_snippet
-                    for author_profile_snippet in author_profile_snippets
-                    if author_profile_snippet["username"] == post["repostAuthor"]
-                ][0]
+                self.loaders.profiles.want([post["author"], post["repostAuthor"]])
+                self.loaders.load(db)
+                post["author"] = self.loaders.profiles.get(post["author"])
+                post["repostAuthor"] = self.loaders.profiles.get(post["repostAuthor"])
 
                 self.set_status(200)
                 self.serialize_and_write(
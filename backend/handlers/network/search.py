@@ -1,22 +1,24 @@
+import asyncio
+import json
 from typing import Dict, List
 
-import requests
+import tornado.httpclient
 import tornado.web
 from tornado.options import options
 
 import global_vars
 from handlers.base_handler import BaseHandler, auth_needed
-from resources.network.post import Posts
-from resources.network.profile import Profiles
-from resources.network.space import Spaces
-from resources.planner.ve_plan import VEPlanResource
+from resources.network.post import AsyncPosts
+from resources.network.profile import AsyncProfiles
+from resources.network.space import AsyncSpaces
+from resources.planner.ve_plan import AsyncVEPlanResource
 
 import util
 
 
 class SearchHandler(BaseHandler):
     @auth_needed
-    def get(self):
+    async def get(self):
         """
         GET /search
         search the database for posts, tags, spaces, users and plans
@@ -90,27 +92,30 @@ class SearchHandler(BaseHandler):
             )
             return
 
-        users_search_result = []
-        tags_search_result = []
-        posts_search_result = []
-        spaces_search_result = []
-        plans_search_result = []
-
-        # depending on flags, gather search results
-        if search_users:
-            users_search_result = self._search_users(query)
-
-        if search_tags:
-            tags_search_result = self._search_tags(query.split(","))
-
-        if search_posts:
-            posts_search_result = self._search_posts(query)
+        # depending on flags, gather search results.
+        # the categories are independent of each other, so they are searched concurrently
+        async def _no_search() -> List[Dict]:
+            return []
 
-        if search_spaces:
-            spaces_search_result = self._search_spaces(query)
+        (
+            users_search_result,
+            tags_search_result,
+            posts_search_result,
+            spaces_search_result,
+            plans_search_result,
+        ) = await asyncio.gather(
+            self._search_users(query) if search_users else _no_search(),
+            self._search_tags(query.split(",")) if search_tags else _no_search(),
+            self._search_posts(query) if search_posts else _no_search(),
+            self._search_spaces(query) if search_spaces else _no_search(),
+            self._search_plans(query) if search_plans else _no_search(),
+        )
 
-        if search_plans:
-            plans_search_result = self._search_plans(query)
+        # the authors of all matched posts and plans are fetched at once,
+        # off the IOLoop
+        await util.run_in_mongodb_executor(
+            self.add_authors_profile, posts_search_result + plans_search_result
+        )
 
         response = self.json_serialize_response(
             {
@@ -127,7 +132,33 @@ class SearchHandler(BaseHandler):
         self.set_status(200)
         self.write(response)
 
-    def _search_users(self, query: str) -> List[Dict]:
+    async def _query_elasticsearch(self, index: str, query: Dict) -> Dict:
+        """
+        run the search `query` on the elasticsearch `index` without blocking
+        the IOLoop and return the parsed response body
+        :param index: name of the index to search in
+        :param query: the elasticsearch query
+        :return: the elasticsearch response
+        """
+
+        # catch test mode, because test_mode forces "test" index
+        if options.test_admin or options.test_user:
+            index = "test"
+
+        search_url = "{}/{}/_search?".format(global_vars.elasticsearch_base_url, index)
+
+        response = await tornado.httpclient.AsyncHTTPClient().fetch(
+            search_url,
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(query),
+            auth_username=global_vars.elasticsearch_username,
+            auth_password=global_vars.elasticsearch_password,
+            raise_error=False,
+        )
+        return json.loads(response.body)
+
+    async def _search_users(self, query: str) -> List[Dict]:
         """
         suggestion search on user profiles based on names
         (i.e. first_name, last_name, username)
@@ -191,35 +222,16 @@ class SearchHandler(BaseHandler):
             },
         }
 
-        search_url = "{}/{}/_search?".format(
-            global_vars.elasticsearch_base_url, "profiles"
-        )
-
-        # catch test mode, because test_mode forces "test" index
-        if options.test_admin or options.test_user:
-            search_url = "{}/{}/_search?".format(
-                global_vars.elasticsearch_base_url, "test"
-            )
-
-        response = requests.post(
-            search_url,
-            auth=(
-                global_vars.elasticsearch_username,
-                global_vars.elasticsearch_password,
-            ),
-            json=query,
-        )
+        response = await self._query_elasticsearch("profiles", query)
 
         # map usernames to exchange them for full profiles
-        usernames = [
-            elem["_source"]["username"] for elem in response.json()["hits"]["hits"]
-        ]
+        usernames = [elem["_source"]["username"] for elem in response["hits"]["hits"]]
 
         with util.get_mongodb() as db:
-            profile_manager = Profiles(db)
-            return profile_manager.get_bulk_profiles(usernames)
+            profile_manager = AsyncProfiles(db)
+            return await profile_manager.get_bulk_profiles(usernames)
 
-    def _search_spaces(self, query: str) -> List[Dict]:
+    async def _search_spaces(self, query: str) -> List[Dict]:
         """
         suggestion search on spaces profiles based on name and description
         :param query: search query
@@ -266,35 +278,16 @@ class SearchHandler(BaseHandler):
             },
         }
 
-        search_url = "{}/{}/_search?".format(
-            global_vars.elasticsearch_base_url, "spaces"
-        )
-
-        # catch test mode, because test_mode forces "test" index
-        if options.test_admin or options.test_user:
-            search_url = "{}/{}/_search?".format(
-                global_vars.elasticsearch_base_url, "test"
-            )
-
-        response = requests.post(
-            search_url,
-            auth=(
-                global_vars.elasticsearch_username,
-                global_vars.elasticsearch_password,
-            ),
-            json=query,
-        )
+        response = await self._query_elasticsearch("spaces", query)
 
         # map _id's to exchange them for full spaces
-        space_ids = [elem["_id"] for elem in response.json()["hits"]["hits"]]
+        space_ids = [elem["_id"] for elem in response["hits"]["hits"]]
 
         with util.get_mongodb() as db:
-            space_manager = Spaces(db)
-            return space_manager.get_bulk_space_snippets(
-                space_ids
-            )
+            space_manager = AsyncSpaces(db)
+            return await space_manager.get_bulk_space_snippets(space_ids)
 
-    def _search_tags(self, tags: List[str]) -> List[Dict]:
+    async def _search_tags(self, tags: List[str]) -> List[Dict]:
         """
         search tags of posts. since tags are only short and precise,
         this search is an exact match instead of full text search.
@@ -306,15 +299,15 @@ class SearchHandler(BaseHandler):
 
         # tags is an exact match query, therefore explicitely search without using index
         with util.get_mongodb() as db:
-            post_manager = Posts(db)
-            matched_posts = post_manager.get_posts_by_tags(tags)
+            post_manager = AsyncPosts(db)
+            matched_posts = await post_manager.get_posts_by_tags(tags)
 
         if matched_posts:
-            return self.reduce_disallowed_posts(matched_posts)
+            return await self.reduce_disallowed_posts(matched_posts)
         else:
             return []
 
-    def _search_posts(self, query: str) -> List[Dict]:
+    async def _search_posts(self, query: str) -> List[Dict]:
         """
         full text search on the contents of a post (i.e. text, tags, and files(-names))
         Results are restricted to posts that the current_user is allowed to see
@@ -325,16 +318,15 @@ class SearchHandler(BaseHandler):
 
         # full text search
         with util.get_mongodb() as db:
-            post_manager = Posts(db)
-            matched_posts = post_manager.fulltext_search(query)
+            post_manager = AsyncPosts(db)
+            matched_posts = await post_manager.fulltext_search(query)
 
         if matched_posts:
-            matched_posts = self.add_authors_profile(matched_posts)
-            return self.reduce_disallowed_posts(matched_posts)
+            return await self.reduce_disallowed_posts(matched_posts)
         else:
             return []
 
-    def reduce_disallowed_posts(self, posts: List[Dict]) -> List[Dict]:
+    async def reduce_disallowed_posts(self, posts: List[Dict]) -> List[Dict]:
         """
         Sort out posts from the input list that the current_user is not allowed to see,
         i.e. only posts will remain, that are
@@ -347,12 +339,12 @@ class SearchHandler(BaseHandler):
 
         reduced = []
         with util.get_mongodb() as db:
-            space_manager = Spaces(db)
-            profile_manager = Profiles(db)
-            space_ids_of_user = space_manager.get_space_ids_of_user(
-                self.current_user.username
+            space_manager = AsyncSpaces(db)
+            profile_manager = AsyncProfiles(db)
+            space_ids_of_user, follows_of_user = await asyncio.gather(
+                space_manager.get_space_ids_of_user(self.current_user.username),
+                profile_manager.get_follows(self.current_user.username),
             )
-            follows_of_user = profile_manager.get_follows(self.current_user.username)
 
         # iterate matched posts and sort out those that user is not allowed to see
         for post in posts:
@@ -371,7 +363,7 @@ class SearchHandler(BaseHandler):
 
         return reduced
 
-    def _search_plans(self, slug: str) -> List[Dict]:
+    async def _search_plans(self, slug: str) -> List[Dict]:
         """
         suggestion search on public and own plans on plan name, topics and abstract
         :param slug: search slug
@@ -431,36 +423,18 @@ class SearchHandler(BaseHandler):
             },
         }
 
-        search_url = "{}/{}/_search?".format(
-            global_vars.elasticsearch_base_url, "plans"
-        )
-
-        # catch test mode, because test_mode forces "test" index
-        if options.test_admin or options.test_user:
-            search_url = "{}/{}/_search?".format(
-                global_vars.elasticsearch_base_url, "test"
-            )
-
-        response = requests.post(
-            search_url,
-            auth=(
-                global_vars.elasticsearch_username,
-                global_vars.elasticsearch_password,
-            ),
-            json=query,
-        )
+        response = await self._query_elasticsearch("plans", query)
 
         # map _id's to exchange them for full plans
-        plans_ids = [elem["_id"] for elem in response.json()["hits"]["hits"]]
+        plans_ids = [elem["_id"] for elem in response["hits"]["hits"]]
 
         with util.get_mongodb() as db:
-            plans_manager = VEPlanResource(db)
+            plans_manager = AsyncVEPlanResource(db)
 
             matched_plans = [
                 plan.to_dict()
-                for plan in plans_manager.get_bulk_plans(plans_ids)
+                for plan in await plans_manager.get_bulk_plans(plans_ids)
             ]
-            matched_plans = self.add_authors_profile(matched_plans)
 
         if matched_plans:
             return matched_plans
@@ -474,27 +448,10 @@ class SearchHandler(BaseHandler):
         :return: assets list
         """
 
-        with util.get_mongodb() as db:
-            profile_manager = Profiles(db)
-
-            # collect all usernames that we have to request the profile information for, avoiding duplicates
-            usernames_to_request = []
-            for asset in assets:
-                if asset["author"] not in usernames_to_request:
-                    usernames_to_request.append(asset["author"])
-
-            profile_snippets = profile_manager.get_profile_snippets(
-                usernames_to_request
-            )
+        self.loaders.profiles.want(asset["author"] for asset in assets)
+        self.loaders.load()
 
-            for asset in assets:
-                asset["author"] = next(
-                    (
-                        profile
-                        for profile in profile_snippets
-                        if profile["username"] == asset["author"]
-                    ),
-                    [None],
-                )
+        for asset in assets:
+            asset["author"] = self.loaders.profiles.get(asset["author"], [None])
 
         return assets
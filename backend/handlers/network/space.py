@@ -1,12 +1,13 @@
 from base64 import b64decode
 import json
 import logging
-from typing import Optional
+from typing import Dict, List, Optional
 
 from bson import ObjectId
 import tornado.web
 
 from handlers.base_handler import BaseHandler, auth_needed
+from handlers.streaming_upload import StreamingUploadHandler
 from resources.network.acl import ACL
 from resources.network.space import (
     AlreadyAdminError,
@@ -18,6 +19,8 @@ from resources.network.space import (
     UserNotMemberError,
 )
 from resources.notifications import NotificationResource
+from resources.streaming_upload import GridFSFileWriter
+from resources.upload_urls import sign_file_url
 import util
 
 logger = logging.getLogger(__name__)
@@ -167,14 +170,16 @@ class SpaceHandler(BaseHandler):
 
         GET /spaceadministration/files
             get the file metadata of the files uploaded to the given space
-            use the static file handler on /uploads to retrieve the actual file
+            use the static file handler on /uploads to retrieve the actual file,
+            or the signed, expiring "url" that needs no authentication
+            (None if signed URLs are disabled)
             query param:
                 "id": the space _id of which to view the files
 
             returns:
                 200 OK
                 {"success": True,
-                 "files": [{"author": <str>, "filename": <str>}, ...]}
+                 "files": [{"author": <str>, "filename": <str>, "url": <str>}, ...]}
 
                 400 Bad Request
                 {"success": False,
@@ -667,42 +672,6 @@ class SpaceHandler(BaseHandler):
                 409 Conflict
                 {"success": False,
                  "reason": "space_doesnt_exist"}
-
-        POST /spaceadministration/put_file
-            add a new file to the space's repository
-            query param:
-                "id": the _id of the space
-
-            form data:
-                "file": the file to upload
-
-            returns:
-                200 OK,
-                {"success": True}
-
-                400 Bad Request
-                {"success": False,
-                 "reason": missing_key:id}
-
-                400 Bad Request
-                {"success": False,
-                 "reason": missing_file:file}
-
-                401 Unauthorized
-                {"success": False,
-                 "reason": "no_logged_in_user"}
-
-                403 Forbidden
-                {"success": False,
-                 "reason": "insufficient_permission"}
-
-                409 Conflict
-                {"success": False,
-                 "reason": "space_doesnt_exist"}
-
-                409 Conflict
-                {"success": False,
-                 "reason": "user_not_member_of_space"}
         """
 
         # join_discussion and create route doesnt need space id, so only
@@ -844,21 +813,6 @@ class SpaceHandler(BaseHandler):
             self.toggle_space_joinability(space_id)
             return
 
-        elif slug == "put_file":
-            if "file" not in self.request.files or not self.request.files["file"][0]:
-                self.set_status(400)
-                self.write({"success": False, "reason": "missing_file:file"})
-                return
-
-            file_obj = self.request.files["file"][0]
-            self.put_new_file(
-                space_id,
-                file_obj["filename"],
-                file_obj["body"],
-                file_obj["content_type"],
-            )
-            return
-
         else:
             self.set_status(404)
 
@@ -1090,7 +1044,7 @@ class SpaceHandler(BaseHandler):
             spaces = space_manager.get_all_spaces()
 
         self.set_status(200)
-        self.write(self.json_serialize_response({"success": True, "spaces": spaces}))
+        self.serialize_and_write({"success": True, "spaces": spaces})
         return
 
     def list_spaces_except_invisible(self) -> None:
@@ -1109,7 +1063,7 @@ class SpaceHandler(BaseHandler):
             )
 
         self.set_status(200)
-        self.write(self.json_serialize_response({"success": True, "spaces": spaces}))
+        self.serialize_and_write({"success": True, "spaces": spaces})
         return
 
     def list_personal_spaces(self) -> None:
@@ -1122,7 +1076,7 @@ class SpaceHandler(BaseHandler):
             spaces = space_manager.get_spaces_of_user(self.current_user.username)
 
         self.set_status(200)
-        self.write(self.json_serialize_response({"success": True, "spaces": spaces}))
+        self.serialize_and_write({"success": True, "spaces": spaces})
         return
 
     def get_space_info(self, space_id: str | ObjectId) -> None:
@@ -1152,7 +1106,7 @@ class SpaceHandler(BaseHandler):
                 return
 
         self.set_status(200)
-        self.write(self.json_serialize_response({"success": True, "space": space}))
+        self.serialize_and_write({"success": True, "space": space})
         return
 
     def get_invites_for_current_user(self) -> None:
@@ -1167,11 +1121,7 @@ class SpaceHandler(BaseHandler):
             )
 
         self.set_status(200)
-        self.write(
-            self.json_serialize_response(
-                {"success": True, "pending_invites": pending_invites}
-            )
-        )
+        self.serialize_and_write({"success": True, "pending_invites": pending_invites})
 
     def get_requests_for_current_user(self) -> None:
         """
@@ -1185,10 +1135,8 @@ class SpaceHandler(BaseHandler):
             )
 
         self.set_status(200)
-        self.write(
-            self.json_serialize_response(
-                {"success": True, "pending_requests": pending_requests}
-            )
+        self.serialize_and_write(
+            {"success": True, "pending_requests": pending_requests}
         )
 
     def get_invites_for_space(self, space_id: str | ObjectId) -> None:
@@ -1221,9 +1169,7 @@ class SpaceHandler(BaseHandler):
             return
 
         self.set_status(200)
-        self.write(
-            self.json_serialize_response({"success": True, "invites": space["invites"]})
-        )
+        self.serialize_and_write({"success": True, "invites": space["invites"]})
 
     def get_join_requests_for_space(self, space_id: str | ObjectId) -> None:
         """
@@ -1255,11 +1201,7 @@ class SpaceHandler(BaseHandler):
             return
 
         self.set_status(200)
-        self.write(
-            self.json_serialize_response(
-                {"success": True, "join_requests": space["requests"]}
-            )
-        )
+        self.serialize_and_write({"success": True, "join_requests": space["requests"]})
 
     def get_files(self, space_id: str | ObjectId) -> None:
         """
@@ -1297,9 +1239,11 @@ class SpaceHandler(BaseHandler):
                 return
 
             files = space_manager.get_files(space_id)
+            for file in files:
+                file["url"] = sign_file_url(file["file_id"])
 
             self.set_status(200)
-            self.write(self.json_serialize_response({"success": True, "files": files}))
+            self.serialize_and_write({"success": True, "files": files})
 
     def create_space(
         self, space_name: str, is_invisible: bool, is_joinable: bool
@@ -1909,62 +1853,6 @@ class SpaceHandler(BaseHandler):
             self.set_status(200)
             self.write({"success": True})
 
-    def put_new_file(
-        self,
-        space_id: str | ObjectId,
-        file_name: str,
-        file_content: bytes,
-        content_type: str,
-    ) -> None:
-        """
-        add a new file to the space's 'repository'.
-        each space has an own directory in the uploads directory, where the files will be stored.
-        using the filename of the file that was just stored, you can retrieve the actual content
-        of the file using the `StaticFileHandler` on the uploads-endpoint using
-        /uploads/<space_id>/<file_name>
-        :param space_id: the _id of the space where to upload the new file
-        :param file_name: the name of the new file
-        :param file_content: the body of the file as raw bytes
-        """
-
-        space_id = util.parse_object_id(space_id)
-
-        with util.get_mongodb() as db:
-            space_manager = Spaces(db)
-            acl = ACL(db)
-
-            # reject if user is not a member or space doesnt exist at all
-            try:
-                if not space_manager.check_user_is_member(
-                    space_id, self.current_user.username
-                ):
-                    self.set_status(409)
-                    self.write({"success": False, "reason": "user_not_member_of_space"})
-                    return
-            except SpaceDoesntExistError:
-                self.set_status(409)
-                self.write({"success": False, "reason": "space_doesnt_exist"})
-                return
-
-            # reject if user is not allowed to add files
-            if not acl.space_acl.ask(
-                self.current_user.username, space_id, "write_files"
-            ):
-                self.set_status(403)
-                self.write({"success": False, "reason": "insufficient_permission"})
-                return
-
-            space_manager.add_new_repo_file(
-                space_id,
-                file_name,
-                file_content,
-                content_type,
-                self.current_user.username,
-            )
-
-        self.set_status(200)
-        self.write({"success": True})
-
     def user_leave(self, space_id: str | ObjectId) -> None:
         """
         let the current user leave the space
@@ -2167,3 +2055,117 @@ class SpaceHandler(BaseHandler):
             # after iterating all files of the space, no match was found --> reply error
             self.set_status(409)
             self.write({"success": False, "reason": "file_doesnt_exist_in_space"})
+
+
+class SpaceFileUploadHandler(StreamingUploadHandler):
+    """
+    POST /spaceadministration/put_file
+        add a new file to the space's repository. The file is streamed into
+        gridfs while it is uploaded, see `StreamingUploadHandler`.
+        query param:
+            "id": the _id of the space
+
+        form data:
+            "file": the file to upload
+
+        returns:
+            200 OK,
+            {"success": True}
+
+            400 Bad Request
+            {"success": False,
+             "reason": missing_key:id}
+
+            400 Bad Request
+            {"success": False,
+             "reason": missing_file:file}
+
+            400 Bad Request
+            {"success": False,
+             "reason": "malformed_multipart_body"}
+
+            401 Unauthorized
+            {"success": False,
+             "reason": "no_logged_in_user"}
+
+            403 Forbidden
+            {"success": False,
+             "reason": "insufficient_permission"}
+
+            409 Conflict
+            {"success": False,
+             "reason": "space_doesnt_exist"}
+
+            409 Conflict
+            {"success": False,
+             "reason": "user_not_member_of_space"}
+
+            413 Payload Too Large
+            {"success": False,
+             "reason": "file_too_large"}
+    """
+
+    def authorize_upload(self) -> bool:
+        """
+        reject the upload if the space doesn't exist or the current user is not
+        allowed to add files to it
+        """
+
+        try:
+            self.space_id = util.parse_object_id(self.get_argument("id"))
+        except tornado.web.MissingArgumentError:
+            self.set_status(400)
+            self.write({"success": False, "reason": "missing_key:id"})
+            return False
+
+        with util.get_mongodb() as db:
+            space_manager = Spaces(db)
+            acl = ACL(db)
+
+            # reject if user is not a member or space doesnt exist at all
+            try:
+                if not space_manager.check_user_is_member(
+                    self.space_id, self.current_user.username
+                ):
+                    self.set_status(409)
+                    self.write({"success": False, "reason": "user_not_member_of_space"})
+                    return False
+            except SpaceDoesntExistError:
+                self.set_status(409)
+                self.write({"success": False, "reason": "space_doesnt_exist"})
+                return False
+
+            # reject if user is not allowed to add files
+            if not acl.space_acl.ask(
+                self.current_user.username, self.space_id, "write_files"
+            ):
+                self.set_status(403)
+                self.write({"success": False, "reason": "insufficient_permission"})
+                return False
+
+        return True
+
+    def upload_received(self, files: Dict[str, List[GridFSFileWriter]]) -> bool:
+        """
+        add the uploaded file to the space's 'repository'
+        """
+
+        file = files["file"][0]
+
+        with util.get_mongodb() as db:
+            try:
+                Spaces(db).attach_repo_file(
+                    self.space_id,
+                    file._id,
+                    file.filename,
+                    self.current_user.username,
+                )
+            except SpaceDoesntExistError:
+                # the space has been deleted in the meantime
+                self.set_status(409)
+                self.write({"success": False, "reason": "space_doesnt_exist"})
+                return False
+
+        self.set_status(200)
+        self.write({"success": True})
+        return True
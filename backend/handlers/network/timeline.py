@@ -2,16 +2,13 @@ from datetime import datetime, timedelta
 import logging
 from typing import Dict, List, Tuple
 
-from bson import ObjectId
 import dateutil.parser
 
 from handlers.base_handler import BaseHandler, auth_needed
-from model import VEPlan
-from resources.network.acl import ACL
-from resources.network.post import Posts
-from resources.network.profile import Profiles
-from resources.network.space import SpaceDoesntExistError, Spaces
-from resources.planner.ve_plan import VEPlanResource
+from resources.network.acl import AsyncACL
+from resources.network.post import AsyncPosts, Posts
+from resources.network.space import AsyncSpaces, SpaceDoesntExistError
+from resources.upload_urls import sign_file_url
 import util
 
 logger = logging.getLogger(__name__)
@@ -41,81 +38,89 @@ class BaseTimelineHandler(BaseHandler):
 
         return time_from, time_to
 
-    def _filter_from_profile_snippets(
-        self, username: str, snippets: list[Dict]
-    ) -> Dict:
+    def _collect_authors(self, posts: List[Dict]) -> None:
         """
-        from the list of profile snippets, filter the one with the matching username
+        register the authors of the posts, their reposts and comments
+        in the profile snippet loader of this request
         """
 
-        for snippet in snippets:
-            if snippet["username"] == username:
-                return snippet
-        return None
+        for post in posts:
+            self.loaders.profiles.want([post["author"]])
+            if "isRepost" in post and post["isRepost"]:
+                self.loaders.profiles.want([post["repostAuthor"]])
+            if "comments" in post and post["comments"]:
+                self.loaders.profiles.want(
+                    comment["author"] for comment in post["comments"]
+                )
 
-    def add_profile_information_to_author(self, posts: List[Dict]) -> List[Dict]:
+    def _join_authors(self, posts: List[Dict]) -> None:
         """
-        modify the "author" key of the post and comments to not only be the username,
-        but a mix of "username", "profile_pic", "first_name", "last_name" and "institution"
-        as a nested dict.
-        :returns: the modified posts
+        replace the author keys of the posts, their reposts and comments
+        with the loaded profile snippets, or None if there is no profile
         """
 
-        with util.get_mongodb() as db:
-            profile_manager = Profiles(db)
-
-            # collect all usernames that we have to request the profile information for, avoiding duplicates
-            usernames_to_request = []
-            for post in posts:
-                if post["author"] not in usernames_to_request:
-                    usernames_to_request.append(post["author"])
-                if "isRepost" in post and post["isRepost"]:
-                    if post["repostAuthor"] not in usernames_to_request:
-                        usernames_to_request.append(post["repostAuthor"])
-                if "comments" in post and post["comments"]:
-                    for comment in post["comments"]:
-                        if comment["author"] not in usernames_to_request:
-                            usernames_to_request.append(comment["author"])
-
-            profile_snippets = profile_manager.get_profile_snippets(
-                usernames_to_request
-            )
+        for post in posts:
+            post["author"] = self.loaders.profiles.get(post["author"])
 
-            # replace the author keys with the respecting profile_information
-            for post in posts:
-                post["author"] = self._filter_from_profile_snippets(
-                    post["author"], profile_snippets
-                )
+            # if the post is a repost, we also have to handle their profile pic
+            if "isRepost" in post and post["isRepost"]:
+                post["repostAuthor"] = self.loaders.profiles.get(post["repostAuthor"])
 
-                # if the post is a repost, we also have to handle their profile pic
-                if "isRepost" in post and post["isRepost"]:
-                    post["repostAuthor"] = self._filter_from_profile_snippets(
-                        post["repostAuthor"], profile_snippets
-                    )
+            # exactly the same procedure for the comments
+            if "comments" in post and post["comments"]:
+                for comment in post["comments"]:
+                    comment["author"] = self.loaders.profiles.get(comment["author"])
 
-                # exactly the same procedure for the comments
-                if "comments" in post and post["comments"]:
-                    for comment in post["comments"]:
-                        comment["author"] = self._filter_from_profile_snippets(
-                            comment["author"], profile_snippets
-                        )
+    def _collect_plans(self, posts: List[Dict]) -> None:
+        """
+        register the plans attached to the posts in the plan loader of this request
+        """
 
-            return posts
+        for post in posts:
+            if "plans" in post and post["plans"] != []:
+                self.loaders.plans.want(post["plans"])
 
-    def _filter_from_plan_objects(
-        self, plan_id: str | ObjectId, plans: list[VEPlan]
-    ) -> Dict:
+    def _join_plans(self, posts: List[Dict]) -> None:
         """
-        from the list of plan objects, filter the one with the matching plan_id,
-        if no matching plan is found, the plan_id is returned back instead
+        replace the plan_ids of the posts with the loaded plans as dicts,
+        or keep the plan_id (as an `ObjectId`) if there is no such plan
         """
 
-        plan_id = util.parse_object_id(plan_id)
+        for post in posts:
+            if "plans" in post and post["plans"] != []:
+                post["plans"] = [
+                    (
+                        plan.to_dict()
+                        if (plan := self.loaders.plans.get(plan_id)) is not None
+                        else util.parse_object_id(plan_id)
+                    )
+                    for plan_id in post["plans"]
+                ]
 
-        for plan in plans:
-            if plan._id == plan_id:
-                return plan
-        return plan_id
+    def _sign_files(self, posts: List[Dict]) -> None:
+        """
+        add a signed URL (see `resources.upload_urls.sign_file_url()`) as "url"
+        to every file attached to the posts, which can be fetched without
+        authentication
+        """
+
+        for post in posts:
+            if "files" in post and post["files"]:
+                for file in post["files"]:
+                    file["url"] = sign_file_url(file["file_id"])
+
+    def add_profile_information_to_author(self, posts: List[Dict]) -> List[Dict]:
+        """
+        modify the "author" key of the post and comments to not only be the username,
+        but a mix of "username", "profile_pic", "first_name", "last_name" and "institution"
+        as a nested dict.
+        :returns: the modified posts
+        """
+
+        self._collect_authors(posts)
+        self.loaders.load()
+        self._join_authors(posts)
+        return posts
 
     def add_plan_to_posts(self, posts: List[Dict]) -> List[Dict]:
         """
@@ -125,31 +130,33 @@ class BaseTimelineHandler(BaseHandler):
         However, if no matching plan is found (e.g. it got deleted), the plan_id is returned back.
         """
 
+        self._collect_plans(posts)
+        self.loaders.load()
+        self._join_plans(posts)
+        return posts
 
-        # collect all plan_ids without duplicates
-        plan_ids = []
-        for post in posts:
-            if "plans" in post and post["plans"] != []:
-                for plan_id in post["plans"]:
-                    if plan_id not in plan_ids:
-                        plan_ids.append(plan_id)
+    def hydrate_posts(self, *post_lists: List[Dict]) -> None:
+        """
+        enhance the posts of all given lists in place with the profile information of
+        their authors (see `add_profile_information_to_author()`), their full plans
+        (see `add_plan_to_posts()`) and signed URLs of their files.
+
+        The usernames and plan_ids of all posts are collected first, so that the
+        profile snippets and plans are fetched with a single query each, no matter
+        how many lists and posts there are. Blocking, async handlers run it in
+        the mongodb executor.
+        """
 
-        with util.get_mongodb() as db:
-            plan_manager = VEPlanResource(db)
-            plans = plan_manager.get_bulk_plans(plan_ids)
-
-            # replace the plan_ids with the full plan objects
-            for post in posts:
-                if "plans" in post and post["plans"] != []:
-                    post_plan_ids_copy = post["plans"].copy()
-                    post["plans"] = []
-                    for plan_id in post_plan_ids_copy:
-                        plan = self._filter_from_plan_objects(plan_id, plans)
-                        if isinstance(plan, VEPlan):
-                            plan = plan.to_dict()
-                        post["plans"].append(plan)
+        for posts in post_lists:
+            self._collect_authors(posts)
+            self._collect_plans(posts)
 
-        return posts
+        self.loaders.load()
+
+        for posts in post_lists:
+            self._join_authors(posts)
+            self._join_plans(posts)
+            self._sign_files(posts)
 
 
 class TimelineHandler(BaseTimelineHandler):
@@ -187,14 +194,12 @@ class TimelineHandler(BaseTimelineHandler):
             post_manager = Posts(db)
             result = post_manager.get_full_timeline(time_to, limit)
 
-        # serialize post objects to dicts and enhance author information
-        posts = self.add_profile_information_to_author(result)
-
-        # add plan information to posts if there are any associated plans with the posts
-        posts = self.add_plan_to_posts(posts)
+        # enhance author information and add plan information to posts
+        # if there are any associated plans with the posts
+        self.hydrate_posts(result)
 
         self.set_status(200)
-        self.write(self.json_serialize_response({"success": True, "posts": posts}))
+        self.serialize_and_write({"success": True, "posts": result})
 
 
 class SpaceTimelineHandler(BaseTimelineHandler):
@@ -207,7 +212,7 @@ class SpaceTimelineHandler(BaseTimelineHandler):
         self.finish()
 
     @auth_needed
-    def get(self, space_id):
+    async def get(self, space_id):
         """
         GET /timeline/space/[space_id]
             Retrieve the timeline of a certain space (includes pinned posts).
@@ -250,9 +255,9 @@ class SpaceTimelineHandler(BaseTimelineHandler):
 
         # reject if user is not member of the space
         with util.get_mongodb() as db:
-            space_manager = Spaces(db)
+            space_manager = AsyncSpaces(db)
             try:
-                if not space_manager.check_user_is_member(
+                if not await space_manager.check_user_is_member(
                     space_id, self.current_user.username
                 ):
                     self.set_status(409)
@@ -264,8 +269,8 @@ class SpaceTimelineHandler(BaseTimelineHandler):
                 return
 
             # ask for permission to read timeline
-            acl = ACL(db)
-            if not acl.space_acl.ask(
+            acl = AsyncACL(db)
+            if not await acl.space_acl.ask(
                 self.current_user.username, space_id, "read_timeline"
             ):
                 self.set_status(403)
@@ -273,24 +278,20 @@ class SpaceTimelineHandler(BaseTimelineHandler):
                 return
 
             # query space timeline
-            post_manager = Posts(db)
-            timeline_posts, pinned_posts = post_manager.get_space_timeline(
+            post_manager = AsyncPosts(db)
+            timeline_posts, pinned_posts = await post_manager.get_space_timeline(
                 space_id, time_to, limit
             )
 
-        # postprocessing
-        timeline_posts = self.add_profile_information_to_author(timeline_posts)
-        pinned_posts = self.add_profile_information_to_author(pinned_posts)
-
-        # add plan information to posts if there are any associated plans with the posts
-        timeline_posts = self.add_plan_to_posts(timeline_posts)
-        pinned_posts = self.add_plan_to_posts(pinned_posts)
+        # postprocessing, the author and plan information of both the timeline
+        # and the pinned posts is queried at once and off the IOLoop as well
+        await util.run_in_mongodb_executor(
+            self.hydrate_posts, timeline_posts, pinned_posts
+        )
 
         self.set_status(200)
-        self.write(
-            self.json_serialize_response(
-                {"success": True, "posts": timeline_posts, "pinned_posts": pinned_posts}
-            )
+        self.serialize_and_write(
+            {"success": True, "posts": timeline_posts, "pinned_posts": pinned_posts}
         )
 
 
@@ -340,13 +341,12 @@ class UserTimelineHandler(BaseTimelineHandler):
             post_manager = Posts(db)
             result = post_manager.get_user_timeline(author, time_to, limit)
 
-        posts = self.add_profile_information_to_author(result)
-
-        # add plan information to posts if there are any associated plans with the posts
-        posts = self.add_plan_to_posts(posts)
+        # enhance author information and add plan information to posts
+        # if there are any associated plans with the posts
+        self.hydrate_posts(result)
 
         self.set_status(200)
-        self.write(self.json_serialize_response({"success": True, "posts": posts}))
+        self.serialize_and_write({"success": True, "posts": result})
 
 
 class PersonalTimelineHandler(BaseTimelineHandler):
@@ -356,7 +356,7 @@ class PersonalTimelineHandler(BaseTimelineHandler):
     """
 
     @auth_needed
-    def get(self):
+    async def get(self):
         """
         GET /timeline/you
             The timeline will always include `limit` number of posts, that are older than the
@@ -386,16 +386,16 @@ class PersonalTimelineHandler(BaseTimelineHandler):
 
         # query personal timeline
         with util.get_mongodb() as db:
-            post_manager = Posts(db)
-            result = post_manager.get_personal_timeline(
+            post_manager = AsyncPosts(db)
+            result = await post_manager.get_personal_timeline(
                 self.current_user.username, time_to, limit
             )
 
-        posts = self.add_profile_information_to_author(result)
-        posts = self.add_plan_to_posts(posts)
+        # the author and plan information is queried off the IOLoop as well
+        await util.run_in_mongodb_executor(self.hydrate_posts, result)
 
         self.set_status(200)
-        self.write(self.json_serialize_response({"success": True, "posts": posts}))
+        self.serialize_and_write({"success": True, "posts": result})
 
 
 class NewPostsSinceTimestampHandler(BaseHandler):
@@ -425,14 +425,12 @@ class NewPostsSinceTimestampHandler(BaseHandler):
             if post_manager.check_new_posts_since_timestamp(timestamp):
                 # new posts since timestamp, user should query the timeline handlers
                 self.set_status(200)
-                self.write(
-                    self.json_serialize_response(
-                        {
-                            "success": True,
-                            "new_posts": True,
-                            "since_timestamp": timestamp.isoformat(),
-                        }
-                    )
+                self.serialize_and_write(
+                    {
+                        "success": True,
+                        "new_posts": True,
+                        "since_timestamp": timestamp.isoformat(),
+                    }
                 )
             else:
                 # no new posts happened since the requested timestamp,
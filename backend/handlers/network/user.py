@@ -12,8 +12,13 @@ from error_reasons import USER_DOESNT_EXIST
 from exceptions import ProfileDoesntExistException
 
 from handlers.base_handler import BaseHandler, auth_needed
-from resources.network.profile import Profiles
+from resources.network.acl import get_acl_cache
+from resources.network.chat import Chat
+from resources.image_derivatives import delete_derivatives
+from resources.network.feed import Feeds
+from resources.network.profile import AsyncProfiles, Profiles
 from resources.network.space import Spaces
+from resources.user_directory import UserDirectory
 import util
 
 import global_vars
@@ -198,7 +203,7 @@ class ProfileInformationHandler(BaseHandler):
             user_information_response["spaces"] = spaces
 
         self.set_status(200)
-        self.write(self.json_serialize_response(user_information_response))
+        self.serialize_and_write(user_information_response)
 
     @auth_needed
     def post(self):
@@ -387,7 +392,7 @@ class ProfileInformationHandler(BaseHandler):
 
 class BulkProfileSnippets(BaseHandler):
     @auth_needed
-    def post(self):
+    async def post(self):
         """
         POST /profile_snippets
             request profile snippets, i.e. username, first_name, last_name,
@@ -395,7 +400,9 @@ class BulkProfileSnippets(BaseHandler):
             Specify this list of usernames in the body.
             The profile_pic is an identifier that can be exchanged for the actual
             profile image at the /uploads endpoint. See the documentation for
-            `GridFSStaticFileHandler` for reference.
+            `GridFSStaticFileHandler` for reference. The profile_pic_url is a signed,
+            expiring URL of the image that needs no authentication (None if signed
+            URLs are disabled), see `SignedGridFSStaticFileHandler`.
 
             query params:
                 None
@@ -414,6 +421,7 @@ class BulkProfileSnippets(BaseHandler):
                         "first_name": "<string>",
                         "last_name": "<string>",
                         "profile_pic": "<string>",
+                        "profile_pic_url": "<string>",
                         "institution": "<string>",
                         "chosen_achievement": {
                             "type": "<string>",           --> one of ACHIEVEMENT_TYPES in class `Profiles`
@@ -450,8 +458,10 @@ class BulkProfileSnippets(BaseHandler):
             return
 
         with util.get_mongodb() as db:
-            profile_manager = Profiles(db)
-            profiles = profile_manager.get_profile_snippets(http_body["usernames"])
+            profile_manager = AsyncProfiles(db)
+            profiles = await profile_manager.get_profile_snippets(
+                http_body["usernames"]
+            )
 
             self.set_status(200)
             self.serialize_and_write({"success": True, "user_snippets": profiles})
@@ -1015,7 +1025,7 @@ class UserHandler(BaseHandler):
                 )
 
             self.set_status(200)
-            self.write(self.json_serialize_response(user_information_response))
+            self.serialize_and_write(user_information_response)
 
         elif slug == "list":
             user_list_kc = self.get_keycloak_user_list()
@@ -1050,7 +1060,7 @@ class UserHandler(BaseHandler):
                     user_list_response[user["username"]] = user_info
 
             self.set_status(200)
-            self.write(self.json_serialize_response(user_list_response))
+            self.serialize_and_write(user_list_response)
 
         else:
             self.set_status(404)
@@ -1145,22 +1155,31 @@ class UserHandler(BaseHandler):
             fs = gridfs.GridFS(db)
             for file in files:
                 fs.delete(file["_id"])
+                delete_derivatives(db, file["_id"])
 
         def delete_chats(db):
             # delete all messages from user and remove from members list, and may remove empty chatro0ms
-            chats = db.chatrooms.find({"members": { "$in": [username] } })
+            chat_manager = Chat(db)
+            db.messages.delete_many({"sender": username})
+            db.chat_unread.delete_many({"username": username})
+            chats = list(db.chatrooms.find({"members": { "$in": [username] } }))
             for chat in chats:
-                db.chatrooms.update_one(
-                    {"_id": chat["_id"]}, {"$pull": {"messages": {"sender": username}}}
-                )
-                db.chatrooms.update_one(
-                    {"_id": chat["_id"]}, {"$pull": {"send_states": {"username": username}}}
+                db.messages.update_many(
+                    {"room_id": chat["_id"]}, {"$pull": {"send_states": {"username": username}}}
                 )
                 db.chatrooms.update_one(
                     {"_id": chat["_id"]},
                     {"$pull": {"members": username }},
                 )
-                db.chatrooms.delete_many({"members": { "$size": 0 }})
+                chat_manager.refresh_last_message(chat["_id"])
+            empty_chats = [
+                chat["_id"]
+                for chat in db.chatrooms.find({"members": { "$size": 0 }}, projection={"_id": True})
+            ]
+            db.messages.delete_many({"room_id": {"$in": empty_chats}})
+            db.chatrooms.delete_many({"_id": {"$in": empty_chats}})
+            # the deleted messages might have been unread by the other members
+            chat_manager.rebuild_unread_counters([chat["_id"] for chat in chats])
 
         def delete_invitations(db):
             # delete invitations sended by user; remove user as recipient
@@ -1180,6 +1199,13 @@ class UserHandler(BaseHandler):
                 {}, {"$pull": {"follows": username}}
             )
             db.profiles.delete_one({"username": username})
+            get_acl_cache().invalidate_role(db, username)
+
+            # delete the personal timeline of the user
+            Feeds(db).delete_feed(username)
+
+            # forget the email and name of the user
+            UserDirectory(db).delete_user(username)
 
         with util.get_mongodb() as db:
             delete_plans(db)
@@ -1,4 +1,3 @@
-import datetime
 import json
 import logging
 from typing import Any, Dict, List, Literal, Optional
@@ -31,13 +30,15 @@ from exceptions import (
     PlanAlreadyExistsError,
     PlanDoesntExistError,
 )
-import global_vars
 from handlers.base_handler import auth_needed, BaseHandler
+from handlers.streaming_upload import StreamingUploadHandler
 from model import Evaluation, IndividualLearningGoal, Step, VEPlan
 from resources.network.profile import Profiles
 from resources.notifications import NotificationResource
 from resources.planner.etherpad_integration import EtherpadResouce
+from resources.planner.plan_lock import PlanLocks
 from resources.planner.ve_plan import VEPlanResource
+from resources.streaming_upload import GridFSFileWriter
 from xml.etree.ElementTree import ElementTree
 import util
 
@@ -67,20 +68,9 @@ class VEPlanHandler(BaseHandler):
 
         plan_id = util.parse_object_id(plan_id)
 
-        # nobody currently holds a lock at all
-        if plan_id not in global_vars.plan_write_lock_map:
-            return False
-
-        # check if the username of the lock holder matches the current user
-        # and if so, the lock has to be not yet expired
-        if (
-                global_vars.plan_write_lock_map[plan_id]["username"]
-                == self.current_user.username
-        ):
-            return (
-                    global_vars.plan_write_lock_map[plan_id]["expires"]
-                    > datetime.datetime.now()
-            )
+        # the lock has to be held by the current user and be not yet expired
+        with util.get_mongodb() as db:
+            return PlanLocks(db).is_held_by(plan_id, self.current_user.username)
 
     def _get_lock_holder(self, plan_id: str | ObjectId) -> str | None:
         """
@@ -94,10 +84,8 @@ class VEPlanHandler(BaseHandler):
 
         plan_id = util.parse_object_id(plan_id)
 
-        if plan_id not in global_vars.plan_write_lock_map:
-            return None
-
-        return global_vars.plan_write_lock_map[plan_id]["username"]
+        with util.get_mongodb() as db:
+            return PlanLocks(db).get_lock_holder(plan_id)
 
     def _extend_lock(self, plan_id: str | ObjectId) -> None:
         """
@@ -106,14 +94,9 @@ class VEPlanHandler(BaseHandler):
 
         plan_id = util.parse_object_id(plan_id)
 
-        try:
-            # extend the lock by 1 hour
-            global_vars.plan_write_lock_map[plan_id][
-                "expires"
-            ] = datetime.datetime.now() + datetime.timedelta(hours=1)
-        except KeyError:
-            # if the plan is not locked, do nothing
-            pass
+        # extend the lock by 1 hour, if the user doesn't hold it, nothing happens
+        with util.get_mongodb() as db:
+            PlanLocks(db).extend(plan_id, self.current_user.username)
 
     def _release_lock(self, plan_id: str | ObjectId) -> None:
         """
@@ -122,15 +105,9 @@ class VEPlanHandler(BaseHandler):
 
         plan_id = util.parse_object_id(plan_id)
 
-        # only release the lock if the user is actually holding it
-        if not self._check_lock_is_held(plan_id):
-            return
-
-        try:
-            del global_vars.plan_write_lock_map[plan_id]
-        except KeyError:
-            # if the plan is not locked, do nothing
-            pass
+        # only releases the lock if the user is actually holding it
+        with util.get_mongodb() as db:
+            PlanLocks(db).release(plan_id, self.current_user.username)
 
     @auth_needed
     def get(self, slug):
@@ -243,6 +220,33 @@ class VEPlanHandler(BaseHandler):
                 {"success": False,
                  "reason": "insufficient_permissions"}
 
+        GET /planner/get_lock_holders
+            request the holders of the write locks of multiple plans at once,
+            e.g. to display them in a plan overview. Plans that don't exist or
+            that the current user has no read access to are omitted.
+
+            query params:
+                plan_ids: comma-separated list of the _id's of the plans
+
+            http body:
+
+            returns:
+                200 OK,
+                (the username of the lock holder per plan _id, or null if
+                the plan is not locked)
+                {"success": True,
+                 "lock_holders": {"<plan_id>": "<username>" | None, ...}}
+
+                400 Bad Request
+                (the request misses the plan_ids query parameter)
+                {"success": False,
+                 "reason": "missing_key:plan_ids"}
+
+                401 Unauthorized
+                (access token is not valid)
+                {"success": False,
+                 "reason": "no_logged_in_user"}
+
         GET /planner/get_scorm_zip
             request plan in scorm format compressed as zip
 
@@ -320,6 +324,21 @@ class VEPlanHandler(BaseHandler):
                 self.get_all_plans(db)
                 return
 
+            elif slug == "get_lock_holders":
+                try:
+                    plan_ids = self.get_argument("plan_ids")
+                except tornado.web.MissingArgumentError:
+                    self.set_status(400)
+                    self.write(
+                        {"success": False, "reason": MISSING_KEY_SLUG + "plan_ids"}
+                    )
+                    return
+
+                self.get_lock_holders_of_plans(
+                    db, [plan_id for plan_id in plan_ids.split(",") if plan_id]
+                )
+                return
+
             elif slug == "get_scorm_zip":
                 try:
                     _id = self.get_argument("_id")
@@ -990,92 +1009,6 @@ class VEPlanHandler(BaseHandler):
                     }
                 }
 
-        POST /planner/put_evaluation_file
-            Upload a file and store it under the given plan's `evaluation_file` attribute.
-            The file will be stored in the gridfs and the plan's `evaluation_file` attribute
-            will be set to the ObjectId of the uploaded file. Use this id to request the actual
-            file from gridfs using the static file endpoint (`GridFSStaticFileHandler`).
-
-            query params:
-                plan_id: the id of the plan to which the file should be attached
-
-            http body:
-                the file itself, as multipart/form-data
-
-            returns:
-                200 OK
-                (the file was successfully uploaded and attached to the plan)
-                {"success": True}
-
-                400 Bad Request
-                (the request misses the plan_id query parameter)
-                {"success": False,
-                 "reason": "missing_key:plan_id"}
-
-                401 Unauthorized
-                (access token is not valid)
-                {"success": False,
-                 "reason": "no_logged_in_user"}
-
-                403 Forbidden
-                (you don't have write access to the plan)
-                {"success": False,
-                 "reason": "insufficient_permission"}
-
-                409 Conflict
-                (No plan was found with the given plan_id)
-                {"success": False,
-                 "reason": "plan_doesnt_exist"}
-
-        POST /planner/put_literature_file
-            Upload a file and store it in the given plan's `literature_files` attribute.
-            The file will be stored in the gridfs and the plan's `literature_files` attribute
-            will contain the ObjectId of the uploaded file. Use this id to request the actual
-            file from gridfs using the static file endpoint (`GridFSStaticFileHandler`).
-
-            Each plan is allowed to have up to 5 literature files attached to it.
-
-            query params:
-                plan_id: the id of the plan to which the file should be attached
-
-            http body:
-                the file itself, as multipart/form-data
-
-            returns:
-                200 OK
-                (the file was successfully uploaded and attached to the plan)
-                {"success": True}
-
-                400 Bad Request
-                (the request misses the plan_id query parameter)
-                {"success": False,
-                 "reason": "missing_key:plan_id"}
-
-                401 Unauthorized
-                (access token is not valid)
-                {"success": False,
-                 "reason": "no_logged_in_user"}
-
-                403 Forbidden
-                (you don't have write access to the plan)
-                {"success": False,
-                 "reason": "insufficient_permission"}
-
-                409 Conflict
-                (No plan was found with the given plan_id)
-                {"success": False,
-                 "reason": "plan_doesnt_exist"}
-
-                409 Conflict
-                (The plan already has 5 literature files attached)
-                {"success": False,
-                 "reason": "maximum_files_exceeded"}
-
-                409 Conflict
-                (then plan is locked, i.e. another user is currently editing it)
-                {"success": False,
-                 "reason": "plan_locked"}
-
         POST /planner/grant_access
             As the author of a plan, grant another user read and/or write access to
             this plan.
@@ -1203,14 +1136,14 @@ class VEPlanHandler(BaseHandler):
                  "reason": "plan_doesnt_exist"}
         """
 
-        # all endpoints except file uploads require a json body
-        if slug not in ["put_evaluation_file", "put_literature_file"]:
-            try:
-                http_body = json.loads(self.request.body)
-            except json.JSONDecodeError:
-                self.set_status(400)
-                self.write({"success": False, "reason": "json_parsing_error"})
-                return
+        # all endpoints require a json body, file uploads are
+        # handled by the VEPlanFileUploadHandler
+        try:
+            http_body = json.loads(self.request.body)
+        except json.JSONDecodeError:
+            self.set_status(400)
+            self.write({"success": False, "reason": "json_parsing_error"})
+            return
 
         # check that upsert query param is either "true" or "false"
         upsert = self.get_argument("upsert", "false")
@@ -1374,64 +1307,6 @@ class VEPlanHandler(BaseHandler):
 
                 self.append_step_to_plan(db, http_body["plan_id"], step)
 
-            elif slug == "put_evaluation_file":
-                try:
-                    plan_id = self.get_argument("plan_id")
-                except tornado.web.MissingArgumentError:
-                    self.set_status(400)
-                    self.write(
-                        {
-                            "success": False,
-                            "reason": MISSING_KEY_SLUG + "plan_id",
-                        }
-                    )
-                    return
-                if (
-                        "file" not in self.request.files
-                        or not self.request.files["file"][0]
-                ):
-                    self.set_status(400)
-                    self.write({"success": False, "reason": "missing_file:file"})
-                    return
-
-                file_obj = self.request.files["file"][0]
-                self.put_evaluation_file(
-                    plan_id,
-                    file_obj["filename"],
-                    file_obj["body"],
-                    file_obj["content_type"],
-                )
-                return
-
-            elif slug == "put_literature_file":
-                try:
-                    plan_id = self.get_argument("plan_id")
-                except tornado.web.MissingArgumentError:
-                    self.set_status(400)
-                    self.write(
-                        {
-                            "success": False,
-                            "reason": MISSING_KEY_SLUG + "plan_id",
-                        }
-                    )
-                    return
-                if (
-                        "file" not in self.request.files
-                        or not self.request.files["file"][0]
-                ):
-                    self.set_status(400)
-                    self.write({"success": False, "reason": "missing_file:file"})
-                    return
-
-                file_obj = self.request.files["file"][0]
-                self.put_literature_file(
-                    plan_id,
-                    file_obj["filename"],
-                    file_obj["body"],
-                    file_obj["content_type"],
-                )
-                return
-
             elif slug == "grant_access":
                 if "plan_id" not in http_body:
                     self.set_status(400)
@@ -2039,6 +1914,36 @@ class VEPlanHandler(BaseHandler):
 
         self.serialize_and_write({"success": True, "plans": plans})
 
+    def get_lock_holders_of_plans(self, db: Database, plan_ids: List[str]) -> None:
+        """
+        This function is invoked by the handler when the correspoding endpoint
+        is requested. It just de-crowds the handler function and should therefore
+        not be called manually anywhere else.
+
+        Request the holders of the write locks of those of the plans that the
+        current user has read access to, with one query for the access check
+        and one for the locks.
+
+        Responses:
+            200 OK --> contains the lock holder (or None) per readable plan
+        """
+
+        planner = VEPlanResource(db)
+        readable_plan_ids = planner.get_readable_plan_ids(
+            plan_ids, self.current_user.username
+        )
+        lock_holders = PlanLocks(db).get_lock_holders(readable_plan_ids)
+
+        self.serialize_and_write(
+            {
+                "success": True,
+                "lock_holders": {
+                    str(plan_id): lock_holders.get(plan_id)
+                    for plan_id in readable_plan_ids
+                },
+            }
+        )
+
     def add_profile_information_to_author(self, plans: List[VEPlan]) -> List[VEPlan]:
         """
         helper function to enhace the authors (which are only usernames) of the given
@@ -2048,28 +1953,11 @@ class VEPlanHandler(BaseHandler):
         Returns the plans with the enhanced author information.
         """
 
-        with util.get_mongodb() as db:
-            profile_manager = Profiles(db)
+        self.loaders.profiles.want(plan["author"] for plan in plans)
+        self.loaders.load()
 
-            # collect all usernames that we have to request the profile information for, avoiding duplicates
-            usernames_to_request = []
-            for plan in plans:
-                if plan["author"] not in usernames_to_request:
-                    usernames_to_request.append(plan["author"])
-
-            profile_snippets = profile_manager.get_profile_snippets(
-                usernames_to_request
-            )
-
-            for plan in plans:
-                plan["author"] = next(
-                    (
-                        profile
-                        for profile in profile_snippets
-                        if profile["username"] == plan["author"]
-                    ),
-                    [None],
-                )
+        for plan in plans:
+            plan["author"] = self.loaders.profiles.get(plan["author"], [None])
 
         return plans
 
@@ -2524,143 +2412,6 @@ class VEPlanHandler(BaseHandler):
 
             self.serialize_and_write({"success": True, "updated_id": _id})
 
-    def put_evaluation_file(
-            self,
-            plan_id: str | ObjectId,
-            file_name: str,
-            file_content: bytes,
-            content_type: str,
-    ) -> None:
-        """
-        add a new file to the plan, resembling the evaluation.
-        each plan has an own attribute `evaluation_file`, where the _id of the corresponding
-        file will be stored.
-        using this _id of the file that was just stored, you can retrieve the actual content
-        of the file using the `StaticFileHandler` on the uploads-endpoint using
-        /uploads/<file_id>
-        :param space_id: the _id of the space where to upload the new file
-        :param file_name: the name of the new file
-        :param file_content: the body of the file as raw bytes
-        """
-
-        plan_id = util.parse_object_id(plan_id)
-
-        with util.get_mongodb() as db:
-            planner = VEPlanResource(db)
-            try:
-                if not planner._check_plan_exists(plan_id):
-                    raise PlanDoesntExistError
-
-                # if another holds a write lock on the plan, deny the update
-                if not self._check_lock_is_held(plan_id):
-                    self.set_status(403)
-                    self.write(
-                        {
-                            "success": False,
-                            "reason": PLAN_LOCKED,
-                            "lock_holder": self._get_lock_holder(plan_id),
-                        }
-                    )
-                    return
-
-                file_id = planner.put_evaluation_file(
-                    plan_id,
-                    file_name,
-                    file_content,
-                    content_type,
-                    self.current_user.username,
-                )
-
-                # after a successful update, extend the lock expiry
-                self._extend_lock(plan_id)
-            except PlanDoesntExistError:
-                self.set_status(409)
-                self.write({"success": False, "reason": PLAN_DOESNT_EXIST})
-                return
-            except NoWriteAccessError:
-                self.set_status(403)
-                self.write({"success": False, "reason": INSUFFICIENT_PERMISSIONS})
-                return
-
-            # count towards the achievement "ve_plans" since update was successfull
-            profile_manager = Profiles(db)
-            profile_manager.achievement_count_up(self.current_user.username, "ve_plans")
-
-        self.set_status(200)
-        self.serialize_and_write({"success": True, "inserted_file_id": file_id})
-
-    def put_literature_file(
-            self,
-            plan_id: str | ObjectId,
-            file_name: str,
-            file_content: bytes,
-            content_type: str,
-    ) -> None:
-        """
-        add a new literature file to the plan.
-        each plan has an own attribute `literature_files`, where the _id of the corresponding
-        file will be stored (up to a maximum of 5 files).
-        using this _id of the file that was just stored, you can retrieve the actual content
-        of the file using the `StaticFileHandler` on the uploads-endpoint using
-        /uploads/<file_id>
-        :param space_id: the _id of the space where to upload the new file
-        :param file_name: the name of the new file
-        :param file_content: the body of the file as raw bytes
-        """
-
-        plan_id = util.parse_object_id(plan_id)
-
-        with util.get_mongodb() as db:
-            planner = VEPlanResource(db)
-            try:
-                if not planner._check_plan_exists(plan_id):
-                    raise PlanDoesntExistError
-
-                if not planner._check_below_max_literature_files(plan_id):
-                    raise MaximumFilesExceededError
-
-                # if another holds a write lock on the plan, deny the update
-                if not self._check_lock_is_held(plan_id):
-                    self.set_status(403)
-                    self.write(
-                        {
-                            "success": False,
-                            "reason": PLAN_LOCKED,
-                            "lock_holder": self._get_lock_holder(plan_id),
-                        }
-                    )
-                    return
-
-                file_id = planner.put_literature_file(
-                    plan_id,
-                    file_name,
-                    file_content,
-                    content_type,
-                    self.current_user.username,
-                )
-
-                # after a successful update, extend the lock expiry
-                self._extend_lock(plan_id)
-            except PlanDoesntExistError:
-                self.set_status(409)
-                self.write({"success": False, "reason": PLAN_DOESNT_EXIST})
-                return
-            except NoWriteAccessError:
-                self.set_status(403)
-                self.write({"success": False, "reason": INSUFFICIENT_PERMISSIONS})
-                return
-            except MaximumFilesExceededError:
-                self.set_status(409)
-                self.write({"success": False, "reason": MAXIMUM_FILES_EXCEEDED})
-                return
-
-            # count towards the achievement "ve_plans" since update was successfull
-            profile_manager = Profiles(db)
-            profile_manager.achievement_count_up(self.current_user.username, "ve_plans")
-
-        self.set_status(200)
-        self.serialize_and_write({"success": True, "inserted_file_id": file_id})
-
     async def grant_acces_right(
             self,
             db: Database,
@@ -3216,3 +2967,223 @@ class VEPlanHandler(BaseHandler):
             if os.path.isfile(source_file):
                 with open(source_file, "rb") as f:
                     zf.writestr(filename, f.read())
+
+
+class VEPlanFileUploadHandler(StreamingUploadHandler, VEPlanHandler):
+    """
+    The files are streamed into gridfs while they are uploaded,
+    see `StreamingUploadHandler`.
+
+    POST /planner/put_evaluation_file
+        Upload a file and store it under the given plan's `evaluation_file` attribute.
+        The file will be stored in the gridfs and the plan's `evaluation_file` attribute
+        will be set to the ObjectId of the uploaded file. Use this id to request the actual
+        file from gridfs using the static file endpoint (`GridFSStaticFileHandler`).
+
+        query params:
+            plan_id: the id of the plan to which the file should be attached
+
+        http body:
+            the file itself, as multipart/form-data in the field "file"
+
+        returns:
+            200 OK
+            (the file was successfully uploaded and attached to the plan)
+            {"success": True}
+
+            400 Bad Request
+            (the request misses the plan_id query parameter)
+            {"success": False,
+             "reason": "missing_key:plan_id"}
+
+            400 Bad Request
+            (the request misses the file)
+            {"success": False,
+             "reason": "missing_file:file"}
+
+            401 Unauthorized
+            (access token is not valid)
+            {"success": False,
+             "reason": "no_logged_in_user"}
+
+            403 Forbidden
+            (you don't have write access to the plan)
+            {"success": False,
+             "reason": "insufficient_permission"}
+
+            403 Forbidden
+            (the plan is locked, i.e. another user is currently editing it)
+            {"success": False,
+             "reason": "plan_locked",
+             "lock_holder": "<username>"}
+
+            409 Conflict
+            (No plan was found with the given plan_id)
+            {"success": False,
+             "reason": "plan_doesnt_exist"}
+
+            413 Payload Too Large
+            (the file is larger than the maximum size of uploads)
+            {"success": False,
+             "reason": "file_too_large"}
+
+    POST /planner/put_literature_file
+        Upload a file and store it in the given plan's `literature_files` attribute.
+        The file will be stored in the gridfs and the plan's `literature_files` attribute
+        will contain the ObjectId of the uploaded file. Use this id to request the actual
+        file from gridfs using the static file endpoint (`GridFSStaticFileHandler`).
+
+        Each plan is allowed to have up to 5 literature files attached to it.
+
+        query params:
+            plan_id: the id of the plan to which the file should be attached
+
+        http body:
+            the file itself, as multipart/form-data in the field "file"
+
+        returns:
+            200 OK
+            (the file was successfully uploaded and attached to the plan)
+            {"success": True}
+
+            400 Bad Request
+            (the request misses the plan_id query parameter)
+            {"success": False,
+             "reason": "missing_key:plan_id"}
+
+            400 Bad Request
+            (the request misses the file)
+            {"success": False,
+             "reason": "missing_file:file"}
+
+            401 Unauthorized
+            (access token is not valid)
+            {"success": False,
+             "reason": "no_logged_in_user"}
+
+            403 Forbidden
+            (you don't have write access to the plan)
+            {"success": False,
+             "reason": "insufficient_permission"}
+
+            409 Conflict
+            (No plan was found with the given plan_id)
+            {"success": False,
+             "reason": "plan_doesnt_exist"}
+
+            409 Conflict
+            (The plan already has 5 literature files attached)
+            {"success": False,
+             "reason": "maximum_files_exceeded"}
+
+            403 Forbidden
+            (the plan is locked, i.e. another user is currently editing it)
+            {"success": False,
+             "reason": "plan_locked",
+             "lock_holder": "<username>"}
+
+            413 Payload Too Large
+            (the file is larger than the maximum size of uploads)
+            {"success": False,
+             "reason": "file_too_large"}
+    """
+
+    def authorize_upload(self, slug: str) -> bool:
+        """
+        reject the upload if the plan doesn't exist, is locked by another user
+        or the current user has no write access to it. Literature files are also
+        rejected if the plan already has the maximum number of them.
+        """
+
+        try:
+            self.plan_id = util.parse_object_id(self.get_argument("plan_id"))
+        except tornado.web.MissingArgumentError:
+            self.set_status(400)
+            self.write({"success": False, "reason": MISSING_KEY_SLUG + "plan_id"})
+            return False
+
+        with util.get_mongodb() as db:
+            planner = VEPlanResource(db)
+
+            if not planner._check_plan_exists(self.plan_id):
+                self.set_status(409)
+                self.write({"success": False, "reason": PLAN_DOESNT_EXIST})
+                return False
+
+            if slug == "put_literature_file":
+                if not planner._check_below_max_literature_files(self.plan_id):
+                    self.set_status(409)
+                    self.write({"success": False, "reason": MAXIMUM_FILES_EXCEEDED})
+                    return False
+
+            # if another holds a write lock on the plan, deny the update
+            if not self._check_lock_is_held(self.plan_id):
+                self.set_status(403)
+                self.write(
+                    {
+                        "success": False,
+                        "reason": PLAN_LOCKED,
+                        "lock_holder": self._get_lock_holder(self.plan_id),
+                    }
+                )
+                return False
+
+            if not planner._check_write_access(
+                self.plan_id, self.current_user.username
+            ):
+                self.set_status(403)
+                self.write({"success": False, "reason": INSUFFICIENT_PERMISSIONS})
+                return False
+
+        return True
+
+    def upload_received(
+        self, files: Dict[str, List[GridFSFileWriter]], slug: str
+    ) -> bool:
+        """
+        attach the uploaded file to the plan, as its evaluation file or one
+        of its literature files
+        """
+
+        file = files["file"][0]
+
+        with util.get_mongodb() as db:
+            planner = VEPlanResource(db)
+            attach = (
+                planner.attach_evaluation_file
+                if slug == "put_evaluation_file"
+                else planner.attach_literature_file
+            )
+
+            # the checks are repeated, because the plan might have changed
+            # while the file was uploaded
+            try:
+                attach(
+                    self.plan_id,
+                    file._id,
+                    file.filename,
+                    self.current_user.username,
+                )
+            except PlanDoesntExistError:
+                self.set_status(409)
+                self.write({"success": False, "reason": PLAN_DOESNT_EXIST})
+                return False
+            except NoWriteAccessError:
+                self.set_status(403)
+                self.write({"success": False, "reason": INSUFFICIENT_PERMISSIONS})
+                return False
+            except MaximumFilesExceededError:
+                self.set_status(409)
+                self.write({"success": False, "reason": MAXIMUM_FILES_EXCEEDED})
+                return False
+
+            # after a successful update, extend the lock expiry
+            self._extend_lock(self.plan_id)
+
+            # count towards the achievement "ve_plans" since update was successfull
+            profile_manager = Profiles(db)
+            profile_manager.achievement_count_up(self.current_user.username, "ve_plans")
+
+        self.set_status(200)
+        self.serialize_and_write({"success": True, "inserted_file_id": file._id})
+        return True
@@ -1,7 +1,8 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Set
 
+from keycloak.exceptions import KeycloakError
 from tornado.options import options
 
 import global_vars
@@ -13,8 +14,11 @@ from error_reasons import (
     UNAUTHENTICATED,
 )
 from exceptions import MessageDoesntExistError, RoomDoesntExistError, UserNotMemberError
-from resources.network.chat import Chat
-from resources.notifications import NotificationResource
+from resources.network.chat import AsyncChat, Chat
+from resources.notifications import AsyncNotificationResource, NotificationResource
+from resources.planner.plan_lock import PlanLocks
+from resources.shared_state import get_state_backend
+from resources.user_directory import sync_user_from_token
 import util
 
 logger = logging.getLogger(__name__)
@@ -28,15 +32,21 @@ logger = logging.getLogger(__name__)
 
 async def emit_event(event_name: str, payload: Dict, room: str | List[str] | None):
     """
-    Wrapper around `socketio.AsyncServer.emit()` that json
-    serializes the dict payload.
+    Wrapper around `socketio.AsyncServer.emit()`. The dict payload is
+    json serialized by the server itself, which is set up to encode ObjectIds
+    and datetimes by `util.SocketIOJSON`, so it is neither copied nor mutated.
     """
 
-    await global_vars.socket_io.emit(
-        event_name,
-        util.json_serialize_response(payload.copy()),
-        room=room,
-    )
+    await global_vars.socket_io.emit(event_name, payload, room=room)
+
+
+def user_room(username: str) -> str:
+    """
+    Returns the name of the socket.io room that all authenticated sessions of
+    the user (tabs, devices) are in, to reach all of them with a single emit.
+    """
+
+    return "user:" + username
 
 
 @global_vars.socket_io.event
@@ -67,7 +77,8 @@ async def disconnect(sid):
     Close a socket connection and invalidate the corresponding user session
     (if there was one initiated by an `authenticate` event).
 
-    This can be interpreted as a user "going offline" if desired.
+    Once the last session of a user is closed, the user "goes offline" and any
+    write locks on plans held by the user are released.
 
     Payload:
         None
@@ -80,16 +91,18 @@ async def disconnect(sid):
 
     session = await global_vars.socket_io.get_session(sid)
 
-    try:
-        # delete the mapping username <--> socket id and remove any existing
-        # write locks on plans
-        del global_vars.username_sid_map[session["preferred_username"]]
-        for plan_id, lock_obj in global_vars.plan_write_lock_map.copy().items():
-            if lock_obj["username"] == session["preferred_username"]:
-                del global_vars.plan_write_lock_map[plan_id]
-    except KeyError:
-        # not finding the mapping is obviously a success as well
-        pass
+    # delete the session of the user and, if it was the last one, remove any
+    # existing write locks on plans (not finding them is obviously a success as well).
+    # socket.io removes the sid from its rooms by itself
+    if "preferred_username" in session:
+        remaining_sessions = await util.run_in_mongodb_executor(
+            get_state_backend().remove_user_session, session["preferred_username"], sid
+        )
+        if remaining_sessions == 0:
+            with util.get_mongodb() as db:
+                await util.run_in_mongodb_executor(
+                    PlanLocks(db).release_all_of_user, session["preferred_username"]
+                )
 
 
 @global_vars.socket_io.event
@@ -162,25 +175,43 @@ async def authenticate(sid, data):
         }
     else:
         try:
-            token_info = util.validate_keycloak_jwt(data["token"])
+            token_info = await util.validate_keycloak_jwt(data["token"])
+        except KeycloakError as e:
+            logger.error(e)
+            return {
+                "status": 401,
+                "success": False,
+                "reason": "keycloak_public_key_not_retrieveable",
+            }
         except Exception as e:
             logger.error(e)
             return {"status": 401, "success": False, "reason": "jwt_invalid"}
 
+        try:
+            await util.run_in_mongodb_executor(sync_user_from_token, token_info)
+        except Exception as e:
+            logger.warning("Could not update the user directory: {}".format(e))
+
     # save the session
     await global_vars.socket_io.save_session(sid, token_info)
 
-    # globally map the username towards the socket id to be able to send messages
-    # from outside the handlers to specific clients
-    global_vars.username_sid_map[token_info["preferred_username"]] = sid
+    # put the session into the room of the user to be able to send messages
+    # from outside the handlers to all sessions of specific users and count it
+    # towards the presence of the user
+    await global_vars.socket_io.enter_room(
+        sid, user_room(token_info["preferred_username"])
+    )
+    await util.run_in_mongodb_executor(
+        get_state_backend().add_user_session, token_info["preferred_username"], sid
+    )
 
     # get notifications that appeared while user was offline or were maybe send,
     # but not acknowledged;
     # dispatch them all to the user and set their state to "sent"
     with util.get_mongodb() as db:
-        notification_manager = NotificationResource(db)
+        notification_manager = AsyncNotificationResource(db)
         new_notifications = (
-            notification_manager.get_unacknowledged_notifications_for_user(
+            await notification_manager.get_unacknowledged_notifications_for_user(
                 token_info["preferred_username"]
             )
         )
@@ -197,13 +228,13 @@ async def authenticate(sid, data):
             # set the notifactions from "pending" to "sent" to signify that
             # they have been atleast tried to be delivered to the client
             # and are awaiting acknowledgement
-            notification_manager.bulk_set_send_state(new_notification_ids)
+            await notification_manager.bulk_set_send_state(new_notification_ids)
 
         # emit messages that appeared while this user was offline, i.e. all
         # messages that dont have send state "acknowledged" for the user and
         # set their send states to "sent"
-        chat_manager = Chat(db)
-        rooms = chat_manager.get_rooms_with_unacknowledged_messages_for_user(
+        chat_manager = AsyncChat(db)
+        rooms = await chat_manager.get_rooms_with_unacknowledged_messages_for_user(
             token_info["preferred_username"]
         )
 
@@ -231,7 +262,7 @@ async def authenticate(sid, data):
         # set the message from "pending" to "sent" to signify that
         # they have been atleast tried to be delivered to the client
         # and are awaiting acknowledgement
-        chat_manager.bulk_set_message_sent_state(
+        await chat_manager.bulk_set_message_sent_state(
             room_ids, message_ids, token_info["preferred_username"]
         )
 
@@ -344,7 +375,7 @@ async def message(sid, data):
         return {"status": 401, "success": False, "reason": UNAUTHENTICATED}
 
     with util.get_mongodb() as db:
-        chat_manager = Chat(db)
+        chat_manager = AsyncChat(db)
         try:
             await chat_manager.send_message(
                 data["room_id"], data["message"], token["preferred_username"]
@@ -472,12 +503,14 @@ async def try_acquire_or_extend_plan_write_lock(sid, data):
 
     plan_id = util.parse_object_id(data["plan_id"])
 
-    LOCK_EXPIRY_HOURS = 1
-
     with util.get_mongodb() as db:
         # check if the plan exists and the user theoretically has write access
-        # in the first place
-        plan = db.plans.find_one({"_id": plan_id})
+        # in the first place, only loading the fields needed for that
+        plan = await util.run_in_mongodb_executor(
+            db.plans.find_one,
+            {"_id": plan_id},
+            projection={"author": True, "write_access": True},
+        )
         if not plan:
             return {"status": 409, "success": False, "reason": PLAN_DOESNT_EXIST}
         if not (
@@ -486,40 +519,22 @@ async def try_acquire_or_extend_plan_write_lock(sid, data):
         ):
             return {"status": 403, "success": False, "reason": INSUFFICIENT_PERMISSIONS}
 
-    # no other user currently holds the lock --> assign it to the current user
-    # lock expiry is set to 1 hour
-    if plan_id not in global_vars.plan_write_lock_map:
-        global_vars.plan_write_lock_map[plan_id] = {
-            "username": token["preferred_username"],
-            "expires": datetime.now() + timedelta(hours=LOCK_EXPIRY_HOURS),
-        }
+        # assign the lock to the current user if no other user currently holds it
+        # (or it is expired), or extend it if the current user already holds it.
+        # lock expiry is set to 1 hour
+        lock_holder = await util.run_in_mongodb_executor(
+            PlanLocks(db).try_acquire_or_extend, plan_id, token["preferred_username"]
+        )
+    if lock_holder is None:
         return {"status": 200, "success": True}
 
-    else:
-        # the lock is expired --> assign it to the current user
-        if global_vars.plan_write_lock_map[plan_id]["expires"] < datetime.now():
-            global_vars.plan_write_lock_map[plan_id] = {
-                "username": token["preferred_username"],
-                "expires": datetime.now() + timedelta(hours=LOCK_EXPIRY_HOURS),
-            }
-            return {"status": 200, "success": True}
-        # the lock is not expired, but the current user holds it --> extend the lock
-        elif (
-            global_vars.plan_write_lock_map[plan_id]["username"]
-            == token["preferred_username"]
-        ):
-            global_vars.plan_write_lock_map[plan_id][
-                "expires"
-            ] = datetime.now() + timedelta(hours=LOCK_EXPIRY_HOURS)
-            return {"status": 200, "success": True}
-        # the lock is not expired and is held by another user --> reject
-        else:
-            return {
-                "status": 403,
-                "success": False,
-                "reason": "plan_locked",
-                "lock_holder": global_vars.plan_write_lock_map[plan_id]["username"],
-            }
+    # the lock is not expired and is held by another user --> reject
+    return {
+        "status": 403,
+        "success": False,
+        "reason": "plan_locked",
+        "lock_holder": lock_holder,
+    }
 
 
 @global_vars.socket_io.event
@@ -563,21 +578,29 @@ async def drop_plan_lock(sid, data):
 
     plan_id = util.parse_object_id(data["plan_id"])
 
-    # reject if there is no active lock or if it is expired
-    if plan_id not in global_vars.plan_write_lock_map:
-        return {"status": 409, "success": False, "reason": "no_active_lock"}
-    if global_vars.plan_write_lock_map[plan_id]["expires"] < datetime.now():
-        return {"status": 409, "success": False, "reason": "lock_expired"}
+    with util.get_mongodb() as db:
+        plan_locks = PlanLocks(db)
 
-    # only the user who holds the lock can drop it
-    if (
-        global_vars.plan_write_lock_map[plan_id]["username"]
-        != token["preferred_username"]
-    ):
-        return {"status": 403, "success": False, "reason": INSUFFICIENT_PERMISSIONS}
+        # reject if there is no active lock or if it is expired
+        # (expired locks are removed shortly after by the db)
+        lock = await util.run_in_mongodb_executor(
+            plan_locks.get_lock, plan_id, include_expired=True
+        )
+        if lock is None:
+            return {"status": 409, "success": False, "reason": "no_active_lock"}
+        if lock["expires"] < datetime.now():
+            return {"status": 409, "success": False, "reason": "lock_expired"}
 
-    # drop the lock after all checks have passed
-    del global_vars.plan_write_lock_map[plan_id]
+        # only the user who holds the lock can drop it
+        if lock["username"] != token["preferred_username"]:
+            return {"status": 403, "success": False, "reason": INSUFFICIENT_PERMISSIONS}
+
+        # drop the lock after all checks have passed, unless it has expired
+        # in the meantime
+        if not await util.run_in_mongodb_executor(
+            plan_locks.release, plan_id, token["preferred_username"]
+        ):
+            return {"status": 409, "success": False, "reason": "lock_expired"}
 
     return {"status": 200, "success": True}
 
@@ -585,20 +608,20 @@ async def drop_plan_lock(sid, data):
 def recipient_online(recipient: str) -> bool:
     """
     Returns True, if the `recipient` username is currently
-    online, i.e. has an open and authenticated socketio connection,
+    online, i.e. has at least one open and authenticated socketio connection,
     or False otherwise.
+
+    This looks up the state backend, so async code has to call it
+    through `util.run_in_mongodb_executor()`.
     """
 
-    return recipient in global_vars.username_sid_map
+    return get_state_backend().count_user_sessions(recipient) > 0
 
 
-def get_sid_of_user(username: str) -> Optional[str]:
+def get_online_recipients(recipients: Iterable[str]) -> Set[str]:
     """
-    Returns the user's socketio sid if the user is currently online,
-    or None otherwise.
+    Returns those of the `recipients` usernames that are currently online
+    (see `recipient_online()`), with a single lookup for all of them.
     """
 
-    try:
-        return global_vars.username_sid_map[username]
-    except KeyError:
-        return None
+    return get_state_backend().get_online_users(recipients)
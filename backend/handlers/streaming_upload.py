@@ -0,0 +1,183 @@
+from abc import ABCMeta, abstractmethod
+from typing import Dict, List, Optional
+
+import tornado.ioloop
+import tornado.web
+
+from error_reasons import FILE_TOO_LARGE, MALFORMED_UPLOAD
+from exceptions import MalformedUploadError, UploadTooLargeError
+import global_vars
+from handlers.base_handler import BaseHandler
+from resources.streaming_upload import GridFSFileWriter, GridFSMultipartUpload
+import util
+
+# room for the boundaries, part headers and small form fields of an upload
+# on top of the file itself
+MULTIPART_OVERHEAD = 1024 * 1024
+
+
+@tornado.web.stream_request_body
+class StreamingUploadHandler(BaseHandler, metaclass=ABCMeta):
+    """
+    base class of the handlers that receive file uploads as multipart/form-data.
+
+    Instead of buffering the whole request body (and then the parsed files once
+    again) in memory, the body is parsed as it arrives and the files are written
+    straight into GridFS (see `resources.streaming_upload.GridFSMultipartUpload`).
+    The next chunk of the body is only read from the connection once the previous
+    one has been handed to GridFS, so a slow database throttles the clients instead
+    of filling the memory.
+
+    The authorization of the upload is checked by `authorize_upload()` before the
+    body is read, so rejected uploads are not transferred (and stored) in the first
+    place. Files larger than `max_file_size` are rejected with 413 as soon as they
+    exceed it. Once the body is complete, `upload_received()` associates the stored
+    files with whatever they were uploaded to. If it fails, the files are removed
+    again, the same happens if the client disconnects during the upload.
+
+    Subclasses have to implement both `authorize_upload()` and `upload_received()`,
+    otherwise they can't be instantiated (before anything of the body is read).
+    """
+
+    # form fields of which the files are stored, files in other fields are skipped
+    file_fields = ("file",)
+
+    # the upload of the current request, if the body is multipart/form-data
+    upload: Optional[GridFSMultipartUpload] = None
+    _upload_complete = False
+
+    def options(self, *args):
+        # no body
+        self.set_status(200)
+        self.finish()
+
+    @property
+    def max_file_size(self) -> int:
+        return global_vars.max_upload_size
+
+    @abstractmethod
+    def authorize_upload(self, *args) -> bool:
+        """
+        check that the current user is allowed to upload, before the body is read.
+        The path arguments of the route are passed on.
+
+        Returns True to accept the upload, otherwise the error has to be written.
+        """
+
+    @abstractmethod
+    def upload_received(self, files: Dict[str, List[GridFSFileWriter]], *args) -> bool:
+        """
+        associate the stored `files` (by form field, only `file_fields` that have
+        been uploaded) with what they were uploaded to, and write the response.
+        The path arguments of the route are passed on.
+
+        Returns True if the files are in use, otherwise the error has to be written
+        and the files are removed.
+        """
+
+    def upload_metadata(self) -> Dict:
+        """
+        the metadata of the stored files
+        """
+
+        return {"uploader": self.current_user.username}
+
+    async def prepare(self):
+        await super().prepare()
+
+        if self.request.method != "POST":
+            return
+
+        if not self.current_user:
+            self.set_status(401)
+            self.write({"status": 401, "reason": "no_logged_in_user"})
+            self.finish()
+            return
+
+        if not self.authorize_upload(*self.path_args):
+            self.finish()
+            return
+
+        max_body_size = self.max_file_size + MULTIPART_OVERHEAD
+        if int(self.request.headers.get("Content-Length", 0)) > max_body_size:
+            self._reject_upload(413, FILE_TOO_LARGE)
+            return
+        self.request.connection.set_max_body_size(max_body_size)
+
+        # bodies that are no multipart/form-data can't contain files,
+        # they are reported as missing files after they are read
+        content_type = self.request.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            return
+        for field in content_type.split(";"):
+            key, _, value = field.strip().partition("=")
+            if key == "boundary" and value:
+                with util.get_mongodb() as db:
+                    self.upload = GridFSMultipartUpload(
+                        db,
+                        value.encode(),
+                        self.file_fields,
+                        self.max_file_size,
+                        self.upload_metadata(),
+                    )
+                break
+
+    async def data_received(self, chunk: bytes) -> None:
+        # the rest of the body of a rejected upload is skipped
+        if self.upload is None or self._finished:
+            return
+
+        try:
+            await util.run_in_mongodb_executor(self.upload.feed, chunk)
+        except UploadTooLargeError:
+            await self._abort_upload()
+            self._reject_upload(413, FILE_TOO_LARGE)
+        except MalformedUploadError:
+            await self._abort_upload()
+            self._reject_upload(400, MALFORMED_UPLOAD)
+
+    async def post(self, *args):
+        # already rejected while the body was received
+        if self._finished:
+            return
+        self._upload_complete = True
+
+        if self.upload is not None:
+            try:
+                await util.run_in_mongodb_executor(self.upload.close)
+            except MalformedUploadError:
+                await self._abort_upload()
+                self._reject_upload(400, MALFORMED_UPLOAD)
+                return
+
+        files = self.upload.files if self.upload is not None else {}
+        for field in self.file_fields:
+            if field not in files:
+                await self._abort_upload()
+                self.set_status(400)
+                self.write({"success": False, "reason": "missing_file:" + field})
+                return
+
+        try:
+            if self.upload_received(files, *args):
+                return
+        except Exception:
+            await self._abort_upload()
+            raise
+        await self._abort_upload()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+
+        # the client has gone away during the upload, remove what has been stored
+        if self.upload is not None and not self._upload_complete:
+            tornado.ioloop.IOLoop.current().add_callback(self._abort_upload)
+
+    async def _abort_upload(self) -> None:
+        if self.upload is not None:
+            await util.run_in_mongodb_executor(self.upload.abort)
+
+    def _reject_upload(self, status: int, reason: str) -> None:
+        self.set_status(status)
+        self.write({"success": False, "reason": reason})
+        self.finish()
@@ -5,6 +5,7 @@ import os
 
 from apscheduler.schedulers.tornado import TornadoScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import bson.json_util
 from dotenv import load_dotenv
 import gridfs
@@ -17,13 +18,18 @@ import tornado.httpserver
 import tornado.ioloop
 import tornado.locks
 import tornado.log
+import tornado.netutil
 from tornado.options import define, options, parse_command_line
+import tornado.process
 import tornado.web
 
 import global_vars
 from handlers.authentication import LoginHandler, LoginCallbackHandler, LogoutHandler
-from handlers.db_static_files import GridFSStaticFileHandler
-from handlers.healthcheck import HealthCheckHandler
+from handlers.db_static_files import (
+    GridFSStaticFileHandler,
+    SignedGridFSStaticFileHandler,
+)
+from handlers.healthcheck import HealthCheckHandler, MetricsHandler
 from handlers.import_personas import ImportDummyPersonasHandler
 from handlers.mail_invitation import EmailInvitationHandler
 from handlers.material_taxonomy import (
@@ -41,21 +47,30 @@ from handlers.network.permissions import (
 )
 from handlers.network.post import *
 from handlers.network.search import SearchHandler
-from handlers.network.space import SpaceHandler
+from handlers.network.space import SpaceFileUploadHandler, SpaceHandler
 from handlers.network.timeline import *
 from handlers.network.user import *
+from resources.elasticsearch_replication import start_replication
+from resources.mail_outbox import start_mail_queue
+from resources.shared_state import MongoStateBackend, refresh_state_backend
+from resources.socketio_pubsub import MongoPubSubManager
+from resources.indexes import reconcile_indexes
 from resources.network.acl import ACL, cleanup_unused_rules
+from resources.network.chat import Chat
+from resources.network.feed import Feeds
 from resources.network.profile import ProfileDoesntExistException, Profiles
 from resources.network.space import Spaces
 from handlers.planner.etherpad_integration import EtherpadIntegrationHandler
-from handlers.planner.ve_plan import VEPlanHandler
+from handlers.planner.ve_plan import VEPlanFileUploadHandler, VEPlanHandler
 from handlers.planner.ve_invite import VeInvitationHandler
 from handlers.report import ReportHandler
 from handlers.template_debug_handler import TemplateDebugHandler
 from resources.notifications import (
     new_message_mail_notification_dispatch,
     periodic_notification_dispatch,
+    resume_notification_dispatches,
 )
+from resources.user_directory import refresh_user_directory
 import util
 from concurrent.futures import ThreadPoolExecutor
 
@@ -80,9 +95,20 @@ load_dotenv()
 
 
 def make_app(cookie_secret: str, debug: bool = False):
-    # setup socketio server
+    # setup socketio server, with multiple processes the emits are relayed
+    # between them through mongodb
+    socket_io_kwargs = {}
+    if global_vars.state_backend == "mongodb":
+        socket_io_kwargs["client_manager"] = MongoPubSubManager()
+    if global_vars.processes != 1:
+        # long-polling would need sticky sessions, because the requests
+        # of a session could hit different processes
+        socket_io_kwargs["transports"] = ["websocket"]
     global_vars.socket_io = socketio.AsyncServer(
-        async_mode="tornado", cors_allowed_origins="*"
+        async_mode="tornado",
+        cors_allowed_origins="*",
+        json=util.SocketIOJSON,
+        **socket_io_kwargs,
     )
     # imports have to be done lazily here, because otherwise the socket_io server in global
     # vars would not be ready, causing the event handling to crash
@@ -102,6 +128,7 @@ def make_app(cookie_secret: str, debug: bool = False):
             (r"/login/callback", LoginCallbackHandler),
             (r"/logout", LogoutHandler),
             (r"/health", HealthCheckHandler),
+            (r"/metrics", MetricsHandler),
             (r"/posts", PostHandler),
             (r"/comment", CommentHandler),
             (r"/like", LikePostHandler),
@@ -109,6 +136,7 @@ def make_app(cookie_secret: str, debug: bool = False):
             (r"/pin", PinHandler),
             (r"/follow", FollowHandler),
             (r"/updates", NewPostsSinceTimestampHandler),
+            (r"/spaceadministration/put_file", SpaceFileUploadHandler),
             (r"/spaceadministration/(.+)", SpaceHandler),
             (r"/timeline", TimelineHandler),
             (r"/timeline/space/(.+)", SpaceTimelineHandler),
@@ -121,6 +149,10 @@ def make_app(cookie_secret: str, debug: bool = False):
             (r"/global_acl/(.+)", GlobalACLHandler),
             (r"/space_acl/(.+)", SpaceACLHandler),
             (r"/search", SearchHandler),
+            (
+                r"/planner/(put_evaluation_file|put_literature_file)",
+                VEPlanFileUploadHandler,
+            ),
             (r"/planner/(.+)", VEPlanHandler),
             (r"/orcid", OrcidProfileHandler),
             (r"/matching_exclusion_info", MatchingExclusionHandler),
@@ -144,6 +176,7 @@ def make_app(cookie_secret: str, debug: bool = False):
                 tornado.web.StaticFileHandler,
                 {"path": "./javascripts/"},
             ),
+            (r"/uploads/signed/(.*)", SignedGridFSStaticFileHandler, {"path": ""}),
             (r"/uploads/(.*)", GridFSStaticFileHandler, {"path": ""}),
             (r"/socket.io/", socketio.get_tornado_handler(global_vars.socket_io)),
             (
@@ -161,69 +194,87 @@ def make_app(cookie_secret: str, debug: bool = False):
 
 def init_indexes(force_rebuild: bool) -> None:
     """
-    build the indexes for posts and profiles (for searching)
-    and spaces, posts and profiles (for faster lookups).
-    the weights of the fields are left default (1).
-    indexes will be build if a) they don't exist or b) if rebuild is forced by setting force_rebuild to True)
+    reconcile the indexes in the db with those declared by the resource modules
+    (see `resources.indexes`): missing and changed indexes are built, redundant and
+    unused ones are reported in the log.
+    indexes will be build if a) they don't exist, b) their declaration has changed
+    or c) if rebuild is forced by setting force_rebuild to True)
 
-    :param force_rebuild: boolean switch to trigger a forced rebuild of the text indexes
+    :param force_rebuild: boolean switch to trigger a forced rebuild of all indexes
     """
 
     with util.get_mongodb() as db:
-        # full text search index on posts
-        if "posts" not in db.posts.index_information() or force_rebuild:
-            try:
-                db.posts.drop_index("posts")
-            except pymongo.errors.OperationFailure:
-                pass
-            db.posts.create_index(
-                [
-                    ("text", pymongo.TEXT),
-                    ("tags", pymongo.TEXT),
-                    ("files", pymongo.TEXT),
-                ],
-                name="posts",
-            )
-            logger.info(
-                "Built text index named {} on collection {}".format("posts", "posts")
-            )
+        report = reconcile_indexes(db, force_rebuild)
+
+    logger.info(
+        "Reconciled indexes: {} missing, {} rebuilt, {} failed, {} redundant, {} unused".format(
+            len(report["missing"]),
+            len(report["rebuilt"]),
+            len(report["failed"]),
+            len(report["redundant"]),
+            len(report["unused"]),
+        )
+    )
 
-        # ascending index on "creation_date" in posts
-        if "posts_creation_date" not in db.posts.index_information() or force_rebuild:
-            try:
-                db.posts.drop_index("posts_creation_date")
-            except pymongo.errors.OperationFailure:
-                pass
-            db.posts.create_index("creation_date", name="posts_creation_date")
-            logger.info(
-                "Built index named {} on collection {}".format(
-                    "posts_creation_date", "posts"
-                )
-            )
 
-        # ascending index on "username" field in profiles
-        if "profiles_username" not in db.profiles.index_information() or force_rebuild:
-            try:
-                db.profiles.drop_index("profiles_username")
-            except pymongo.errors.OperationFailure:
-                pass
-            db.profiles.create_index("username", name="profiles_username")
-            logger.info(
-                "Built index named {} on collection {}".format(
-                    "profiles_username", "profiles"
+def init_feeds(force_rebuild: bool, check_consistency: bool) -> None:
+    """
+    make sure the materialized personal timelines (see `Feeds`) exist:
+    they are backfilled if there are posts but no feeds yet (i.e. on the first
+    startup after their introduction), or rebuilt from scratch if forced.
+    Optionally check the consistency of the feeds and log the result.
+
+    :param force_rebuild: boolean switch to trigger a rebuild of all feeds
+    :param check_consistency: boolean switch to check the feeds against the posts
+    """
+
+    with util.get_mongodb() as db:
+        feed_manager = Feeds(db)
+
+        if force_rebuild:
+            feed_manager.rebuild_all()
+        else:
+            feed_manager.backfill_if_empty()
+
+        if check_consistency:
+            report = feed_manager.check_consistency()
+            if report["inconsistent_users"]:
+                logger.warning(
+                    "Feeds of {} of {} users are inconsistent ({} missing, {} stale entries): {}. Use --rebuild_feeds to repair them".format(
+                        len(report["inconsistent_users"]),
+                        report["checked_users"],
+                        report["missing_entries"],
+                        report["stale_entries"],
+                        ", ".join(report["inconsistent_users"]),
+                    )
                 )
-            )
+            else:
+                logger.info(
+                    "Feeds of all {} users are consistent".format(
+                        report["checked_users"]
+                    )
+                )
+
+
+def migrate_chat_messages() -> None:
+    """
+    move chat messages that are still embedded in their rooms into the
+    `messages` collection (see `Chat.migrate_embedded_messages()`) and build
+    the unread counters if there are none yet.
+    Does nothing if all rooms have already been migrated.
+    """
 
-        # ascending index on "name" field in spaces
-        if "space_name" not in db.spaces.index_information() or force_rebuild:
-            try:
-                db.spaces.drop_index("space_name")
-            except pymongo.errors.OperationFailure:
-                pass
-            db.spaces.create_index("name", name="space_name")
-            logger.info(
-                "Built index named {} on collection {}".format("space_name", "spaces")
+    with util.get_mongodb() as db:
+        chat_manager = Chat(db)
+        migrated_rooms = chat_manager.migrate_embedded_messages()
+        chat_manager.backfill_unread_counters_if_empty()
+
+    if migrated_rooms > 0:
+        logger.info(
+            "Migrated the messages of {} chatrooms into their own collection".format(
+                migrated_rooms
             )
+        )
 
 
 def create_initial_admin() -> None:
@@ -386,6 +437,25 @@ def set_global_vars() -> None:
     global_vars.mongodb_username = os.getenv("MONGODB_USERNAME")
     global_vars.mongodb_password = os.getenv("MONGODB_PASSWORD")
     global_vars.mongodb_db_name = os.getenv("MONGODB_DB_NAME", "ve_collab")
+    global_vars.mongodb_max_pool_size = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+    global_vars.mongodb_min_pool_size = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+    global_vars.mongodb_executor_workers = int(
+        os.getenv("MONGODB_EXECUTOR_WORKERS", "16")
+    )
+    global_vars.image_derivative_workers = int(
+        os.getenv("IMAGE_DERIVATIVE_WORKERS", "2")
+    )
+    global_vars.max_upload_size = (
+        int(os.getenv("MAX_UPLOAD_SIZE_MB", "100")) * 1024 * 1024
+    )
+    if os.getenv("MONGODB_MAX_IDLE_TIME_MS"):
+        global_vars.mongodb_max_idle_time_ms = int(
+            os.getenv("MONGODB_MAX_IDLE_TIME_MS")
+        )
+    if os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS"):
+        global_vars.mongodb_wait_queue_timeout_ms = int(
+            os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS")
+        )
     global_vars.etherpad_base_url = os.getenv("ETHERPAD_BASE_URL")
     global_vars.etherpad_api_key = os.getenv("ETHERPAD_API_KEY")
     global_vars.elasticsearch_base_url = os.getenv("ELASTICSEARCH_BASE_URL")
@@ -401,6 +471,8 @@ def set_global_vars() -> None:
     global_vars.smtp_port = int(os.getenv("SMTP_PORT", 587))
     global_vars.smtp_username = os.getenv("SMTP_USERNAME")
     global_vars.smtp_password = os.getenv("SMTP_PASSWORD")
+    global_vars.smtp_max_per_minute = int(os.getenv("SMTP_MAX_PER_MINUTE", 0))
+    global_vars.state_backend = os.getenv("STATE_BACKEND", "memory")
 
     global_vars.keycloak_base_url = os.getenv("KEYCLOAK_BASE_URL")
     global_vars.keycloak_realm = os.getenv("KEYCLOAK_REALM")
@@ -432,13 +504,7 @@ def init_default_pictures():
     assets folder into gridfs to be serveable by the GridFSFileHandler
     """
 
-    with pymongo.MongoClient(
-        global_vars.mongodb_host,
-        global_vars.mongodb_port,
-        username=global_vars.mongodb_username,
-        password=global_vars.mongodb_password,
-    ) as client:
-        db = client[global_vars.mongodb_db_name]
+    with util.get_mongodb() as db:
         fs = gridfs.GridFS(db)
 
         if not fs.exists("default_profile_pic.jpg"):
@@ -521,17 +587,33 @@ def schedule_periodic_tasks():
                     hour=execution_dates["hour"],
                     minute=execution_dates["minute"],
                 )
+                # the dispatch is a coroutine that runs on the IOLoop (to be able
+                # to emit socket events) and moves its database work to the
+                # mongodb executor itself
                 scheduler.add_job(
-                    run_in_executor,
+                    periodic_notification_dispatch,
                     trigger,
                     args=[
-                        periodic_notification_dispatch,
                         notification["type"],
                         notification["payload"],
                         notification["email_subject"],
                     ],
                 )
 
+    # resume the dispatches that were interrupted by a restart
+    scheduler.add_job(resume_notification_dispatches)
+
+    # refresh the user directory from keycloak nightly, and right away
+    # if it has never been filled
+    scheduler.add_job(
+        run_in_executor,
+        CronTrigger(hour=1, minute=30),
+        args=[refresh_user_directory],
+    )
+    with util.get_mongodb() as db:
+        if db.user_directory.count_documents({}, limit=1) == 0:
+            scheduler.add_job(run_in_executor, args=[refresh_user_directory])
+
     # new message mail notifications
     scheduler.add_job(
         run_in_executor,
@@ -539,6 +621,13 @@ def schedule_periodic_tasks():
         args=[new_message_mail_notification_dispatch],
     )
 
+    # cleanup of orphaned acl entries every hour, off the IOLoop
+    scheduler.add_job(
+        run_in_executor,
+        IntervalTrigger(hours=1),
+        args=[cleanup_unused_rules],
+    )
+
     scheduler.start()
 
 
@@ -548,8 +637,11 @@ def load_email_templates():
     store it in `global_vars.email_template_env`
     """
 
+    # the templates don't change at runtime, so they are compiled only once
     jinja_env = Environment(
-        loader=FileSystemLoader("assets/email_templates"), autoescape=True
+        loader=FileSystemLoader("assets/email_templates"),
+        autoescape=True,
+        auto_reload=False,
     )
     global_vars.email_template_env = jinja_env
 
@@ -567,6 +659,18 @@ def main():
         type=bool,
         help="force the application to (re)build the indexes for full text search and query optimization. Warning: this might take a long time depending on your database size",
     )
+    define(
+        "rebuild_feeds",
+        default=False,
+        type=bool,
+        help="force the application to rebuild the materialized personal timelines of all users from the posts. Warning: this might take a long time depending on your database size",
+    )
+    define(
+        "check_feeds",
+        default=False,
+        type=bool,
+        help="check the materialized personal timelines of all users for consistency with the posts on startup and log the result",
+    )
     define(
         "supress_stdout_access_log",
         default=False,
@@ -579,12 +683,33 @@ def main():
         type=bool,
         help="Load default taxonomy even if it already exists in DB",
     )
+    define(
+        "processes",
+        default=1,
+        type=int,
+        help="number of worker processes to fork, 0 means one per CPU core. More than one process requires STATE_BACKEND=mongodb and websocket-only socket.io clients",
+    )
 
     parse_command_line()
 
     # setup global vars from env
     set_global_vars()
 
+    global_vars.processes = options.processes
+    if global_vars.processes != 1:
+        if options.debug:
+            raise RuntimeError("debug mode (autoreload) requires a single process")
+        if global_vars.state_backend != "mongodb":
+            logger.warning(
+                "STATE_BACKEND={} can't be shared between processes, using mongodb".format(
+                    global_vars.state_backend
+                )
+            )
+            global_vars.state_backend = "mongodb"
+
+    # create the process-wide pooled mongodb client that is used by util.get_mongodb()
+    util.init_mongodb_client()
+
     # load email template env
     load_email_templates()
 
@@ -594,6 +719,12 @@ def main():
     # setup text indexes for searching
     init_indexes(options.build_indexes)
 
+    # move chat messages out of their rooms, if not already done
+    migrate_chat_messages()
+
+    # backfill, rebuild or check the materialized personal timelines
+    init_feeds(options.rebuild_feeds, options.check_feeds)
+
     # setup default group and profile pictures
     init_default_pictures()
 
@@ -606,19 +737,44 @@ def main():
     # write tornado access log to separate logfile
     hook_tornado_access_log()
 
-    # schedule periodic tasks (new message and reminder notifications)
-    schedule_periodic_tasks()
-
-    # periodically schedule acl entry cleanup
-    # cleanup happens every  3,600,000 ms = 1 hour
-    # TODO can also do this using APScheduler since we have to use it now anyways
-    tornado.ioloop.PeriodicCallback(cleanup_unused_rules, 3_600_000).start()
+    # bind the port once and fork the worker processes that share it,
+    # the startup work above has only been done by the parent. pymongo clients
+    # are not fork-safe, so every process creates its own
+    sockets = tornado.netutil.bind_sockets(global_vars.port)
+    task_id = None
+    if global_vars.processes != 1:
+        util.close_mongodb_client()
+        task_id = tornado.process.fork_processes(global_vars.processes)
+        util.init_mongodb_client()
+
+    # replicate changes to elasticsearch in the background
+    start_replication()
+
+    # send emails in the background over a reused smtp session
+    start_mail_queue()
+
+    # the scheduled jobs only run in one of the processes
+    if task_id in (None, 0):
+        # schedule periodic tasks (new message and reminder notifications,
+        # acl entry cleanup)
+        schedule_periodic_tasks()
+
+    # keep the socket.io presence of the users of this process alive
+    if global_vars.state_backend == "mongodb":
+        tornado.ioloop.PeriodicCallback(
+            refresh_state_backend,
+            MongoStateBackend.PRESENCE_REFRESH_INTERVAL * 1000,
+        ).start()
 
     # build and start server
     app = make_app(global_vars.cookie_secret, options.debug)
     server = tornado.httpserver.HTTPServer(app)
-    logger.info("Starting server on port: " + str(global_vars.port))
-    server.listen(global_vars.port)
+    logger.info(
+        "Starting server on port: {}{}".format(
+            global_vars.port, "" if task_id is None else " (process {})".format(task_id)
+        )
+    )
+    server.add_sockets(sockets)
 
     tornado.ioloop.IOLoop.current().start()
 
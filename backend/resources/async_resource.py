@@ -0,0 +1,65 @@
+import functools
+import inspect
+from typing import Any
+
+from pymongo.database import Database
+
+import util
+
+
+class AsyncResource:
+    """
+    Async variant of a (synchronous) resource class. Every public method of the
+    wrapped resource becomes awaitable and its pymongo calls are run in the
+    mongodb executor (see `util.run_in_mongodb_executor()`), so the IOLoop stays
+    responsive while the database works. Methods that are already coroutines are
+    handed out unchanged. Non-callable attributes are passed through as well.
+
+    The query logic itself lives only in the synchronous resource, which remains
+    the API to use outside of the IOLoop, e.g. in APScheduler jobs.
+
+    Subclasses only have to point `sync_resource_class` to the resource class,
+    to use them, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            post_manager = AsyncPosts(db)
+            posts = await post_manager.get_personal_timeline(username, time_to)
+            ...
+
+    """
+
+    sync_resource_class: type = None
+
+    def __init__(self, db: Database):
+        self.sync = self.sync_resource_class(db)
+
+    @classmethod
+    def wrap(cls, resource: Any) -> "AsyncResource":
+        """
+        build an async variant around an already existing resource instance,
+        e.g. the `global_acl` and `space_acl` of an `ACL` instance.
+        """
+
+        async_resource = cls.__new__(cls)
+        async_resource.sync = resource
+        return async_resource
+
+    def __getattr__(self, name: str) -> Any:
+        # avoid infinite recursion if `sync` has not been set (yet)
+        if name == "sync":
+            raise AttributeError(name)
+
+        attr = getattr(self.sync, name)
+
+        if (
+            name.startswith("__")
+            or not callable(attr)
+            or inspect.iscoroutinefunction(attr)
+        ):
+            return attr
+
+        @functools.wraps(attr)
+        async def run_async(*args, **kwargs):
+            return await util.run_in_mongodb_executor(attr, *args, **kwargs)
+
+        return run_async
@@ -6,6 +6,7 @@ import requests
 from tornado.options import options
 
 import global_vars
+from resources.elasticsearch_replication import replicate
 import util
 
 
@@ -15,6 +16,9 @@ class ElasticsearchConnector:
     full-text and fuzzy search than the native MongoDB text search.
     """
 
+    # nesting depth up to which `_dict_or_list_values_to_str()` flattens values
+    MAX_FLATTEN_DEPTH = 32
+
     def __init__(self):
         pass
 
@@ -29,61 +33,65 @@ class ElasticsearchConnector:
         will be transformed into:
         "a b d f g h j"
 
+        Values nested deeper than `MAX_FLATTEN_DEPTH` levels are skipped,
+        `None` and empty strings are skipped as well.
+
         This function is used as a helper to flatten out nested objects before
         they are inserted into the elasticsearch index, because that way the
         search algorithms only deal with text, which they are optimized for.
         """
 
-        result_str = ""
-        # for the recursion base case: str remains as str
-        if isinstance(doc, str):
-            result_str = doc
-        # ObjectIds also get returned as str representation
-        elif isinstance(doc, ObjectId):
-            result_str = str(doc)
-        # ints and floats get returned as str representation
-        elif isinstance(doc, int):
-            result_str = str(doc)
-        elif isinstance(doc, float):
-            result_str = str(doc)
-        # lists get flattened, if values are str, they remain str,
-        # dicts or nested lists get flattened recursively
-        elif isinstance(doc, list):
-            for elem in doc:
-                result_str = " ".join(
-                    [result_str, self._dict_or_list_values_to_str(elem)]
-                )
-        # dicts get flattened, i.e. only values of base entries are kept and
-        # concatenated into the single string, keys are lost.
-        # if dict values are lists or nested dicts, the are flattened recursively
-        elif isinstance(doc, dict):
-            for value in doc.values():
-                result_str = " ".join(
-                    [result_str, self._dict_or_list_values_to_str(value)]
-                )
-        # last fallback, any object gets flattened according to its __dict__
-        elif isinstance(doc, object):
-            result_str = " ".join(
-                [result_str, self._dict_or_list_values_to_str(doc.__dict__)]
-            )
-
-        return result_str.strip()
-
-    def on_insert(self, _id: str | ObjectId, document: dict, collection: str) -> None:
+        # the values are walked depth-first with an explicit stack of iterators
+        # instead of recursion and collected into a list that is only joined once
+        # at the end, keeping the flattening linear in the number of values
+        tokens = []
+        stack = [iter((doc,))]
+        while stack:
+            for value in stack[-1]:
+                # str remains as str
+                if isinstance(value, str):
+                    value = value.strip()
+                    if value:
+                        tokens.append(value)
+                    continue
+
+                # lists and dicts get flattened, i.e. only values of base entries are
+                # kept and concatenated into the single string, dict keys are lost.
+                if isinstance(value, dict):
+                    nested = value.values()
+                elif isinstance(value, list):
+                    nested = value
+                elif value is None:
+                    continue
+                # ObjectIds, ints and floats get returned as str representation
+                elif isinstance(value, (ObjectId, int, float)):
+                    tokens.append(str(value))
+                    continue
+                # any other object gets flattened according to its __dict__
+                elif hasattr(value, "__dict__"):
+                    nested = value.__dict__.values()
+                # last fallback, e.g. datetimes
+                else:
+                    tokens.append(str(value))
+                    continue
+
+                if len(stack) <= self.MAX_FLATTEN_DEPTH:
+                    # continue with the nested values, the rest of the current
+                    # level is resumed afterwards from its iterator
+                    stack.append(iter(nested))
+                    break
+            else:
+                stack.pop()
+
+        return " ".join(tokens)
+
+    def _prepare_document(self, document: dict) -> dict:
         """
-        Replicate a new document to Elasticsearch.
-        `_id` is the MongoDB ObjectId of the `document`, which in turn is the corresponding
-        MongoDB record that should be replicated.
-        `collection` is the same collection that the `document` is stored in inside MongoDB.
+        transform a MongoDB record into the document that is stored in Elasticsearch:
+        all nested attributes are flattened into a single string and fields that
+        Elasticsearch can't deal with are removed.
         """
 
-        # catch test mode
-        if options.test_admin or options.test_user:
-            collection = "test"
-
-        if isinstance(_id, ObjectId):
-            _id = str(_id)
-
         # flatten all nested attributes into a single string
         for key, value in document.items():
             if isinstance(value, (dict, list)):
@@ -97,19 +105,24 @@ class ElasticsearchConnector:
         if "birthday" in document:
             del document["birthday"]
 
-        try:
-            requests.put(
-                "{}/{}/_doc/{}".format(
-                    global_vars.elasticsearch_base_url, collection, _id
-                ),
-                json=util.json_serialize_response(document),
-                auth=(
-                    global_vars.elasticsearch_username,
-                    global_vars.elasticsearch_password,
-                ),
-            )
-        except Exception as e:
-            print(e)
+        return util.json_serialize_response(document)
+
+    def on_insert(self, _id: str | ObjectId, document: dict, collection: str) -> None:
+        """
+        Replicate a new document to Elasticsearch.
+        `_id` is the MongoDB ObjectId of the `document`, which in turn is the corresponding
+        MongoDB record that should be replicated.
+        `collection` is the same collection that the `document` is stored in inside MongoDB.
+
+        The document is not sent right away, but enqueued for the replication worker
+        (see `resources.elasticsearch_replication`).
+        """
+
+        # catch test mode
+        if options.test_admin or options.test_user:
+            collection = "test"
+
+        replicate(collection, _id, "index", document=self._prepare_document(document))
 
     def on_update(
         self,
@@ -127,6 +140,24 @@ class ElasticsearchConnector:
         # fully override doc by putting a new document with the same id
         self.on_insert(_id, update_doc, collection)
 
+    def on_update_deferred(
+        self, _id: str | ObjectId, collection: str, source: str
+    ) -> None:
+        """
+        Replicate the update of a document to Elasticsearch, without having to
+        supply the updated document: it is loaded by the document loader registered
+        for `source` (see `resources.elasticsearch_replication.register_document_loader()`)
+        when the update is sent. That way, consecutive updates of the same document
+        only cause a single read of it.
+        `collection` is the same collection that the document is stored in inside MongoDB.
+        """
+
+        # catch test mode
+        if options.test_admin or options.test_user:
+            collection = "test"
+
+        replicate(collection, _id, "index", source=source)
+
     def on_delete(self, _id: str | ObjectId, collection: str) -> None:
         """
         Delete the document from Elasticsearch.
@@ -138,16 +169,7 @@ class ElasticsearchConnector:
         if options.test_admin or options.test_user:
             collection = "test"
 
-        if isinstance(_id, ObjectId):
-            _id = str(_id)
-
-        requests.delete(
-            "{}/{}/_doc/{}".format(global_vars.elasticsearch_base_url, collection, _id),
-            auth=(
-                global_vars.elasticsearch_username,
-                global_vars.elasticsearch_password,
-            ),
-        )
+        replicate(collection, _id, "delete")
 
     def search_profile_match(
         self,
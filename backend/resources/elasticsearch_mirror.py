@@ -0,0 +1,350 @@
+import datetime
+import hashlib
+import json
+import logging
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import requests
+from pymongo.database import Database
+
+import global_vars
+from model import VEPlan
+from resources.elasticsearch_integration import ElasticsearchConnector
+from resources.elasticsearch_replication import (
+    ElasticsearchOutbox,
+    ElasticsearchReplicationQueue,
+)
+from resources.planner.ve_plan import VEPlanResource
+
+logger = logging.getLogger(__name__)
+
+
+class ElasticsearchMirror:
+    """
+    maintenance of the Elasticsearch mirror of the MongoDB collections as a whole,
+    in contrast to the replication of single changes
+    (see `resources.elasticsearch_replication`):
+
+    - `reindex()` rebuilds an index from scratch into a fresh versioned index
+      (e.g. `profiles_20240101120000000000`) and then atomically points the alias
+      (e.g. `profiles`) that all reads and writes use to it
+    - `diff()` compares the documents in MongoDB and Elasticsearch by their
+      checksums and reports (and optionally repairs) the drift
+
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            mirror = ElasticsearchMirror(db)
+            ...
+
+    """
+
+    # number of documents per cursor batch, bulk request and scroll page
+    BATCH_SIZE = 1000
+    SCROLL_TIMEOUT = "2m"
+    REQUEST_TIMEOUT = 60
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.connector = ElasticsearchConnector()
+
+        # name of the mirrored index -> (MongoDB collection, function that transforms
+        # a record into the Elasticsearch document the same way the replication does)
+        self.MIRRORED_INDEXES: Dict[str, Tuple[str, Callable[[Dict], Dict]]] = {
+            "profiles": ("profiles", self.connector._prepare_document),
+            "spaces": ("spaces", self.connector._prepare_document),
+            "plans": ("plans", self._prepare_plan),
+        }
+
+    def _prepare_plan(self, record: Dict) -> Dict:
+        plan_manager = VEPlanResource(self.db)
+        return self.connector._prepare_document(
+            plan_manager._get_plan_for_elastic(VEPlan.from_dict(record))
+        )
+
+    @staticmethod
+    def checksum(document: Dict) -> str:
+        """
+        checksum of an Elasticsearch document, independent of the order of its keys
+        """
+
+        return hashlib.sha1(
+            json.dumps(document, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = requests.request(
+            method,
+            "{}/{}".format(global_vars.elasticsearch_base_url, path),
+            auth=(
+                global_vars.elasticsearch_username,
+                global_vars.elasticsearch_password,
+            ),
+            timeout=self.REQUEST_TIMEOUT,
+            **kwargs,
+        )
+        response.raise_for_status()
+        return response
+
+    def _mongodb_documents(self, name: str) -> Iterator[Tuple[str, Dict]]:
+        """
+        stream the records of the collection mirrored in the index `name`
+        as (_id, Elasticsearch document) tuples
+        """
+
+        collection, prepare = self.MIRRORED_INDEXES[name]
+        for record in self.db[collection].find({}, batch_size=self.BATCH_SIZE):
+            yield str(record["_id"]), prepare(record)
+
+    def _elasticsearch_documents(self, index: str) -> Iterator[Tuple[str, Dict]]:
+        """
+        stream all documents of the index (or alias) as (_id, document) tuples,
+        using the scroll API
+        """
+
+        response = self._request(
+            "POST",
+            "{}/_search?scroll={}".format(index, self.SCROLL_TIMEOUT),
+            json={"size": self.BATCH_SIZE, "sort": ["_doc"]},
+        ).json()
+        scroll_id = response.get("_scroll_id")
+
+        try:
+            while response["hits"]["hits"]:
+                for hit in response["hits"]["hits"]:
+                    yield hit["_id"], hit["_source"]
+
+                response = self._request(
+                    "POST",
+                    "_search/scroll",
+                    json={"scroll": self.SCROLL_TIMEOUT, "scroll_id": scroll_id},
+                ).json()
+                scroll_id = response.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                requests.delete(
+                    "{}/_search/scroll".format(global_vars.elasticsearch_base_url),
+                    json={"scroll_id": scroll_id},
+                    auth=(
+                        global_vars.elasticsearch_username,
+                        global_vars.elasticsearch_password,
+                    ),
+                    timeout=self.REQUEST_TIMEOUT,
+                )
+
+    def _bulk_index(self, index: str, documents: Iterable[Tuple[str, Dict]]) -> Dict:
+        """
+        index the given (_id, document) tuples into the index in batches.
+        The documents get the current time as their external version, just like
+        the changes of the replication queue, so that changes that are replicated
+        concurrently are never overridden by an older state.
+
+        Returns the number of indexed and failed documents.
+        """
+
+        result = {"indexed": 0, "failed": 0}
+
+        def send(lines: List[str], count: int) -> None:
+            response = self._request(
+                "POST",
+                "_bulk",
+                data="\n".join(lines) + "\n",
+                headers={"Content-Type": "application/x-ndjson"},
+            ).json()
+            failed = sum(
+                1
+                for item in response["items"]
+                if not 200 <= item["index"]["status"] < 300
+                # a newer version has been replicated in the meantime
+                and item["index"]["status"] != 409
+            )
+            result["indexed"] += count - failed
+            result["failed"] += failed
+
+        lines = []
+        count = 0
+        for doc_id, document in documents:
+            lines.append(
+                json.dumps(
+                    {
+                        "index": {
+                            "_index": index,
+                            "_id": doc_id,
+                            "version": time.time_ns(),
+                            "version_type": "external",
+                        }
+                    }
+                )
+            )
+            lines.append(json.dumps(document, default=str))
+            count += 1
+            if count >= self.BATCH_SIZE:
+                send(lines, count)
+                lines = []
+                count = 0
+        if lines:
+            send(lines, count)
+
+        return result
+
+    def _get_aliased_indexes(self, alias: str) -> Tuple[List[str], bool]:
+        """
+        determine the indexes the alias currently points to.
+        Returns the list of those indexes and whether `alias` is the name of a
+        concrete index instead (i.e. the mirror has never been reindexed before).
+        """
+
+        response = requests.get(
+            "{}/_alias/{}".format(global_vars.elasticsearch_base_url, alias),
+            auth=(
+                global_vars.elasticsearch_username,
+                global_vars.elasticsearch_password,
+            ),
+            timeout=self.REQUEST_TIMEOUT,
+        )
+        if response.status_code == 200:
+            return list(response.json().keys()), False
+
+        response = requests.head(
+            "{}/{}".format(global_vars.elasticsearch_base_url, alias),
+            auth=(
+                global_vars.elasticsearch_username,
+                global_vars.elasticsearch_password,
+            ),
+            timeout=self.REQUEST_TIMEOUT,
+        )
+        return [], response.status_code == 200
+
+    def reindex(
+        self, name: str, alias: str = None, keep_old_indexes: bool = False
+    ) -> Dict:
+        """
+        rebuild the index `name` ("profiles", "spaces" or "plans") from MongoDB
+        into a fresh versioned index and atomically swap the alias (defaults to `name`)
+        to it. Afterwards, changes that were replicated into the previous index
+        during the rebuild are caught up by a repairing `diff()`.
+        The previous indexes are deleted, unless `keep_old_indexes` is set.
+
+        Returns a report of the form::
+
+            {
+                "alias": <str>,
+                "index": <name of the new index>,
+                "indexed": <int>,
+                "failed": <int>,
+                "previous_indexes": [<str>, ...],
+                "diff": <report of the catch-up diff(), see there>,
+            }
+
+        """
+
+        alias = alias or name
+        index = "{}_{}".format(
+            alias, datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+
+        self._request("PUT", index)
+        result = self._bulk_index(index, self._mongodb_documents(name))
+        self._request("POST", "{}/_refresh".format(index))
+
+        previous_indexes, alias_is_index = self._get_aliased_indexes(alias)
+        actions = [{"add": {"index": index, "alias": alias}}]
+        if alias_is_index:
+            # the concrete index of the same name has to make way for the alias
+            actions.append({"remove_index": {"index": alias}})
+        for previous_index in previous_indexes:
+            actions.append({"remove": {"index": previous_index, "alias": alias}})
+        self._request("POST", "_aliases", json={"actions": actions})
+
+        if not keep_old_indexes:
+            for previous_index in previous_indexes:
+                self._request("DELETE", previous_index)
+
+        logger.info(
+            "Reindexed {} documents into {} ({} failed), alias {} swapped".format(
+                result["indexed"], index, result["failed"], alias
+            )
+        )
+
+        return {
+            "alias": alias,
+            "index": index,
+            **result,
+            "previous_indexes": previous_indexes + ([alias] if alias_is_index else []),
+            "diff": self.diff(name, alias, repair=True),
+        }
+
+    def diff(self, name: str, alias: str = None, repair: bool = False) -> Dict:
+        """
+        compare the documents of the index `name` ("profiles", "spaces" or "plans")
+        in MongoDB and Elasticsearch (under `alias`, defaults to `name`) by their
+        checksums, without rebuilding anything.
+        If `repair` is set, the differences are enqueued to the replication queue
+        and flushed.
+
+        Returns a report of the form::
+
+            {
+                "alias": <str>,
+                "mongodb_count": <int>,
+                "elasticsearch_count": <int>,
+                "missing": [<_id>, ...],    (in MongoDB, but not in Elasticsearch)
+                "stale": [<_id>, ...],      (in Elasticsearch, but not in MongoDB anymore)
+                "differing": [<_id>, ...],  (in both, but with different content)
+            }
+
+        """
+
+        alias = alias or name
+
+        mongodb_documents = {}
+        mongodb_checksums = {}
+        for doc_id, document in self._mongodb_documents(name):
+            mongodb_checksums[doc_id] = self.checksum(document)
+            if repair:
+                mongodb_documents[doc_id] = document
+
+        elasticsearch_checksums = {
+            doc_id: self.checksum(document)
+            for doc_id, document in self._elasticsearch_documents(alias)
+        }
+
+        report = {
+            "alias": alias,
+            "mongodb_count": len(mongodb_checksums),
+            "elasticsearch_count": len(elasticsearch_checksums),
+            "missing": [
+                doc_id
+                for doc_id in mongodb_checksums
+                if doc_id not in elasticsearch_checksums
+            ],
+            "stale": [
+                doc_id
+                for doc_id in elasticsearch_checksums
+                if doc_id not in mongodb_checksums
+            ],
+            "differing": [
+                doc_id
+                for doc_id, checksum in mongodb_checksums.items()
+                if doc_id in elasticsearch_checksums
+                and elasticsearch_checksums[doc_id] != checksum
+            ],
+        }
+
+        if repair:
+            outbox = ElasticsearchOutbox(self.db)
+            for doc_id in report["missing"] + report["differing"]:
+                outbox.enqueue(
+                    alias, doc_id, "index", document=mongodb_documents[doc_id]
+                )
+            for doc_id in report["stale"]:
+                outbox.enqueue(alias, doc_id, "delete")
+
+            # a running replication worker would pick them up as well,
+            # but don't wait for it
+            queue = ElasticsearchReplicationQueue()
+            while queue.flush(self.db) > 0:
+                pass
+
+        return report
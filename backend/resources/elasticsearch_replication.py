@@ -0,0 +1,473 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+
+from bson import ObjectId
+import pymongo
+import requests
+from pymongo.database import Database
+
+import global_vars
+from resources.indexes import Index
+import util
+
+logger = logging.getLogger(__name__)
+
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # coalescing of the pending changes of a document
+    Index(
+        "elasticsearch_outbox",
+        [("index", pymongo.ASCENDING), ("doc_id", pymongo.ASCENDING)],
+        name="elasticsearch_outbox_index_doc_id",
+        unique=True,
+    ),
+    # claiming the due entries
+    Index(
+        "elasticsearch_outbox",
+        [("failed", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING)],
+        name="elasticsearch_outbox_failed_next_attempt_at",
+    ),
+]
+
+# source -> function(db, doc_ids) -> {doc_id: document}, see `register_document_loader()`
+_DOCUMENT_LOADERS: Dict[str, Callable[[Database, List[str]], Dict[str, Dict]]] = {}
+
+
+def register_document_loader(
+    source: str, loader: Callable[[Database, List[str]], Dict[str, Dict]]
+) -> None:
+    """
+    register the function that loads the (already flattened) Elasticsearch
+    documents of the given `source` for deferred updates
+    (see `ElasticsearchConnector.on_update_deferred()`).
+    The loader receives a db handle and a list of document _id's (as str) and
+    returns a dict mapping the _id's to the documents, documents that don't exist
+    (anymore) are simply omitted.
+    """
+
+    _DOCUMENT_LOADERS[source] = loader
+
+
+class ElasticsearchOutbox:
+    """
+    durable queue of the changes that have yet to be replicated to Elasticsearch,
+    holding at most one entry per document::
+
+        {
+            "index": <name of the Elasticsearch index>,
+            "doc_id": <_id of the document as str>,
+            "action": "index" | "delete",
+            "document": <the document to index, or None>,
+            "source": <name of the document loader or None>,
+            "version": <int, increases with every change>,
+            "enqueued_at": <datetime of the oldest change not yet replicated>,
+            "attempts": <int>,
+            "next_attempt_at": <datetime>,
+            "last_error": <str or None>,
+            "failed": <bool>,
+        }
+
+    Further changes of a document that is still pending replace its entry
+    (coalescing), so only its latest state is sent. The `version` is passed to
+    Elasticsearch as an external version, so a delayed older state never
+    overrides a newer one.
+    If an "index" entry has no `document`, it is loaded by the document loader of
+    its `source` right before it is sent (see `register_document_loader()`).
+
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            outbox = ElasticsearchOutbox(db)
+            ...
+
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def enqueue(
+        self,
+        index: str,
+        doc_id: str | ObjectId,
+        action: str,
+        document: Dict = None,
+        source: str = None,
+    ) -> None:
+        """
+        enqueue the change of a document, replacing any pending change
+        of the same document.
+        """
+
+        now = datetime.datetime.now()
+
+        self.db.elasticsearch_outbox.update_one(
+            {"index": index, "doc_id": str(doc_id)},
+            {
+                "$set": {
+                    "action": action,
+                    "document": document,
+                    "source": source,
+                    "version": time.time_ns(),
+                    "attempts": 0,
+                    "next_attempt_at": now,
+                    "last_error": None,
+                    "failed": False,
+                },
+                "$setOnInsert": {"enqueued_at": now},
+            },
+            upsert=True,
+        )
+
+    def claim(self, limit: int, lease_seconds: int) -> List[Dict]:
+        """
+        claim up to `limit` due entries for sending. Claimed entries are not due
+        again for `lease_seconds`, so that they are retried if the claiming
+        process dies before it has acknowledged them.
+        """
+
+        now = datetime.datetime.now()
+
+        candidate_ids = [
+            entry["_id"]
+            for entry in self.db.elasticsearch_outbox.find(
+                {"failed": False, "next_attempt_at": {"$lte": now}},
+                projection={"_id": True},
+                sort=[("next_attempt_at", pymongo.ASCENDING)],
+                limit=limit,
+            )
+        ]
+        if not candidate_ids:
+            return []
+
+        claim_id = ObjectId()
+        self.db.elasticsearch_outbox.update_many(
+            {"_id": {"$in": candidate_ids}, "next_attempt_at": {"$lte": now}},
+            {
+                "$set": {
+                    "claim_id": claim_id,
+                    "next_attempt_at": now + datetime.timedelta(seconds=lease_seconds),
+                }
+            },
+        )
+
+        return list(self.db.elasticsearch_outbox.find({"claim_id": claim_id}))
+
+    def acknowledge(self, entry: Dict) -> None:
+        """
+        remove the entry after it has been replicated, unless the document
+        has been changed again in the meantime.
+        """
+
+        self.db.elasticsearch_outbox.delete_one(
+            {"_id": entry["_id"], "version": entry["version"]}
+        )
+
+    def retry(
+        self,
+        entry: Dict,
+        error: str,
+        max_attempts: int,
+        backoff_base: float,
+        backoff_max: float,
+    ) -> None:
+        """
+        schedule another attempt of the entry with exponential backoff. After
+        `max_attempts` attempts, the entry is marked as failed and is not
+        retried anymore until the document changes again.
+        """
+
+        attempts = entry["attempts"] + 1
+        delay = min(backoff_base * 2 ** (attempts - 1), backoff_max)
+
+        self.db.elasticsearch_outbox.update_one(
+            {"_id": entry["_id"], "version": entry["version"]},
+            {
+                "$set": {
+                    "attempts": attempts,
+                    "last_error": error,
+                    "next_attempt_at": datetime.datetime.now()
+                    + datetime.timedelta(seconds=delay),
+                    "failed": attempts >= max_attempts,
+                }
+            },
+        )
+
+    def get_metrics(self) -> Dict:
+        """
+        Returns the depth of the queue, the number of failed entries and the lag,
+        i.e. the age of the oldest change that has not been replicated yet in seconds.
+        """
+
+        oldest = self.db.elasticsearch_outbox.find_one(
+            {"failed": False},
+            projection={"enqueued_at": True},
+            sort=[("enqueued_at", pymongo.ASCENDING)],
+        )
+
+        return {
+            "depth": self.db.elasticsearch_outbox.count_documents({"failed": False}),
+            "failed": self.db.elasticsearch_outbox.count_documents({"failed": True}),
+            "lag_seconds": (
+                (datetime.datetime.now() - oldest["enqueued_at"]).total_seconds()
+                if oldest
+                else 0.0
+            ),
+        }
+
+
+class ElasticsearchReplicationQueue:
+    """
+    background worker that replicates the changes in the `ElasticsearchOutbox`
+    to Elasticsearch through its `_bulk` API. It flushes every `FLUSH_INTERVAL`
+    seconds or as soon as `BATCH_SIZE` changes have been enqueued, whatever
+    happens first. Failed changes are retried with exponential backoff.
+
+    The worker runs in its own thread, because sending the bulk requests blocks.
+    There is one per process, started by `start_replication()`. Without a
+    running worker (e.g. in scripts or tests), `replicate()` flushes immediately.
+    """
+
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 1.0
+    LEASE_SECONDS = 60
+    MAX_ATTEMPTS = 12
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 300.0
+    REQUEST_TIMEOUT = 30
+
+    def __init__(self):
+        self._thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._lock = threading.Lock()
+        self._enqueued_since_flush = 0
+
+        self.replicated = 0
+        self.retried = 0
+        self.last_flush: datetime.datetime | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="elasticsearch-replication", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        stop the worker after its current flush, pending changes remain in the outbox
+        """
+
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def notify(self) -> None:
+        """
+        signal that a change has been enqueued, waking up the worker early
+        once a full batch is pending.
+        """
+
+        with self._lock:
+            self._enqueued_since_flush += 1
+            if self._enqueued_since_flush >= self.BATCH_SIZE:
+                self._enqueued_since_flush = 0
+                self._wake_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake_event.wait(self.FLUSH_INTERVAL)
+            self._wake_event.clear()
+            with self._lock:
+                self._enqueued_since_flush = 0
+
+            try:
+                with util.get_mongodb() as db:
+                    # drain the backlog in full batches
+                    while (
+                        self.flush(db) >= self.BATCH_SIZE
+                        and not self._stop_event.is_set()
+                    ):
+                        pass
+            except Exception as e:
+                logger.exception("Elasticsearch replication failed: {}".format(e))
+
+    def _load_deferred_documents(self, db: Database, entries: List[Dict]) -> None:
+        """
+        load the documents of the "index" entries that don't carry one,
+        with one call of the document loader per source.
+        """
+
+        doc_ids_by_source: Dict[str, List[str]] = {}
+        for entry in entries:
+            if entry["action"] == "index" and entry["document"] is None:
+                doc_ids_by_source.setdefault(entry["source"], []).append(
+                    entry["doc_id"]
+                )
+
+        for source, doc_ids in doc_ids_by_source.items():
+            documents = _DOCUMENT_LOADERS[source](db, doc_ids)
+            for entry in entries:
+                if entry["source"] == source and entry["document"] is None:
+                    entry["document"] = documents.get(entry["doc_id"])
+
+    def flush(self, db: Database) -> int:
+        """
+        send one batch of due changes to Elasticsearch.
+        Returns the number of changes that were handled.
+        """
+
+        outbox = ElasticsearchOutbox(db)
+
+        entries = outbox.claim(self.BATCH_SIZE, self.LEASE_SECONDS)
+        if not entries:
+            return 0
+
+        self._load_deferred_documents(db, entries)
+
+        lines = []
+        sent_entries = []
+        for entry in entries:
+            if entry["action"] == "index" and entry["document"] is None:
+                # the source document is gone, its deletion is enqueued separately
+                outbox.acknowledge(entry)
+                continue
+
+            lines.append(
+                json.dumps(
+                    {
+                        entry["action"]: {
+                            "_index": entry["index"],
+                            "_id": entry["doc_id"],
+                            "version": entry["version"],
+                            "version_type": "external",
+                        }
+                    }
+                )
+            )
+            if entry["action"] == "index":
+                lines.append(json.dumps(entry["document"]))
+            sent_entries.append(entry)
+
+        if sent_entries:
+            try:
+                response = requests.post(
+                    "{}/_bulk".format(global_vars.elasticsearch_base_url),
+                    data="\n".join(lines) + "\n",
+                    headers={"Content-Type": "application/x-ndjson"},
+                    auth=(
+                        global_vars.elasticsearch_username,
+                        global_vars.elasticsearch_password,
+                    ),
+                    timeout=self.REQUEST_TIMEOUT,
+                )
+                response.raise_for_status()
+                items = response.json()["items"]
+            except Exception as e:
+                logger.warning(
+                    "Elasticsearch bulk request failed, retrying later: {}".format(e)
+                )
+                for entry in sent_entries:
+                    self._retry(outbox, entry, str(e))
+                items = []
+
+            # the items of the response are in the order of the request
+            for entry, item in zip(sent_entries, items):
+                result = item[entry["action"]]
+                if (
+                    200 <= result["status"] < 300
+                    # a newer version has already been replicated
+                    or result["status"] == 409
+                    or (entry["action"] == "delete" and result["status"] == 404)
+                ):
+                    outbox.acknowledge(entry)
+                    self.replicated += 1
+                else:
+                    self._retry(
+                        outbox,
+                        entry,
+                        json.dumps(result.get("error") or {"status": result["status"]}),
+                    )
+
+        self.last_flush = datetime.datetime.now()
+        return len(entries)
+
+    def _retry(self, outbox: ElasticsearchOutbox, entry: Dict, error: str) -> None:
+        outbox.retry(
+            entry, error, self.MAX_ATTEMPTS, self.BACKOFF_BASE, self.BACKOFF_MAX
+        )
+        self.retried += 1
+        if entry["attempts"] + 1 >= self.MAX_ATTEMPTS:
+            logger.error(
+                "Giving up to replicate document {} to Elasticsearch index {}: {}".format(
+                    entry["doc_id"], entry["index"], error
+                )
+            )
+
+    def get_metrics(self, db: Database) -> Dict:
+        return {
+            **ElasticsearchOutbox(db).get_metrics(),
+            "running": self.running,
+            "replicated": self.replicated,
+            "retried": self.retried,
+            "last_flush": self.last_flush.isoformat() if self.last_flush else None,
+        }
+
+
+def start_replication() -> None:
+    """
+    start the replication worker of this process
+    """
+
+    if global_vars.elasticsearch_replication_queue is None:
+        global_vars.elasticsearch_replication_queue = ElasticsearchReplicationQueue()
+    if not global_vars.elasticsearch_replication_queue.running:
+        global_vars.elasticsearch_replication_queue.start()
+
+
+def replicate(
+    index: str,
+    doc_id: str | ObjectId,
+    action: str,
+    document: Dict = None,
+    source: str = None,
+) -> None:
+    """
+    enqueue the change of a document for replication to Elasticsearch.
+    If the replication worker of this process is not running, the change
+    is flushed immediately.
+    """
+
+    with util.get_mongodb() as db:
+        ElasticsearchOutbox(db).enqueue(index, doc_id, action, document, source)
+
+        queue = global_vars.elasticsearch_replication_queue
+        if queue is not None and queue.running:
+            queue.notify()
+        else:
+            (queue or ElasticsearchReplicationQueue()).flush(db)
+
+
+def get_replication_metrics() -> Dict:
+    """
+    Returns the metrics of the replication queue (see `ElasticsearchOutbox.get_metrics()`)
+    along with the counters of the worker of this process.
+    """
+
+    queue = (
+        global_vars.elasticsearch_replication_queue or ElasticsearchReplicationQueue()
+    )
+    with util.get_mongodb() as db:
+        return queue.get_metrics(db)
@@ -0,0 +1,146 @@
+import abc
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.database import Database
+
+from model import VEPlan
+from resources.network.profile import Profiles
+from resources.planner.ve_plan import VEPlanResource
+import util
+
+
+class BatchLoader(abc.ABC):
+    """
+    DataLoader-style loader of one type of entity (e.g. profile snippets by username):
+    the keys needed anywhere in a response are first collected via `want()`, then
+    all of them that haven't been loaded yet are fetched with a single query by
+    `load()`, after which the entities can be looked up via `get()` in constant time.
+
+    Loaded entities are cached for the lifetime of the loader, which is meant to be
+    a single request (see `Loaders`), so they are never stale for longer than that.
+
+    Subclasses implement `_fetch()` and, if necessary, `_normalize_key()`.
+    """
+
+    def __init__(self):
+        self._cache: Dict[Hashable, Any] = {}
+        self._pending: Dict[Hashable, None] = {}
+
+    def _normalize_key(self, key: Any) -> Hashable:
+        return key
+
+    @abc.abstractmethod
+    def _fetch(self, db: Database, keys: List[Hashable]) -> Dict[Hashable, Any]:
+        """
+        fetch the entities of the given keys with a single query.
+
+        Returns a dict mapping the keys to their entities, keys that have
+        no entity are omitted.
+        """
+
+    def want(self, keys: Iterable[Any]) -> None:
+        """
+        register the keys whose entities will be needed, they are fetched
+        by the next `load()`.
+        """
+
+        for key in keys:
+            key = self._normalize_key(key)
+            if key not in self._cache:
+                self._pending[key] = None
+
+    def load(self, db: Database) -> None:
+        """
+        fetch the entities of all keys that have been registered since the last load.
+        Keys without an entity are cached as missing as well.
+        """
+
+        if not self._pending:
+            return
+
+        keys = list(self._pending)
+        self._pending = {}
+        entities = self._fetch(db, keys)
+        for key in keys:
+            self._cache[key] = entities.get(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """
+        Returns the loaded entity of the key, or `default` if it has no entity
+        (or hasn't been loaded).
+        """
+
+        entity = self._cache.get(self._normalize_key(key))
+        return default if entity is None else entity
+
+
+class ProfileSnippetLoader(BatchLoader):
+    """
+    loads profile snippets (see `Profiles.get_profile_snippets()`) by username
+    """
+
+    def _fetch(self, db: Database, keys: List[str]) -> Dict[str, Dict]:
+        return {
+            snippet["username"]: snippet
+            for snippet in Profiles(db).get_profile_snippets(keys)
+        }
+
+
+class PlanLoader(BatchLoader):
+    """
+    loads plans as `VEPlan`'s by their _id, which may be given as `ObjectId`
+    or its str-representation
+    """
+
+    def _normalize_key(self, key: str | ObjectId) -> Hashable:
+        try:
+            return util.parse_object_id(key)
+        except (InvalidId, TypeError):
+            # can't match any plan, but is still cached as missing
+            return key
+
+    def _fetch(self, db: Database, keys: List[ObjectId]) -> Dict[ObjectId, VEPlan]:
+        plan_ids = [key for key in keys if isinstance(key, ObjectId)]
+        if not plan_ids:
+            return {}
+        return {plan._id: plan for plan in VEPlanResource(db).get_bulk_plans(plan_ids)}
+
+
+class Loaders:
+    """
+    the batching loaders of all entity types for a single request, so that every
+    entity type is fetched at most once per round of hydration, no matter in how
+    many places of the response it is needed. Handlers get theirs via
+    `BaseHandler.loaders`.
+
+    Hydration happens in three steps::
+
+        loaders = Loaders()
+        for post in posts:
+            loaders.profiles.want([post["author"]])
+        loaders.load()
+        for post in posts:
+            post["author"] = loaders.profiles.get(post["author"])
+
+    `load()` is blocking, async handlers run it in the mongodb executor.
+    """
+
+    def __init__(self):
+        self.profiles = ProfileSnippetLoader()
+        self.plans = PlanLoader()
+
+    def load(self, db: Optional[Database] = None) -> None:
+        """
+        fetch everything that has been registered in any of the loaders, using
+        the given `db` or acquiring a connection of its own.
+        """
+
+        if db is not None:
+            self.profiles.load(db)
+            self.plans.load(db)
+            return
+
+        with util.get_mongodb() as db:
+            self.load(db)
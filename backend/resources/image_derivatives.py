@@ -0,0 +1,300 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import functools
+import io
+import logging
+from typing import Hashable, Optional
+
+from bson import ObjectId
+import gridfs
+from gridfs.grid_file import GridOut
+from PIL import Image, ImageOps, UnidentifiedImageError
+import pymongo
+from pymongo.database import Database
+
+import global_vars
+from resources.indexes import Index
+import util
+
+logger = logging.getLogger(__name__)
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # lookup of a derivative of a file in a given size and format, every
+    # derivative is only stored once, even if it is generated concurrently
+    Index(
+        "fs.files",
+        [
+            ("metadata.derivative_of", pymongo.ASCENDING),
+            ("metadata.size", pymongo.ASCENDING),
+            ("metadata.format", pymongo.ASCENDING),
+            ("metadata.original_upload_date", pymongo.ASCENDING),
+        ],
+        name="fs_files_derivatives",
+        unique=True,
+        sparse=True,
+    ),
+]
+
+# the sizes (length of the longer edge in px) of the derivatives,
+# other sizes can't be requested
+DERIVATIVE_SIZES = (40, 80, 160, 320)
+
+# format of the derivatives -> (format name of Pillow, content type)
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+QUALITY = 85
+
+# derivatives are only generated of images up to this size, larger files are
+# served as they are, so that they are never read into memory as a whole
+MAX_ORIGINAL_SIZE = 20 * 1024 * 1024
+
+
+def _resize(content: bytes, size: int, format: str) -> Optional[bytes]:
+    """
+    scale the image down to fit into `size` x `size` (smaller images are not scaled
+    up) and encode it in the `format`.
+
+    Returns the encoded derivative, or None if the content is no image that
+    Pillow can read.
+    """
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            # let the JPEG decoder downscale already, which is a lot faster
+            image.draft("RGB", (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            if image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGBA")
+            if format == "jpeg" and image.mode == "RGBA":
+                # JPEG has no alpha channel, use a white background instead
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+
+            output = io.BytesIO()
+            image.save(output, DERIVATIVE_FORMATS[format][0], quality=QUALITY)
+            return output.getvalue()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        logger.info("could not generate derivative: {}".format(e))
+        return None
+
+
+def is_no_image(original: GridOut) -> bool:
+    """
+    Returns True if generating a derivative of the `original` file has already
+    failed, because it is no image
+    """
+
+    return bool(original.metadata and original.metadata.get("no_derivatives"))
+
+
+def has_derivatives(original: GridOut) -> bool:
+    """
+    Returns True if derivatives of the `original` file can be generated, i.e. if
+    it is an image by its content type, isn't larger than `MAX_ORIGINAL_SIZE`
+    and generating a derivative of it hasn't failed before.
+    Other files are served as they are, without reading them.
+    """
+
+    return (
+        (original.content_type or "").startswith("image/")
+        and original.length <= MAX_ORIGINAL_SIZE
+        and not is_no_image(original)
+    )
+
+
+def find_derivative(
+    db: Database, original: GridOut, size: int, format: str
+) -> Optional[GridOut]:
+    """
+    Returns the derivative of the `original` file in the size and format,
+    or None if it hasn't been generated yet (or the original has no derivatives,
+    see `has_derivatives()`).
+
+    Derivatives of a file that has been uploaded again under the same _id
+    (i.e. the default pictures) are outdated and not returned.
+    """
+
+    if not has_derivatives(original):
+        return None
+
+    return gridfs.GridFS(db).find_one(
+        {
+            "metadata.derivative_of": original._id,
+            "metadata.size": size,
+            "metadata.format": format,
+            "metadata.original_upload_date": original.upload_date,
+        }
+    )
+
+
+def _store_derivative(
+    db: Database, original: GridOut, content: bytes, size: int, format: str
+) -> Optional[Hashable]:
+    """
+    generate the derivative of the `original` file (with the given `content`) and
+    store it in gridfs. If the original is no image, it is marked as such, so
+    that no derivatives of it are attempted again.
+
+    If the derivative has been stored concurrently in the meantime (by another
+    request or `schedule_derivatives()`), that one is kept instead.
+
+    Returns the _id of the derivative, or None if the original is no image.
+    """
+
+    derivative = _resize(content, size, format)
+    if derivative is None:
+        if original.metadata is None:
+            update = {"$set": {"metadata": {"no_derivatives": True}}}
+        else:
+            update = {"$set": {"metadata.no_derivatives": True}}
+        db.fs.files.update_one({"_id": original._id}, update)
+        return None
+
+    _id = ObjectId()
+    try:
+        return gridfs.GridFS(db).put(
+            derivative,
+            _id=_id,
+            filename="{}_{}.{}".format(original._id, size, format),
+            content_type=DERIVATIVE_FORMATS[format][1],
+            metadata={
+                "uploader": "system",
+                "derivative_of": original._id,
+                "original_upload_date": original.upload_date,
+                "size": size,
+                "format": format,
+            },
+        )
+    except gridfs.errors.FileExists:
+        # the file document has been rejected by the unique index of the derivatives
+        # (which gridfs reports as an existing _id), after the chunks were written
+        db.fs.chunks.delete_many({"files_id": _id})
+        existing = find_derivative(db, original, size, format)
+        return existing._id if existing is not None else None
+
+
+def get_or_create_derivative(
+    original: GridOut, size: int, format: str
+) -> Optional[GridOut]:
+    """
+    Returns the derivative of the `original` file in the size and format,
+    which is generated and stored in gridfs if it doesn't exist yet.
+
+    Returns None if the original has no derivatives (see `has_derivatives()`),
+    in which case it has to be served as it is. Blocking, async callers use
+    `get_or_create_derivative_async()`.
+    """
+
+    if not has_derivatives(original):
+        return None
+
+    with util.get_mongodb() as db:
+        derivative = find_derivative(db, original, size, format)
+        if derivative is not None:
+            return derivative
+
+        fs = gridfs.GridFS(db)
+        content = fs.get(original._id).read()
+        _id = _store_derivative(db, original, content, size, format)
+        return fs.get(_id) if _id is not None else None
+
+
+def create_derivatives(file_id: Hashable) -> int:
+    """
+    generate the missing derivatives of the file in all `DERIVATIVE_SIZES` and
+    `DERIVATIVE_FORMATS`, reading it from gridfs only once.
+
+    Returns the number of generated derivatives.
+    """
+
+    with util.get_mongodb() as db:
+        fs = gridfs.GridFS(db)
+        try:
+            original = fs.get(file_id)
+        except gridfs.NoFile:
+            return 0
+        if not has_derivatives(original):
+            return 0
+
+        content = None
+        created = 0
+        for size in DERIVATIVE_SIZES:
+            for format in DERIVATIVE_FORMATS:
+                if find_derivative(db, original, size, format) is not None:
+                    continue
+                if content is None:
+                    content = original.read()
+                if _store_derivative(db, original, content, size, format) is None:
+                    # no image, none of the other derivatives will work either
+                    return created
+                created += 1
+        return created
+
+
+def delete_derivatives(db: Database, file_id: Hashable) -> None:
+    """
+    delete all derivatives of the file from gridfs, meant to be called
+    whenever the file itself is deleted
+    """
+
+    fs = gridfs.GridFS(db)
+    for derivative in db.fs.files.find(
+        {"metadata.derivative_of": file_id}, projection={"_id": True}
+    ):
+        fs.delete(derivative["_id"])
+
+
+def get_derivative_executor() -> ThreadPoolExecutor:
+    """
+    Returns the process-wide thread pool that generates the derivatives, so that
+    neither the IOLoop nor the mongodb executor are busy resizing images.
+    It is lazily created on first use.
+    """
+
+    if global_vars.image_derivative_executor is None:
+        global_vars.image_derivative_executor = ThreadPoolExecutor(
+            max_workers=global_vars.image_derivative_workers,
+            thread_name_prefix="image_derivatives",
+        )
+    return global_vars.image_derivative_executor
+
+
+def _log_failure(future: Future) -> None:
+    if future.exception() is not None:
+        logger.error(
+            "generating derivatives failed: {}".format(future.exception()),
+            exc_info=future.exception(),
+        )
+
+
+def schedule_derivatives(file_id: Hashable) -> Future:
+    """
+    generate the derivatives of a newly uploaded image (see `create_derivatives()`)
+    in the background, so that they already exist when they are requested.
+    """
+
+    future = get_derivative_executor().submit(create_derivatives, file_id)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+async def get_or_create_derivative_async(
+    original: GridOut, size: int, format: str
+) -> Optional[GridOut]:
+    """
+    `get_or_create_derivative()` in the derivative executor
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_derivative_executor(),
+        functools.partial(get_or_create_derivative, original, size, format),
+    )
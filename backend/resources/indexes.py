@@ -0,0 +1,347 @@
+import importlib
+import logging
+from typing import Dict, List, Tuple
+
+import pymongo
+import pymongo.errors
+from pymongo.database import Database
+
+logger = logging.getLogger(__name__)
+
+# the modules that declare the indexes of the collections they manage
+# in a module-level `INDEXES` list
+INDEX_MODULES = [
+    "resources.network.acl",
+    "resources.network.chat",
+    "resources.network.feed",
+    "resources.network.post",
+    "resources.network.profile",
+    "resources.network.space",
+    "resources.planner.ve_plan",
+    "resources.notifications",
+    "resources.mail_invitation",
+    "resources.elasticsearch_replication",
+    "resources.user_directory",
+    "resources.mail_outbox",
+    "resources.shared_state",
+    "resources.planner.plan_lock",
+    "resources.image_derivatives",
+    "resources.streaming_upload",
+]
+
+
+class Index:
+    """
+    declaration of an index on a collection, e.g.::
+
+        INDEXES = [
+            Index(
+                "posts",
+                [("space", pymongo.ASCENDING), ("creation_date", pymongo.DESCENDING)],
+                name="posts_space_creation_date",
+            ),
+        ]
+
+    `keys` is either a single field name or a list of (field, direction) tuples
+    just as in `pymongo.collection.Collection.create_index()`, any further keyword
+    arguments (e.g. `unique=True`) are passed through to it as well.
+    """
+
+    def __init__(
+        self,
+        collection: str,
+        keys: str | List[Tuple[str, int | str]],
+        name: str,
+        **options
+    ):
+        self.collection = collection
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        self.keys = list(keys)
+        self.name = name
+        self.options = options
+
+    def __repr__(self):
+        return "Index({}.{})".format(self.collection, self.name)
+
+    @property
+    def is_text(self) -> bool:
+        return any(direction == pymongo.TEXT for _, direction in self.keys)
+
+    def matches(self, index_info: Dict) -> bool:
+        """
+        determine if the existing index described by `index_info` (an entry of
+        `pymongo.collection.Collection.index_information()`) is equal to this
+        declaration, i.e. if it doesn't have to be rebuilt.
+        """
+
+        if self.is_text:
+            # text indexes are stored as _fts/_ftsx keys, the fields are in the weights
+            if "weights" in index_info:
+                existing_fields = set(index_info["weights"])
+            else:
+                existing_fields = {
+                    field
+                    for field, direction in index_info["key"]
+                    if direction == pymongo.TEXT
+                }
+            if existing_fields != {
+                field for field, direction in self.keys if direction == pymongo.TEXT
+            }:
+                return False
+        elif [(field, direction) for field, direction in index_info["key"]] != [
+            (field, direction) for field, direction in self.keys
+        ]:
+            return False
+
+        if bool(index_info.get("unique", False)) != bool(
+            self.options.get("unique", False)
+        ):
+            return False
+
+        for option in ("sparse", "expireAfterSeconds", "partialFilterExpression"):
+            if index_info.get(option) != self.options.get(option):
+                return False
+
+        return True
+
+    def create(self, db: Database) -> None:
+        db[self.collection].create_index(self.keys, name=self.name, **self.options)
+
+
+def get_registered_indexes() -> List[Index]:
+    """
+    collect the declared indexes of all modules in `INDEX_MODULES`
+    """
+
+    indexes = []
+    for module_name in INDEX_MODULES:
+        module = importlib.import_module(module_name)
+        indexes.extend(module.INDEXES)
+    return indexes
+
+
+def _index_from_information(collection: str, name: str, index_info: Dict) -> Index:
+    """
+    the declaration of the existing index described by `index_info` (an entry of
+    `pymongo.collection.Collection.index_information()`), to be able to create
+    it once again.
+    """
+
+    keys = []
+    for field, direction in index_info["key"]:
+        # text indexes are stored as _fts/_ftsx keys, the fields are in the weights
+        if field == "_fts":
+            keys.extend(
+                (text_field, pymongo.TEXT) for text_field in index_info["weights"]
+            )
+        elif field != "_ftsx":
+            keys.append((field, direction))
+
+    options = {
+        option: value
+        for option, value in index_info.items()
+        if option not in ("v", "key", "ns")
+    }
+    return Index(collection, keys, name=name, **options)
+
+
+def _restore_index(db: Database, collection: str, name: str, index_info: Dict) -> None:
+    """
+    create the index described by `index_info` once again, after it has been
+    dropped to be rebuilt and the rebuild failed, so that the collection is not
+    left without it.
+    """
+
+    try:
+        _index_from_information(collection, name, index_info).create(db)
+        logger.info(
+            "Restored previous index named {} on collection {}".format(name, collection)
+        )
+    except pymongo.errors.OperationFailure as e:
+        logger.error(
+            "Failed to restore previous index named {} on collection {}: {}".format(
+                name, collection, e
+            )
+        )
+
+
+def _find_redundant_indexes(
+    collection: str, index_information: Dict[str, Dict], registered_names: List[str]
+) -> List[Dict]:
+    """
+    determine the indexes of a collection that are redundant, i.e.:
+    - they are not declared by any module (anymore)
+    - or their keys are a prefix of the keys of another index of the collection,
+      which can serve all their queries as well
+    """
+
+    redundant = []
+    for name, info in index_information.items():
+        if name == "_id_":
+            continue
+
+        if name not in registered_names:
+            redundant.append(
+                {"collection": collection, "name": name, "reason": "not_registered"}
+            )
+            continue
+
+        # unique, sparse, partial, ttl and text indexes have other purposes
+        # than speeding up queries, so they are never covered by another index
+        if any(
+            option in info
+            for option in (
+                "unique",
+                "sparse",
+                "partialFilterExpression",
+                "expireAfterSeconds",
+                "weights",
+            )
+        ):
+            continue
+
+        keys = list(info["key"])
+        for other_name, other_info in index_information.items():
+            if (
+                other_name == name
+                or "weights" in other_info
+                or "partialFilterExpression" in other_info
+            ):
+                continue
+            other_keys = list(other_info["key"])
+            if len(other_keys) > len(keys) and other_keys[: len(keys)] == keys:
+                redundant.append(
+                    {
+                        "collection": collection,
+                        "name": name,
+                        "reason": "prefix_of_{}".format(other_name),
+                    }
+                )
+                break
+
+    return redundant
+
+
+def _find_unused_indexes(db: Database, collection: str) -> List[Dict]:
+    """
+    determine the indexes of a collection that have not been used by any query
+    since the statistics were reset (i.e. since the last restart of the mongodb server),
+    using the `$indexStats` aggregation stage.
+    """
+
+    unused = []
+    try:
+        for stats in db[collection].aggregate([{"$indexStats": {}}]):
+            if stats["name"] == "_id_":
+                continue
+            if stats["accesses"]["ops"] == 0:
+                unused.append(
+                    {
+                        "collection": collection,
+                        "name": stats["name"],
+                        "since": stats["accesses"]["since"],
+                    }
+                )
+    except pymongo.errors.OperationFailure as e:
+        # e.g. missing privileges to run $indexStats
+        logger.warning(
+            "Could not determine index usage of collection {}: {}".format(collection, e)
+        )
+
+    return unused
+
+
+def reconcile_indexes(db: Database, force_rebuild: bool = False) -> Dict:
+    """
+    reconcile the indexes in the db with the declared ones:
+    missing indexes are built, indexes whose declaration has changed are rebuilt
+    (as well as all declared indexes if `force_rebuild` is set).
+    Indexes that are redundant or unused are only reported, but never dropped
+    automatically, since they might still be needed by e.g. a running older
+    version of the platform.
+
+    Returns a report of the form::
+
+        {
+            "missing": [{"collection": <str>, "name": <str>}, ...],
+            "rebuilt": [{"collection": <str>, "name": <str>}, ...],
+            "failed": [{"collection": <str>, "name": <str>, "error": <str>}, ...],
+            "redundant": [{"collection": <str>, "name": <str>, "reason": <str>}, ...],
+            "unused": [{"collection": <str>, "name": <str>, "since": <datetime>}, ...],
+        }
+
+    where `missing` indexes were built. If rebuilding an index fails, the previous
+    index is restored.
+    """
+
+    report = {"missing": [], "rebuilt": [], "failed": [], "redundant": [], "unused": []}
+
+    indexes_by_collection: Dict[str, List[Index]] = {}
+    for index in get_registered_indexes():
+        indexes_by_collection.setdefault(index.collection, []).append(index)
+
+    for collection, indexes in indexes_by_collection.items():
+        index_information = db[collection].index_information()
+
+        for index in indexes:
+            entry = {"collection": collection, "name": index.name}
+
+            # the existing index that is rebuilt, if any
+            previous = None
+            if index.name not in index_information:
+                report["missing"].append(entry)
+            elif force_rebuild or not index.matches(index_information[index.name]):
+                previous = index_information[index.name]
+                report["rebuilt"].append(entry)
+            else:
+                continue
+
+            try:
+                # the index has to be dropped first, mongodb refuses a second index
+                # with the same keys (e.g. if only the options have changed) under
+                # a temporary name, so it is restored below if the rebuild fails
+                if previous is not None:
+                    db[collection].drop_index(index.name)
+                index.create(db)
+                logger.info(
+                    "Built index named {} on collection {}".format(
+                        index.name, collection
+                    )
+                )
+            except pymongo.errors.OperationFailure as e:
+                # e.g. an equal index under a different name or duplicates
+                # violating a unique index, don't block the startup because of that
+                report["failed"].append({**entry, "error": str(e)})
+                logger.error(
+                    "Failed to build index named {} on collection {}: {}".format(
+                        index.name, collection, e
+                    )
+                )
+                # the previous index is still better than none at all
+                if previous is not None:
+                    _restore_index(db, collection, index.name, previous)
+
+        report["redundant"].extend(
+            _find_redundant_indexes(
+                collection,
+                db[collection].index_information(),
+                [index.name for index in indexes],
+            )
+        )
+        report["unused"].extend(_find_unused_indexes(db, collection))
+
+    for entry in report["redundant"]:
+        logger.warning(
+            "Index named {} on collection {} is redundant ({}), consider dropping it".format(
+                entry["name"], entry["collection"], entry["reason"]
+            )
+        )
+    for entry in report["unused"]:
+        logger.info(
+            "Index named {} on collection {} has not been used since {}".format(
+                entry["name"], entry["collection"], entry["since"]
+            )
+        )
+
+    return report
@@ -1,12 +1,27 @@
 import datetime
 
 from bson import ObjectId
+import pymongo
 from pymongo.database import Database
 from bson.errors import InvalidId
 from exceptions import InvitationDoesntExistError
 from typing import Dict
+from resources.indexes import Index
 import util
 
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # rate limit of invitations per sender
+    Index(
+        "mail_invitations",
+        [("sender", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)],
+        name="mail_invitations_sender_timestamp",
+    ),
+]
+
+
 class MailInvitation:
     """
     to use this class, acquire a mongodb connection first via::
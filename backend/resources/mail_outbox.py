@@ -0,0 +1,628 @@
+from collections import deque
+import datetime
+import logging
+import smtplib
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from bson import ObjectId
+from jinja2 import TemplateNotFound
+import pymongo
+from pymongo.database import Database
+
+import global_vars
+from resources.indexes import Index
+import util
+
+logger = logging.getLogger(__name__)
+
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # claiming the due entries
+    Index(
+        "mail_outbox",
+        [("failed", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING)],
+        name="mail_outbox_failed_next_attempt_at",
+    ),
+]
+
+
+class MailOutbox:
+    """
+    durable queue of the emails that have yet to be sent::
+
+        {
+            "recipient_username": <str or None>,
+            "recipient_email": <str>,
+            "subject": <str or None>,
+            "template": <name of the html template>,
+            "payload": <dict to fill the template with>,
+            "enqueued_at": <datetime>,
+            "attempts": <int>,
+            "next_attempt_at": <datetime>,
+            "last_error": <str or None>,
+            "failed": <bool>,
+        }
+
+    The emails are only rendered right before they are sent (see `util.build_email()`).
+    Sent emails are removed, failed ones are kept for inspection.
+
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            outbox = MailOutbox(db)
+            ...
+
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def enqueue(
+        self,
+        recipient_username: str | None,
+        recipient_email: str,
+        subject: str | None,
+        template: str,
+        payload: Dict,
+    ) -> ObjectId:
+        """
+        enqueue an email, returning the _id of its entry.
+        """
+
+        return self.enqueue_many(
+            [(recipient_username, recipient_email)], subject, template, payload
+        )[0]
+
+    def enqueue_many(
+        self,
+        recipients: List[Tuple[str | None, str]],
+        subject: str | None,
+        template: str,
+        payload: Dict,
+    ) -> List[ObjectId]:
+        """
+        enqueue the same email to all `recipients`, given as (username, email address)
+        tuples, with one write. Returns the _id's of the entries.
+        """
+
+        if not recipients:
+            return []
+
+        now = datetime.datetime.now()
+
+        return self.db.mail_outbox.insert_many(
+            [
+                {
+                    "recipient_username": recipient_username,
+                    "recipient_email": recipient_email,
+                    "subject": subject,
+                    "template": template,
+                    "payload": payload,
+                    "enqueued_at": now,
+                    "attempts": 0,
+                    "next_attempt_at": now,
+                    "last_error": None,
+                    "failed": False,
+                }
+                for recipient_username, recipient_email in recipients
+            ]
+        ).inserted_ids
+
+    def claim(self, limit: int, lease_seconds: int) -> List[Dict]:
+        """
+        claim up to `limit` due entries for sending. Claimed entries are not due
+        again for `lease_seconds`, so that they are retried if the claiming
+        process dies before it has acknowledged them.
+        """
+
+        now = datetime.datetime.now()
+
+        candidate_ids = [
+            entry["_id"]
+            for entry in self.db.mail_outbox.find(
+                {"failed": False, "next_attempt_at": {"$lte": now}},
+                projection={"_id": True},
+                sort=[("next_attempt_at", pymongo.ASCENDING)],
+                limit=limit,
+            )
+        ]
+        if not candidate_ids:
+            return []
+
+        claim_id = ObjectId()
+        self.db.mail_outbox.update_many(
+            {"_id": {"$in": candidate_ids}, "next_attempt_at": {"$lte": now}},
+            {
+                "$set": {
+                    "claim_id": claim_id,
+                    "next_attempt_at": now + datetime.timedelta(seconds=lease_seconds),
+                }
+            },
+        )
+
+        return list(
+            self.db.mail_outbox.find(
+                {"claim_id": claim_id}, sort=[("next_attempt_at", pymongo.ASCENDING)]
+            )
+        )
+
+    def acknowledge(self, entry: Dict) -> None:
+        """
+        remove the entry after its email has been sent.
+        """
+
+        self.db.mail_outbox.delete_one({"_id": entry["_id"]})
+
+    def retry(
+        self,
+        entry: Dict,
+        error: str,
+        max_attempts: int,
+        backoff_base: float,
+        backoff_max: float,
+    ) -> None:
+        """
+        schedule another attempt of the entry with exponential backoff. After
+        `max_attempts` attempts, the entry is marked as failed and is not
+        retried anymore.
+        """
+
+        attempts = entry["attempts"] + 1
+        delay = min(backoff_base * 2 ** (attempts - 1), backoff_max)
+
+        self.db.mail_outbox.update_one(
+            {"_id": entry["_id"]},
+            {
+                "$set": {
+                    "attempts": attempts,
+                    "last_error": error,
+                    "next_attempt_at": datetime.datetime.now()
+                    + datetime.timedelta(seconds=delay),
+                    "failed": attempts >= max_attempts,
+                }
+            },
+        )
+
+    def fail(self, entry: Dict, error: str) -> None:
+        """
+        mark the entry as failed without retrying it, e.g. because the
+        mail server rejected the recipient.
+        """
+
+        self.db.mail_outbox.update_one(
+            {"_id": entry["_id"]},
+            {
+                "$set": {
+                    "attempts": entry["attempts"] + 1,
+                    "last_error": error,
+                    "failed": True,
+                }
+            },
+        )
+
+    def get_metrics(self) -> Dict:
+        """
+        Returns the depth of the queue, the number of failed entries and the lag,
+        i.e. the age of the oldest email that has not been sent yet in seconds.
+        """
+
+        oldest = self.db.mail_outbox.find_one(
+            {"failed": False},
+            projection={"enqueued_at": True},
+            sort=[("enqueued_at", pymongo.ASCENDING)],
+        )
+
+        return {
+            "depth": self.db.mail_outbox.count_documents({"failed": False}),
+            "failed": self.db.mail_outbox.count_documents({"failed": True}),
+            "lag_seconds": (
+                (datetime.datetime.now() - oldest["enqueued_at"]).total_seconds()
+                if oldest
+                else 0.0
+            ),
+        }
+
+
+def connect_smtp() -> smtplib.SMTP:
+    """
+    open an authenticated session to the mail server configured in `global_vars`
+    """
+
+    session = smtplib.SMTP(
+        global_vars.smtp_host, global_vars.smtp_port, timeout=MailQueue.SMTP_TIMEOUT
+    )
+    session.starttls()
+    session.login(global_vars.smtp_username, global_vars.smtp_password)
+    return session
+
+
+class MailQueue:
+    """
+    background worker that sends the emails in the `MailOutbox`. It flushes every
+    `FLUSH_INTERVAL` seconds or as soon as `BATCH_SIZE` emails have been enqueued,
+    whatever happens first, sending all emails of a batch over the same SMTP session.
+    The session is kept open between batches and only closed after being idle for
+    `IDLE_TIMEOUT` seconds or when the mail server drops it.
+
+    At most `max_per_minute` emails are sent per minute (0 for no limit), the rest
+    stays queued for later. Emails that could not be sent because of temporary
+    errors (connection problems or 4xx replies) are retried with exponential
+    backoff, emails rejected permanently (5xx replies) are marked as failed.
+
+    The worker runs in its own thread, because talking to the mail server blocks.
+    There is one per process, started by `start_mail_queue()`. Without a
+    running worker (e.g. in scripts or tests), `send_email()` flushes immediately.
+    """
+
+    BATCH_SIZE = 50
+    FLUSH_INTERVAL = 5.0
+    LEASE_SECONDS = 300
+    MAX_ATTEMPTS = 8
+    BACKOFF_BASE = 30.0
+    BACKOFF_MAX = 3600.0
+    SMTP_TIMEOUT = 30
+    IDLE_TIMEOUT = 60.0
+
+    def __init__(
+        self,
+        smtp_factory: Callable[[], smtplib.SMTP] = None,
+        max_per_minute: int = None,
+    ):
+        self.smtp_factory = smtp_factory or connect_smtp
+        self.max_per_minute = (
+            global_vars.smtp_max_per_minute
+            if max_per_minute is None
+            else max_per_minute
+        )
+
+        self._thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._enqueued_since_flush = 0
+
+        self._session: smtplib.SMTP | None = None
+        self._session_used_at = 0.0
+        # monotonic timestamps of the emails sent within the last minute
+        self._sent_times: deque[float] = deque()
+
+        self.sent = 0
+        self.retried = 0
+        self.rejected = 0
+        self.sessions_opened = 0
+        self.last_flush: datetime.datetime | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="mail-queue", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        stop the worker after its current flush, pending emails remain in the outbox
+        """
+
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.close_session()
+
+    def notify(self, count: int = 1) -> None:
+        """
+        signal that `count` emails have been enqueued, waking up the worker early
+        once a full batch is pending.
+        """
+
+        with self._lock:
+            self._enqueued_since_flush += count
+            if self._enqueued_since_flush >= self.BATCH_SIZE:
+                self._enqueued_since_flush = 0
+                self._wake_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake_event.wait(self.FLUSH_INTERVAL)
+            self._wake_event.clear()
+            with self._lock:
+                self._enqueued_since_flush = 0
+
+            try:
+                with util.get_mongodb() as db:
+                    # drain the backlog in full batches
+                    while (
+                        self.flush(db) >= self.BATCH_SIZE
+                        and not self._stop_event.is_set()
+                    ):
+                        pass
+            except Exception as e:
+                logger.exception("Sending emails failed: {}".format(e))
+
+            if (
+                self._session is not None
+                and time.monotonic() - self._session_used_at >= self.IDLE_TIMEOUT
+            ):
+                self.close_session()
+
+    def _get_session(self) -> smtplib.SMTP:
+        """
+        Returns the open SMTP session, checking that it is still alive if it has
+        been idle, or opens a new one.
+        """
+
+        if self._session is not None and (
+            time.monotonic() - self._session_used_at >= self.FLUSH_INTERVAL
+        ):
+            try:
+                if self._session.noop()[0] != 250:
+                    self.close_session()
+            except smtplib.SMTPException:
+                self.close_session()
+
+        if self._session is None:
+            self._session = self.smtp_factory()
+            self.sessions_opened += 1
+        self._session_used_at = time.monotonic()
+        return self._session
+
+    def close_session(self) -> None:
+        if self._session is None:
+            return
+        try:
+            self._session.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._session = None
+
+    def _remaining_budget(self) -> int:
+        """
+        Returns the number of emails that may still be sent within the current minute.
+        """
+
+        if not self.max_per_minute:
+            return self.BATCH_SIZE
+
+        now = time.monotonic()
+        while self._sent_times and now - self._sent_times[0] >= 60:
+            self._sent_times.popleft()
+        return max(0, self.max_per_minute - len(self._sent_times))
+
+    def _get_display_names(self, db: Database, entries: List[Dict]) -> Dict[str, str]:
+        """
+        Returns the display names of the recipients of the entries that have a profile,
+        mapped by their username, with one query for the whole batch.
+        """
+
+        usernames = list(
+            {
+                entry["recipient_username"]
+                for entry in entries
+                if entry["recipient_username"] is not None
+            }
+        )
+        if not usernames:
+            return {}
+
+        return {
+            profile["username"]: "{} {}".format(
+                profile["first_name"], profile["last_name"]
+            )
+            for profile in db.profiles.find(
+                {"username": {"$in": usernames}},
+                projection={"username": True, "first_name": True, "last_name": True},
+            )
+            if "first_name" in profile and "last_name" in profile
+        }
+
+    def flush(self, db: Database) -> int:
+        """
+        send one batch of due emails, limited by the throughput limit.
+        Returns the number of emails that were handled.
+        """
+
+        # the worker and immediate flushes must not share the session concurrently
+        with self._flush_lock:
+            limit = min(self.BATCH_SIZE, self._remaining_budget())
+            if limit == 0:
+                return 0
+
+            outbox = MailOutbox(db)
+            entries = outbox.claim(limit, self.LEASE_SECONDS)
+            if not entries:
+                return 0
+
+            display_names = self._get_display_names(db, entries)
+
+            for i, entry in enumerate(entries):
+                try:
+                    msg = util.build_email(
+                        db,
+                        entry["recipient_username"],
+                        entry["recipient_email"],
+                        entry["subject"],
+                        entry["template"],
+                        entry["payload"],
+                        # users without a profile are addressed by their username
+                        display_names.get(entry["recipient_username"])
+                        or entry["recipient_username"]
+                        or "Nutzer:in",
+                    )
+                except Exception as e:
+                    logger.exception(
+                        "Building email from template {} failed: {}".format(
+                            entry["template"], e
+                        )
+                    )
+                    self._reject(outbox, entry, "{}: {}".format(type(e).__name__, e))
+                    continue
+
+                try:
+                    self._send(msg)
+                except (
+                    smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError,
+                ) as e:
+                    if self._is_permanent(e):
+                        self._reject(outbox, entry, repr(e))
+                    else:
+                        self._retry(outbox, entry, repr(e))
+                    continue
+                except (smtplib.SMTPException, OSError) as e:
+                    # the mail server is unreachable or the session is broken,
+                    # so don't bother with the rest of the batch for now
+                    logger.warning(
+                        "Sending emails failed, retrying later: {}".format(e)
+                    )
+                    self.close_session()
+                    for remaining in entries[i:]:
+                        self._retry(outbox, remaining, repr(e))
+                    break
+
+                outbox.acknowledge(entry)
+                self._sent_times.append(time.monotonic())
+                self.sent += 1
+
+            self.last_flush = datetime.datetime.now()
+            return len(entries)
+
+    def _send(self, msg) -> None:
+        """
+        send the message over the open session. If the session has been dropped by
+        the mail server in the meantime, it is reopened once.
+        """
+
+        try:
+            self._get_session().send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self.close_session()
+            self._get_session().send_message(msg)
+
+    @staticmethod
+    def _is_permanent(error: smtplib.SMTPException) -> bool:
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in error.recipients.values())
+        return error.smtp_code >= 500
+
+    def _reject(self, outbox: MailOutbox, entry: Dict, error: str) -> None:
+        outbox.fail(entry, error)
+        self.rejected += 1
+        logger.error(
+            "Giving up to send email {} to {}: {}".format(
+                entry["template"], entry["recipient_email"], error
+            )
+        )
+
+    def _retry(self, outbox: MailOutbox, entry: Dict, error: str) -> None:
+        outbox.retry(
+            entry, error, self.MAX_ATTEMPTS, self.BACKOFF_BASE, self.BACKOFF_MAX
+        )
+        self.retried += 1
+        if entry["attempts"] + 1 >= self.MAX_ATTEMPTS:
+            logger.error(
+                "Giving up to send email {} to {}: {}".format(
+                    entry["template"], entry["recipient_email"], error
+                )
+            )
+
+    def get_metrics(self, db: Database) -> Dict:
+        return {
+            **MailOutbox(db).get_metrics(),
+            "running": self.running,
+            "sent": self.sent,
+            "retried": self.retried,
+            "rejected": self.rejected,
+            "sessions_opened": self.sessions_opened,
+            "max_per_minute": self.max_per_minute,
+            "last_flush": self.last_flush.isoformat() if self.last_flush else None,
+        }
+
+
+def start_mail_queue() -> None:
+    """
+    start the mail worker of this process
+    """
+
+    if global_vars.mail_queue is None:
+        global_vars.mail_queue = MailQueue()
+    if not global_vars.mail_queue.running:
+        global_vars.mail_queue.start()
+
+
+def send_email(
+    recipient_username: str | None,
+    recipient_email: str,
+    subject: str | None,
+    template: str,
+    payload: Dict,
+) -> None:
+    """
+    enqueue an email to the recipient with the given username and email address,
+    see `util.build_email()` for the meaning of the parameters.
+    If the template does not exist, an error is logged and the email is dropped.
+
+    If the mail worker of this process is not running, the email is sent immediately.
+    """
+
+    send_emails([(recipient_username, recipient_email)], subject, template, payload)
+
+
+def send_emails(
+    recipients: List[Tuple[str | None, str]],
+    subject: str | None,
+    template: str,
+    payload: Dict,
+) -> None:
+    """
+    enqueue the same email to all `recipients`, given as (username, email address)
+    tuples, see `send_email()`.
+    """
+
+    if not recipients:
+        return
+
+    # sanity check: email template exists
+    try:
+        global_vars.email_template_env.get_template(template)
+    except TemplateNotFound:
+        logger.error("Email template not found: {}".format(template))
+        return
+
+    with util.get_mongodb() as db:
+        MailOutbox(db).enqueue_many(recipients, subject, template, payload)
+
+        queue = global_vars.mail_queue
+        if queue is not None and queue.running:
+            queue.notify(len(recipients))
+        else:
+            if queue is None:
+                queue = global_vars.mail_queue = MailQueue()
+            # the emails are safe in the outbox, a failed flush is retried later
+            try:
+                queue.flush(db)
+            except Exception as e:
+                logger.exception("Sending emails failed: {}".format(e))
+            queue.close_session()
+
+
+def get_mail_metrics() -> Dict:
+    """
+    Returns the metrics of the mail queue (see `MailOutbox.get_metrics()`)
+    along with the counters of the worker of this process.
+    """
+
+    queue = global_vars.mail_queue or MailQueue()
+    with util.get_mongodb() as db:
+        return queue.get_metrics(db)
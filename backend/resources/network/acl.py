@@ -1,16 +1,280 @@
 from __future__ import annotations
+from collections import OrderedDict
+import datetime
 import logging
-from typing import Optional, Dict, List
+import threading
+import time
+from typing import Iterable, Optional, Dict, List, Tuple
 from bson import ObjectId
 
+import pymongo
+from pymongo import ReturnDocument
 from pymongo.database import Database
 
 import global_vars
+from resources.async_resource import AsyncResource
+from resources.indexes import Index
 import util
 
 logger = logging.getLogger(__name__)
 
 
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    Index("global_acl", "role", name="global_acl_role"),
+    Index(
+        "space_acl",
+        [("username", pymongo.ASCENDING), ("space", pymongo.ASCENDING)],
+        name="space_acl_username_space",
+    ),
+    Index("space_acl", "space", name="space_acl_space"),
+]
+
+
+class ACLCache:
+    """
+    process-wide cache of everything that ACL decisions are based on: the full
+    global ACL (it only has one entry per role), the space ACL entries per
+    (username, space) with LRU eviction and the roles of the users.
+
+    Every change of an ACL entry or a role through `ACL` or `Profiles.set_role()`
+    increments the counter in the `acl_version` collection and drops the affected
+    entries of this process right away. Other processes compare the counter at most
+    every `VERSION_CHECK_INTERVAL` seconds and drop their whole cache once it has
+    changed, so they decide on outdated permissions for at most that long.
+    Changes made directly in the database have to increment the counter as well.
+
+    Use the cache of this process (see `get_acl_cache()`), `_GlobalACL.ask()`
+    and `_SpaceACL.ask()` do so on their own.
+    """
+
+    MAX_SIZE = 10000
+    VERSION_CHECK_INTERVAL = 1.0
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or self.MAX_SIZE
+        self._global_acl: Optional[Dict[str, Dict]] = None
+        # (username, space_id) -> entry, or None if there is no entry
+        self._space_acl: OrderedDict[Tuple[str, ObjectId], Optional[Dict]] = (
+            OrderedDict()
+        )
+        self._roles: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _clear(self) -> None:
+        self._global_acl = None
+        self._space_acl.clear()
+        self._roles.clear()
+
+    def _check_version(self, db: Database) -> None:
+        """
+        drop everything if another process changed the ACL or a role,
+        which is checked at most every `VERSION_CHECK_INTERVAL` seconds.
+        """
+
+        now = time.monotonic()
+        if now - self._version_checked_at < self.VERSION_CHECK_INTERVAL:
+            return
+
+        record = db.acl_version.find_one({"_id": "acl"})
+        version = record["version"] if record else 0
+        with self._lock:
+            if version != self._version:
+                self._clear()
+                self._version = version
+            self._version_checked_at = now
+
+    def _changed(self, db: Database) -> None:
+        """
+        increment the counter, so that the other processes drop their caches
+        """
+
+        version = db.acl_version.find_one_and_update(
+            {"_id": "acl"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )["version"]
+        with self._lock:
+            # if somebody else changed something in the meantime as well,
+            # that change is not known here
+            if self._version != version - 1:
+                self._clear()
+            self._version = version
+            self.invalidations += 1
+
+    def _put(self, entries: OrderedDict, key, value) -> None:
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def get_global_acl(self, db: Database, role: str) -> Optional[Dict]:
+        """
+        Returns the global ACL entry of the role, or None if there is none.
+        The whole global ACL is loaded at once.
+        """
+
+        self._check_version(db)
+        with self._lock:
+            global_acl = self._global_acl
+            if global_acl is not None:
+                self.hits += 1
+        if global_acl is None:
+            global_acl = {
+                record["role"]: record
+                for record in db.global_acl.find(projection={"_id": False})
+            }
+            with self._lock:
+                self._global_acl = global_acl
+                self.misses += 1
+        return global_acl.get(role)
+
+    def get_space_acl(
+        self, db: Database, username: str, space_ids: Iterable[ObjectId]
+    ) -> Dict[ObjectId, Optional[Dict]]:
+        """
+        Returns the space ACL entries of the user in the spaces as a dict mapping
+        the space_id to the entry, or None if there is none. The entries that
+        are not cached yet are fetched with a single query.
+        """
+
+        self._check_version(db)
+        entries = {}
+        with self._lock:
+            for space_id in space_ids:
+                key = (username, space_id)
+                if key in self._space_acl:
+                    self._space_acl.move_to_end(key)
+                    entries[space_id] = self._space_acl[key]
+            missing = [space_id for space_id in space_ids if space_id not in entries]
+            self.hits += len(entries)
+            self.misses += len(missing)
+
+        if missing:
+            fetched = {
+                record["space"]: record
+                for record in db.space_acl.find(
+                    {"username": username, "space": {"$in": missing}},
+                    projection={"_id": False},
+                )
+            }
+            with self._lock:
+                for space_id in missing:
+                    entries[space_id] = fetched.get(space_id)
+                    self._put(self._space_acl, (username, space_id), entries[space_id])
+        return entries
+
+    def get_role(self, db: Database, username: str) -> Optional[str]:
+        """
+        Returns the role of the user, or None if the user has no profile.
+        """
+
+        self._check_version(db)
+        with self._lock:
+            role = self._roles.get(username)
+            if role is not None:
+                self._roles.move_to_end(username)
+                self.hits += 1
+                return role
+            self.misses += 1
+
+        profile = db.profiles.find_one(
+            {"username": username}, projection={"_id": False, "role": True}
+        )
+        if not profile or "role" not in profile:
+            # not cached, the profile is usually created right away
+            return None
+        with self._lock:
+            self._put(self._roles, username, profile["role"])
+        return profile["role"]
+
+    def invalidate_global_acl(self, db: Database) -> None:
+        self._changed(db)
+        with self._lock:
+            self._global_acl = None
+
+    def invalidate_space_acl(
+        self, db: Database, username: str = None, space_id: ObjectId = None
+    ) -> None:
+        """
+        drop the entries of the user, of the space, or both
+        """
+
+        self._changed(db)
+        with self._lock:
+            for key in list(self._space_acl):
+                if key[0] == username or key[1] == space_id:
+                    del self._space_acl[key]
+
+    def invalidate_space_acl_entry(
+        self, db: Database, username: str, space_id: ObjectId
+    ) -> None:
+        """
+        drop the entry of the user in the space
+        """
+
+        self.invalidate_space_acl_entries(db, [(username, space_id)])
+
+    def invalidate_space_acl_entries(
+        self, db: Database, keys: Iterable[Tuple[str, ObjectId]]
+    ) -> None:
+        """
+        drop the entries of the given (username, space_id) pairs
+        """
+
+        self._changed(db)
+        with self._lock:
+            for key in keys:
+                self._space_acl.pop(key, None)
+
+    def invalidate_role(self, db: Database, username: str) -> None:
+        self._changed(db)
+        with self._lock:
+            self._roles.pop(username, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def get_metrics(self) -> Dict:
+        return {
+            "cached_roles": len(self._roles),
+            "cached_global_acl": self._global_acl is not None,
+            "cached_space_acl": len(self._space_acl),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+def get_acl_cache() -> ACLCache:
+    """
+    Returns the ACL cache of this process, which is lazily created on first use.
+    """
+
+    if global_vars.acl_cache is None:
+        global_vars.acl_cache = ACLCache()
+    return global_vars.acl_cache
+
+
+def get_acl_cache_metrics() -> Dict:
+    """
+    Returns the metrics of the ACL cache of this process (see `ACLCache.get_metrics()`),
+    or an empty dict if it has not been used yet.
+    """
+
+    if global_vars.acl_cache is None:
+        return {}
+    return global_vars.acl_cache.get_metrics()
+
+
 class ACL:
     """
     to use this class, acquire a mongodb connection first via::
@@ -46,35 +310,6 @@ class ACL:
         #    if not self.space_acl.get(role, space):
         #        self.space_acl.insert_default(role, space)
 
-    def _cleanup_unused_rules(self):
-        """
-        Delete all ACL entries whose role (or space) does no longer exist, because those entries are orphans.
-        This function is periodically scheduled (every 1 hour), but may also be manually called if desired
-        """
-
-        logger.info("Running ACL cleanup")
-
-        # initiate new mongo connection, because old objects might have been GC'ed
-        self.__init__()
-        with self:
-            db = self.client[global_vars.mongodb_db_name]
-            currently_existing_roles = db.profiles.distinct("role")
-            currently_existing_spaces = db.spaces.distinct("_id")
-
-            # clean global acl (roles no longer exists)
-            for global_acl_rule in self.global_acl.get_all():
-                if global_acl_rule["role"] not in currently_existing_roles:
-                    self.global_acl.delete(global_acl_rule["role"])
-
-            # clean space acl (role or space no longer exist)
-            for space_acl_rule in self.space_acl.get_full_list():
-                if (space_acl_rule["role"] not in currently_existing_roles) or (
-                    space_acl_rule["space"] not in currently_existing_spaces
-                ):
-                    self.space_acl.delete(
-                        space_acl_rule["role"], space_acl_rule["space"]
-                    )
-
 
 class _GlobalACL:
     """
@@ -102,6 +337,7 @@ class _GlobalACL:
         self.db.global_acl.update_one(  # use update + upsert so this function can also be used to restore to default
             {"role": role}, {"$set": default_rule}, upsert=True
         )
+        get_acl_cache().invalidate_global_acl(self.db)
         return default_rule
 
     def insert_admin(self) -> dict:
@@ -114,6 +350,7 @@ class _GlobalACL:
         self.db.global_acl.update_one(  # use update + upsert so this function can also be used to restore to default
             {"role": "admin"}, {"$set": admin_rule}, upsert=True
         )
+        get_acl_cache().invalidate_global_acl(self.db)
 
         return admin_rule
 
@@ -131,7 +368,7 @@ class _GlobalACL:
                 )
             )
 
-        record = self.db.global_acl.find_one({"role": role})
+        record = get_acl_cache().get_global_acl(self.db, role)
         if not record:
             raise ValueError("no Global ACL entry exists for role '{}'".format(role))
         return record[permission_key]
@@ -180,6 +417,7 @@ class _GlobalACL:
         self.db.global_acl.update_one(
             {"role": role}, {"$set": {permission_key: value}}, upsert=True
         )
+        get_acl_cache().invalidate_global_acl(self.db)
 
     def set_all(self, acl_entry: dict) -> None:
         """
@@ -204,6 +442,7 @@ class _GlobalACL:
         self.db.global_acl.update_one(
             {"role": acl_entry["role"]}, {"$set": acl_entry}, upsert=True
         )
+        get_acl_cache().invalidate_global_acl(self.db)
 
     def delete(self, role: str) -> None:
         """
@@ -211,6 +450,7 @@ class _GlobalACL:
         """
 
         self.db.global_acl.delete_one({"role": role})
+        get_acl_cache().invalidate_global_acl(self.db)
 
 
 class _SpaceACL:
@@ -271,6 +511,7 @@ class _SpaceACL:
         self.db.space_acl.update_one(  # use update + upsert so this function can also be used to restore to default
             {"username": username, "space": space_id}, {"$set": default_rule}, upsert=True
         )
+        get_acl_cache().invalidate_space_acl_entry(self.db, username, space_id)
 
         return default_rule
 
@@ -293,6 +534,7 @@ class _SpaceACL:
         self.db.space_acl.update_one(
             {"username": username, "space": space_id}, {"$set": admin_rule}, upsert=True
         )
+        get_acl_cache().invalidate_space_acl_entry(self.db, username, space_id)
         return admin_rule
 
     def insert_default_discussion(self, username: str, space_id: str | ObjectId):
@@ -314,6 +556,7 @@ class _SpaceACL:
         self.db.space_acl.update_one(  # use update + upsert so this function can also be used to restore to default
             {"username": username, "space": space_id}, {"$set": default_rule}, upsert=True
         )
+        get_acl_cache().invalidate_space_acl_entry(self.db, username, space_id)
         return default_rule
 
     def ask(self, username: str, space_id: str | ObjectId, permission_key: str) -> bool:
@@ -334,7 +577,7 @@ class _SpaceACL:
                 )
             )
 
-        record = self.db.space_acl.find_one({"username": username, "space": space_id})
+        record = get_acl_cache().get_space_acl(self.db, username, [space_id])[space_id]
         if not record:
             raise ValueError(
                 "no Space ACL entry exists for user '{}' in space '{}'".format(
@@ -343,6 +586,40 @@ class _SpaceACL:
             )
         return record[permission_key]
 
+    def ask_many(
+        self, username: str, requests: List[Tuple[str | ObjectId, str]]
+    ) -> List[bool]:
+        """
+        "ask" the acl for several permissions of a user at once, e.g. to authorize
+        all items of a page, with at most a single query for the entries that are
+        not cached yet.
+        :param username: which user to query
+        :param requests: list of (space_id, permission_key) tuples
+        :return: list of boolean indicators whether the user has the requested permission,
+                 in the order of the `requests`. Unlike `ask()`, spaces where the user
+                 has no entry yield False instead of raising a ValueError.
+        """
+
+        requests = [
+            (util.parse_object_id(space_id), permission_key)
+            for space_id, permission_key in requests
+        ]
+        for _, permission_key in requests:
+            if permission_key not in self._EXISTING_KEYS:
+                raise KeyError(
+                    "Key '{}' does not match any permission key in the db".format(
+                        permission_key
+                    )
+                )
+
+        records = get_acl_cache().get_space_acl(
+            self.db, username, list(dict.fromkeys(space_id for space_id, _ in requests))
+        )
+        return [
+            bool(records[space_id] and records[space_id].get(permission_key, False))
+            for space_id, permission_key in requests
+        ]
+
     def get(self, username: str, space_id: str | ObjectId) -> Optional[Dict]:
         """
         request the entire set of permissions for the user in the space
@@ -413,6 +690,7 @@ class _SpaceACL:
             {"$set": {permission_key: value}},
             upsert=True,
         )
+        get_acl_cache().invalidate_space_acl_entry(self.db, username, space_id)
         # TODO fix: we get an inconsistency problem here when using upsert, because all other keys would not be present
 
     def set_all(self, acl_entry: dict) -> None:
@@ -457,6 +735,9 @@ class _SpaceACL:
             {"$set": acl_entry},
             upsert=True,
         )
+        get_acl_cache().invalidate_space_acl_entry(
+            self.db, acl_entry["username"], acl_entry["space"]
+        )
 
     def delete(self, username: str = None, space_id: str | ObjectId = None):
         """
@@ -467,39 +748,207 @@ class _SpaceACL:
             space_id = util.parse_object_id(space_id)
 
         self.db.space_acl.delete_many({"$or": [{"username": username}, {"space": space_id}]})
+        get_acl_cache().invalidate_space_acl(self.db, username, space_id)
+
 
+class AsyncACL(AsyncResource):
+    """
+    async variant of `ACL`, see `AsyncResource` for details.
+    `global_acl` and `space_acl` are async variants as well.
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            acl = AsyncACL(db)
+            allowed = await acl.space_acl.ask(username, space_id, "read_timeline")
+            ...
 
-def cleanup_unused_rules() -> None:
     """
-    Delete all ACL entries whose role (or space) does no longer exist,
+
+    sync_resource_class = ACL
+
+    def __init__(self, db: Database):
+        super().__init__(db)
+        self.global_acl = AsyncResource.wrap(self.sync.global_acl)
+        self.space_acl = AsyncResource.wrap(self.sync.space_acl)
+
+
+# number of space ACL entries that are checked per aggregation and
+# the maximum number of those batches per run of `cleanup_unused_rules()`
+CLEANUP_BATCH_SIZE = 1000
+CLEANUP_MAX_BATCHES = 50
+
+
+def _find_orphaned_global_acl_rules(db: Database) -> Tuple[int, List[Dict]]:
+    """
+    anti-join of the global ACL against the roles of the profiles.
+
+    Returns the number of scanned entries and the orphaned entries
+    (their `_id` and `role`).
+    """
+
+    scanned = 0
+    orphans = []
+    for rule in db.global_acl.aggregate(
+        [
+            {
+                "$lookup": {
+                    "from": "profiles",
+                    "localField": "role",
+                    "foreignField": "role",
+                    "pipeline": [{"$limit": 1}, {"$project": {"_id": True}}],
+                    "as": "profiles",
+                }
+            },
+            {
+                "$project": {
+                    "role": True,
+                    "orphaned": {"$eq": [{"$size": "$profiles"}, 0]},
+                }
+            },
+        ]
+    ):
+        scanned += 1
+        if rule["orphaned"]:
+            orphans.append(rule)
+    return scanned, orphans
+
+
+def _find_orphaned_space_acl_entries(
+    db: Database, after: Optional[ObjectId]
+) -> Tuple[List[Dict], Optional[ObjectId]]:
+    """
+    anti-join of the next `CLEANUP_BATCH_SIZE` space ACL entries after the `_id`
+    `after` (in the order of their `_id`s) against the profiles and spaces.
+
+    Returns the checked entries as dicts with their `_id`, `username`, `space` and
+    whether they are `orphaned`, i.e. their user or space doesn't exist anymore.
+    """
+
+    return list(
+        db.space_acl.aggregate(
+            [
+                {"$match": {"_id": {"$gt": after}} if after is not None else {}},
+                {"$sort": {"_id": pymongo.ASCENDING}},
+                {"$limit": CLEANUP_BATCH_SIZE},
+                {
+                    "$lookup": {
+                        "from": "profiles",
+                        "localField": "username",
+                        "foreignField": "username",
+                        "pipeline": [{"$limit": 1}, {"$project": {"_id": True}}],
+                        "as": "profiles",
+                    }
+                },
+                {
+                    "$lookup": {
+                        "from": "spaces",
+                        "localField": "space",
+                        "foreignField": "_id",
+                        "pipeline": [{"$project": {"_id": True}}],
+                        "as": "spaces",
+                    }
+                },
+                {
+                    "$project": {
+                        "username": True,
+                        "space": True,
+                        "orphaned": {
+                            "$or": [
+                                {"$eq": [{"$size": "$profiles"}, 0]},
+                                {"$eq": [{"$size": "$spaces"}, 0]},
+                            ]
+                        },
+                    }
+                },
+            ]
+        )
+    )
+
+
+def cleanup_unused_rules(max_batches: int = CLEANUP_MAX_BATCHES) -> Dict:
+    """
+    Delete all ACL entries whose role (or username or space) does no longer exist,
     because those entries are orphans.
-    This function is periodically scheduled (every 1 hour) from `main.py`,
-    but may also be manually called if desired.
+    This function is periodically scheduled (every 1 hour) from `main.py` in a worker
+    thread, but may also be manually called if desired.
+
+    The orphans are found by the database itself (anti-joins via `$lookup`) and deleted
+    with one `delete_many` per batch. The space ACL is checked incrementally: every run
+    checks at most `max_batches` batches of `CLEANUP_BATCH_SIZE` entries, continuing
+    after the high-water mark (the last checked `_id`) that the previous run stored
+    in the `acl_cleanup` collection. Once the end is reached, the next run starts
+    over from the beginning.
+
+    Returns a report of the numbers of "scanned" and "removed" entries of
+    the "global_acl" and "space_acl", whether the check of the space ACL
+    "completed" and its current "high_water_mark".
     """
 
     logger.info("Running ACL cleanup")
 
-    # initiate new mongo connection, because old objects might have been GC'ed
     with util.get_mongodb() as db:
-        acl_manager = ACL(db)
-        currently_existing_roles = db.profiles.distinct("role")
-        currently_existing_users = db.profiles.distinct("username")
-        currently_existing_spaces = db.spaces.distinct("_id")
+        cache = get_acl_cache()
 
         # clean global acl (roles no longer exists)
-        for global_acl_rule in acl_manager.global_acl.get_all():
-            if global_acl_rule["role"] not in currently_existing_roles:
-                acl_manager.global_acl.delete(global_acl_rule["role"])
-
-        # clean space acl (username or space no longer exist)
-        for space_acl_rule in acl_manager.space_acl.get_full_list():
-            if (space_acl_rule["username"] not in currently_existing_users) or (
-                space_acl_rule["space"] not in currently_existing_spaces
-            ):
-                acl_manager.space_acl.delete(
-                    space_acl_rule["username"], space_acl_rule["space"]
+        global_scanned, global_orphans = _find_orphaned_global_acl_rules(db)
+        if global_orphans:
+            db.global_acl.delete_many(
+                {"_id": {"$in": [rule["_id"] for rule in global_orphans]}}
+            )
+            cache.invalidate_global_acl(db)
+
+        # clean space acl (username or space no longer exist),
+        # continuing after the high-water mark of the previous run
+        state = db.acl_cleanup.find_one({"_id": "space_acl"}) or {}
+        high_water_mark = state.get("high_water_mark")
+        space_scanned = 0
+        space_removed = 0
+        completed = False
+        for _ in range(max_batches):
+            entries = _find_orphaned_space_acl_entries(db, high_water_mark)
+            space_scanned += len(entries)
+
+            orphans = [entry for entry in entries if entry["orphaned"]]
+            if orphans:
+                space_removed += db.space_acl.delete_many(
+                    {"_id": {"$in": [entry["_id"] for entry in orphans]}}
+                ).deleted_count
+                cache.invalidate_space_acl_entries(
+                    db, [(entry["username"], entry["space"]) for entry in orphans]
                 )
 
+            if len(entries) < CLEANUP_BATCH_SIZE:
+                high_water_mark = None
+                completed = True
+                break
+            high_water_mark = entries[-1]["_id"]
+
+        db.acl_cleanup.update_one(
+            {"_id": "space_acl"},
+            {
+                "$set": {
+                    "high_water_mark": high_water_mark,
+                    "last_run": datetime.datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+
+    report = {
+        "global_acl": {
+            "scanned": global_scanned,
+            "removed": len(global_orphans),
+        },
+        "space_acl": {
+            "scanned": space_scanned,
+            "removed": space_removed,
+            "completed": completed,
+            "high_water_mark": high_water_mark,
+        },
+    }
+    logger.info("ACL cleanup finished: {}".format(report))
+    return report
+
 
 if __name__ == "__main__":
     pass
@@ -1,16 +1,72 @@
 import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from bson import ObjectId
-from pymongo import ReturnDocument
+import pymongo
+import pymongo.errors
+from pymongo import ReturnDocument, UpdateOne
 from pymongo.database import Database
 
 from exceptions import MessageDoesntExistError, RoomDoesntExistError, UserNotMemberError
+from resources.async_resource import AsyncResource
+from resources.indexes import Index
 import util
 
 
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    Index("chatrooms", "members", name="chatrooms_members"),
+    # message history of a room, newest first
+    Index(
+        "messages",
+        [("room_id", pymongo.ASCENDING), ("creation_date", pymongo.DESCENDING)],
+        name="messages_room_id_creation_date",
+    ),
+    # unacknowledged messages of a user
+    Index("messages", "send_states.username", name="messages_send_states_username"),
+    # unacknowledged messages of the last 24 hours
+    Index("messages", "creation_date", name="messages_creation_date"),
+    # messages of a user (user deletion)
+    Index("messages", "sender", name="messages_sender"),
+    # one unread counter per (room, user)
+    Index(
+        "chat_unread",
+        [("room_id", pymongo.ASCENDING), ("username", pymongo.ASCENDING)],
+        name="chat_unread_room_id_username",
+        unique=True,
+    ),
+    # rooms with unread messages of a user
+    Index(
+        "chat_unread",
+        [("username", pymongo.ASCENDING), ("unread_count", pymongo.ASCENDING)],
+        name="chat_unread_username_unread_count",
+    ),
+    # users with recent unread messages (nightly mail)
+    Index("chat_unread", "last_unread_date", name="chat_unread_last_unread_date"),
+]
+
+
 class Chat:
     """
+    Messages are stored as one document per message in the `messages` collection,
+    referencing their room by `room_id`. The room itself only keeps a denormalized
+    copy of its newest message as `last_message` for the room snippets.
+
+    For every (room, user) that has unacknowledged messages, the `chat_unread`
+    collection holds a precomputed counter::
+
+        {
+            "room_id": <_id of the room>,
+            "username": <member of the room>,
+            "unread_count": <number of messages not yet acknowledged by the user>,
+            "last_unread_date": <creation_date of the newest unread message>,
+        }
+
+    which is incremented when a message is stored and decremented when it is
+    acknowledged, so that looking up unread messages doesn't have to scan the
+    send states of the whole message history.
+
     to use this class, acquire a mongodb connection first via::
 
         with util.get_mongodb() as db:
@@ -54,7 +110,7 @@ class Chat:
             {
                 "$setOnInsert": {
                     "members": members,
-                    "messages": [],
+                    "last_message": None,
                     "name": name,
                 }
             },
@@ -68,30 +124,34 @@ class Chat:
     def get_room_snippets_for_user(self, username: str) -> List[Dict]:
         """
         Retrieve snippets of all rooms that the given user is a member of.
-        Snippets include: _id, members, name and the last sent message.
+        Snippets include: _id, members, name, the last sent message and the number
+        of messages the user has not yet acknowledged.
 
         Returns a list of dicts containing the room snippets, or an empty list
         if the user is not a member of any room.
         """
 
-        return list(
-            self.db.chatrooms.aggregate(
-                [
-                    {"$match": {"members": username}},
-                    {
-                        "$project": {
-                            "_id": True,
-                            "members": True,
-                            "name": True,
-                            "last_message": {
-                                "$ifNull": [{"$arrayElemAt": ["$messages", -1]}, None]
-                            },
-                        }
-                    },
-                ]
+        rooms = list(
+            self.db.chatrooms.find(
+                {"members": username},
+                projection={
+                    "_id": True,
+                    "members": True,
+                    "name": True,
+                    "last_message": True,
+                },
             )
         )
 
+        unread_counts = self.get_unread_counts_for_user(username)
+
+        # rooms without any message might not have the attribute at all
+        for room in rooms:
+            room.setdefault("last_message", None)
+            room["unread_count"] = unread_counts.get(room["_id"], 0)
+
+        return rooms
+
     def check_is_user_chatroom_member(
         self, room_id: str | ObjectId, username: str
     ) -> bool:
@@ -114,9 +174,18 @@ class Chat:
 
         return username in room["members"]
 
+    def _check_room_exists(self, room_id: ObjectId) -> None:
+        """
+        Raises `RoomDoesntExistError` if no room with the given _id was found.
+        """
+
+        if self.db.chatrooms.count_documents({"_id": room_id}, limit=1) == 0:
+            raise RoomDoesntExistError()
+
     def get_all_messages_of_room(self, room_id: str | ObjectId) -> List[Dict]:
         """
-        Retrieve a list of all message of the room given by its _id.
+        Retrieve a list of all message of the room given by its _id, oldest first.
+        Prefer `get_messages_of_room` to only retrieve a page of them.
 
         Returns a list of dicts containing the messages, or an empty list
         if no messages have yet been sent in the room.
@@ -126,19 +195,77 @@ class Chat:
 
         room_id = util.parse_object_id(room_id)
 
-        room = self.db.chatrooms.find_one(
-            {"_id": room_id},
-            projection={"messages": True},
+        self._check_room_exists(room_id)
+
+        return list(
+            self.db.messages.find(
+                {"room_id": room_id},
+                projection={"room_id": False},
+                sort=[("creation_date", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+            )
         )
 
-        if not room:
-            raise RoomDoesntExistError()
+    def get_messages_of_room(
+        self,
+        room_id: str | ObjectId,
+        before: str | ObjectId = None,
+        limit: int = 50,
+    ) -> List[Dict]:
+        """
+        Retrieve a page of the messages of the room given by its _id.
+        The page consists of the newest `limit` messages that were sent before the
+        message given by its _id as `before` (the cursor), or the newest `limit`
+        messages of the room, if no cursor is given.
+        To scroll further back, use the oldest message of the page as the next cursor.
+        If less than `limit` messages are returned, there are no older messages.
+
+        Returns a list of dicts containing the messages, oldest first, or an empty
+        list if there are no (more) messages.
+
+        Raises `RoomDoesntExistError` if no room with the given _id was found.
+        Raises `MessageDoesntExistError` if the cursor message was not found in the room.
+        """
+
+        room_id = util.parse_object_id(room_id)
 
-        return room["messages"]
+        self._check_room_exists(room_id)
+
+        query = {"room_id": room_id}
+        if before is not None:
+            before = util.parse_object_id(before)
+            cursor_message = self.db.messages.find_one(
+                {"_id": before, "room_id": room_id}, projection={"creation_date": True}
+            )
+            if not cursor_message:
+                raise MessageDoesntExistError()
+
+            # messages with the same creation date are ordered by their _id
+            query["$or"] = [
+                {"creation_date": {"$lt": cursor_message["creation_date"]}},
+                {
+                    "creation_date": cursor_message["creation_date"],
+                    "_id": {"$lt": before},
+                },
+            ]
+
+        messages = list(
+            self.db.messages.find(
+                query,
+                projection={"room_id": False},
+                sort=[
+                    ("creation_date", pymongo.DESCENDING),
+                    ("_id", pymongo.DESCENDING),
+                ],
+                limit=limit,
+            )
+        )
+        messages.reverse()
+        return messages
 
     def store_message(self, room_id: str | ObjectId, message: Dict) -> None:
         """
-        Store the given message in the room given by its _id.
+        Store the given message in the room given by its _id and set it as the
+        `last_message` of the room.
 
         Raises `ValueError` if the message dict misses required attributes.
         Raises `TypeError` if the types of the attributes in the message dict
@@ -146,6 +273,8 @@ class Chat:
         Raises `RoomDoesntExistError` if no room with the given _id was found.
         """
 
+        room_id = util.parse_object_id(room_id)
+
         # check correct message keys and their types in the dict
         if not all(key in message for key in self.MESSAGE_ATTRIBUTES.keys()):
             raise ValueError("Message misses required attribute")
@@ -161,12 +290,211 @@ class Chat:
 
         result = self.db.chatrooms.update_one(
             {"_id": room_id},
-            {"$push": {"messages": message}},
+            {"$set": {"last_message": message}},
         )
 
         if result.matched_count != 1:
             raise RoomDoesntExistError()
 
+        self.db.messages.insert_one({**message, "room_id": room_id})
+
+        self._increment_unread_counters(room_id, message)
+
+    def _increment_unread_counters(self, room_id: ObjectId, message: Dict) -> None:
+        """
+        count the given (freshly stored) message as unread for all users
+        that haven't acknowledged it yet.
+        """
+
+        operations = [
+            UpdateOne(
+                {"room_id": room_id, "username": send_state["username"]},
+                {
+                    "$inc": {"unread_count": 1},
+                    "$max": {"last_unread_date": message["creation_date"]},
+                },
+                upsert=True,
+            )
+            for send_state in message["send_states"]
+            if send_state["send_state"] != "acknowledged"
+        ]
+        if operations:
+            self.db.chat_unread.bulk_write(operations, ordered=False)
+
+    def get_unread_counts_for_user(self, username: str) -> Dict[ObjectId, int]:
+        """
+        Retrieve the number of unacknowledged messages of the given user per room.
+
+        Returns a dict mapping the room _id's to the number of unread messages,
+        rooms without unread messages are omitted.
+        """
+
+        return {
+            counter["room_id"]: counter["unread_count"]
+            for counter in self.db.chat_unread.find(
+                {"username": username, "unread_count": {"$gt": 0}},
+                projection={"_id": False, "room_id": True, "unread_count": True},
+            )
+        }
+
+    def get_unread_counts_since(self, since: datetime.datetime) -> Dict[str, Dict]:
+        """
+        Retrieve the users that have received messages since `since` which they
+        haven't acknowledged yet, along with their total number of unread messages
+        and the number of rooms they are in.
+
+        Returns a dict of the form::
+
+            {
+                <username>: {"messages": <int>, "rooms": <int>},
+                ...
+            }
+
+        """
+
+        return {
+            entry["_id"]: {"messages": entry["messages"], "rooms": entry["rooms"]}
+            for entry in self.db.chat_unread.aggregate(
+                [
+                    {
+                        "$match": {
+                            "unread_count": {"$gt": 0},
+                            "last_unread_date": {"$gte": since},
+                        }
+                    },
+                    {
+                        "$group": {
+                            "_id": "$username",
+                            "messages": {"$sum": "$unread_count"},
+                            "rooms": {"$sum": 1},
+                        }
+                    },
+                ]
+            )
+        }
+
+    def rebuild_unread_counters(self, room_ids: List[str | ObjectId] = None) -> int:
+        """
+        re-determine the unread counters from the send states of the stored messages,
+        either of the rooms given by their _id's or of all rooms. This is used to
+        backfill the counters for already existing messages and to repair them
+        after messages have been deleted.
+
+        Returns the number of counters.
+        """
+
+        room_filter = {}
+        if room_ids is not None:
+            room_filter = {
+                "room_id": {"$in": [util.parse_object_id(room_id) for room_id in room_ids]}
+            }
+
+        counters = [
+            {
+                "room_id": entry["_id"]["room_id"],
+                "username": entry["_id"]["username"],
+                "unread_count": entry["unread_count"],
+                "last_unread_date": entry["last_unread_date"],
+            }
+            for entry in self.db.messages.aggregate(
+                [
+                    {"$match": room_filter},
+                    {"$unwind": "$send_states"},
+                    {"$match": {"send_states.send_state": {"$ne": "acknowledged"}}},
+                    {
+                        "$group": {
+                            "_id": {
+                                "room_id": "$room_id",
+                                "username": "$send_states.username",
+                            },
+                            "unread_count": {"$sum": 1},
+                            "last_unread_date": {"$max": "$creation_date"},
+                        }
+                    },
+                ]
+            )
+        ]
+
+        self.db.chat_unread.delete_many(room_filter)
+        if counters:
+            self.db.chat_unread.insert_many(counters, ordered=False)
+
+        return len(counters)
+
+    def backfill_unread_counters_if_empty(self) -> None:
+        """
+        build the unread counters of all rooms if there are messages, but no counters
+        at all, i.e. on the first startup after the counters were introduced.
+        """
+
+        if self.db.chat_unread.count_documents({}, limit=1) == 0:
+            if self.db.messages.count_documents({}, limit=1) != 0:
+                self.rebuild_unread_counters()
+
+    def refresh_last_message(self, room_id: str | ObjectId) -> None:
+        """
+        re-determine the denormalized `last_message` of the room given by its _id
+        from its stored messages, e.g. after messages have been deleted.
+        """
+
+        room_id = util.parse_object_id(room_id)
+
+        last_message = self.db.messages.find_one(
+            {"room_id": room_id},
+            projection={"room_id": False},
+            sort=[("creation_date", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+        )
+        self.db.chatrooms.update_one(
+            {"_id": room_id}, {"$set": {"last_message": last_message}}
+        )
+
+    def migrate_embedded_messages(self) -> int:
+        """
+        move the messages of rooms that still embed them in a `messages` array
+        (the storage layout before the `messages` collection was introduced)
+        into the `messages` collection and set the `last_message` of those rooms.
+        The migration works room by room and can safely be re-run after
+        an interruption, rooms that have already been migrated are skipped.
+
+        Returns the number of migrated rooms.
+        """
+
+        migrated_rooms = 0
+        for room in self.db.chatrooms.find(
+            {"messages": {"$exists": True}}, projection={"messages": True}
+        ):
+            if room["messages"]:
+                try:
+                    self.db.messages.insert_many(
+                        [
+                            {**message, "room_id": room["_id"]}
+                            for message in room["messages"]
+                        ],
+                        ordered=False,
+                    )
+                except pymongo.errors.BulkWriteError as e:
+                    # messages that were already copied by an interrupted previous run
+                    # are rejected as duplicate _id's, anything else is a real error
+                    if any(
+                        error["code"] != 11000 for error in e.details["writeErrors"]
+                    ):
+                        raise
+
+            self.db.chatrooms.update_one(
+                {"_id": room["_id"]},
+                {
+                    "$set": {
+                        "last_message": (
+                            room["messages"][-1] if room["messages"] else None
+                        )
+                    },
+                    "$unset": {"messages": ""},
+                },
+            )
+            migrated_rooms += 1
+
+        return migrated_rooms
+
     async def send_message(
         self, room_id: str | ObjectId, message_content: str, sender: str
     ) -> None:
@@ -186,8 +514,10 @@ class Chat:
         message_id = ObjectId()
         creation_date = datetime.datetime.now()
 
-        room = self.db.chatrooms.find_one(
-            {"_id": room_id}, projection={"members": True}
+        # this function is a coroutine anyway, so the database is queried
+        # off the IOLoop
+        room = await util.run_in_mongodb_executor(
+            self.db.chatrooms.find_one, {"_id": room_id}, projection={"members": True}
         )
 
         if not room:
@@ -200,24 +530,30 @@ class Chat:
         send_states = []
 
         # i really don't know why, but top level import crashes the socketio server...
-        from handlers.socket_io import emit_event, get_sid_of_user, recipient_online
+        from handlers.socket_io import emit_event, get_online_recipients, user_room
+
+        # dispatch message to all sessions of the online recipients at once,
+        # the offline ones will receive it once they connect again
+        online_recipients = await util.run_in_mongodb_executor(
+            get_online_recipients, room["members"]
+        )
+        if online_recipients:
+            await emit_event(
+                "message",
+                {
+                    "_id": message_id,
+                    "message": message_content,
+                    "sender": sender,
+                    "recipients": room["members"],
+                    "room_id": room_id,
+                    "creation_date": creation_date,
+                },
+                room=[user_room(recipient) for recipient in online_recipients],
+            )
 
-        # dispatch message to all recipients
         for recipient in room["members"]:
-            if recipient_online(recipient):
-                # recipient is online, send message via socketio and store as "sent"
-                await emit_event(
-                    "message",
-                    {
-                        "_id": message_id,
-                        "message": message_content,
-                        "sender": sender,
-                        "recipients": room["members"],
-                        "room_id": room_id,
-                        "creation_date": creation_date,
-                    },
-                    room=get_sid_of_user(recipient),
-                )
+            if recipient in online_recipients:
+                # recipient is online, message was sent via socketio, store as "sent"
                 send_state = "sent"
             else:
                 # recipient is offline, message will be stored as "pending"
@@ -240,7 +576,7 @@ class Chat:
             "creation_date": creation_date,
             "send_states": send_states,
         }
-        self.store_message(room_id, message)
+        await util.run_in_mongodb_executor(self.store_message, room_id, message)
 
     def acknowledge_message(
         self,
@@ -263,7 +599,7 @@ class Chat:
         message_id = util.parse_object_id(message_id)
 
         # check if room exists
-        room = self.db.chatrooms.find_one({"_id": room_id})
+        room = self.db.chatrooms.find_one({"_id": room_id}, projection={"members": True})
         if not room:
             raise RoomDoesntExistError()
 
@@ -272,26 +608,68 @@ class Chat:
             raise UserNotMemberError()
 
         # update the send state of this user to "acknowledged"
-        result = self.db.chatrooms.update_one(
+        # (every user has exactly one send state per message)
+        result = self.db.messages.update_one(
             {
-                "_id": room_id,
-                "messages._id": message_id,
-                "messages.send_states.username": acknowledging_user,
+                "_id": message_id,
+                "room_id": room_id,
+                "send_states.username": acknowledging_user,
             },
-            {
-                "$set": {
-                    "messages.$[message].send_states.$[state].send_state": "acknowledged"
-                }
-            },
-            array_filters=[
-                {"message._id": message_id},
-                {"state.username": acknowledging_user},
-            ],
+            {"$set": {"send_states.$.send_state": "acknowledged"}},
         )
 
         if result.modified_count != 1:
             raise MessageDoesntExistError()
 
+        # the message was unread until now
+        self.db.chat_unread.update_one(
+            {
+                "room_id": room_id,
+                "username": acknowledging_user,
+                "unread_count": {"$gt": 0},
+            },
+            {"$inc": {"unread_count": -1}},
+        )
+
+        # keep the denormalized copy in the room in sync
+        self.db.chatrooms.update_one(
+            {
+                "_id": room_id,
+                "last_message._id": message_id,
+                "last_message.send_states.username": acknowledging_user,
+            },
+            {"$set": {"last_message.send_states.$.send_state": "acknowledged"}},
+        )
+
+    def _group_messages_by_room(
+        self, messages: List[Dict], room_filter: Optional[Dict] = None
+    ) -> List[Dict]:
+        """
+        group the given messages (sorted oldest first) by their room and enrich
+        them with the members and name of the room, resulting in dicts of the form::
+
+            {"_id": <room_id>, "members": [...], "name": <str>, "messages": [...]}
+
+        Only rooms matching the optional `room_filter` are included.
+        """
+
+        room_filter = room_filter or {}
+
+        messages_by_room = {}
+        for message in messages:
+            messages_by_room.setdefault(message.pop("room_id"), []).append(message)
+
+        if not messages_by_room:
+            return []
+
+        return [
+            {**room, "messages": messages_by_room[room["_id"]]}
+            for room in self.db.chatrooms.find(
+                {"_id": {"$in": list(messages_by_room.keys())}, **room_filter},
+                projection={"members": True, "name": True},
+            )
+        ]
+
     def get_rooms_with_unacknowledged_messages_for_user(
         self, username: str
     ) -> List[Dict]:
@@ -302,137 +680,65 @@ class Chat:
         The messages in the result are only those that are unacknowledged.
         """
 
-        return list(
-            self.db.chatrooms.aggregate(
-                [
-                    # find rooms that the user is member in
-                    # and has messages in it that are not yet acknowledged for the user
-                    {
-                        "$match": {
-                            "members": username,
-                            "messages": {
-                                "$elemMatch": {
-                                    "send_states": {
-                                        "$elemMatch": {
-                                            "username": username,
-                                            "send_state": {"$ne": "acknowledged"},
-                                        }
-                                    }
-                                }
-                            },
+        # the unread counters tell which rooms to look into at all,
+        # so users without unread messages don't cause any scan of the messages
+        room_ids = list(self.get_unread_counts_for_user(username).keys())
+        if not room_ids:
+            return []
+
+        messages = list(
+            self.db.messages.find(
+                {
+                    "room_id": {"$in": room_ids},
+                    "send_states": {
+                        "$elemMatch": {
+                            "username": username,
+                            "send_state": {"$ne": "acknowledged"},
                         }
-                    },
-                    # only return the messages that are not yet acknowledged
-                    # for easier dispatching of the events and less data queried
-                    {
-                        "$project": {
-                            "messages": {
-                                "$filter": {
-                                    "input": "$messages",
-                                    "as": "message",
-                                    "cond": {
-                                        "$gt": [
-                                            {
-                                                "$size": {
-                                                    "$filter": {
-                                                        "input": "$$message.send_states",
-                                                        "as": "state",
-                                                        "cond": {
-                                                            "$and": [
-                                                                {
-                                                                    "$eq": [
-                                                                        "$$state.username",
-                                                                        username,
-                                                                    ]
-                                                                },
-                                                                {
-                                                                    "$ne": [
-                                                                        "$$state.send_state",
-                                                                        "acknowledged",
-                                                                    ]
-                                                                },
-                                                            ]
-                                                        },
-                                                    }
-                                                }
-                                            },
-                                            0,
-                                        ]
-                                    },
-                                }
-                            },
-                            "members": True,
-                            "name": True,
-                        }
-                    },
-                ]
+                    }
+                },
+                sort=[("creation_date", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
             )
         )
 
+        return self._group_messages_by_room(messages, {"members": username})
+
     def get_rooms_with_unacknowledged_messages(self) -> List[Dict]:
         """
         Retrieve a list of rooms and messages that have unacknowledged messages
         within the past 24 hours.
+        The messages in the result are all unacknowledged messages of those rooms.
         """
 
-        return list(
-            self.db.chatrooms.aggregate(
-                [
-                    # find rooms that have at max 24h old messages in it that are not yet acknowledged
-                    {
-                        "$match": {
-                            "messages": {
-                                "$elemMatch": {
-                                    "creation_date": {
-                                        "$gte": datetime.datetime.now()
-                                        - datetime.timedelta(days=1)
-                                    },
-                                    "send_states": {
-                                        "$elemMatch": {
-                                            "send_state": {"$ne": "acknowledged"},
-                                        }
-                                    },
-                                }
-                            },
-                        }
-                    },
-                    # only return the messages that are not yet acknowledged
-                    # for easier dispatching of the events and less data queried
-                    {
-                        "$project": {
-                            "messages": {
-                                "$filter": {
-                                    "input": "$messages",
-                                    "as": "message",
-                                    "cond": {
-                                        "$gt": [
-                                            {
-                                                "$size": {
-                                                    "$filter": {
-                                                        "input": "$$message.send_states",
-                                                        "as": "state",
-                                                        "cond": {
-                                                            "$ne": [
-                                                                "$$state.send_state",
-                                                                "acknowledged",
-                                                            ]
-                                                        },
-                                                    }
-                                                }
-                                            },
-                                            0,
-                                        ]
-                                    },
-                                }
-                            },
-                            "members": True,
-                            "name": True,
-                        }
-                    },
-                ]
+        unacknowledged_filter = {
+            "send_states": {"$elemMatch": {"send_state": {"$ne": "acknowledged"}}}
+        }
+
+        # find rooms that have at max 24h old messages in it that are not yet acknowledged
+        room_ids = self.db.messages.distinct(
+            "room_id",
+            {
+                "creation_date": {
+                    "$gte": datetime.datetime.now() - datetime.timedelta(days=1)
+                },
+                **unacknowledged_filter,
+            },
+        )
+
+        if not room_ids:
+            return []
+
+        # only return the messages that are not yet acknowledged
+        # for easier dispatching of the events and less data queried
+        messages = list(
+            self.db.messages.find(
+                {"room_id": {"$in": room_ids}, **unacknowledged_filter},
+                sort=[("creation_date", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
             )
         )
 
+        return self._group_messages_by_room(messages)
+
     def bulk_set_message_sent_state(
         self,
         room_ids: List[str | ObjectId],
@@ -448,16 +754,40 @@ class Chat:
         (all of them together, NOT separated by rooms).
         """
 
-        for room_id in room_ids:
-            room_id = util.parse_object_id(room_id)
-        for message_id in message_ids:
-            message_id = util.parse_object_id(message_id)
+        room_ids = [util.parse_object_id(room_id) for room_id in room_ids]
+        message_ids = [util.parse_object_id(message_id) for message_id in message_ids]
+
+        # (every user has exactly one send state per message)
+        self.db.messages.update_many(
+            {
+                "_id": {"$in": message_ids},
+                "room_id": {"$in": room_ids},
+                "send_states.username": username,
+            },
+            {"$set": {"send_states.$.send_state": "sent"}},
+        )
 
+        # keep the denormalized copies in the rooms in sync
         self.db.chatrooms.update_many(
-            {"_id": {"$in": room_ids}},
-            {"$set": {"messages.$[message].send_states.$[state].send_state": "sent"}},
-            array_filters=[
-                {"message._id": {"$in": message_ids}},
-                {"state.username": username},
-            ],
+            {
+                "_id": {"$in": room_ids},
+                "last_message._id": {"$in": message_ids},
+                "last_message.send_states.username": username,
+            },
+            {"$set": {"last_message.send_states.$.send_state": "sent"}},
         )
+
+
+class AsyncChat(AsyncResource):
+    """
+    async variant of `Chat`, see `AsyncResource` for details.
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            chat_manager = AsyncChat(db)
+            rooms = await chat_manager.get_room_snippets_for_user(...)
+            ...
+
+    """
+
+    sync_resource_class = Chat
@@ -0,0 +1,406 @@
+import datetime
+import logging
+from typing import Dict, Iterable, List, Set
+
+from bson.objectid import ObjectId
+import pymongo
+from pymongo import UpdateOne
+from pymongo.database import Database
+
+from resources.indexes import Index
+import util
+
+logger = logging.getLogger(__name__)
+
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # lookup and upsert of a single feed entry
+    Index(
+        "feeds",
+        [("username", pymongo.ASCENDING), ("post_id", pymongo.ASCENDING)],
+        name="feeds_username_post_id",
+        unique=True,
+    ),
+    # range query of the personal timeline
+    Index(
+        "feeds",
+        [("username", pymongo.ASCENDING), ("creation_date", pymongo.DESCENDING)],
+        name="feeds_username_creation_date",
+    ),
+    # removing deleted posts
+    Index("feeds", "post_id", name="feeds_post_id"),
+    # removing posts of deleted spaces
+    Index("feeds", "space", name="feeds_space"),
+]
+
+
+class Feeds:
+    """
+    materialized "personal" timelines (see `Posts.get_personal_timeline()`).
+
+    Instead of determining the visible posts of a user at read time, every post
+    is fanned out on write into the `feeds` collection, holding one entry per
+    (recipient, post)::
+
+        {
+            "username": <recipient>,
+            "post_id": <_id of the post>,
+            "creation_date": <creation_date of the post>,
+            "author": <author of the post>,
+            "space": <space _id of the post or None>,
+        }
+
+    `author` and `space` are denormalized so that entries can be pruned with
+    a single indexed delete once the relation that made the post visible ends
+    (unfollowing a user, leaving a space).
+
+    The recipients of a post are:
+    - the author himself
+    - if the post is in a space: all members of that space
+    - if the post is not in a space: all followers of the author
+
+    This is exactly the set of users whose personal timeline included the post
+    before the feeds were introduced.
+
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            feed_manager = Feeds(db)
+            ...
+
+    """
+
+    # number of write operations that are sent to the db in one bulk request
+    BATCH_SIZE = 1000
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    @staticmethod
+    def _feed_entry_op(username: str, post: Dict) -> UpdateOne:
+        """
+        build an idempotent upsert of the feed entry of `post` for `username`,
+        so that duplicate fan-outs (e.g. concurrent follow and post) don't
+        create duplicate entries.
+        """
+
+        return UpdateOne(
+            {"username": username, "post_id": post["_id"]},
+            {
+                "$setOnInsert": {
+                    "username": username,
+                    "post_id": post["_id"],
+                    "creation_date": post["creation_date"],
+                    "author": post["author"],
+                    "space": post.get("space"),
+                }
+            },
+            upsert=True,
+        )
+
+    def _bulk_write(self, operations: Iterable) -> int:
+        """
+        send the given write operations to the db in batches of `BATCH_SIZE`.
+        Returns the number of operations that were sent.
+        """
+
+        count = 0
+        batch = []
+        for operation in operations:
+            batch.append(operation)
+            if len(batch) >= self.BATCH_SIZE:
+                self.db.feeds.bulk_write(batch, ordered=False)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.db.feeds.bulk_write(batch, ordered=False)
+            count += len(batch)
+        return count
+
+    def _visible_posts_query(self, username: str) -> Dict:
+        """
+        build the query on the `posts` collection that matches all posts
+        that belong into the feed of the given user. This is the single source of
+        truth for the fan-out rule, used to backfill, rebuild and check the feeds.
+        """
+
+        profile = self.db.profiles.find_one(
+            {"username": username}, projection={"_id": False, "follows": True}
+        )
+        follows = profile.get("follows", []) if profile else []
+
+        member_spaces = [
+            space["_id"]
+            for space in self.db.spaces.find(
+                {"members": username}, projection={"_id": True}
+            )
+        ]
+
+        return {
+            "$or": [
+                {"author": username},
+                {"space": {"$in": member_spaces}},
+                {"space": None, "author": {"$in": follows}},
+            ]
+        }
+
+    def get_recipients(self, post: Dict) -> Set[str]:
+        """
+        determine the users whose feed the given post belongs to.
+        :param post: the post, requires at least the `author` and `space` attributes
+        """
+
+        recipients = {post["author"]}
+
+        if post.get("space"):
+            space = self.db.spaces.find_one(
+                {"_id": post["space"]}, projection={"_id": False, "members": True}
+            )
+            if space:
+                recipients.update(space["members"])
+        else:
+            recipients.update(
+                profile["username"]
+                for profile in self.db.profiles.find(
+                    {"follows": post["author"]},
+                    projection={"_id": False, "username": True},
+                )
+            )
+
+        return recipients
+
+    def fan_out_post(self, post: Dict) -> None:
+        """
+        add the given (freshly inserted) post to the feeds of all its recipients.
+        :param post: the post, requires the `_id`, `author`, `space` and
+                     `creation_date` attributes
+        """
+
+        self._bulk_write(
+            self._feed_entry_op(username, post)
+            for username in self.get_recipients(post)
+        )
+
+    def remove_post(self, post_id: str | ObjectId) -> None:
+        """
+        remove the given post from all feeds
+        """
+
+        post_id = util.parse_object_id(post_id)
+
+        self.db.feeds.delete_many({"post_id": post_id})
+
+    def remove_space(self, space_id: str | ObjectId) -> None:
+        """
+        remove all posts of the given space from all feeds
+        """
+
+        space_id = util.parse_object_id(space_id)
+
+        self.db.feeds.delete_many({"space": space_id})
+
+    def add_space_posts(self, username: str, space_id: str | ObjectId) -> None:
+        """
+        add all posts of the given space to the feed of the given user,
+        i.e. because the user has become a member of the space.
+        """
+
+        space_id = util.parse_object_id(space_id)
+
+        self._bulk_write(
+            self._feed_entry_op(username, post)
+            for post in self.db.posts.find(
+                {"space": space_id},
+                projection={
+                    "_id": True,
+                    "creation_date": True,
+                    "author": True,
+                    "space": True,
+                },
+            )
+        )
+
+    def remove_space_posts(self, username: str, space_id: str | ObjectId) -> None:
+        """
+        remove all posts of the given space from the feed of the given user,
+        i.e. because the user has left the space. The users own posts in the space
+        remain in his feed.
+        """
+
+        space_id = util.parse_object_id(space_id)
+
+        self.db.feeds.delete_many(
+            {"username": username, "space": space_id, "author": {"$ne": username}}
+        )
+
+    def add_author_posts(self, username: str, author: str) -> None:
+        """
+        add all posts of `author` that are not in a space to the feed of `username`,
+        i.e. because `username` has started following `author`.
+        """
+
+        self._bulk_write(
+            self._feed_entry_op(username, post)
+            for post in self.db.posts.find(
+                {"author": author, "space": None},
+                projection={
+                    "_id": True,
+                    "creation_date": True,
+                    "author": True,
+                    "space": True,
+                },
+            )
+        )
+
+    def remove_author_posts(self, username: str, author: str) -> None:
+        """
+        remove all posts of `author` that are not in a space from the feed of
+        `username`, i.e. because `username` has unfollowed `author`. Posts of `author`
+        in spaces where `username` is a member remain in the feed.
+        """
+
+        if username == author:
+            return
+
+        self.db.feeds.delete_many(
+            {"username": username, "author": author, "space": None}
+        )
+
+    def delete_feed(self, username: str) -> None:
+        """
+        delete the whole feed of the given user, e.g. when the user is deleted
+        """
+
+        self.db.feeds.delete_many({"username": username})
+
+    def get_feed(
+        self, username: str, time_to: datetime.datetime, limit: int = 10
+    ) -> List[ObjectId]:
+        """
+        get the _id's of the newest `limit` posts in the feed of the given user
+        that are older than `time_to`, newest first.
+        This is a range query on the (username, creation_date) index.
+        """
+
+        return [
+            entry["post_id"]
+            for entry in self.db.feeds.find(
+                {"username": username, "creation_date": {"$lte": time_to}},
+                projection={"_id": False, "post_id": True},
+                sort=[("creation_date", -1)],
+                limit=limit,
+            )
+        ]
+
+    def _get_all_usernames(self) -> Set[str]:
+        """
+        get all users that may have a feed, i.e. everybody who has a profile,
+        is member of a space or has already a feed
+        """
+
+        usernames = set(self.db.profiles.distinct("username"))
+        usernames.update(self.db.spaces.distinct("members"))
+        usernames.update(self.db.feeds.distinct("username"))
+        return usernames
+
+    def rebuild_feed(self, username: str) -> int:
+        """
+        rebuild the feed of the given user from scratch.
+        Returns the number of entries in the rebuilt feed.
+        """
+
+        self.db.feeds.delete_many({"username": username})
+
+        return self._bulk_write(
+            self._feed_entry_op(username, post)
+            for post in self.db.posts.find(
+                self._visible_posts_query(username),
+                projection={
+                    "_id": True,
+                    "creation_date": True,
+                    "author": True,
+                    "space": True,
+                },
+            )
+        )
+
+    def rebuild_all(self) -> int:
+        """
+        rebuild the feeds of all users. This is used to backfill the feeds for
+        already existing posts and to repair feeds that were found to be
+        inconsistent by `check_consistency()`.
+        Returns the total number of feed entries.
+        """
+
+        count = 0
+        for username in self._get_all_usernames():
+            count += self.rebuild_feed(username)
+
+        logger.info("Rebuilt feeds, {} entries total".format(count))
+        return count
+
+    def backfill_if_empty(self) -> None:
+        """
+        build the feeds of all users if there are posts but no feed entries at all,
+        i.e. on the first startup after the feeds were introduced.
+        """
+
+        if self.db.feeds.count_documents({}, limit=1) == 0:
+            if self.db.posts.count_documents({}, limit=1) != 0:
+                self.rebuild_all()
+
+    def check_consistency(self, username: str = None) -> Dict:
+        """
+        compare the feeds with the posts that should be visible to their users and
+        report the differences, without repairing anything (use `rebuild_feed()` or
+        `rebuild_all()` for that).
+        If a username is given, only the feed of that user is checked, otherwise
+        the feeds of all users.
+
+        Returns a dict of the form::
+
+            {
+                "checked_users": <int>,
+                "inconsistent_users": [<username>, ...],
+                "missing_entries": <int>,
+                "stale_entries": <int>,
+            }
+
+        where `missing_entries` are posts that should be in a feed, but aren't,
+        and `stale_entries` are feed entries that shouldn't be there (anymore).
+        """
+
+        usernames = [username] if username else self._get_all_usernames()
+
+        report = {
+            "checked_users": 0,
+            "inconsistent_users": [],
+            "missing_entries": 0,
+            "stale_entries": 0,
+        }
+        for user in usernames:
+            expected = {
+                post["_id"]
+                for post in self.db.posts.find(
+                    self._visible_posts_query(user), projection={"_id": True}
+                )
+            }
+            actual = {
+                entry["post_id"]
+                for entry in self.db.feeds.find(
+                    {"username": user}, projection={"_id": False, "post_id": True}
+                )
+            }
+
+            missing = len(expected - actual)
+            stale = len(actual - expected)
+
+            report["checked_users"] += 1
+            report["missing_entries"] += missing
+            report["stale_entries"] += stale
+            if missing or stale:
+                report["inconsistent_users"].append(user)
+
+        return report
@@ -8,8 +8,13 @@ from exceptions import (
     PostNotExistingException,
 )
 import gridfs
+import pymongo
 from pymongo.database import Database
 
+from resources.async_resource import AsyncResource
+from resources.image_derivatives import delete_derivatives
+from resources.indexes import Index
+from resources.network.feed import Feeds
 from resources.network.profile import Profiles
 from resources.network.space import FileDoesntExistError, SpaceDoesntExistError, Spaces
 from model import VEPlan
@@ -17,6 +22,34 @@ from resources.planner.ve_plan import VEPlanResource
 import util
 
 
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # full text search
+    Index(
+        "posts",
+        [("text", pymongo.TEXT), ("tags", pymongo.TEXT), ("files", pymongo.TEXT)],
+        name="posts",
+    ),
+    # full timeline and new posts check
+    Index("posts", "creation_date", name="posts_creation_date"),
+    # space timeline
+    Index(
+        "posts",
+        [("space", pymongo.ASCENDING), ("creation_date", pymongo.DESCENDING)],
+        name="posts_space_creation_date",
+    ),
+    # user timeline
+    Index(
+        "posts",
+        [("author", pymongo.ASCENDING), ("creation_date", pymongo.DESCENDING)],
+        name="posts_author_creation_date",
+    ),
+    # comment lookups
+    Index("posts", "comments._id", name="posts_comments_id"),
+]
+
+
 class Posts:
     """
     to use this class, acquire a mongodb connection first via::
@@ -160,6 +193,9 @@ class Posts:
 
         result = self.db.posts.insert_one(post)
 
+        # distribute the post into the personal timelines of its recipients
+        Feeds(self.db).fan_out_post(post)
+
         # the post is viable for the achievement "create_posts", when the
         # text ist not empty
         if post["text"] and post["text"] != "":
@@ -238,8 +274,9 @@ class Posts:
             for file_obj in post["files"]:
                 self.delete_post_file(post_id, file_obj["file_id"])
 
-        # finally delete the post itself
+        # finally delete the post itself and remove it from the personal timelines
         self.db.posts.delete_one({"_id": post_id})
+        Feeds(self.db).remove_post(post_id)
 
     def delete_post_by_space(self, space_id: str | ObjectId) -> None:
         """
@@ -249,6 +286,7 @@ class Posts:
         space_id = util.parse_object_id(space_id)
 
         self.db.posts.delete_many({"space": space_id})
+        Feeds(self.db).remove_space(space_id)
 
     def like_post(self, post_id: str | ObjectId, username: str) -> None:
         """
@@ -396,6 +434,9 @@ class Posts:
 
         result = self.db.posts.insert_one(repost)
 
+        # distribute the repost into the personal timelines of its recipients
+        Feeds(self.db).fan_out_post(repost)
+
         return result.inserted_id
 
     def update_repost_text(self, repost_id: str | ObjectId, text: str) -> ObjectId:
@@ -526,6 +567,7 @@ class Posts:
             raise
 
         fs.delete(file_id)
+        delete_derivatives(self.db, file_id)
 
         if post["space"]:
             space_manager = Spaces(self.db)
@@ -680,186 +722,17 @@ class Posts:
         :param limit: the maximum number of posts to be returned, default 10
         """
 
-        pipeline = self.db.posts.aggregate(
-            [
-                # add the current_user as a field,
-                # we need this because looksups have to be on fields
-                {"$addFields": {"curr_user": username}},
-                # join with the space collection on the space name
-                {
-                    "$lookup": {
-                        "from": "spaces",
-                        "localField": "space",
-                        "foreignField": "_id",
-                        "as": "space_obj",
-                    }
-                },
-                # join with the follows collection on the current user
-                {
-                    "$lookup": {
-                        "from": "profiles",
-                        "localField": "curr_user",
-                        "foreignField": "username",
-                        "as": "profile_obj",
-                    }
-                },
-                # lookup result is a list, but since it is a n:1-relation,
-                # we only expect one space and can safely flatten the list to a dict
-                {
-                    "$unwind": {
-                        "path": "$space_obj",
-                        "preserveNullAndEmptyArrays": True,
-                    }
-                },
-                # lookup result is a list, but since it is a n:1-relation,
-                # we only expect one follow-record
-                # and can safely flatten the list to a dict
-                {
-                    "$unwind": {
-                        "path": "$profile_obj",
-                        "preserveNullAndEmptyArrays": True,
-                    }
-                },
-                # to make our lives easier with matching later
-                # we extract the list of users the current_user follows from the dict
-                # and also append the current_user himself to it
-                # (that way we can simply match "author in flattened_follows").
-                # this is rather complex, because if the lookup doesnt find any match,
-                # the result is missing (instead of None or []), so we have to check for that
-                {
-                    "$addFields": {
-                        "flattened_follows": {
-                            "$cond": {
-                                "if": {"$ne": [{"$type": "$profile_obj"}, "missing"]},
-                                "then": {
-                                    "$concatArrays": [
-                                        "$profile_obj.follows",
-                                        [username],
-                                    ]
-                                },
-                                "else": {
-                                    "$concatArrays": [
-                                        [],
-                                        [username],
-                                    ]
-                                },
-                            }
-                        }
-                    }
-                },
-                # now the actual filtering begins:
-                # - we first check for the time frame to include only posts that are older than time_to
-                # we now have to check for the 3 cases described on top of the pipeline,
-                # that allow for the post to be in the timeline
-                {
-                    "$match": {
-                        "creation_date": {"$lte": time_to},
-                        "$or": [
-                            # this catches the first and the second case
-                            # (being either the author yourself or you are following
-                            # the author of the post)
-                            {"$expr": {"$in": ["$author", "$flattened_follows"]}},
-                            # this catches the third case, being a member of the space
-                            # the post was put into
-                            # same story as for the flattened_follows:
-                            # this is rather complex, because if the lookup doesnt find anything
-                            # the expected dict is not present (instead of None or []),
-                            # so we have to check existence, and only if it exists, if current_user
-                            # is really a member of the space
-                            {
-                                "$expr": {
-                                    "$in": [
-                                        username,
-                                        {
-                                            "$cond": {
-                                                "if": {
-                                                    "$ne": [
-                                                        {"$type": "$space_obj"},
-                                                        "missing",
-                                                    ]
-                                                },
-                                                "then": "$space_obj.members",
-                                                "else": [],
-                                            }
-                                        },
-                                    ]
-                                }
-                            },
-                        ],
-                        # the matches above actually cover all relevant cases, but one single detail is missing:
-                        # they include posts from user that i follow, that they have posted into spaces
-                        # where i am not a member.
-                        # since i am not a member of that space, i shouldnt be allowed to view that post,
-                        # so we have to filter those out as well by checking:
-                        #   author is not current_user
-                        #   AND post is in a space
-                        #   AND current_user is not member of that space
-                        # if that is true, we leave out the post
-                        "$expr": {
-                            "$eq": [
-                                False,
-                                {
-                                    "$cond": {
-                                        "if": {
-                                            "$and": [
-                                                # check author != cur_user
-                                                {
-                                                    "$ne": [
-                                                        "$author",
-                                                        "$curr_user",
-                                                    ]
-                                                },
-                                                # check space not None
-                                                {"$ne": ["$space", None]},
-                                                # check cur_user not member of space
-                                                {
-                                                    "$not": {
-                                                        "$in": [
-                                                            username,
-                                                            {
-                                                                "$cond": {
-                                                                    "if": {
-                                                                        "$ne": [
-                                                                            {
-                                                                                "$type": "$space_obj"
-                                                                            },
-                                                                            "missing",
-                                                                        ]
-                                                                    },
-                                                                    "then": "$space_obj.members",
-                                                                    "else": [],
-                                                                }
-                                                            },
-                                                        ]
-                                                    }
-                                                },
-                                            ]
-                                        },
-                                        "then": True,
-                                        "else": False,
-                                    }
-                                },
-                            ]
-                        },
-                    }
-                },
-                # sort by creation date, descending
-                {"$sort": {"creation_date": -1}},
-                # only include the last `limit` posts
-                {"$limit": limit},
-                # last step, cleanup all the extra fields we had to use along
-                {
-                    "$unset": [
-                        "curr_user",
-                        "flattened_follows",
-                        "profile_obj",
-                        "space_obj",
-                    ]
-                },
-            ]
-        )
+        # the visible posts are materialized into the feed of the user on write
+        # (see `Feeds`), so the timeline is an indexed range query on the feed
+        post_ids = Feeds(self.db).get_feed(username, time_to, limit)
 
-        return list(pipeline)
+        posts = {
+            post["_id"]: post
+            for post in self.db.posts.find({"_id": {"$in": post_ids}})
+        }
+
+        # keep the newest-first order of the feed
+        return [posts[post_id] for post_id in post_ids if post_id in posts]
 
     def check_new_posts_since_timestamp(self, timestamp: datetime.datetime) -> bool:
         """
@@ -876,3 +749,18 @@ class Posts:
             return False
         else:
             return True
+
+
+class AsyncPosts(AsyncResource):
+    """
+    async variant of `Posts`, see `AsyncResource` for details.
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            post_manager = AsyncPosts(db)
+            posts = await post_manager.get_personal_timeline(...)
+            ...
+
+    """
+
+    sync_resource_class = Posts
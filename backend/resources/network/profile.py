@@ -2,9 +2,17 @@ from typing import Dict, List, Literal, Optional
 from bson import ObjectId
 
 import gridfs
+import pymongo
 from pymongo import ReturnDocument
 from pymongo.database import Database
+from resources.async_resource import AsyncResource
+from resources.indexes import Index
+from resources.network.acl import get_acl_cache
 from resources.elasticsearch_integration import ElasticsearchConnector
+from resources.network.feed import Feeds
+from resources.image_derivatives import schedule_derivatives
+from resources.network.profile_snippet_cache import get_profile_snippet_cache
+from resources.upload_urls import sign_file_url
 
 from exceptions import (
     AlreadyFollowedException,
@@ -14,6 +22,17 @@ from exceptions import (
 import util
 
 
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    Index("profiles", "username", name="profiles_username"),
+    # finding the followers of a user
+    Index("profiles", "follows", name="profiles_follows"),
+    # finding the users of a role, e.g. by the ACL cleanup
+    Index("profiles", "role", name="profiles_role"),
+]
+
+
 class Profiles:
     """
     to use this class, acquire a mongodb connection first via::
@@ -24,6 +43,20 @@ class Profiles:
 
     """
 
+    # the attributes of a profile that make up its snippet
+    SNIPPET_PROJECTION = {
+        "_id": True,
+        "username": True,
+        "first_name": True,
+        "last_name": True,
+        "institutions": True,
+        "chosen_institution_id": True,
+        "profile_pic": True,
+        "chosen_achievement": True,
+        "ve_ready": True,
+        "snippet_version": True,
+    }
+
     def __init__(self, db: Database):
         self.db = db
 
@@ -371,6 +404,9 @@ class Profiles:
         if update_result.modified_count != 1:
             raise AlreadyFollowedException()
 
+        # the posts of the followed user now belong into the personal timeline
+        Feeds(self.db).add_author_posts(username, username_to_follow)
+
     def remove_follows(self, username: str, username_to_unfollow: str) -> None:
         """
         let the user behind 'username' unfollow the user behind 'username_to_follow'.
@@ -392,6 +428,9 @@ class Profiles:
         if update_result.modified_count != 1:
             raise NotFollowedException()
 
+        # the posts of the unfollowed user are no longer part of the personal timeline
+        Feeds(self.db).remove_author_posts(username, username_to_unfollow)
+
     def get_followers(self, username: str) -> List[str]:
         """
         get a list of usernames that follow the given user
@@ -430,6 +469,8 @@ class Profiles:
         if update_result.matched_count != 1:
             raise ProfileDoesntExistException()
 
+        get_acl_cache().invalidate_role(self.db, username)
+
     def check_role_exists(self, role: str) -> bool:
         """
         check if the given role exists, i.e. atleast one user has this role.
@@ -584,6 +625,9 @@ class Profiles:
             )
             updated_profile["profile_pic"] = _id
 
+            # thumbnails for the avatars are generated in the background
+            schedule_derivatives(_id)
+
         # ensure that plan_id inside a ve_window entry is an ObjectId
         if "ve_window" in updated_profile:
             for ve_window_entry in updated_profile["ve_window"]:
@@ -637,11 +681,13 @@ class Profiles:
                 if updated_profile["chosen_achievement"]["level"] > user_achievements[updated_profile["chosen_achievement"]["type"]]["level"]:
                         raise ValueError("User has not reached the achievement level he is trying to set")
 
-        # all checks passed, update the profile
+        # all checks passed, update the profile. The snippet version is incremented,
+        # so that no process serves the outdated snippet from its cache
         result = self.db.profiles.find_one_and_update(
             {"username": username},
             {
                 "$set": updated_profile,
+                "$inc": {"snippet_version": 1},
                 # set default values only on insert
                 "$setOnInsert": {"username": username, "role": "guest", "follows": []},
             },
@@ -649,6 +695,9 @@ class Profiles:
             return_document=ReturnDocument.AFTER,
         )
 
+        # write the new snippet through to the cache of this process
+        self._cache_snippet(result)
+
         # replicate the update to elasticsearch
         updated_profile["username"] = username
         ElasticsearchConnector().on_update(
@@ -670,9 +719,16 @@ class Profiles:
         has not chosen an institution, the field is an empty string (""), even if he might have
         listed institution in his profile (in case he has listed them, but not yet chosen one as
         the current one).
+        Additionally, every snippet contains a signed URL of the profile pic as
+        `profile_pic_url` (see `resources.upload_urls.sign_file_url()`), which can be
+        fetched without authentication, or None if signed URLs are disabled.
         If any of the usernames has no profile, it is omitted from the response,
         meaning the length of the response list and the given list of usernames
         might differ.
+
+        The snippets are cached by this process (see `ProfileSnippetCache`),
+        a single query of the `snippet_version`s ensures that only snippets of
+        unchanged profiles are served from the cache.
         """
 
         if not isinstance(usernames, list):
@@ -685,33 +741,88 @@ class Profiles:
         if not usernames:
             return []
 
-        profiles = self.get_bulk_profiles(
-            usernames,
-            projection={
-                "_id": False,
-                "username": True,
-                "first_name": True,
-                "last_name": True,
-                "institutions": True,
-                "chosen_institution_id": True,
-                "profile_pic": True,
-                "chosen_achievement": True,
-                "ve_ready": True
-            },
+        # snippets are served from the cache of this process, as long as their
+        # profile hasn't changed since they were cached
+        cache = get_profile_snippet_cache()
+        cached = cache.get_many(usernames)
+        snippets = {}
+        if cached:
+            current_versions = {
+                profile["username"]: (
+                    profile["_id"],
+                    profile.get("snippet_version", 0),
+                )
+                for profile in self.db.profiles.find(
+                    {"username": {"$in": list(cached)}},
+                    projection={"username": True, "snippet_version": True},
+                )
+            }
+            for username, (_id, version, snippet) in cached.items():
+                if current_versions.get(username) == (_id, version):
+                    snippets[username] = snippet
+                else:
+                    cache.invalidate(username)
+
+        usernames_to_fetch = [
+            username for username in set(usernames) if username not in snippets
+        ]
+        cache.record(
+            hits=len(snippets),
+            misses=len(usernames_to_fetch),
+            stale=len(cached) - len(snippets),
         )
 
-        # refactor the institutions: only keep the name of the chosen institution as
-        # "institution" and discard "institutions" and "chosen_institution_id"
-        for profile in profiles:
-            profile["institution"] = ""  # default empty string
-            for institution in profile["institutions"]:
-                if institution["_id"] == profile["chosen_institution_id"]:
-                    profile["institution"] = institution["name"]
-                    break
-            del profile["institutions"]
-            del profile["chosen_institution_id"]
+        if usernames_to_fetch:
+            for profile in self.get_bulk_profiles(
+                usernames_to_fetch, projection=self.SNIPPET_PROJECTION
+            ):
+                snippet = self._cache_snippet(profile)
+                snippets[snippet["username"]] = snippet
 
-        return profiles
+        # copies, so that the cached snippets can't be modified by the caller,
+        # the signed URL of the profile pic is added to the copy, because it expires
+        return [
+            dict(
+                snippets[username],
+                profile_pic_url=sign_file_url(
+                    snippets[username].get("profile_pic", "default_profile_pic.jpg")
+                ),
+            )
+            for username in dict.fromkeys(usernames)
+            if username in snippets
+        ]
+
+    def _cache_snippet(self, profile: Dict) -> Dict:
+        """
+        build the snippet from the `profile` (projected by `SNIPPET_PROJECTION`)
+        and put it into the cache of this process.
+        The institutions are refactored: only the name of the chosen institution
+        is kept as "institution", "institutions" and "chosen_institution_id" are discarded.
+
+        Returns the snippet.
+        """
+
+        snippet = {
+            key: profile[key]
+            for key in self.SNIPPET_PROJECTION
+            if key in profile
+            and key
+            not in ("_id", "institutions", "chosen_institution_id", "snippet_version")
+        }
+
+        snippet["institution"] = ""  # default empty string
+        for institution in profile.get("institutions", []):
+            if institution["_id"] == profile.get("chosen_institution_id"):
+                snippet["institution"] = institution["name"]
+                break
+
+        get_profile_snippet_cache().put(
+            profile["username"],
+            profile["_id"],
+            profile.get("snippet_version", 0),
+            snippet,
+        )
+        return snippet
 
     def get_matching_exclusion(self, username: str) -> bool:
         """
@@ -862,11 +973,15 @@ class Profiles:
             )
             leveled_up = True
 
-        # update the profile with the new achievement status
-        self.db.profiles.update_one(
-            {"username": username},
-            {"$set": {"achievements": achievements}},
-        )
+        # update the profile with the new achievement status, a level up
+        # invalidates the cached snippets, because it changes which
+        # achievement levels the user may show in it
+        update = {"$set": {"achievements": achievements}}
+        if leveled_up:
+            update["$inc"] = {"snippet_version": 1}
+        self.db.profiles.update_one({"username": username}, update)
+        if leveled_up:
+            get_profile_snippet_cache().invalidate(username)
 
         # send a notification if the user has leveled up
         if leveled_up:
@@ -984,3 +1099,18 @@ class Profiles:
                 }
             },
         )
+
+
+class AsyncProfiles(AsyncResource):
+    """
+    async variant of `Profiles`, see `AsyncResource` for details.
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            profile_manager = AsyncProfiles(db)
+            snippets = await profile_manager.get_profile_snippets(...)
+            ...
+
+    """
+
+    sync_resource_class = Profiles
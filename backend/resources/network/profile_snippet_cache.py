@@ -0,0 +1,131 @@
+from collections import OrderedDict
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from bson import ObjectId
+
+import global_vars
+
+
+class ProfileSnippetCache:
+    """
+    bounded LRU cache of profile snippets (see `Profiles.get_profile_snippets()`),
+    keyed by username. An entry is only valid for `TTL` seconds.
+
+    Every entry remembers the `_id` and `snippet_version` of the profile it was
+    built from. Every change of a snippet attribute increments the `snippet_version`
+    of the profile, so before cached snippets are used, their versions are compared
+    against the database (which `Profiles.get_profile_snippets()` does with a single
+    small query). That way snippets changed by another process or profiles that were
+    deleted and created again are never served from the cache. Changes made by this
+    process are written through to the cache right away.
+    """
+
+    MAX_SIZE = 10000
+    TTL = 300
+
+    def __init__(self, max_size: int = None, ttl: float = None):
+        self.max_size = max_size or self.MAX_SIZE
+        self.ttl = ttl or self.TTL
+        # username -> (profile _id, snippet_version, snippet, expires)
+        self._entries: OrderedDict[str, Tuple[ObjectId, int, Dict, float]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get_many(
+        self, usernames: Iterable[str]
+    ) -> Dict[str, Tuple[ObjectId, int, Dict]]:
+        """
+        Returns the unexpired entries of the users as a dict mapping the username to
+        the `_id` and `snippet_version` of the profile and the snippet. The versions
+        still have to be validated, afterwards `record()` the outcome.
+        """
+
+        now = time.monotonic()
+        entries = {}
+        with self._lock:
+            for username in usernames:
+                entry = self._entries.get(username)
+                if entry is None:
+                    continue
+                if entry[3] <= now:
+                    del self._entries[username]
+                    continue
+                self._entries.move_to_end(username)
+                entries[username] = entry[:3]
+        return entries
+
+    def put(self, username: str, _id: ObjectId, version: int, snippet: Dict) -> None:
+        with self._lock:
+            self._entries[username] = (
+                _id,
+                version,
+                snippet,
+                time.monotonic() + self.ttl,
+            )
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username: str) -> None:
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def record(self, hits: int, misses: int, stale: int) -> None:
+        """
+        record the outcome of a lookup: `hits` snippets were served from the cache,
+        `misses` had to be fetched, `stale` of them because their cached version was
+        outdated.
+        """
+
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.stale += stale
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def get_metrics(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "cached_snippets": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def get_profile_snippet_cache() -> ProfileSnippetCache:
+    """
+    Returns the profile snippet cache of this process, which is lazily created
+    on first use.
+    """
+
+    if global_vars.profile_snippet_cache is None:
+        global_vars.profile_snippet_cache = ProfileSnippetCache()
+    return global_vars.profile_snippet_cache
+
+
+def get_profile_snippet_cache_metrics() -> Dict:
+    """
+    Returns the metrics of the profile snippet cache of this process (see
+    `ProfileSnippetCache.get_metrics()`), or an empty dict if it has not been used yet.
+    """
+
+    if global_vars.profile_snippet_cache is None:
+        return {}
+    return global_vars.profile_snippet_cache.get_metrics()
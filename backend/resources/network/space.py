@@ -2,6 +2,7 @@ from typing import Dict, List, Optional
 
 from bson import ObjectId
 import gridfs
+import pymongo
 from pymongo import ReturnDocument
 from pymongo.database import Database
 from exceptions import (
@@ -18,12 +19,33 @@ from exceptions import (
     UserNotInvitedError,
     UserNotMemberError,
 )
+from resources.async_resource import AsyncResource
+from resources.indexes import Index
 from resources.elasticsearch_integration import ElasticsearchConnector
+from resources.image_derivatives import delete_derivatives, schedule_derivatives
+from resources.network.feed import Feeds
 from resources.network.profile import Profiles
 from model import Space
 import util
 
 
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    Index("spaces", "name", name="space_name"),
+    Index("spaces", "members", name="spaces_members"),
+    # files of a user, the gridfs index below is the one that
+    # gridfs itself builds lazily, declared here to be reconciled as well
+    # (the one on fs.chunks is declared by `resources.streaming_upload`)
+    Index("fs.files", "metadata.uploader", name="fs_files_metadata_uploader"),
+    Index(
+        "fs.files",
+        [("filename", pymongo.ASCENDING), ("uploadDate", pymongo.ASCENDING)],
+        name="filename_1_uploadDate_1",
+    ),
+]
+
+
 class Spaces:
     """
     to use this class, acquire a mongodb connection first via::
@@ -341,6 +363,7 @@ class Spaces:
         fs = gridfs.GridFS(self.db)
         for file in space_files:
             fs.delete(file["file_id"])
+            delete_derivatives(self.db, file["file_id"])
 
         self.db.spaces.delete_one({"_id": space_id})
 
@@ -395,6 +418,9 @@ class Spaces:
         # because a set doesnt allow duplicates, meaning his name is already in it
         if update_result.modified_count != 1:
             raise AlreadyMemberError()
+
+        # the posts of the space now belong into the personal timeline of the user
+        Feeds(self.db).add_space_posts(username, space_id)
         
         # since all checks have passed, count towards the achievement "join_groups"
         profile_manager = Profiles(self.db)
@@ -444,6 +470,10 @@ class Spaces:
         # because a set doesnt allow duplicates, meaning his name is already in it
         if update_result.modified_count != 1:
             raise AlreadyAdminError()
+
+        # the user might have become a member just now, so the posts of the space
+        # belong into his personal timeline (already present entries are kept)
+        Feeds(self.db).add_space_posts(username, space_id)
         
         # since all checks have passed, count towards the achievement "admin_groups"
         profile_manager = Profiles(self.db)
@@ -471,6 +501,9 @@ class Spaces:
             metadata={"uploader": "me"},
         )
 
+        # thumbnails are generated in the background
+        schedule_derivatives(_id)
+
         update_result = self.db.spaces.update_one(
             {"_id": space_id},
             {
@@ -556,6 +589,9 @@ class Spaces:
             },
         )
 
+        # the posts of the space now belong into the personal timeline of the user
+        Feeds(self.db).add_space_posts(username, space_id)
+
         # since all checks have passed, count towards the achievement "join_groups"
         profile_manager = Profiles(self.db)
         profile_manager.achievement_count_up(username, "join_groups")
@@ -626,6 +662,9 @@ class Spaces:
             {"$addToSet": {"members": username}, "$pull": {"requests": username}},
         )
 
+        # the posts of the space now belong into the personal timeline of the user
+        Feeds(self.db).add_space_posts(username, space_id)
+
         # since all checks have passed, count towards the achievement "join_groups"
         profile_manager = Profiles(self.db)
         profile_manager.achievement_count_up(username, "join_groups")
@@ -747,6 +786,9 @@ class Spaces:
             },
         )
 
+        # the posts of the space are no longer part of the personal timeline of the user
+        Feeds(self.db).remove_space_posts(username, space_id)
+
     def kick_user(self, space_id: str | ObjectId, username: str) -> None:
         """
         the given user is kicked from the space (usually by an admin, but permission are
@@ -768,6 +810,9 @@ class Spaces:
         if update_result.modified_count != 1:
             raise UserNotMemberError()
 
+        # the posts of the space are no longer part of the personal timeline of the user
+        Feeds(self.db).remove_space_posts(username, space_id)
+
     def revoke_space_admin_privilege(
         self, space_id: str | ObjectId, username: str
     ) -> None:
@@ -876,21 +921,40 @@ class Spaces:
             metadata={"uploader": uploader},
         )
 
-        self.db.spaces.update_one(
+        self.attach_repo_file(space_id, _id, file_name, uploader)
+
+        return _id
+
+    def attach_repo_file(
+        self,
+        space_id: str | ObjectId,
+        file_id: ObjectId,
+        file_name: str,
+        uploader: str,
+    ) -> None:
+        """
+        add a file that has already been stored in gridfs (e.g. streamed there
+        while it was uploaded, see `handlers.streaming_upload`) to the space's
+        'repository'.
+        """
+
+        space_id = util.parse_object_id(space_id)
+
+        result = self.db.spaces.update_one(
             {"_id": space_id},
             {
                 "$addToSet": {
                     "files": {
                         "author": uploader,
-                        "file_id": _id,
+                        "file_id": file_id,
                         "file_name": file_name,
                         "manually_uploaded": True,
                     }
                 }
             },
         )
-
-        return _id
+        if result.matched_count == 0:
+            raise SpaceDoesntExistError()
 
     def remove_file(self, space_id: str | ObjectId, file_id: ObjectId) -> None:
         """
@@ -926,6 +990,7 @@ class Spaces:
                         {"$pull": {"files": {"file_id": file_id}}},
                     )
                     fs.delete(file_id)
+                    delete_derivatives(self.db, file_id)
             return
 
         # after iterating the whole loop, the file wasnt found, so we raise an error
@@ -953,3 +1018,18 @@ class Spaces:
         # if no document was modified, the file wasn't in the space files metadata
         if update_result.modified_count != 1:
             raise FileDoesntExistError()
+
+
+class AsyncSpaces(AsyncResource):
+    """
+    async variant of `Spaces`, see `AsyncResource` for details.
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            space_manager = AsyncSpaces(db)
+            is_member = await space_manager.check_user_is_member(...)
+            ...
+
+    """
+
+    sync_resource_class = Spaces
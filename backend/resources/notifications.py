@@ -1,20 +1,45 @@
+import asyncio
 import datetime
-from typing import Dict, List
+import time
+from typing import Dict, List, Tuple
 
 from bson import ObjectId
 from bson.errors import InvalidId
 import logging
+import pymongo
 from pymongo.database import Database
 
 from exceptions import NotificationDoesntExistError
-import global_vars
+from resources.async_resource import AsyncResource
+from resources.indexes import Index
+from resources.mail_outbox import send_email, send_emails
 from resources.network.chat import Chat
 from resources.network.profile import Profiles
+from resources.user_directory import UserDirectory
 import util
 
 logger = logging.getLogger(__name__)
 
 
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    Index(
+        "notifications",
+        [("to", pymongo.ASCENDING), ("receive_state", pymongo.ASCENDING)],
+        name="notifications_to_receive_state",
+    ),
+    # skipping the users that already received a notification
+    # of a resumed dispatch
+    Index(
+        "notifications",
+        [("dispatch_id", pymongo.ASCENDING), ("to", pymongo.ASCENDING)],
+        name="notifications_dispatch_id_to",
+        sparse=True,
+    ),
+]
+
+
 class NotificationResource:
     """
     to use this class, acquire a mongodb connection first via::
@@ -25,6 +50,9 @@ class NotificationResource:
 
     """
 
+    # number of users per batch of `bulk_send_notifications()`
+    DISPATCH_BATCH_SIZE = 500
+
     def __init__(self, db: Database) -> None:
         self.db = db
 
@@ -160,19 +188,17 @@ class NotificationResource:
         }
 
         # i really don't know why, but top level import crashes the socketio server...
-        from handlers.socket_io import emit_event, get_sid_of_user, recipient_online
+        from handlers.socket_io import emit_event, recipient_online, user_room
 
         # if recipient of the invitation is currently "online" (i.e. connected via socket),
-        # emit the notification instantly, otherwise it will be held back until
-        # until the user connects the next time
-        if recipient_online(recipient):
-            user_sid = get_sid_of_user(recipient)
-            if user_sid is not None:
-                await emit_event("notification", notification_payload, user_sid)
+        # emit the notification instantly to all of their sessions, otherwise it will be
+        # held back until the user connects the next time
+        if await util.run_in_mongodb_executor(recipient_online, recipient):
+            await emit_event("notification", notification_payload, user_room(recipient))
 
-                # store notification as "sent", because user was online
-                # and notification is already dispatched
-                notification_payload["receive_state"] = "sent"
+            # store notification as "sent", because user was online
+            # and notification is already dispatched
+            notification_payload["receive_state"] = "sent"
 
         # store notification, either as "pending" or "sent",
         # depending on if the user was currently online or not.
@@ -193,10 +219,16 @@ class NotificationResource:
         via email
         """
 
-        user_id = global_vars.keycloak_admin.get_user_id(recipient)
-        recipient_email = global_vars.keycloak_admin.get_user(user_id)["email"]
+        recipient_email = UserDirectory(self.db).get_email(recipient)
+        if recipient_email is None:
+            logger.warning(
+                "No email address known for {}, skipping email notification".format(
+                    recipient
+                )
+            )
+            return
 
-        util.send_email(
+        send_email(
             recipient,
             recipient_email,
             email_subject,
@@ -205,8 +237,12 @@ class NotificationResource:
         )
 
     async def bulk_send_notifications(
-        self, notification_type: str, payload: Dict, email_subject: str
-    ) -> None:
+        self,
+        notification_type: str,
+        payload: Dict,
+        email_subject: str,
+        dispatch_id: str = None,
+    ) -> Dict:
         """
         Dispatch a notification to ALL(!) users,
         by specifying the `notification_type` and the `payload` that
@@ -236,9 +272,18 @@ class NotificationResource:
         `handlers.socket_io.acknowledge_notification` on how to send appropriate
         acknowledgements to notifications.
 
-        Email notifications are sent instantly, if the user has complied to receive them.
+        Email notifications are enqueued to the mail outbox, if the user has complied
+        to receive them.
 
-        Returns nothing.
+        The users are processed in batches of `DISPATCH_BATCH_SIZE` in the order of
+        their usernames. After each batch, the progress is recorded in a checkpoint
+        in `notification_dispatches` under the `dispatch_id`, so that a dispatch that
+        was interrupted resumes where it stopped when it is run again with the same
+        `dispatch_id`, and a dispatch that has already finished is not repeated.
+        If no `dispatch_id` is given, a new one is generated.
+
+        Returns the checkpoint, containing the number of "recipients", "push" and
+        "email" notifications.
 
         Raises `ValueError` if the `notification_type` is not allowed.
         """
@@ -251,35 +296,285 @@ class NotificationResource:
                 )
             )
 
-        # grab users and their notification settings
-        all_users_notification_settings = Profiles(self.db).get_all_profiles(
-            projection={"username": True, "notification_settings": True}
+        if dispatch_id is None:
+            dispatch_id = str(ObjectId())
+
+        checkpoint, resumed = await util.run_in_mongodb_executor(
+            self._start_dispatch, dispatch_id, notification_type, payload, email_subject
         )
+        if checkpoint["finished_at"] is not None:
+            logger.info(
+                "Notification dispatch {} has already finished, skipping".format(
+                    dispatch_id
+                )
+            )
+            return checkpoint
+        if resumed:
+            logger.info(
+                "Resuming notification dispatch {} after {}".format(
+                    dispatch_id, checkpoint["last_username"]
+                )
+            )
 
-        # determine relevant notification settings for the notification type
-        notification_setting = self.notification_type_setting_mapper[notification_type]
+        # i really don't know why, but top level import crashes the socketio server...
+        from handlers.socket_io import emit_event
+
+        while True:
+            start = time.perf_counter()
+            batch = await util.run_in_mongodb_executor(
+                self._dispatch_batch,
+                checkpoint,
+                payload,
+                email_subject,
+                # the batch after the checkpoint may have been dispatched partially
+                # before the interruption
+                resumed,
+            )
+            resumed = False
 
-        # dispatch the notification to each user, respecting their notification settings
-        for recipient in all_users_notification_settings:
-            # no notifications at all
-            if recipient["notification_settings"][notification_setting] == "none":
-                return
-            # push only
-            elif recipient["notification_settings"][notification_setting] == "push":
-                await self._notify_push(
-                    recipient["username"], notification_type, payload
+            # notifications of online users are emitted right away
+            await asyncio.gather(
+                *(
+                    emit_event("notification", notification, room)
+                    for room, notification in batch["emit"]
                 )
-            # email and push
-            elif recipient["notification_settings"][notification_setting] == "email":
-                await self._notify_push(
-                    recipient["username"], notification_type, payload
+            )
+
+            duration = time.perf_counter() - start
+            if batch["recipients"]:
+                logger.info(
+                    "Notification dispatch {}: batch of {} users in {:.2f}s "
+                    "({:.0f} users/s), {} push, {} email, {} emitted".format(
+                        dispatch_id,
+                        batch["recipients"],
+                        duration,
+                        batch["recipients"] / max(duration, 1e-6),
+                        batch["push"],
+                        batch["email"],
+                        len(batch["emit"]),
+                    )
                 )
+
+            if batch["recipients"] < self.DISPATCH_BATCH_SIZE:
+                break
+
+        checkpoint = await util.run_in_mongodb_executor(
+            self._finish_dispatch, dispatch_id
+        )
+        logger.info(
+            "Notification dispatch {} finished: {} users, {} push, {} email".format(
+                dispatch_id,
+                checkpoint["recipients"],
+                checkpoint["push"],
+                checkpoint["email"],
+            )
+        )
+        return checkpoint
+
+    def _start_dispatch(
+        self,
+        dispatch_id: str,
+        notification_type: str,
+        payload: Dict,
+        email_subject: str,
+    ) -> Tuple[Dict, bool]:
+        """
+        create the checkpoint of the dispatch, or load it if the dispatch has
+        been started before.
+        Returns the checkpoint and whether it already existed.
+        """
+
+        checkpoint = self.db.notification_dispatches.find_one_and_update(
+            {"_id": dispatch_id},
+            {
+                "$setOnInsert": {
+                    "notification_type": notification_type,
+                    "payload": payload,
+                    "email_subject": email_subject,
+                    "started_at": datetime.datetime.now(),
+                    "finished_at": None,
+                    "last_username": None,
+                    "emailed_through": None,
+                    "batches": 0,
+                    "recipients": 0,
+                    "push": 0,
+                    "email": 0,
+                }
+            },
+            upsert=True,
+            return_document=pymongo.ReturnDocument.BEFORE,
+        )
+        if checkpoint is not None:
+            return checkpoint, True
+        return self.db.notification_dispatches.find_one({"_id": dispatch_id}), False
+
+    def _dispatch_batch(
+        self, checkpoint: Dict, payload: Dict, email_subject: str, resumed: bool
+    ) -> Dict:
+        """
+        dispatch the notification of `checkpoint` to the next
+        `DISPATCH_BATCH_SIZE` users after the checkpoint, in the order of their
+        usernames, and advance the checkpoint (in place and in the database).
+        If the dispatch is `resumed`, users that already received the push
+        notification are skipped.
+
+        Emails are tracked separately in the checkpoint: `emailed_through` is the
+        last username whose email has been queued, so that the emails of a batch
+        that was interrupted after its push notifications are still sent.
+
+        Returns the number of "recipients", "push" and "email" notifications of
+        the batch, as well as the (room, notification) pairs of the online
+        users to "emit".
+        """
+
+        # i really don't know why, but top level import crashes the socketio server...
+        from handlers.socket_io import get_online_recipients, user_room
+
+        notification_type = checkpoint["notification_type"]
+        notification_setting = self.notification_type_setting_mapper[notification_type]
+
+        profile_query = {}
+        if checkpoint["last_username"] is not None:
+            profile_query["username"] = {"$gt": checkpoint["last_username"]}
+        recipients = list(
+            self.db.profiles.find(
+                profile_query,
+                projection={
+                    "_id": False,
+                    "username": True,
+                    "notification_settings": True,
+                },
+                sort=[("username", pymongo.ASCENDING)],
+                limit=self.DISPATCH_BATCH_SIZE,
+                batch_size=self.DISPATCH_BATCH_SIZE,
+            )
+        )
+        if not recipients:
+            return {"recipients": 0, "push": 0, "email": 0, "emit": []}
+
+        # group the recipients by channel, users that don't want any
+        # notifications of this type are skipped
+        push_recipients = []
+        email_recipients = []
+        for recipient in recipients:
+            setting = recipient.get("notification_settings", {}).get(
+                notification_setting
+            )
+            if setting in ("push", "email"):
+                push_recipients.append(recipient["username"])
+            if setting == "email":
+                email_recipients.append(recipient["username"])
+
+        if resumed:
+            already_notified = set(
+                self.db.notifications.distinct(
+                    "to",
+                    {
+                        "dispatch_id": checkpoint["_id"],
+                        "to": {"$in": push_recipients},
+                    },
+                )
+            )
+            push_recipients = [
+                username
+                for username in push_recipients
+                if username not in already_notified
+            ]
+
+        # checkpoints of dispatches started before emails were tracked separately
+        # have only been advanced after queueing the emails
+        emailed_through = checkpoint.get("emailed_through", checkpoint["last_username"])
+        if emailed_through is not None:
+            email_recipients = [
+                username for username in email_recipients if username > emailed_through
+            ]
+
+        # push notifications, those of online users are "sent" right away
+        now = datetime.datetime.now()
+        notifications = []
+        emit = []
+        online_recipients = get_online_recipients(push_recipients)
+        for username in push_recipients:
+            notification = {
+                "_id": ObjectId(),
+                "type": notification_type,
+                "to": username,
+                "receive_state": "pending",
+                "creation_timestamp": now,
+                "payload": payload,
+                "dispatch_id": checkpoint["_id"],
+            }
+            if username in online_recipients:
+                notification["receive_state"] = "sent"
+                emit.append((user_room(username), notification))
+            notifications.append(notification)
+        if notifications:
+            self.db.notifications.insert_many(notifications)
+
+        # email notifications
+        email_addresses = []
+        if email_recipients:
+            directory = UserDirectory(self.db)
+            entries = directory.get_users(email_recipients)
+            for username in email_recipients:
                 try:
-                    self._notify_email(
-                        recipient["username"], notification_type, payload, email_subject
-                    )
+                    entry = entries.get(username) or directory.lookup(username)
                 except Exception as e:
                     logger.error(e)
+                    entry = None
+                if entry is None or not entry["email"]:
+                    logger.warning(
+                        "No email address known for {}, skipping email notification".format(
+                            username
+                        )
+                    )
+                    continue
+                email_addresses.append((username, entry["email"]))
+
+            send_emails(
+                email_addresses,
+                email_subject,
+                self.notification_type_template_mapper[notification_type],
+                payload,
+            )
+
+        # the emails are recorded right after they have been queued, only an
+        # interruption in between makes them be queued once again on resume
+        checkpoint["emailed_through"] = recipients[-1]["username"]
+        self.db.notification_dispatches.update_one(
+            {"_id": checkpoint["_id"]},
+            {
+                "$set": {"emailed_through": checkpoint["emailed_through"]},
+                "$inc": {"email": len(email_addresses)},
+            },
+        )
+
+        checkpoint["last_username"] = recipients[-1]["username"]
+        self.db.notification_dispatches.update_one(
+            {"_id": checkpoint["_id"]},
+            {
+                "$set": {"last_username": checkpoint["last_username"]},
+                "$inc": {
+                    "batches": 1,
+                    "recipients": len(recipients),
+                    "push": len(push_recipients),
+                },
+            },
+        )
+
+        return {
+            "recipients": len(recipients),
+            "push": len(push_recipients),
+            "email": len(email_addresses),
+            "emit": emit,
+        }
+
+    def _finish_dispatch(self, dispatch_id: str) -> Dict:
+        return self.db.notification_dispatches.find_one_and_update(
+            {"_id": dispatch_id},
+            {"$set": {"finished_at": datetime.datetime.now()}},
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
 
     def acknowledge_notification(self, notification_id: str | ObjectId) -> None:
         """
@@ -373,18 +668,83 @@ class NotificationResource:
             raise NotificationDoesntExistError()
 
 
+class AsyncNotificationResource(AsyncResource):
+    """
+    async variant of `NotificationResource`, see `AsyncResource` for details.
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            notification_manager = AsyncNotificationResource(db)
+            notifications = await notification_manager.get_unacknowledged_notifications_for_user(...)
+            ...
+
+    """
+
+    sync_resource_class = NotificationResource
+
+
 async def periodic_notification_dispatch(
     periodic_notification_type: str, payload: Dict, email_subject: str
 ) -> None:
+    """
+    dispatch the periodic notification to all users (see
+    `NotificationResource.bulk_send_notifications()`). The dispatch is identified
+    by the notification type and the current date, so it happens at most once a day,
+    even if the job is run again after an interruption.
+    """
+
     with util.get_mongodb() as db:
         notification_resource = NotificationResource(db)
 
         # dispatch the notification to all users
         await notification_resource.bulk_send_notifications(
-            periodic_notification_type, payload, email_subject
+            periodic_notification_type,
+            payload,
+            email_subject,
+            dispatch_id="{}:{}".format(
+                periodic_notification_type, datetime.date.today().isoformat()
+            ),
         )
 
 
+async def resume_notification_dispatches() -> None:
+    """
+    resume the dispatches of (periodic) notifications that have been started
+    within the last day, but were interrupted before they finished,
+    e.g. by a restart of the server.
+    """
+
+    with util.get_mongodb() as db:
+        notification_resource = NotificationResource(db)
+
+        checkpoints = await util.run_in_mongodb_executor(
+            lambda: list(
+                db.notification_dispatches.find(
+                    {
+                        "finished_at": None,
+                        "started_at": {
+                            "$gte": datetime.datetime.now() - datetime.timedelta(days=1)
+                        },
+                    }
+                )
+            )
+        )
+        for checkpoint in checkpoints:
+            try:
+                await notification_resource.bulk_send_notifications(
+                    checkpoint["notification_type"],
+                    checkpoint["payload"],
+                    checkpoint["email_subject"],
+                    dispatch_id=checkpoint["_id"],
+                )
+            except Exception as e:
+                logger.exception(
+                    "Resuming notification dispatch {} failed: {}".format(
+                        checkpoint["_id"], e
+                    )
+                )
+
+
 def new_message_mail_notification_dispatch() -> None:
     """
     determine all users that have received new messages within the last 24 hours
@@ -395,27 +755,11 @@ def new_message_mail_notification_dispatch() -> None:
     with util.get_mongodb() as db:
         chat_manager = Chat(db)
 
-        # list of unread rooms and messages within the last 24 hours
-        rooms_with_unread_msg = chat_manager.get_rooms_with_unacknowledged_messages()
-
-        # for each user, count the number of unread messages and rooms with unread messages
-        username_to_unread_msg_count = {}
-        for room in rooms_with_unread_msg:
-            for message in room["messages"]:
-                for send_state in message["send_states"]:
-                    if send_state["send_state"] != "acknowledged":
-                        if send_state["username"] in username_to_unread_msg_count:
-                            username_to_unread_msg_count[send_state["username"]][
-                                "messages"
-                            ] += 1
-                            username_to_unread_msg_count[send_state["username"]][
-                                "rooms"
-                            ].add(room["_id"])
-                        else:
-                            username_to_unread_msg_count[send_state["username"]] = {
-                                "messages": 1,
-                                "rooms": set([room["_id"]]),
-                            }
+        # number of unread messages and rooms with unread messages per user,
+        # for all users that received unread messages within the last 24 hours
+        username_to_unread_msg_count = chat_manager.get_unread_counts_since(
+            datetime.datetime.now() - datetime.timedelta(days=1)
+        )
 
         # send email notifications to users
         notification_resounce = NotificationResource(db)
@@ -430,7 +774,7 @@ def new_message_mail_notification_dispatch() -> None:
 
             email_payload = {
                 "unread_messages_amount": unread_count["messages"],
-                "unread_rooms_amount": len(unread_count["rooms"]),
+                "unread_rooms_amount": unread_count["rooms"],
             }
             notification_resounce._notify_email(
                 username, "new_messages", email_payload, "neue Nachricht(en)"
@@ -0,0 +1,180 @@
+import datetime
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+import pymongo
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+from resources.indexes import Index
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # expired locks are removed by the TTL monitor
+    Index(
+        "plan_locks",
+        [("expires", pymongo.ASCENDING)],
+        name="plan_locks_expires",
+        expireAfterSeconds=0,
+    ),
+    # release all locks of a user once they go offline
+    Index("plan_locks", "username", name="plan_locks_username"),
+]
+
+
+class PlanLocks:
+    """
+    write locks of plans, which guarantee a user that nobody else modifies
+    a plan while they are editing it. A lock is a document
+    ``{"_id": <plan_id>, "username": <str>, "expires": <datetime>}`` in the
+    `plan_locks` collection, so locks are shared by all processes and survive
+    restarts. All changes of a lock are single atomic operations.
+
+    Expired locks are removed by a TTL index, but since the TTL monitor
+    only runs every minute, they are also ignored by all queries.
+
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            plan_locks = PlanLocks(db)
+            ...
+
+    """
+
+    # time after which a lock expires, unless it is extended
+    LOCK_DURATION = datetime.timedelta(hours=1)
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def _expiry(self) -> datetime.datetime:
+        return datetime.datetime.now() + self.LOCK_DURATION
+
+    def get_lock(
+        self, plan_id: ObjectId, include_expired: bool = False
+    ) -> Optional[Dict]:
+        """
+        Returns the lock of the plan as a dict ``{"username": <str>,
+        "expires": <datetime>}``, or None if the plan isn't locked.
+
+        If `include_expired` is True, a lock that has expired, but hasn't been
+        removed by the TTL monitor yet, is returned as well.
+        """
+
+        query = {"_id": plan_id}
+        if not include_expired:
+            query["expires"] = {"$gt": datetime.datetime.now()}
+        return self.db.plan_locks.find_one(query, projection={"_id": False})
+
+    def get_lock_holder(self, plan_id: ObjectId) -> Optional[str]:
+        """
+        Returns the username of the user that holds the lock of the plan,
+        or None if the plan isn't locked.
+        """
+
+        lock = self.get_lock(plan_id)
+        return lock["username"] if lock else None
+
+    def get_lock_holders(self, plan_ids: List[ObjectId]) -> Dict[ObjectId, str]:
+        """
+        Returns a dict mapping those of the plans that are locked to the username
+        of the lock holder, using a single query.
+        """
+
+        return {
+            lock["_id"]: lock["username"]
+            for lock in self.db.plan_locks.find(
+                {
+                    "_id": {"$in": plan_ids},
+                    "expires": {"$gt": datetime.datetime.now()},
+                },
+                projection={"username": True},
+            )
+        }
+
+    def is_held_by(self, plan_id: ObjectId, username: str) -> bool:
+        """
+        Returns True if the user holds the (unexpired) lock of the plan,
+        False otherwise.
+        """
+
+        return self.get_lock_holder(plan_id) == username
+
+    def try_acquire_or_extend(self, plan_id: ObjectId, username: str) -> Optional[str]:
+        """
+        acquire the lock of the plan for the user, if the plan isn't locked by
+        anybody else (or their lock has expired), or extend it, if the user already
+        holds it. The lock expires after `LOCK_DURATION`.
+
+        Returns None on success, or the username of the lock holder otherwise.
+        """
+
+        try:
+            self.db.plan_locks.find_one_and_update(
+                {
+                    "_id": plan_id,
+                    "$or": [
+                        {"username": username},
+                        {"expires": {"$lte": datetime.datetime.now()}},
+                    ],
+                },
+                {"$set": {"username": username, "expires": self._expiry()}},
+                upsert=True,
+            )
+            return None
+        except DuplicateKeyError:
+            # the upsert collided with the unexpired lock of another user
+            lock_holder = self.get_lock_holder(plan_id)
+            if lock_holder is None:
+                # released or expired in the meantime
+                return self.try_acquire_or_extend(plan_id, username)
+            return lock_holder
+
+    def extend(self, plan_id: ObjectId, username: str) -> bool:
+        """
+        extend the lock of the plan that the user holds by `LOCK_DURATION`.
+
+        Returns True if the lock was extended, False if the user doesn't hold it.
+        """
+
+        return (
+            self.db.plan_locks.find_one_and_update(
+                {
+                    "_id": plan_id,
+                    "username": username,
+                    "expires": {"$gt": datetime.datetime.now()},
+                },
+                {"$set": {"expires": self._expiry()}},
+                projection={"_id": True},
+            )
+            is not None
+        )
+
+    def release(self, plan_id: ObjectId, username: str) -> bool:
+        """
+        release the lock of the plan that the user holds.
+
+        Returns True if the lock was released, False if the user doesn't hold it.
+        """
+
+        return (
+            self.db.plan_locks.find_one_and_delete(
+                {
+                    "_id": plan_id,
+                    "username": username,
+                    "expires": {"$gt": datetime.datetime.now()},
+                },
+                projection={"_id": True},
+            )
+            is not None
+        )
+
+    def release_all_of_user(self, username: str) -> int:
+        """
+        release all locks that the user holds.
+
+        Returns the number of released locks.
+        """
+
+        return self.db.plan_locks.delete_many({"username": username}).deleted_count
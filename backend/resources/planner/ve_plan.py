@@ -4,6 +4,7 @@ import datetime
 from bson import ObjectId
 from bson.errors import InvalidId
 import gridfs
+import pymongo
 from pymongo.database import Database
 from pymongo.errors import DuplicateKeyError
 from typing import Any, Dict, List, Literal
@@ -36,12 +37,43 @@ from model import (
     TargetGroup,
     VEPlan,
 )
+from resources.async_resource import AsyncResource
+from resources.image_derivatives import delete_derivatives
+from resources.indexes import Index
 from resources.notifications import NotificationResource
 from resources.elasticsearch_integration import ElasticsearchConnector
+from resources.elasticsearch_replication import register_document_loader
 from resources.network.profile import Profiles
 import util
 
 
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # plan listings of a user, sorted by last modification
+    Index(
+        "plans",
+        [("author", pymongo.ASCENDING), ("last_modified", pymongo.DESCENDING)],
+        name="plans_author_last_modified",
+    ),
+    Index(
+        "plans",
+        [("read_access", pymongo.ASCENDING), ("last_modified", pymongo.DESCENDING)],
+        name="plans_read_access_last_modified",
+    ),
+    Index(
+        "plans",
+        [("write_access", pymongo.ASCENDING), ("last_modified", pymongo.DESCENDING)],
+        name="plans_write_access_last_modified",
+    ),
+    Index(
+        "plans",
+        [("is_good_practise", pymongo.ASCENDING), ("last_modified", pymongo.DESCENDING)],
+        name="plans_is_good_practise_last_modified",
+    ),
+]
+
+
 class VEPlanResource:
     """
     to use this class, acquire a mongodb connection first via::
@@ -220,6 +252,38 @@ class VEPlanResource:
 
         return [VEPlan.from_dict(res) for res in result]
 
+    def get_readable_plan_ids(
+        self, plan_ids: List[str | ObjectId], username: str
+    ) -> List[ObjectId]:
+        """
+        Filter the given plan _id's down to those of existing plans that the user
+        given by `username` has read access to (i.e. is in the read_access list or
+        the plan is a good practise example), using a single query that only
+        loads the _id's.
+
+        Invalid _id's are silently dropped.
+
+        Returns the _id's of the readable plans as `ObjectId`'s.
+        """
+
+        object_ids = []
+        for plan_id in plan_ids:
+            try:
+                object_ids.append(util.parse_object_id(plan_id))
+            except InvalidId:
+                continue
+
+        return [
+            plan["_id"]
+            for plan in self.db.plans.find(
+                {
+                    "_id": {"$in": object_ids},
+                    "$or": [{"read_access": username}, {"is_good_practise": True}],
+                },
+                projection={"_id": True},
+            )
+        ]
+
     def get_public_plans_of_user(self, username: str) -> List[VEPlan]:
         """
         Request all plans that the user given by `username` is an author of and are
@@ -303,13 +367,13 @@ class VEPlanResource:
         self, plan_id: str | ObjectId, elasticsearch_collection: str = "plans"
     ) -> None:
         """
-        Simply update existing plan in Elasticsearch by given plan_id
+        Simply update existing plan in Elasticsearch by given plan_id.
+        The plan is read by `_load_elastic_plans()` only when the update is sent,
+        so a series of field updates of the same plan results in a single read.
         """
 
-        elastic_plan = self._get_plan_for_elastic(self.get_plan(plan_id))
-
-        ElasticsearchConnector().on_update(
-            plan_id, elasticsearch_collection, elastic_plan
+        ElasticsearchConnector().on_update_deferred(
+            plan_id, elasticsearch_collection, "plans"
         )
 
     def insert_plan(
@@ -841,15 +905,8 @@ class VEPlanResource:
         to the plan.
         """
 
-        plan_id = util.parse_object_id(plan_id)
-
-        if not self._check_plan_exists(plan_id):
-            raise PlanDoesntExistError()
-
-        # if a user is given, check if he/she has appropriate write access
-        if requesting_username is not None:
-            if not self._check_write_access(plan_id, requesting_username):
-                raise NoWriteAccessError()
+        # validate before anything is stored
+        plan_id = self._check_evaluation_file_attachable(plan_id, requesting_username)
 
         # store file in gridfs
         # TODO: if there was a file before, delete the old one
@@ -861,20 +918,67 @@ class VEPlanResource:
             metadata={"uploader": requesting_username},
         )
 
+        try:
+            self.attach_evaluation_file(plan_id, _id, file_name, requesting_username)
+        except Exception:
+            fs.delete(_id)
+            raise
+
+        return _id
+
+    def _check_evaluation_file_attachable(
+        self, plan_id: str | ObjectId, requesting_username: str = None
+    ) -> ObjectId:
+        """
+        check that an evaluation file may be attached to the plan,
+        see `attach_evaluation_file()` for the raised errors.
+
+        Returns the _id of the plan as an ObjectId.
+        """
+
+        plan_id = util.parse_object_id(plan_id)
+
+        if not self._check_plan_exists(plan_id):
+            raise PlanDoesntExistError()
+
+        # if a user is given, check if he/she has appropriate write access
+        if requesting_username is not None:
+            if not self._check_write_access(plan_id, requesting_username):
+                raise NoWriteAccessError()
+
+        return plan_id
+
+    def attach_evaluation_file(
+        self,
+        plan_id: str | ObjectId,
+        file_id: ObjectId,
+        file_name: str,
+        requesting_username: str = None,
+    ) -> None:
+        """
+        Associate a file that has already been stored in gridfs (e.g. streamed there
+        while it was uploaded, see `handlers.streaming_upload`) with the plan given
+        by its _id as its evaluation file, see `put_evaluation_file()`.
+
+        Raises `PlanDoesntExistError` if no plan with the same _id already exists.
+        Raises `NoWriteAccessError` if the requesting username (if supplied) has no write access
+        to the plan.
+        """
+
+        plan_id = self._check_evaluation_file_attachable(plan_id, requesting_username)
+
         self.db.plans.update_one(
             {"_id": plan_id},
             {
                 "$set": {
                     "evaluation_file": {
-                        "file_id": _id,
+                        "file_id": file_id,
                         "file_name": file_name,
                     }
                 }
             },
         )
 
-        return _id
-
     def remove_evaluation_file(
         self,
         plan_id: str | ObjectId,
@@ -914,6 +1018,7 @@ class VEPlanResource:
             raise FileDoesntExistError()
 
         fs.delete(file_id)
+        delete_derivatives(self.db, file_id)
 
         # remove the reference from the plan
         self.db.plans.update_one(
@@ -948,6 +1053,36 @@ class VEPlanResource:
         5 after the update.
         """
 
+        # validate before anything is stored
+        plan_id = self._check_literature_file_attachable(plan_id, requesting_username)
+
+        # store file in gridfs
+        fs = gridfs.GridFS(self.db)
+        _id = fs.put(
+            file_content,
+            filename=file_name,
+            content_type=content_type,
+            metadata={"uploader": requesting_username},
+        )
+
+        try:
+            self.attach_literature_file(plan_id, _id, file_name, requesting_username)
+        except Exception:
+            fs.delete(_id)
+            raise
+
+        return _id
+
+    def _check_literature_file_attachable(
+        self, plan_id: str | ObjectId, requesting_username: str = None
+    ) -> ObjectId:
+        """
+        check that another literature file may be attached to the plan,
+        see `attach_literature_file()` for the raised errors.
+
+        Returns the _id of the plan as an ObjectId.
+        """
+
         plan_id = util.parse_object_id(plan_id)
 
         if not self._check_plan_exists(plan_id):
@@ -961,29 +1096,41 @@ class VEPlanResource:
             if not self._check_write_access(plan_id, requesting_username):
                 raise NoWriteAccessError()
 
-        # store file in gridfs
-        fs = gridfs.GridFS(self.db)
-        _id = fs.put(
-            file_content,
-            filename=file_name,
-            content_type=content_type,
-            metadata={"uploader": requesting_username},
-        )
+        return plan_id
+
+    def attach_literature_file(
+        self,
+        plan_id: str | ObjectId,
+        file_id: ObjectId,
+        file_name: str,
+        requesting_username: str = None,
+    ) -> None:
+        """
+        Associate a file that has already been stored in gridfs (e.g. streamed there
+        while it was uploaded, see `handlers.streaming_upload`) with the plan given
+        by its _id as one of its literature files, see `put_literature_file()`.
+
+        Raises `PlanDoesntExistError` if no plan with the same _id already exists.
+        Raises `NoWriteAccessError` if the requesting username (if supplied) has no write access
+        to the plan.
+        Raises `MaximumFilesExceededError` if the maximum number of literature files would be larger than
+        5 after the update.
+        """
+
+        plan_id = self._check_literature_file_attachable(plan_id, requesting_username)
 
         self.db.plans.update_one(
             {"_id": plan_id},
             {
                 "$push": {
                     "literature_files": {
-                        "file_id": _id,
+                        "file_id": file_id,
                         "file_name": file_name,
                     }
                 }
             },
         )
 
-        return _id
-
     def remove_literature_file(
         self,
         plan_id: str | ObjectId,
@@ -1023,6 +1170,7 @@ class VEPlanResource:
             raise FileDoesntExistError()
 
         fs.delete(file_id)
+        delete_derivatives(self.db, file_id)
 
         # remove the reference from the plan
         self.db.plans.update_one(
@@ -1256,10 +1404,12 @@ class VEPlanResource:
         plan = self.get_plan(_id)
         if plan.evaluation_file and plan.evaluation_file["file_id"]:
             fs.delete(plan.evaluation_file["file_id"])
+            delete_derivatives(self.db, plan.evaluation_file["file_id"])
 
         if plan.literature_files:
             for file in plan.literature_files:
                 fs.delete(file["file_id"])
+                delete_derivatives(self.db, file["file_id"])
 
         result = self.db.plans.delete_one({"_id": _id})
 
@@ -1454,3 +1604,38 @@ class VEPlanResource:
 
         if update_result.matched_count == 0:
             raise InvitationDoesntExistError()
+
+
+def _load_elastic_plans(db: Database, plan_ids: List[str]) -> Dict[str, Dict]:
+    """
+    document loader of deferred plan updates for Elasticsearch,
+    see `resources.elasticsearch_replication.register_document_loader()`
+    """
+
+    plan_manager = VEPlanResource(db)
+    connector = ElasticsearchConnector()
+
+    return {
+        str(plan._id): connector._prepare_document(
+            plan_manager._get_plan_for_elastic(plan)
+        )
+        for plan in plan_manager.get_bulk_plans(plan_ids)
+    }
+
+
+register_document_loader("plans", _load_elastic_plans)
+
+
+class AsyncVEPlanResource(AsyncResource):
+    """
+    async variant of `VEPlanResource`, see `AsyncResource` for details.
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            plan_manager = AsyncVEPlanResource(db)
+            plans = await plan_manager.get_bulk_plans(...)
+            ...
+
+    """
+
+    sync_resource_class = VEPlanResource
@@ -0,0 +1,206 @@
+import abc
+import datetime
+import logging
+import threading
+import uuid
+from typing import Iterable, Set
+
+import pymongo
+
+import global_vars
+from resources.indexes import Index
+import util
+
+logger = logging.getLogger(__name__)
+
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # presence entries of crashed processes expire on their own
+    Index(
+        "socket_presence",
+        [("expires_at", pymongo.ASCENDING)],
+        name="socket_presence_expires_at",
+        expireAfterSeconds=0,
+    ),
+    # heartbeat of the presence entries of a process
+    Index("socket_presence", "host_id", name="socket_presence_host_id"),
+    Index("socket_presence", "username", name="socket_presence_username"),
+]
+
+
+class StateBackend(abc.ABC):
+    """
+    state that has to be shared by all processes of the backend: which user is
+    online with which socket.io sessions (presence).
+
+    A user may be online with several sessions at once (tabs, devices), the user
+    is online as long as at least one of them is.
+
+    Use the backend of this process (see `get_state_backend()`)::
+
+        get_state_backend().count_user_sessions(username)
+
+    The methods may block on I/O, so async code has to call them through
+    `util.run_in_mongodb_executor()`.
+    """
+
+    @abc.abstractmethod
+    def add_user_session(self, username: str, sid: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def remove_user_session(self, username: str, sid: str) -> int:
+        """
+        remove the session of the user.
+
+        Returns the number of sessions the user still has.
+        """
+
+    @abc.abstractmethod
+    def count_user_sessions(self, username: str) -> int:
+        pass
+
+    @abc.abstractmethod
+    def get_online_users(self, usernames: Iterable[str]) -> Set[str]:
+        """
+        Returns those of the given users that have at least one session.
+        """
+
+    def refresh(self) -> None:
+        """
+        keep the state of this process alive, meant to be called periodically
+        """
+
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    state kept in the dict `global_vars.username_sid_map` of this process,
+    only suitable for a single process.
+    """
+
+    def __init__(self):
+        # the methods are called from the threads of the mongodb executor
+        self._lock = threading.Lock()
+
+    def add_user_session(self, username: str, sid: str) -> None:
+        with self._lock:
+            global_vars.username_sid_map.setdefault(username, set()).add(sid)
+
+    def remove_user_session(self, username: str, sid: str) -> int:
+        with self._lock:
+            sids = global_vars.username_sid_map.get(username, set())
+            sids.discard(sid)
+            if not sids:
+                global_vars.username_sid_map.pop(username, None)
+            return len(sids)
+
+    def count_user_sessions(self, username: str) -> int:
+        with self._lock:
+            return len(global_vars.username_sid_map.get(username, ()))
+
+    def get_online_users(self, usernames: Iterable[str]) -> Set[str]:
+        with self._lock:
+            return {
+                username
+                for username in usernames
+                if global_vars.username_sid_map.get(username)
+            }
+
+
+class MongoStateBackend(StateBackend):
+    """
+    state kept in the `socket_presence` collection, shared by all processes
+    that use the same database.
+
+    The presence entries of this process are refreshed every `PRESENCE_REFRESH_INTERVAL`
+    seconds (see `refresh()`) and expire `PRESENCE_TTL` seconds after the last refresh,
+    so that the users of a process that died don't stay online forever.
+    """
+
+    PRESENCE_TTL = 180
+    PRESENCE_REFRESH_INTERVAL = 60
+
+    def __init__(self):
+        # identifies the presence entries of this process
+        self.host_id = uuid.uuid4().hex
+
+    def _presence_expiry(self) -> datetime.datetime:
+        return datetime.datetime.now() + datetime.timedelta(seconds=self.PRESENCE_TTL)
+
+    def add_user_session(self, username: str, sid: str) -> None:
+        with util.get_mongodb() as db:
+            db.socket_presence.update_one(
+                {"_id": sid},
+                {
+                    "$set": {
+                        "username": username,
+                        "host_id": self.host_id,
+                        "expires_at": self._presence_expiry(),
+                    }
+                },
+                upsert=True,
+            )
+
+    def remove_user_session(self, username: str, sid: str) -> int:
+        with util.get_mongodb() as db:
+            db.socket_presence.delete_one({"_id": sid})
+        return self.count_user_sessions(username)
+
+    def count_user_sessions(self, username: str) -> int:
+        with util.get_mongodb() as db:
+            # the TTL monitor only runs every minute
+            return db.socket_presence.count_documents(
+                {"username": username, "expires_at": {"$gt": datetime.datetime.now()}}
+            )
+
+    def get_online_users(self, usernames: Iterable[str]) -> Set[str]:
+        with util.get_mongodb() as db:
+            return set(
+                db.socket_presence.distinct(
+                    "username",
+                    {
+                        "username": {"$in": list(usernames)},
+                        "expires_at": {"$gt": datetime.datetime.now()},
+                    },
+                )
+            )
+
+    def refresh(self) -> None:
+        with util.get_mongodb() as db:
+            db.socket_presence.update_many(
+                {"host_id": self.host_id},
+                {"$set": {"expires_at": self._presence_expiry()}},
+            )
+
+
+STATE_BACKENDS = {
+    "memory": MemoryStateBackend,
+    "mongodb": MongoStateBackend,
+}
+
+
+def get_state_backend() -> StateBackend:
+    """
+    Returns the state backend of this process, which is lazily created on first use
+    according to `global_vars.state_backend` ("memory" or "mongodb").
+    """
+
+    if global_vars.state_backend_instance is None:
+        global_vars.state_backend_instance = STATE_BACKENDS[global_vars.state_backend]()
+    return global_vars.state_backend_instance
+
+
+async def refresh_state_backend() -> None:
+    """
+    refresh the state of this process (see `StateBackend.refresh()`) without
+    blocking the IOLoop, meant to be run periodically.
+    """
+
+    try:
+        await util.run_in_mongodb_executor(get_state_backend().refresh)
+    except Exception as e:
+        logger.warning("Refreshing the shared state failed: {}".format(e))
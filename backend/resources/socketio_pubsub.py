@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import pickle
+import threading
+import time
+
+from bson import Binary
+import pymongo
+import pymongo.errors
+from pymongo.collection import Collection
+from pymongo.database import Database
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+import util
+
+logger = logging.getLogger(__name__)
+
+
+class MongoPubSubManager(AsyncPubSubManager):
+    """
+    socket.io client manager that relays emits, room changes and disconnects between
+    all processes of the backend through a capped collection in MongoDB, so that e.g.
+    an event emitted to the sid of a user reaches them whichever process holds their
+    socket. Works like the Redis or RabbitMQ managers of python-socketio, but without
+    an additional broker.
+
+    Every process tails the collection with a tailable cursor in a background thread
+    and hands the messages of the other processes to the socket.io server.
+    Old messages are overwritten once the collection reaches `COLLECTION_SIZE` bytes.
+
+    Usage::
+
+        socketio.AsyncServer(client_manager=MongoPubSubManager(), ...)
+
+    """
+
+    name = "mongodbpubsub"
+
+    COLLECTION = "socketio_messages"
+    COLLECTION_SIZE = 16 * 1024 * 1024
+    # pause before tailing again after the cursor died or the connection failed
+    RETRY_INTERVAL = 1.0
+
+    def __init__(self, channel: str = "socketio", write_only: bool = False):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._stop_event = threading.Event()
+
+    def _get_collection(self, db: Database) -> Collection:
+        """
+        Returns the collection of the messages, creating it as a capped collection
+        if it doesn't exist yet.
+        """
+
+        if self.COLLECTION not in db.list_collection_names():
+            try:
+                db.create_collection(
+                    self.COLLECTION, capped=True, size=self.COLLECTION_SIZE
+                )
+                # tailable cursors on an empty collection die immediately
+                db[self.COLLECTION].insert_one({"channel": None})
+            except pymongo.errors.CollectionInvalid:
+                # created by another process in the meantime
+                pass
+        return db[self.COLLECTION]
+
+    def _insert(self, data: dict) -> None:
+        with util.get_mongodb() as db:
+            self._get_collection(db).insert_one(
+                {"channel": self.channel, "data": Binary(pickle.dumps(data))}
+            )
+
+    async def _publish(self, data: dict) -> None:
+        await util.run_in_mongodb_executor(self._insert, data)
+
+    def _tail(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> None:
+        """
+        tail the collection until `stop()` is called and put the messages that
+        were published after the start into the `queue`.
+
+        The messages are read in insertion order, which the _id's don't reflect
+        across processes, so the cursor is not filtered by _id. Instead, after
+        (re)opening it, the messages up to the last one seen are skipped. If that
+        one has already been overwritten (the capped collection wrapped around),
+        there is nothing to skip and every message in the collection is delivered.
+        """
+
+        last_id = None
+        started = False
+        while not self._stop_event.is_set():
+            try:
+                with util.get_mongodb() as db:
+                    collection = self._get_collection(db)
+                    if not started:
+                        newest = collection.find_one(
+                            sort=[("$natural", pymongo.DESCENDING)]
+                        )
+                        last_id = newest["_id"] if newest else None
+                        started = True
+
+                    cursor = collection.find(
+                        cursor_type=pymongo.CursorType.TAILABLE_AWAIT
+                    )
+                    skipping = (
+                        last_id is not None
+                        and collection.find_one(
+                            {"_id": last_id}, projection={"_id": True}
+                        )
+                        is not None
+                    )
+                    while cursor.alive and not self._stop_event.is_set():
+                        for message in cursor:
+                            if skipping:
+                                skipping = message["_id"] != last_id
+                                continue
+                            last_id = message["_id"]
+                            if message["channel"] == self.channel:
+                                loop.call_soon_threadsafe(
+                                    queue.put_nowait, bytes(message["data"])
+                                )
+                        # caught up, everything from here on is new
+                        skipping = False
+            except Exception as e:
+                logger.warning(
+                    "Tailing the socket.io messages failed, retrying: {}".format(e)
+                )
+
+            time.sleep(self.RETRY_INTERVAL)
+
+    async def _listen(self):
+        queue = asyncio.Queue()
+        threading.Thread(
+            target=self._tail,
+            args=(asyncio.get_running_loop(), queue),
+            name="socketio-pubsub",
+            daemon=True,
+        ).start()
+
+        while True:
+            yield await queue.get()
+
+    def stop(self) -> None:
+        """
+        stop tailing the collection (after the current await of the cursor)
+        """
+
+        self._stop_event.set()
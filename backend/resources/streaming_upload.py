@@ -0,0 +1,320 @@
+import datetime
+from email.parser import HeaderParser
+from email.utils import collapse_rfc2231_value
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from bson import Int64, ObjectId
+import gridfs
+import pymongo
+from pymongo.database import Database
+
+from exceptions import MalformedUploadError, UploadTooLargeError
+from resources.indexes import Index
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    # the index of the GridFS spec, that `gridfs.GridIn` would create itself
+    Index(
+        "fs.chunks",
+        [("files_id", pymongo.ASCENDING), ("n", pymongo.ASCENDING)],
+        name="files_id_1_n_1",
+        unique=True,
+    ),
+]
+
+# states of the parser
+_PREAMBLE = "preamble"
+_DELIMITER = "delimiter"
+_HEADERS = "headers"
+_BODY = "body"
+_EPILOGUE = "epilogue"
+_ABORTED = "aborted"
+
+
+class GridFSFileWriter:
+    """
+    writes a file into GridFS chunk by chunk, just like `gridfs.GridIn`, which however
+    keeps up to 48MB of chunks in memory before it inserts them all at once.
+    Here, the chunks are inserted as soon as `FLUSH_CHUNKS` of them are complete,
+    so an upload only occupies about 1MB of memory, however large the file is.
+
+    The file document is inserted by `close()`, until then the file doesn't exist
+    for readers. `abort()` removes the chunks and, if already closed, the file.
+    """
+
+    FLUSH_CHUNKS = 4
+
+    def __init__(
+        self,
+        db: Database,
+        filename: str,
+        content_type: str,
+        metadata: Dict,
+        chunk_size: int = gridfs.DEFAULT_CHUNK_SIZE,
+    ):
+        self.db = db
+        self._id = ObjectId()
+        self.filename = filename
+        self.content_type = content_type
+        self.metadata = metadata
+        self.chunk_size = chunk_size
+        self.length = 0
+        self.closed = False
+
+        self._buffer = bytearray()
+        self._chunks: List[Dict] = []
+        self._chunk_number = 0
+
+    def write(self, data: bytes) -> None:
+        self._buffer += data
+        self.length += len(data)
+
+        while len(self._buffer) >= self.chunk_size:
+            self._add_chunk(bytes(self._buffer[: self.chunk_size]))
+            del self._buffer[: self.chunk_size]
+        if len(self._chunks) >= self.FLUSH_CHUNKS:
+            self._flush()
+
+    def close(self) -> None:
+        if self._buffer:
+            self._add_chunk(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._flush()
+
+        self.db.fs.files.insert_one(
+            {
+                "_id": self._id,
+                "filename": self.filename,
+                "contentType": self.content_type,
+                "metadata": self.metadata,
+                "chunkSize": self.chunk_size,
+                # the GridFS spec says length SHOULD be an Int64
+                "length": Int64(self.length),
+                "uploadDate": datetime.datetime.now(tz=datetime.timezone.utc),
+            }
+        )
+        self.closed = True
+
+    def abort(self) -> None:
+        self._buffer = bytearray()
+        self._chunks = []
+        self.db.fs.chunks.delete_many({"files_id": self._id})
+        self.db.fs.files.delete_one({"_id": self._id})
+
+    def _add_chunk(self, data: bytes) -> None:
+        self._chunks.append(
+            {"files_id": self._id, "n": self._chunk_number, "data": data}
+        )
+        self._chunk_number += 1
+
+    def _flush(self) -> None:
+        if self._chunks:
+            self.db.fs.chunks.insert_many(self._chunks)
+            self._chunks = []
+
+
+class GridFSMultipartUpload:
+    """
+    incremental parser of a multipart/form-data request body, that writes the
+    files straight into GridFS as the body arrives chunk by chunk (see
+    `handlers.streaming_upload.StreamingUploadHandler`), instead of buffering the
+    whole body and every file in it in memory first.
+
+    Only the files of the `file_fields` are stored, files in other form fields are
+    skipped. Every file may be at most `max_file_size` bytes large, other form fields
+    `MAX_FIELD_SIZE` bytes, otherwise `UploadTooLargeError` is raised.
+    Invalid bodies raise `MalformedUploadError`.
+
+    After `close()`, the stored files (see `GridFSFileWriter`) are in `files` and the
+    values of the other form fields in `arguments`, both by name of the form field
+    just like `tornado.httputil.HTTPServerRequest.files` / `body_arguments`.
+    As long as they are not referenced anywhere, `abort()` removes them again,
+    e.g. if the upload is rejected or the connection is lost.
+
+    Calls to `feed()`, `close()` and `abort()` are blocking and may be made
+    from different threads.
+    """
+
+    MAX_FIELD_SIZE = 64 * 1024
+    MAX_HEADER_SIZE = 16 * 1024
+
+    def __init__(
+        self,
+        db: Database,
+        boundary: bytes,
+        file_fields: Iterable[str],
+        max_file_size: int,
+        metadata: Optional[Dict] = None,
+    ):
+        # the boundary may be quoted in the Content-Type header
+        if boundary.startswith(b'"') and boundary.endswith(b'"'):
+            boundary = boundary[1:-1]
+
+        self.db = db
+        self.file_fields = set(file_fields)
+        self.max_file_size = max_file_size
+        self.metadata = metadata or {}
+        self.files: Dict[str, List[GridFSFileWriter]] = {}
+        self.arguments: Dict[str, List[bytes]] = {}
+        self.bytes_received = 0
+
+        # every delimiter is preceded by CRLF, except for the first one, that
+        # starts the body, so a CRLF is prepended to find it the same way
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = bytearray(b"\r\n")
+        self._state = _PREAMBLE
+        self._lock = threading.Lock()
+
+        # the form field of the current part, its file in gridfs (if it is stored),
+        # its value (if it is no file) and its size so far
+        self._name: Optional[str] = None
+        self._file: Optional[GridFSFileWriter] = None
+        self._value: Optional[bytearray] = None
+        self._size = 0
+        self._uploads: List[GridFSFileWriter] = []
+
+    def feed(self, chunk: bytes) -> None:
+        """
+        parse the next chunk of the body, writing file contents to GridFS
+        """
+
+        with self._lock:
+            if self._state == _ABORTED:
+                return
+            self.bytes_received += len(chunk)
+            self._buffer += chunk
+            self._parse()
+
+    def close(self) -> None:
+        """
+        finish the upload after the whole body has been received.
+
+        Raises `MalformedUploadError` if the body ended before its final boundary.
+        """
+
+        with self._lock:
+            if self._state == _ABORTED:
+                return
+            if self._state != _EPILOGUE:
+                raise MalformedUploadError("no final boundary found")
+
+    def abort(self) -> None:
+        """
+        remove all files of this upload from GridFS, including the one that is
+        currently being written, and ignore the rest of the body
+        """
+
+        with self._lock:
+            self._state = _ABORTED
+            self._buffer = bytearray()
+            for upload in self._uploads:
+                upload.abort()
+            self._uploads = []
+            self.files = {}
+
+    def _parse(self) -> None:
+        while True:
+            if self._state == _PREAMBLE:
+                index = self._buffer.find(self._delimiter)
+                if index == -1:
+                    # keep what could be the beginning of the delimiter
+                    del self._buffer[: -len(self._delimiter)]
+                    return
+                del self._buffer[: index + len(self._delimiter)]
+                self._state = _DELIMITER
+
+            elif self._state == _DELIMITER:
+                # a delimiter is followed by either "--" (the final boundary)
+                # or CRLF and the headers of the next part
+                if len(self._buffer) < 2:
+                    return
+                if self._buffer.startswith(b"--"):
+                    self._buffer = bytearray()
+                    self._state = _EPILOGUE
+                    return
+                if not self._buffer.startswith(b"\r\n"):
+                    raise MalformedUploadError("invalid boundary")
+                del self._buffer[:2]
+                self._state = _HEADERS
+
+            elif self._state == _HEADERS:
+                index = self._buffer.find(b"\r\n\r\n")
+                if index == -1:
+                    if len(self._buffer) > self.MAX_HEADER_SIZE:
+                        raise MalformedUploadError("headers of part too large")
+                    return
+                self._start_part(bytes(self._buffer[:index]))
+                del self._buffer[: index + 4]
+                self._state = _BODY
+
+            elif self._state == _BODY:
+                index = self._buffer.find(self._delimiter)
+                if index == -1:
+                    # the delimiter might already have begun at the end of the buffer
+                    keep = len(self._delimiter) - 1
+                    if len(self._buffer) > keep:
+                        self._write(bytes(self._buffer[:-keep]))
+                        del self._buffer[:-keep]
+                    return
+                self._write(bytes(self._buffer[:index]))
+                del self._buffer[: index + len(self._delimiter)]
+                self._finish_part()
+                self._state = _DELIMITER
+
+            else:
+                # the epilogue after the final boundary is ignored
+                self._buffer = bytearray()
+                return
+
+    def _start_part(self, raw_headers: bytes) -> None:
+        headers = HeaderParser().parsestr(raw_headers.decode("utf-8", "replace"))
+        name = headers.get_param("name", header="content-disposition")
+        if name is not None:
+            name = collapse_rfc2231_value(name)
+        if headers.get_content_disposition() != "form-data" or not name:
+            raise MalformedUploadError("invalid Content-Disposition of part")
+
+        self._name = name
+        self._size = 0
+        self._file = None
+        self._value = None
+
+        filename = headers.get_filename()
+        if filename:
+            if name in self.file_fields:
+                self._file = GridFSFileWriter(
+                    self.db,
+                    filename,
+                    headers.get("Content-Type", "application/unknown"),
+                    dict(self.metadata),
+                )
+                self._uploads.append(self._file)
+        else:
+            self._value = bytearray()
+
+    def _write(self, data: bytes) -> None:
+        if not data:
+            return
+
+        self._size += len(data)
+        if self._value is not None:
+            if self._size > self.MAX_FIELD_SIZE:
+                raise UploadTooLargeError("form field {} too large".format(self._name))
+            self._value += data
+        elif self._size > self.max_file_size:
+            raise UploadTooLargeError("file in {} too large".format(self._name))
+        elif self._file is not None:
+            self._file.write(data)
+
+    def _finish_part(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self.files.setdefault(self._name, []).append(self._file)
+        elif self._value is not None:
+            self.arguments.setdefault(self._name, []).append(bytes(self._value))
+
+        self._name = None
+        self._file = None
+        self._value = None
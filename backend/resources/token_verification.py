@@ -0,0 +1,244 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from jwcrypto import jwk, jwt
+from keycloak import KeycloakOpenID
+
+from exceptions import InvalidTokenError
+import global_vars
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSCache:
+    """
+    the signing keys of the Keycloak realm (its JWKS, i.e. JSON Web Key Set),
+    mapped by their key id (`kid`).
+
+    The keys are fetched once and then refreshed in the background every
+    `REFRESH_INTERVAL` seconds, while the known keys keep being used.
+    A token signed by a key that is not known yet (because Keycloak rotated its keys)
+    triggers an immediate refresh, but at most once every `MIN_REFRESH_INTERVAL`
+    seconds, so tokens with made up key ids can't flood Keycloak with requests.
+    Fetching the keys always happens in a worker thread, never on the IOLoop.
+    """
+
+    REFRESH_INTERVAL = 3600
+    MIN_REFRESH_INTERVAL = 30
+
+    def __init__(self, keycloak_openid: KeycloakOpenID):
+        self.keycloak_openid = keycloak_openid
+        self.keys: Dict[str, jwk.JWK] = {}
+        self.fetched_at: Optional[float] = None
+        self.refreshes = 0
+        self._refresh_future: Optional[asyncio.Future] = None
+
+    def _fetch(self) -> Dict[str, jwk.JWK]:
+        """
+        blocking retrieval of the signing keys from Keycloak. Keys for encryption
+        are skipped.
+        """
+
+        key_set = jwk.JWKSet.from_json(json.dumps(self.keycloak_openid.certs()))
+        return {
+            key.key_id: key
+            for key in key_set
+            if key.key_id is not None and key.get("use", "sig") == "sig"
+        }
+
+    async def refresh(self) -> None:
+        """
+        fetch the keys again. Concurrent calls share the same request.
+        Raises `keycloak.exceptions.KeycloakError` if Keycloak is unreachable.
+        """
+
+        if self._refresh_future is None:
+            self._refresh_future = asyncio.ensure_future(self._refresh())
+        future = self._refresh_future
+        try:
+            await asyncio.shield(future)
+        finally:
+            if self._refresh_future is future and future.done():
+                self._refresh_future = None
+
+    async def _refresh(self) -> None:
+        # also rate-limit failed attempts
+        self.fetched_at = time.monotonic()
+        keys = await asyncio.get_running_loop().run_in_executor(None, self._fetch)
+        if set(keys) != set(self.keys):
+            logger.info("Keycloak signing keys changed: {}".format(list(keys)))
+        self.keys = keys
+        self.refreshes += 1
+
+    def _refresh_in_background(self) -> None:
+        async def refresh():
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(
+                    "Refreshing the Keycloak signing keys failed: {}".format(e)
+                )
+
+        asyncio.ensure_future(refresh())
+
+    async def get_key(self, kid: str) -> Optional[jwk.JWK]:
+        """
+        Returns the key with the id `kid`, or None if Keycloak doesn't know it either.
+        """
+
+        if not self.keys:
+            await self.refresh()
+        elif time.monotonic() - self.fetched_at >= self.REFRESH_INTERVAL:
+            self._refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None and (
+            time.monotonic() - self.fetched_at >= self.MIN_REFRESH_INTERVAL
+        ):
+            await self.refresh()
+            key = self.keys.get(kid)
+        return key
+
+
+class VerifiedTokenCache:
+    """
+    bounded LRU cache of the claims of tokens whose signature has already been
+    verified, keyed by the hash of the token. An entry is only valid until the
+    `exp` of its token, tokens without `exp` are not cached at all.
+    """
+
+    MAX_SIZE = 10000
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or self.MAX_SIZE
+        self._entries: OrderedDict[str, Dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> Optional[Dict]:
+        token_hash = self._hash(token)
+        with self._lock:
+            claims = self._entries.get(token_hash)
+            if claims is None:
+                self.misses += 1
+                return None
+            if claims["exp"] <= time.time():
+                del self._entries[token_hash]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token_hash)
+            self.hits += 1
+            return claims
+
+    def put(self, token: str, claims: Dict) -> None:
+        if not isinstance(claims.get("exp"), (int, float)):
+            return
+
+        token_hash = self._hash(token)
+        with self._lock:
+            self._entries[token_hash] = claims
+            self._entries.move_to_end(token_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class TokenVerifier:
+    """
+    offline verification of the access tokens issued by Keycloak against the cached
+    signing keys of the realm (see `JWKSCache`), with the claims of already verified
+    tokens being cached (see `VerifiedTokenCache`).
+    Equivalent to `KeycloakOpenID.decode_token()`, which in contrast retrieves
+    the public key of the realm from Keycloak on every call, blocking the IOLoop.
+
+    Use the verifier of this process::
+
+        token_info = await get_token_verifier().verify(token)
+
+    """
+
+    # same tolerance for `exp` and `nbf` as `KeycloakOpenID.decode_token()`
+    LEEWAY = 60
+
+    def __init__(self, keycloak_openid: KeycloakOpenID, cache_size: int = None) -> None:
+        self.keys = JWKSCache(keycloak_openid)
+        self.cache = VerifiedTokenCache(cache_size)
+        self.verifications = 0
+
+    async def verify(self, token: str) -> Dict:
+        """
+        verify the signature, `exp` and `nbf` of the `token` and return its claims.
+
+        Raises `InvalidTokenError` if the token is malformed, expired or not signed
+        by any key of the realm, or `keycloak.exceptions.KeycloakError` if the
+        signing keys could not be retrieved from Keycloak.
+        """
+
+        claims = self.cache.get(token)
+        if claims is not None:
+            return dict(claims)
+
+        try:
+            parsed_jwt = jwt.JWT(jwt=token)
+            kid = parsed_jwt.token.jose_header.get("kid")
+        except Exception as e:
+            raise InvalidTokenError("malformed token: {}".format(e)) from e
+
+        key = await self.keys.get_key(kid)
+        if key is None:
+            raise InvalidTokenError("token is signed by an unknown key: {}".format(kid))
+
+        try:
+            parsed_jwt.leeway = self.LEEWAY
+            parsed_jwt.validate(key)
+            claims = json.loads(parsed_jwt.claims)
+        except Exception as e:
+            raise InvalidTokenError("token did not validate: {}".format(e)) from e
+
+        self.verifications += 1
+        self.cache.put(token, claims)
+        return dict(claims)
+
+    def get_metrics(self) -> Dict:
+        return {
+            "cached_tokens": len(self.cache),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "verifications": self.verifications,
+            "known_keys": len(self.keys.keys),
+            "key_refreshes": self.keys.refreshes,
+        }
+
+
+def get_token_verifier() -> TokenVerifier:
+    """
+    Returns the token verifier of this process, which is lazily created on first use.
+    """
+
+    if global_vars.token_verifier is None:
+        global_vars.token_verifier = TokenVerifier(global_vars.keycloak)
+    return global_vars.token_verifier
+
+
+def get_token_verification_metrics() -> Dict:
+    """
+    Returns the metrics of the token verifier of this process (see
+    `TokenVerifier.get_metrics()`), or an empty dict if it has not been used yet.
+    """
+
+    if global_vars.token_verifier is None:
+        return {}
+    return global_vars.token_verifier.get_metrics()
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+import datetime
+import threading
+from typing import Dict, Hashable, Optional, Tuple
+
+import global_vars
+
+
+class UploadCache:
+    """
+    bounded LRU cache of the content of small files in GridFS (avatars, the default
+    pictures, ...), keyed by the `_id` of the file, so that they don't have to be
+    read chunk by chunk from GridFS on every request (see
+    `handlers.db_static_files.GridFSStaticFileHandler`).
+
+    Only files of at most `MAX_FILE_SIZE` bytes are cached, the least recently used
+    ones are evicted as soon as the cached files exceed `MAX_BYTES` in total.
+
+    Every entry remembers the `upload_date` of the file it was read from. Uploads
+    with an ObjectId as `_id` never change, but the default pictures can be replaced
+    under the same `_id`, so the metadata of the file is still queried on every
+    request and an entry is only used if its `upload_date` matches.
+    """
+
+    MAX_BYTES = 64 * 1024 * 1024
+    MAX_FILE_SIZE = 512 * 1024
+
+    def __init__(self, max_bytes: int = None, max_file_size: int = None):
+        self.max_bytes = self.MAX_BYTES if max_bytes is None else max_bytes
+        self.max_file_size = (
+            self.MAX_FILE_SIZE if max_file_size is None else max_file_size
+        )
+        # file _id -> (upload_date, content)
+        self._entries: OrderedDict[Hashable, Tuple[datetime.datetime, bytes]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_cacheable(self, length: int) -> bool:
+        return length <= self.max_file_size and length <= self.max_bytes
+
+    def get(self, _id: Hashable, upload_date: datetime.datetime) -> Optional[bytes]:
+        """
+        Returns the cached content of the file, or None if it isn't cached
+        or has been uploaded again in the meantime.
+        """
+
+        with self._lock:
+            entry = self._entries.get(_id)
+            if entry is None or entry[0] != upload_date:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(
+        self, _id: Hashable, upload_date: datetime.datetime, content: bytes
+    ) -> None:
+        if not self.is_cacheable(len(content)):
+            return
+
+        with self._lock:
+            previous = self._entries.pop(_id, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._entries[_id] = (upload_date, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, _id: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.pop(_id, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_metrics(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "cached_files": len(self),
+            "cached_bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def get_upload_cache() -> UploadCache:
+    """
+    Returns the upload cache of this process, which is lazily created on first use.
+    """
+
+    if global_vars.upload_cache is None:
+        global_vars.upload_cache = UploadCache()
+    return global_vars.upload_cache
+
+
+def get_upload_cache_metrics() -> Dict:
+    """
+    Returns the metrics of the upload cache of this process (see
+    `UploadCache.get_metrics()`), or an empty dict if it has not been used yet.
+    """
+
+    if global_vars.upload_cache is None:
+        return {}
+    return global_vars.upload_cache.get_metrics()
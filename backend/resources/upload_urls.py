@@ -0,0 +1,90 @@
+import base64
+import hashlib
+import hmac
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
+from bson import ObjectId
+
+import global_vars
+
+# signed URLs are served by `handlers.db_static_files.SignedGridFSStaticFileHandler`
+SIGNED_UPLOADS_PATH = "/uploads/signed/"
+
+# the expiry of signed URLs is rounded up to the end of the next period of this
+# length, so that all URLs of a file signed within the same period are identical
+# and can be cached by browsers and proxies. A URL is therefore valid for at least
+# one and at most two periods.
+EXPIRY_PERIOD = 12 * 60 * 60
+
+
+def _signature(file_id: str, expires: int, viewer: Optional[str]) -> str:
+    message = "uploads\n{}\n{}\n{}".format(file_id, expires, viewer or "")
+    digest = hmac.new(
+        global_vars.cookie_secret.encode("utf-8"),
+        message.encode("utf-8"),
+        hashlib.sha256,
+    ).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+def signed_urls_enabled() -> bool:
+    """
+    signed URLs are keyed by the cookie secret, without one they are disabled
+    """
+
+    return bool(global_vars.cookie_secret)
+
+
+def sign_file_url(
+    file_id: str | ObjectId, viewer: Optional[str] = None, now: float = None
+) -> Optional[str]:
+    """
+    Returns a URL (relative to the backend) of the file in GridFS that can be
+    fetched without authentication until it expires, carrying the `file_id`,
+    the expiry and optionally a `viewer`, in which case only that user may use it,
+    signed by a HMAC with the cookie secret as key.
+
+    Returns None if signed URLs are disabled, because there is no cookie secret.
+    """
+
+    if not signed_urls_enabled():
+        return None
+
+    if now is None:
+        now = time.time()
+    expires = (int(now) // EXPIRY_PERIOD + 2) * EXPIRY_PERIOD
+
+    file_id = str(file_id)
+    params = {"expires": expires}
+    if viewer is not None:
+        params["viewer"] = viewer
+    params["signature"] = _signature(file_id, expires, viewer)
+    return SIGNED_UPLOADS_PATH + file_id + "?" + urlencode(params)
+
+
+def verify_file_url(
+    file_id: str,
+    expires: int,
+    signature: str,
+    viewer: Optional[str] = None,
+    now: float = None,
+) -> bool:
+    """
+    Returns True if the signature of the URL is valid and it hasn't expired yet,
+    False otherwise (or if signed URLs are disabled).
+    """
+
+    if not signed_urls_enabled():
+        return False
+
+    if now is None:
+        now = time.time()
+    if expires <= now:
+        return False
+
+    return hmac.compare_digest(
+        signature.encode("utf-8"),
+        _signature(file_id, expires, viewer).encode("utf-8"),
+    )
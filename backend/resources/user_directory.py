@@ -0,0 +1,270 @@
+from collections import OrderedDict
+import datetime
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import pymongo
+from pymongo.database import Database
+
+import global_vars
+from resources.indexes import Index
+import util
+
+logger = logging.getLogger(__name__)
+
+
+# indexes on the collections managed by this module,
+# reconciled on startup by `resources.indexes.reconcile_indexes()`
+INDEXES = [
+    Index(
+        "user_directory",
+        [("username", pymongo.ASCENDING)],
+        name="user_directory_username",
+        unique=True,
+    ),
+]
+
+# the fields of a directory entry that are taken over from Keycloak
+DIRECTORY_FIELDS = ("user_id", "email", "first_name", "last_name")
+
+
+class UserDirectory:
+    """
+    local copy of the user accounts of Keycloak (id, email and name per username),
+    so that e.g. the mail dispatch doesn't need a round trip to the Keycloak admin API
+    for every recipient. The entries are kept in their own collection instead of
+    the profiles, because profiles are served to other users and replicated to
+    Elasticsearch, whereas emails must stay private.
+
+    Entries are written whenever a user authenticates (see `sync_user_from_token()`),
+    unknown users are loaded from Keycloak on first lookup and all users are
+    refreshed from Keycloak periodically (see `refresh_from_keycloak()`).
+
+    to use this class, acquire a mongodb connection first via::
+
+        with util.get_mongodb() as db:
+            directory = UserDirectory(db)
+            ...
+
+    """
+
+    # number of users per page of the Keycloak admin API
+    PAGE_SIZE = 500
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    @staticmethod
+    def entry_from_keycloak_user(user: Dict) -> Dict:
+        """
+        transform a user representation of the Keycloak admin API into a directory entry
+        """
+
+        return {
+            "username": user["username"],
+            "user_id": user["id"],
+            "email": user.get("email", ""),
+            "first_name": user.get("firstName", ""),
+            "last_name": user.get("lastName", ""),
+        }
+
+    @staticmethod
+    def entry_from_token(token_info: Dict) -> Dict:
+        """
+        transform the claims of an access token into a directory entry
+        """
+
+        return {
+            "username": token_info["preferred_username"],
+            "user_id": token_info["sub"],
+            "email": token_info.get("email", ""),
+            "first_name": token_info.get("given_name", ""),
+            "last_name": token_info.get("family_name", ""),
+        }
+
+    def store(self, entries: Iterable[Dict]) -> int:
+        """
+        insert or update the given entries, writing only those that are new or
+        have changed.
+
+        Returns the number of written entries.
+        """
+
+        entries = {entry["username"]: entry for entry in entries}
+        if not entries:
+            return 0
+
+        existing = {
+            entry["username"]: entry
+            for entry in self.db.user_directory.find(
+                {"username": {"$in": list(entries)}}, projection={"_id": False}
+            )
+        }
+
+        now = datetime.datetime.now()
+        operations = [
+            pymongo.UpdateOne(
+                {"username": username},
+                {"$set": {**entry, "updated_at": now}},
+                upsert=True,
+            )
+            for username, entry in entries.items()
+            if username not in existing
+            or any(
+                existing[username].get(field) != entry[field]
+                for field in DIRECTORY_FIELDS
+            )
+        ]
+        if operations:
+            self.db.user_directory.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    def get_user(self, username: str) -> Optional[Dict]:
+        """
+        Returns the directory entry of the user, or None if there is none (yet).
+        """
+
+        return self.db.user_directory.find_one(
+            {"username": username}, projection={"_id": False}
+        )
+
+    def get_users(self, usernames: List[str]) -> Dict[str, Dict]:
+        """
+        Returns the directory entries of the given users as a dict mapping
+        the usernames to their entries. Users without an entry are omitted.
+        """
+
+        return {
+            entry["username"]: entry
+            for entry in self.db.user_directory.find(
+                {"username": {"$in": usernames}}, projection={"_id": False}
+            )
+        }
+
+    def load_from_keycloak(self, username: str) -> Optional[Dict]:
+        """
+        request the user from the Keycloak admin API and store it.
+
+        Returns the directory entry of the user, or None if Keycloak doesn't know
+        the user either.
+        Raises `keycloak.exceptions.KeycloakError` if Keycloak is unreachable.
+        """
+
+        users = global_vars.keycloak_admin.get_users(
+            {"username": username, "exact": True}
+        )
+        for user in users:
+            if user["username"] == username:
+                entry = self.entry_from_keycloak_user(user)
+                self.store([entry])
+                return entry
+        return None
+
+    def lookup(self, username: str) -> Optional[Dict]:
+        """
+        Returns the directory entry of the user, loading it from Keycloak if there is
+        none yet (see `load_from_keycloak()`), or None if the user doesn't exist.
+        """
+
+        entry = self.get_user(username)
+        if entry is None:
+            entry = self.load_from_keycloak(username)
+        return entry
+
+    def get_email(self, username: str) -> Optional[str]:
+        """
+        Returns the email address of the user (see `lookup()`), or None if the user
+        doesn't exist or has no email address.
+        """
+
+        entry = self.lookup(username)
+        if entry is None:
+            return None
+        return entry["email"] or None
+
+    def delete_user(self, username: str) -> None:
+        self.db.user_directory.delete_one({"username": username})
+
+    def refresh_from_keycloak(self) -> Dict:
+        """
+        page through all users of the Keycloak admin API and store the ones that
+        are new or have changed. Entries of users that don't exist in Keycloak
+        anymore are removed.
+
+        Returns the number of "fetched", "written" and "removed" entries.
+        Raises `keycloak.exceptions.KeycloakError` if Keycloak is unreachable.
+        """
+
+        usernames = set()
+        written = 0
+        first = 0
+        while True:
+            users = global_vars.keycloak_admin.get_users(
+                {"first": first, "max": self.PAGE_SIZE, "briefRepresentation": True}
+            )
+            written += self.store(self.entry_from_keycloak_user(user) for user in users)
+            usernames.update(user["username"] for user in users)
+            if len(users) < self.PAGE_SIZE:
+                break
+            first += self.PAGE_SIZE
+
+        removed = self.db.user_directory.delete_many(
+            {"username": {"$nin": list(usernames)}}
+        ).deleted_count
+
+        return {"fetched": len(usernames), "written": written, "removed": removed}
+
+
+# username -> directory entry that has most recently been stored by this process,
+# see `sync_user_from_token()`
+_SYNCED_USERS: OrderedDict[str, Dict] = OrderedDict()
+_SYNCED_USERS_MAX_SIZE = 10000
+_synced_users_lock = threading.Lock()
+
+
+def sync_user_from_token(token_info: Dict) -> None:
+    """
+    store the account information (id, email and name) contained in the claims
+    of a verified access token in the user directory. The entry is only written
+    if it differs from the one this process has stored last for the user,
+    so calling this on every request is cheap.
+    """
+
+    if "preferred_username" not in token_info or "sub" not in token_info:
+        return
+
+    entry = UserDirectory.entry_from_token(token_info)
+    with _synced_users_lock:
+        if _SYNCED_USERS.get(entry["username"]) == entry:
+            _SYNCED_USERS.move_to_end(entry["username"])
+            return
+
+    with util.get_mongodb() as db:
+        UserDirectory(db).store([entry])
+
+    with _synced_users_lock:
+        _SYNCED_USERS[entry["username"]] = entry
+        _SYNCED_USERS.move_to_end(entry["username"])
+        while len(_SYNCED_USERS) > _SYNCED_USERS_MAX_SIZE:
+            _SYNCED_USERS.popitem(last=False)
+
+
+def refresh_user_directory() -> None:
+    """
+    refresh the user directory from Keycloak (see `UserDirectory.refresh_from_keycloak()`),
+    meant to be run periodically in the background.
+    """
+
+    try:
+        with util.get_mongodb() as db:
+            result = UserDirectory(db).refresh_from_keycloak()
+    except Exception as e:
+        logger.warning("Refreshing the user directory failed: {}".format(e))
+        return
+
+    logger.info(
+        "Refreshed the user directory: {} users, {} written, {} removed".format(
+            result["fetched"], result["written"], result["removed"]
+        )
+    )
@@ -5,11 +5,13 @@ import json
 import logging
 import os
 import requests
+import time
 from typing import List
 
 from bson import ObjectId
 from dotenv import load_dotenv
 import gridfs
+from PIL import Image
 import pymongo
 import pymongo.errors
 from requests_toolbelt import MultipartEncoder
@@ -32,7 +34,9 @@ from model import (
 )
 from resources.elasticsearch_integration import ElasticsearchConnector
 from resources.network.acl import ACL
+from resources.network.feed import Feeds
 from resources.network.profile import Profiles
+from resources.upload_urls import EXPIRY_PERIOD, sign_file_url
 import util
 
 # load environment variables
@@ -72,10 +76,13 @@ PLAN_LOCKED_ERROR = "plan_locked"
 MAXIMUM_FILES_EXCEEDED_ERROR = "maximum_files_exceeded"
 FILE_DOESNT_EXIST_ERROR = "file_doesnt_exist"
 REPORT_DOESNT_EXIST_ERROR = "report_doesnt_exist"
+FILE_TOO_LARGE_ERROR = "file_too_large"
+MALFORMED_UPLOAD_ERROR = "malformed_multipart_body"
 
 INVITATION_DOESNT_EXIST_ERROR = "invitation_doesnt_exist"
 
 ROOM_DOESNT_EXIST_ERROR = "room_doesnt_exist"
+MESSAGE_DOESNT_EXIST_ERROR = "message_doesnt_exist"
 
 # don't change, these values match with the ones in BaseHandler
 CURRENT_ADMIN = User(
@@ -167,6 +174,10 @@ class BaseApiTestCase(AsyncHTTPTestCase):
         self.client = self.__class__._client
         self.db = self.__class__._db
 
+        # the test data is written directly into the database, bypassing
+        # the invalidation of the ACL cache, so every test starts with an empty one
+        global_vars.acl_cache = None
+
     def tearDown(self) -> None:
         self.client = None
         super().tearDown()
@@ -7080,6 +7091,103 @@ class SpaceHandlerTest(BaseApiTestCase):
         )
         self.assertEqual(response["reason"], INSUFFICIENT_PERMISSION_ERROR)
 
+    def test_post_space_put_file_streamed(self):
+        """
+        expect: successfully add a file that is larger than a chunk of the
+        request body, the content arrives unchanged in gridfs
+        """
+
+        file_name = "test_file.bin"
+        content = os.urandom(1024 * 1024)
+
+        # encode file as formdata, together with another form field
+        request = MultipartEncoder(
+            fields={
+                "description": "test",
+                "file": (file_name, io.BytesIO(content), "application/octet-stream"),
+            }
+        )
+
+        self.base_checks(
+            "POST",
+            "/spaceadministration/put_file?id={}".format(str(self.test_space_id)),
+            True,
+            200,
+            headers={"Content-Type": request.content_type},
+            body=request.to_string(),
+        )
+
+        # assert file is stored in db
+        fs = gridfs.GridFS(self.db)
+        file = fs.find_one({"filename": file_name})
+        self.assertIsNotNone(file)
+        self.assertEqual(file.read(), content)
+        self.assertEqual(file.content_type, "application/octet-stream")
+        self.assertEqual(file.metadata, {"uploader": CURRENT_ADMIN.username})
+
+        db_state = self.db.spaces.find_one({"_id": self.test_space_id})
+        self.assertIn(file._id, [f["file_id"] for f in db_state["files"]])
+
+    def test_post_space_put_file_error_too_large(self):
+        """
+        expect: fail message because the file exceeds the maximum size of uploads,
+        nothing is stored
+        """
+
+        max_upload_size = global_vars.max_upload_size
+        global_vars.max_upload_size = 100 * 1024
+        self.addCleanup(setattr, global_vars, "max_upload_size", max_upload_size)
+
+        file_name = "test_file.bin"
+        request = MultipartEncoder(
+            fields={
+                "file": (
+                    file_name,
+                    io.BytesIO(os.urandom(200 * 1024)),
+                    "application/octet-stream",
+                )
+            }
+        )
+
+        response = self.base_checks(
+            "POST",
+            "/spaceadministration/put_file?id={}".format(str(self.test_space_id)),
+            False,
+            413,
+            headers={"Content-Type": request.content_type},
+            body=request.to_string(),
+        )
+        self.assertEqual(response["reason"], FILE_TOO_LARGE_ERROR)
+
+        # expect neither the file nor any of its chunks to be stored
+        self.assertIsNone(gridfs.GridFS(self.db).find_one({"filename": file_name}))
+        self.assertEqual(self.db.fs.chunks.count_documents({}), 0)
+        db_state = self.db.spaces.find_one({"_id": self.test_space_id})
+        self.assertEqual(db_state.get("files", []), [])
+
+    def test_post_space_put_file_error_malformed_body(self):
+        """
+        expect: fail message because the body ends before its final boundary,
+        nothing is stored
+        """
+
+        file_name = "test_file.txt"
+        request = MultipartEncoder(
+            fields={"file": (file_name, io.BytesIO(b"test"), "text/plain")}
+        )
+
+        response = self.base_checks(
+            "POST",
+            "/spaceadministration/put_file?id={}".format(str(self.test_space_id)),
+            False,
+            400,
+            headers={"Content-Type": request.content_type},
+            body=request.to_string()[:-10],
+        )
+        self.assertEqual(response["reason"], MALFORMED_UPLOAD_ERROR)
+
+        self.assertIsNone(gridfs.GridFS(self.db).find_one({"filename": file_name}))
+
     def test_delete_space_error_no_name(self):
         """
         expect: fail message because request is missing name parameter
@@ -7867,10 +7975,15 @@ class TimelineHandlerTest(BaseApiTestCase):
         ]
         self.db.posts.insert_many(self.posts)
 
+        # the posts were inserted directly, so the personal timelines
+        # have to be built from them
+        Feeds(self.db).rebuild_all()
+
     def tearDown(self) -> None:
         # cleanup test data
         self.base_permission_environments_tearDown()
         self.db.posts.delete_many({})
+        self.db.feeds.delete_many({})
         super().tearDown()
 
     def assert_author_enhanced(self, posts: List[dict]):
@@ -8081,6 +8194,8 @@ class TimelineHandlerTest(BaseApiTestCase):
             },
         )
 
+        Feeds(self.db).rebuild_all()
+
         response = self.base_checks("GET", "/timeline/you", True, 200)
         self.assertIn("posts", response)
 
@@ -8137,6 +8252,8 @@ class TimelineHandlerTest(BaseApiTestCase):
             },
         )
 
+        Feeds(self.db).rebuild_all()
+
         response = self.base_checks("GET", "/timeline/you", True, 200)
         self.assertIn("posts", response)
 
@@ -8164,6 +8281,8 @@ class TimelineHandlerTest(BaseApiTestCase):
             {"$set": {"follows": [CURRENT_USER.username]}},
         )
 
+        Feeds(self.db).rebuild_all()
+
         response = self.base_checks("GET", "/timeline/you", True, 200)
         self.assertIn("posts", response)
 
@@ -8227,7 +8346,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         self.db.notifications.delete_many({})
 
         # reset locks
-        global_vars.plan_write_lock_map = {}
+        self.db.plan_locks.delete_many({})
 
         # delete uploaded files that were generated by tests
         fs = gridfs.GridFS(self.db)
@@ -8237,6 +8356,17 @@ class VEPlanHandlerTest(BaseApiTestCase):
 
         super().tearDown()
 
+    def set_plan_lock(self, username: str) -> None:
+        """
+        convenience method to let the user hold the write lock of the default plan
+        """
+
+        self.db.plan_locks.replace_one(
+            {"_id": self.plan_id},
+            {"username": username, "expires": datetime.now() + timedelta(hours=1)},
+            upsert=True,
+        )
+
     def create_step(
         self,
         name: str,
@@ -8418,10 +8548,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         }
         self.db.plans.insert_one(self.default_plan)
 
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_ADMIN.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_ADMIN.username)
 
     def additional_user_profiles_setup(self):
         # add additional user profiles
@@ -9010,6 +9137,56 @@ class VEPlanHandlerTest(BaseApiTestCase):
         response = self.base_checks("GET", "/planner/get_all", False, 403)
         self.assertEqual(response["reason"], INSUFFICIENT_PERMISSION_ERROR)
 
+    def test_get_lock_holders(self):
+        """
+        expect: the lock holders of all readable plans, null for plans that
+        aren't locked, plans without read access and invalid _id's are omitted
+        """
+
+        unlocked_plan_id = ObjectId()
+        foreign_plan_id = ObjectId()
+        self.db.plans.insert_many(
+            [
+                {**self.default_plan, "_id": unlocked_plan_id},
+                {
+                    **self.default_plan,
+                    "_id": foreign_plan_id,
+                    "author": "other",
+                    "read_access": ["other"],
+                    "write_access": ["other"],
+                },
+            ]
+        )
+        self.set_plan_lock(CURRENT_USER.username)
+        self.db.plan_locks.insert_one(
+            {
+                "_id": foreign_plan_id,
+                "username": "other",
+                "expires": datetime.now() + timedelta(hours=1),
+            }
+        )
+
+        response = self.base_checks(
+            "GET",
+            "/planner/get_lock_holders?plan_ids={},{},{},invalid".format(
+                self.plan_id, unlocked_plan_id, foreign_plan_id
+            ),
+            True,
+            200,
+        )
+        self.assertEqual(
+            response["lock_holders"],
+            {str(self.plan_id): CURRENT_USER.username, str(unlocked_plan_id): None},
+        )
+
+    def test_get_lock_holders_error_missing_key(self):
+        """
+        expect: fail message because the plan_ids query parameter is missing
+        """
+
+        response = self.base_checks("GET", "/planner/get_lock_holders", False, 400)
+        self.assertEqual(response["reason"], MISSING_KEY_ERROR_SLUG + "plan_ids")
+
     def test_post_error_no_json(self):
         """
         expect: fail message because payload is not in json
@@ -9486,10 +9663,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         options.test_admin = False
         options.test_user = True
 
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         plan = VEPlan(_id=self.plan_id, name="updated_plan")
 
@@ -9510,10 +9684,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         """
 
         # set lock to other user
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         plan = VEPlan(_id=self.plan_id, name="updated_plan")
 
@@ -10267,10 +10438,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         options.test_admin = False
         options.test_user = True
 
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         payload = {
             "plan_id": self.plan_id,
@@ -10318,10 +10486,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         """
 
         # set lock to other user
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         payload = {
             "plan_id": self.plan_id,
@@ -10495,10 +10660,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         self._assert_no_achievement_progress(CURRENT_ADMIN.username)
 
         # try as a separate case that a plan is locked
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         payload = {
             "update": [
@@ -10645,10 +10807,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         options.test_admin = False
         options.test_user = True
 
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create file with IO Buffer
         file_name = "test_file.txt"
@@ -10686,10 +10845,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         """
 
         # set lock to other user
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create file with IO Buffer
         file_name = "test_file.txt"
@@ -10809,10 +10965,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         options.test_admin = False
         options.test_user = True
 
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create file with IO Buffer
         file_name = "test_file.txt"
@@ -10850,10 +11003,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         """
 
         # set lock to other user
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create file with IO Buffer
         file_name = "test_file.txt"
@@ -11582,10 +11732,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         # switch to user mode
         options.test_admin = False
         options.test_user = True
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         response = self.base_checks(
             "DELETE",
@@ -11613,10 +11760,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         """
 
         # set lock to other user
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # by step id
         response = self.base_checks(
@@ -11777,10 +11921,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         # switch to user mode
         options.test_admin = False
         options.test_user = True
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create a file manually
         fs = gridfs.GridFS(self.db)
@@ -11810,10 +11951,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         """
 
         # set lock to other user
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create a file manually
         fs = gridfs.GridFS(self.db)
@@ -11953,10 +12091,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         # switch to user mode
         options.test_admin = False
         options.test_user = True
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create 3 files manually
         fs = gridfs.GridFS(self.db)
@@ -11989,10 +12124,7 @@ class VEPlanHandlerTest(BaseApiTestCase):
         """
 
         # set lock to other user
-        global_vars.plan_write_lock_map[self.plan_id] = {
-            "username": CURRENT_USER.username,
-            "expires": datetime.now() + timedelta(hours=1),
-        }
+        self.set_plan_lock(CURRENT_USER.username)
 
         # create 3 files manually
         fs = gridfs.GridFS(self.db)
@@ -12284,14 +12416,16 @@ class ChatHandlerTest(BaseApiTestCase):
             "_id": self.room_id,
             "name": "test_room",
             "members": [CURRENT_ADMIN.username, "other_user"],
-            "messages": [self.default_message],
+            "last_message": self.default_message,
         }
         self.db.chatrooms.insert_one(self.default_room)
+        self.db.messages.insert_one({**self.default_message, "room_id": self.room_id})
 
     def tearDown(self) -> None:
         self.base_permission_environments_tearDown()
 
         self.db.chatrooms.delete_many({})
+        self.db.messages.delete_many({})
 
         super().tearDown()
 
@@ -12306,13 +12440,13 @@ class ChatHandlerTest(BaseApiTestCase):
             "_id": ObjectId(),
             "name": "room1",
             "members": [CURRENT_ADMIN.username, CURRENT_USER.username],
-            "messages": [],
+            "last_message": None,
         }
         room2 = {
             "_id": ObjectId(),
             "name": "room2",
             "members": [CURRENT_USER.username, "some_other_user"],
-            "messages": [],
+            "last_message": None,
         }
         self.db.chatrooms.insert_many([room1, room2])
 
@@ -12339,6 +12473,36 @@ class ChatHandlerTest(BaseApiTestCase):
                 self.assertEqual(snippet["members"], room1["members"])
                 self.assertEqual(snippet["last_message"], None)
 
+        # profiles are only included on request
+        self.assertNotIn("profiles", response)
+
+    def test_get_get_mine_include_profiles(self):
+        """
+        expect: successfully get chatroom snippets together with the profile
+        snippets of the members of all rooms, omitting members without a profile
+        """
+
+        room1 = {
+            "_id": ObjectId(),
+            "name": "room1",
+            "members": [CURRENT_ADMIN.username, CURRENT_USER.username],
+            "last_message": None,
+        }
+        self.db.chatrooms.insert_one(room1)
+
+        response = self.base_checks(
+            "GET", "/chatroom/get_mine?include_profiles=true", True, 200
+        )
+        self.assertEqual(len(response["rooms"]), 2)
+        self.assertEqual(
+            set(response["profiles"].keys()),
+            {CURRENT_ADMIN.username, CURRENT_USER.username},
+        )
+        self.assertEqual(
+            response["profiles"][CURRENT_USER.username]["first_name"],
+            self.test_profiles[CURRENT_USER.username]["first_name"],
+        )
+
     def test_get_get_messages(self):
         """
         expect: successfully get all messages of the given room
@@ -12355,9 +12519,7 @@ class ChatHandlerTest(BaseApiTestCase):
                 "other_user": "acknowledged",
             },
         }
-        self.db.chatrooms.update_one(
-            {"_id": self.room_id}, {"$push": {"messages": message}}
-        )
+        self.db.messages.insert_one({**message, "room_id": self.room_id})
 
         response = self.base_checks(
             "GET",
@@ -12375,6 +12537,72 @@ class ChatHandlerTest(BaseApiTestCase):
         )
         self.assertIn(str(message["_id"]), [msg["_id"] for msg in response["messages"]])
 
+    def test_get_get_messages_paginated(self):
+        """
+        expect: successfully get the messages of the given room page by page
+        """
+
+        # add 4 more messages to the default room
+        messages = [
+            {
+                "_id": ObjectId(),
+                "message": "test{}".format(i),
+                "sender": "other_user",
+                "creation_date": datetime(2023, 1, 1, 9, i, 0),
+                "send_states": {
+                    CURRENT_ADMIN.username: "sent",
+                    "other_user": "acknowledged",
+                },
+            }
+            for i in range(4)
+        ]
+        self.db.messages.insert_many(
+            [{**message, "room_id": self.room_id} for message in messages]
+        )
+
+        # newest page first
+        response = self.base_checks(
+            "GET",
+            "/chatroom/get_messages?room_id={}&limit=3".format(str(self.room_id)),
+            True,
+            200,
+        )
+        self.assertEqual(
+            [msg["_id"] for msg in response["messages"]],
+            [str(message["_id"]) for message in messages[1:]],
+        )
+        self.assertEqual(response["next_cursor"], str(messages[1]["_id"]))
+
+        # scroll back using the cursor, expect the last page not to be full
+        response = self.base_checks(
+            "GET",
+            "/chatroom/get_messages?room_id={}&limit=3&before={}".format(
+                str(self.room_id), response["next_cursor"]
+            ),
+            True,
+            200,
+        )
+        self.assertEqual(
+            [msg["_id"] for msg in response["messages"]],
+            [str(self.default_message["_id"]), str(messages[0]["_id"])],
+        )
+        self.assertIsNone(response["next_cursor"])
+
+    def test_get_get_messages_error_message_doesnt_exist(self):
+        """
+        expect: fail message because the cursor message doesnt exist in the room
+        """
+
+        response = self.base_checks(
+            "GET",
+            "/chatroom/get_messages?room_id={}&limit=3&before={}".format(
+                str(self.room_id), str(ObjectId())
+            ),
+            False,
+            409,
+        )
+        self.assertEqual(response["reason"], MESSAGE_DOESNT_EXIST_ERROR)
+
     def test_get_get_messages_error_missing_key(self):
         """
         expect: fail message because room_id is missing
@@ -12433,7 +12661,7 @@ class ChatHandlerTest(BaseApiTestCase):
         self.assertIsNotNone(db_state)
         self.assertEqual(db_state["name"], None)
         self.assertEqual(db_state["members"], payload["members"])
-        self.assertEqual(db_state["messages"], [])
+        self.assertEqual(db_state["last_message"], None)
         self.assertNotEqual(db_state["_id"], self.room_id)
 
         # this time, create a new room with a name, though again with the same members
@@ -12451,7 +12679,7 @@ class ChatHandlerTest(BaseApiTestCase):
         self.assertIsNotNone(db_state2)
         self.assertEqual(db_state2["name"], payload2["name"])
         self.assertEqual(db_state2["members"], payload2["members"])
-        self.assertEqual(db_state2["messages"], [])
+        self.assertEqual(db_state2["last_message"], None)
         self.assertNotEqual(db_state2["_id"], self.room_id)
 
         # this time, create a room with an already existing name, but different members,
@@ -12470,7 +12698,7 @@ class ChatHandlerTest(BaseApiTestCase):
         self.assertIsNotNone(db_state3)
         self.assertEqual(db_state3["name"], payload3["name"])
         self.assertEqual(db_state3["members"], payload3["members"])
-        self.assertEqual(db_state3["messages"], [])
+        self.assertEqual(db_state3["last_message"], None)
         self.assertNotEqual(db_state3["_id"], self.room_id)
 
         # and finally, get the already existing room
@@ -12488,7 +12716,7 @@ class ChatHandlerTest(BaseApiTestCase):
         self.assertIsNotNone(db_state4)
         self.assertEqual(db_state4["name"], payload4["name"])
         self.assertEqual(db_state4["members"], payload4["members"])
-        self.assertEqual(db_state4["messages"], [self.default_message])
+        self.assertEqual(db_state4["last_message"], self.default_message)
         self.assertEqual(db_state4["_id"], self.room_id)
 
     def test_post_create_or_get_eroror_missing_key(self):
@@ -12854,3 +13082,299 @@ class ReportHandlerTest(BaseApiTestCase):
             403,
         )
         self.assertEqual(response["reason"], INSUFFICIENT_PERMISSION_ERROR)
+
+
+class MetricsHandlerTest(BaseApiTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.base_permission_environment_setUp()
+
+    def tearDown(self) -> None:
+        # cleanup test data
+        self.base_permission_environments_tearDown()
+        super().tearDown()
+
+    def test_get_metrics(self):
+        """
+        expect: successfully retrieve the metrics of the mongodb connection pool
+        """
+
+        response = self.base_checks("GET", "/metrics", True, 200)
+        self.assertIn("mongodb_pool", response)
+
+        # the admin check of the handler already used the pooled client,
+        # so there has been atleast one checkout
+        pool_metrics = response["mongodb_pool"]
+        self.assertGreaterEqual(pool_metrics["checkouts"], 1)
+        self.assertGreaterEqual(pool_metrics["open_connections"], 1)
+        self.assertGreaterEqual(pool_metrics["max_checked_out"], 1)
+
+    def test_get_metrics_error_insufficient_permission(self):
+        """
+        expect: fail message because user is not an admin
+        """
+
+        # switch to user mode
+        options.test_admin = False
+        options.test_user = True
+
+        response = self.base_checks("GET", "/metrics", False, 403)
+        self.assertEqual(response["reason"], INSUFFICIENT_PERMISSION_ERROR)
+
+
+class GridFSStaticFileHandlerTest(BaseApiTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        # every test starts with an empty upload cache
+        global_vars.upload_cache = None
+
+        self._cookie_secret = global_vars.cookie_secret
+        global_vars.cookie_secret = "unittest_secret"
+
+        fs = gridfs.GridFS(self.db)
+        self.content = b"unittest upload"
+        self.file_id = fs.put(
+            self.content,
+            content_type="image/png",
+            metadata={"uploader": CURRENT_ADMIN.username},
+        )
+        fs.put(
+            b"unittest logo",
+            _id="logo.png",
+            content_type="image/png",
+            metadata={"uploader": "system"},
+        )
+
+    def tearDown(self) -> None:
+        # cleanup test data
+        fs = gridfs.GridFS(self.db)
+        fs.delete(self.file_id)
+        fs.delete("logo.png")
+        global_vars.upload_cache = None
+        global_vars.cookie_secret = self._cookie_secret
+        super().tearDown()
+
+    def test_get_upload(self):
+        """
+        expect: successfully retrieve the file with a strong ETag, browsers may
+        cache it forever
+        """
+
+        response = self.fetch("/uploads/{}".format(self.file_id))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.content)
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertTrue(response.headers["Etag"].startswith('"'))
+        self.assertEqual(
+            response.headers["Cache-Control"], "private, max-age=31536000, immutable"
+        )
+
+    def test_get_upload_not_modified(self):
+        """
+        expect: 304 without content if the client already has the current version
+        """
+
+        etag = self.fetch("/uploads/{}".format(self.file_id)).headers["Etag"]
+
+        response = self.fetch(
+            "/uploads/{}".format(self.file_id), headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b"")
+
+        response = self.fetch(
+            "/uploads/{}".format(self.file_id), headers={"If-None-Match": '"other"'}
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.content)
+
+    def test_get_upload_cached(self):
+        """
+        expect: the file is only read once from gridfs, afterwards (partial)
+        contents are served from the upload cache
+        """
+
+        self.fetch("/uploads/{}".format(self.file_id))
+        response = self.fetch(
+            "/uploads/{}".format(self.file_id), headers={"Range": "bytes=0-7"}
+        )
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.content[:8])
+
+        metrics = global_vars.upload_cache.get_metrics()
+        self.assertEqual(metrics["cached_files"], 1)
+        self.assertEqual(metrics["hits"], 1)
+        self.assertEqual(metrics["misses"], 1)
+
+    def test_get_default_picture(self):
+        """
+        expect: default pictures have to be revalidated, because they can be
+        replaced under the same name, after which the new version is served
+        """
+
+        response = self.fetch("/uploads/logo.png")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b"unittest logo")
+        self.assertEqual(response.headers["Cache-Control"], "private, no-cache")
+        etag = response.headers["Etag"]
+
+        # replace the default picture
+        fs = gridfs.GridFS(self.db)
+        fs.delete("logo.png")
+        fs.put(
+            b"new unittest logo",
+            _id="logo.png",
+            content_type="image/png",
+            metadata={"uploader": "system"},
+        )
+
+        response = self.fetch("/uploads/logo.png", headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b"new unittest logo")
+        self.assertNotEqual(response.headers["Etag"], etag)
+
+    def test_get_upload_error_doesnt_exist(self):
+        """
+        expect: 404 if there is no file with this _id
+        """
+
+        response = self.fetch("/uploads/{}".format(ObjectId()))
+        self.assertEqual(response.code, 404)
+
+    def test_get_signed_upload(self):
+        """
+        expect: successfully retrieve the file by its signed URL without a session,
+        shared caches may store it until the URL expires
+        """
+
+        # no session
+        options.test_admin = False
+        options.test_user = False
+
+        response = self.fetch(sign_file_url(self.file_id))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.content)
+
+        cache_control = response.headers["Cache-Control"].split(", ")
+        self.assertEqual(cache_control[0], "public")
+        self.assertEqual(cache_control[2], "immutable")
+        max_age = int(cache_control[1].split("=")[1])
+        self.assertGreater(max_age, 0)
+        self.assertLessEqual(max_age, 2 * EXPIRY_PERIOD)
+
+        response = self.fetch(sign_file_url("logo.png"))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "public, no-cache")
+
+    def test_get_signed_upload_viewer(self):
+        """
+        expect: a signed URL scoped to a viewer can only be used by that user
+        """
+
+        response = self.fetch(
+            sign_file_url(self.file_id, viewer=CURRENT_ADMIN.username)
+        )
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers["Cache-Control"].startswith("private, "))
+
+        response = self.fetch(sign_file_url(self.file_id, viewer=CURRENT_USER.username))
+        self.assertEqual(response.code, 403)
+
+        # no session
+        options.test_admin = False
+        options.test_user = False
+        response = self.fetch(
+            sign_file_url(self.file_id, viewer=CURRENT_ADMIN.username)
+        )
+        self.assertEqual(response.code, 401)
+
+    def test_get_signed_upload_error_invalid_signature(self):
+        """
+        expect: 403 if the signature is invalid or the URL is missing parameters
+        """
+
+        options.test_admin = False
+        options.test_user = False
+
+        url = sign_file_url(self.file_id)
+        response = self.fetch(url.replace(str(self.file_id), str(ObjectId())))
+        self.assertEqual(response.code, 403)
+
+        response = self.fetch(url.split("&signature=")[0])
+        self.assertEqual(response.code, 403)
+
+        response = self.fetch("/uploads/signed/{}".format(self.file_id))
+        self.assertEqual(response.code, 403)
+
+    def test_get_signed_upload_error_expired(self):
+        """
+        expect: 403 if the signed URL has expired
+        """
+
+        options.test_admin = False
+        options.test_user = False
+
+        response = self.fetch(
+            sign_file_url(self.file_id, now=time.time() - 3 * EXPIRY_PERIOD)
+        )
+        self.assertEqual(response.code, 403)
+
+    def test_get_upload_derivative(self):
+        """
+        expect: the derivative of the image in the requested size is generated
+        on demand, as WebP if the client accepts it, as JPEG otherwise
+        """
+
+        image = io.BytesIO()
+        Image.new("RGB", (400, 400), (255, 0, 0)).save(image, "PNG")
+        image_id = gridfs.GridFS(self.db).put(
+            image.getvalue(),
+            content_type="image/png",
+            metadata={"uploader": CURRENT_ADMIN.username},
+        )
+
+        response = self.fetch(
+            "/uploads/{}?size=80".format(image_id),
+            headers={"Accept": "image/webp,image/*"},
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/webp")
+        self.assertEqual(response.headers["Vary"], "Accept")
+        with Image.open(io.BytesIO(response.body)) as derivative:
+            self.assertEqual(derivative.size, (80, 80))
+
+        response = self.fetch("/uploads/{}?size=80".format(image_id))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/jpeg")
+
+        # both derivatives have been stored
+        self.assertEqual(
+            self.db.fs.files.count_documents({"metadata.derivative_of": image_id}), 2
+        )
+
+        fs = gridfs.GridFS(self.db)
+        for derivative in fs.find({"metadata.derivative_of": image_id}):
+            fs.delete(derivative._id)
+        fs.delete(image_id)
+
+    def test_get_upload_derivative_no_image(self):
+        """
+        expect: files that are no images are served as they are
+        """
+
+        response = self.fetch("/uploads/{}?size=40".format(self.file_id))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.content)
+
+    def test_get_upload_derivative_error_invalid_size(self):
+        """
+        expect: 400 if the size is not one of the sizes of the derivatives
+        """
+
+        response = self.fetch("/uploads/{}?size=41".format(self.file_id))
+        self.assertEqual(response.code, 400)
+
+        response = self.fetch("/uploads/{}?size=large".format(self.file_id))
+        self.assertEqual(response.code, 400)
@@ -1,12 +1,21 @@
 from bson import ObjectId
+from collections import deque
 from datetime import datetime, timedelta
+import io
+import json
 import os
+import smtplib
 import time
+from typing import Dict, List
 from unittest import TestCase
+from urllib.parse import parse_qsl
 from bson import ObjectId
+from bson.errors import InvalidId
 import gridfs
 
 from dotenv import load_dotenv
+from jwcrypto import jwk, jwt
+from PIL import Image
 import pymongo
 import requests
 from tornado.testing import AsyncTestCase
@@ -21,7 +30,9 @@ from exceptions import (
     AlreadyRequestedJoinError,
     FileAlreadyInRepoError,
     FileDoesntExistError,
+    InvalidTokenError,
     InvitationDoesntExistError,
+    MalformedUploadError,
     MaximumFilesExceededError,
     MessageDoesntExistError,
     MissingKeyError,
@@ -40,11 +51,13 @@ from exceptions import (
     PostNotExistingException,
     ProfileDoesntExistException,
     SpaceDoesntExistError,
+    UploadTooLargeError,
     UserNotAdminError,
     UserNotInvitedError,
     UserNotMemberError,
 )
 import global_vars
+from main import load_email_templates
 from main import make_app  # import, otherwise test mode will fail in the app
 from model import (
     Evaluation,
@@ -59,14 +72,51 @@ from model import (
     VEPlan,
 )
 from resources.elasticsearch_integration import ElasticsearchConnector
+from resources.hydration import Loaders
+from resources.elasticsearch_mirror import ElasticsearchMirror
+from resources.elasticsearch_replication import (
+    ElasticsearchOutbox,
+    ElasticsearchReplicationQueue,
+)
+from resources.image_derivatives import (
+    DERIVATIVE_FORMATS,
+    DERIVATIVE_SIZES,
+    INDEXES as DERIVATIVE_INDEXES,
+    create_derivatives,
+    delete_derivatives,
+    find_derivative,
+    get_or_create_derivative,
+    is_no_image,
+)
+from resources import image_derivatives as image_derivatives_module
+from resources.indexes import get_registered_indexes, reconcile_indexes
 from resources.mail_invitation import MailInvitation
-from resources.network.acl import ACL
+from resources.mail_outbox import MailOutbox, MailQueue
+from resources.network import acl as acl_module
+from resources.network.acl import ACL, cleanup_unused_rules, get_acl_cache
 from resources.network.chat import Chat
-from resources.network.post import Posts
+from resources.network.feed import Feeds
+from resources.network.post import AsyncPosts, Posts
 from resources.network.profile import Profiles
+from resources.network.profile_snippet_cache import ProfileSnippetCache
 from resources.network.space import Spaces
+from resources.notifications import (
+    NotificationResource,
+    resume_notification_dispatches,
+)
+from resources.planner.plan_lock import PlanLocks
 from resources.planner.ve_plan import VEPlanResource
 from resources.reports import Reports
+from resources.shared_state import MemoryStateBackend, MongoStateBackend, StateBackend
+from resources.streaming_upload import GridFSMultipartUpload
+from resources.token_verification import (
+    JWKSCache,
+    TokenVerifier,
+    VerifiedTokenCache,
+)
+from resources.upload_cache import UploadCache
+from resources.upload_urls import sign_file_url, verify_file_url
+from resources.user_directory import UserDirectory, sync_user_from_token
 import util
 
 # don't change, these values match with the ones in BaseHandler
@@ -132,6 +182,10 @@ class BaseResourceTestCase(TestCase):
         self.client = self.__class__._client
         self.db = self.__class__._db
 
+        # the test data is written directly into the database, bypassing
+        # the invalidation of the ACL cache, so every test starts with an empty one
+        global_vars.acl_cache = None
+
         # multiplier values for achievements
         self.SOCIAL_ACHIEVEMENTS_PROGRESS_MULTIPLIERS = Profiles(
             self.db
@@ -1126,6 +1180,7 @@ class PostResourceTest(BaseResourceTestCase):
         self.db.posts.delete_many({})
         self.db.profiles.delete_many({})
         self.db.spaces.delete_many({})
+        self.db.feeds.delete_many({})
 
         # delete all created files in gridfs
         fs = gridfs.GridFS(self.db)
@@ -2495,6 +2550,10 @@ class PostResourceTest(BaseResourceTestCase):
 
         self.db.posts.insert_many([post1, post2, post3, post4, post5, post6])
 
+        # the posts were inserted directly, so the personal timelines
+        # have to be built from them
+        Feeds(self.db).rebuild_all()
+
         post_manager = Posts(self.db)
         # this should include post1 because it is from a user that the user follows,
         # post3 because it is from a space that the user is a member of,
@@ -2590,6 +2649,260 @@ class PostResourceTest(BaseResourceTestCase):
             PostNotExistingException, post_manager.update_post_files, ObjectId(), []
         )
 
+    def _insert_feed_test_space(self, members: List[str]) -> ObjectId:
+        """
+        helper to insert a space with the given members for the feed tests
+        """
+
+        space_id = ObjectId()
+        self.db.spaces.insert_one(
+            {
+                "_id": space_id,
+                "name": "feed_test_space",
+                "invisible": False,
+                "joinable": True,
+                "members": members,
+                "admins": [members[0]],
+                "invites": [],
+                "requests": [],
+                "files": [],
+            }
+        )
+        return space_id
+
+    def _create_feed_test_post(self, author: str, space_id: ObjectId = None) -> dict:
+        """
+        helper to create a post for the feed tests
+        """
+
+        return {
+            "author": author,
+            "creation_date": datetime.now(),
+            "text": "feed_test",
+            "space": space_id,
+            "pinned": False,
+            "isRepost": False,
+            "wordpress_post_id": None,
+            "tags": [],
+            "plans": [],
+            "files": [],
+            "comments": [],
+            "likers": [],
+        }
+
+    def _get_feed_usernames(self, post_id: ObjectId) -> List[str]:
+        return sorted(
+            entry["username"] for entry in self.db.feeds.find({"post_id": post_id})
+        )
+
+    def test_insert_post_fan_out_followers(self):
+        """
+        expect: a new post without a space is put into the feeds of the author and
+        his followers
+        """
+
+        self.db.profiles.update_one(
+            {"username": CURRENT_USER.username},
+            {"$push": {"follows": CURRENT_ADMIN.username}},
+        )
+
+        post_manager = Posts(self.db)
+        post_id = post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_ADMIN.username)
+        )
+
+        self.assertEqual(
+            self._get_feed_usernames(post_id),
+            sorted([CURRENT_ADMIN.username, CURRENT_USER.username]),
+        )
+
+        # the feed entry carries the creation date of the post for range queries
+        entry = self.db.feeds.find_one(
+            {"post_id": post_id, "username": CURRENT_USER.username}
+        )
+        post = self.db.posts.find_one({"_id": post_id})
+        self.assertEqual(entry["creation_date"], post["creation_date"])
+
+    def test_insert_post_fan_out_space_members(self):
+        """
+        expect: a new post in a space is put into the feeds of the author and the
+        space members, but not of followers of the author
+        """
+
+        space_id = self._insert_feed_test_space(["other_user"])
+        self.db.profiles.update_one(
+            {"username": CURRENT_USER.username},
+            {"$push": {"follows": CURRENT_ADMIN.username}},
+        )
+
+        post_manager = Posts(self.db)
+        post_id = post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_ADMIN.username, space_id)
+        )
+
+        self.assertEqual(
+            self._get_feed_usernames(post_id),
+            sorted([CURRENT_ADMIN.username, "other_user"]),
+        )
+
+    def test_insert_repost_fan_out(self):
+        """
+        expect: a new repost is put into the feeds as well
+        """
+
+        repost = self._create_feed_test_post(CURRENT_ADMIN.username)
+        repost["isRepost"] = True
+        repost["repostAuthor"] = CURRENT_USER.username
+        repost["originalCreationDate"] = datetime(2023, 1, 1, 9, 0, 0)
+        repost["repostText"] = "repost"
+
+        post_manager = Posts(self.db)
+        repost_id = post_manager.insert_repost(repost)
+
+        self.assertEqual(
+            self._get_feed_usernames(repost_id), [CURRENT_ADMIN.username]
+        )
+
+    def test_delete_post_removes_feed_entries(self):
+        """
+        expect: deleting a post removes it from all feeds
+        """
+
+        self.db.profiles.update_one(
+            {"username": CURRENT_USER.username},
+            {"$push": {"follows": CURRENT_ADMIN.username}},
+        )
+
+        post_manager = Posts(self.db)
+        post_id = post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_ADMIN.username)
+        )
+        post_manager.delete_post(post_id)
+
+        self.assertEqual(self.db.feeds.count_documents({"post_id": post_id}), 0)
+
+    def test_delete_post_by_space_removes_feed_entries(self):
+        """
+        expect: deleting all posts of a space removes them from all feeds
+        """
+
+        space_id = self._insert_feed_test_space([CURRENT_USER.username])
+
+        post_manager = Posts(self.db)
+        post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_ADMIN.username, space_id)
+        )
+        post_manager.delete_post_by_space(space_id)
+
+        self.assertEqual(self.db.feeds.count_documents({"space": space_id}), 0)
+
+    def test_follows_update_feed(self):
+        """
+        expect: following a user adds his posts (outside of spaces) to the feed,
+        unfollowing removes them again
+        """
+
+        post_manager = Posts(self.db)
+        post_id = post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_ADMIN.username)
+        )
+        space_id = self._insert_feed_test_space([CURRENT_USER.username])
+        space_post_id = post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_ADMIN.username, space_id)
+        )
+
+        profile_manager = Profiles(self.db)
+        profile_manager.add_follows(CURRENT_USER.username, CURRENT_ADMIN.username)
+        self.assertIn(CURRENT_USER.username, self._get_feed_usernames(post_id))
+
+        profile_manager.remove_follows(CURRENT_USER.username, CURRENT_ADMIN.username)
+        self.assertNotIn(CURRENT_USER.username, self._get_feed_usernames(post_id))
+
+        # the post in the space stays in the feed, because the user is still a member
+        self.assertIn(CURRENT_USER.username, self._get_feed_usernames(space_post_id))
+
+    def test_space_membership_updates_feed(self):
+        """
+        expect: joining a space adds its posts to the feed, leaving or
+        being kicked removes them again, but own posts in the space remain
+        """
+
+        space_id = self._insert_feed_test_space([CURRENT_ADMIN.username])
+
+        post_manager = Posts(self.db)
+        post_id = post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_ADMIN.username, space_id)
+        )
+
+        space_manager = Spaces(self.db)
+        space_manager.join_space(space_id, CURRENT_USER.username)
+        self.assertIn(CURRENT_USER.username, self._get_feed_usernames(post_id))
+        own_post_id = post_manager.insert_post(
+            self._create_feed_test_post(CURRENT_USER.username, space_id)
+        )
+
+        space_manager.leave_space(space_id, CURRENT_USER.username)
+        self.assertNotIn(CURRENT_USER.username, self._get_feed_usernames(post_id))
+        self.assertIn(CURRENT_USER.username, self._get_feed_usernames(own_post_id))
+
+        space_manager.join_space(space_id, CURRENT_USER.username)
+        self.assertIn(CURRENT_USER.username, self._get_feed_usernames(post_id))
+
+        space_manager.kick_user(space_id, CURRENT_USER.username)
+        self.assertNotIn(CURRENT_USER.username, self._get_feed_usernames(post_id))
+
+    def test_feed_consistency_check_and_rebuild(self):
+        """
+        expect: the consistency check reports missing and stale feed entries,
+        rebuilding the feeds repairs them
+        """
+
+        feed_manager = Feeds(self.db)
+
+        # the default post was inserted directly, so the feed of its author misses it
+        # and an entry of a post that doesnt exist is stale
+        self.db.feeds.insert_one(
+            {
+                "username": CURRENT_USER.username,
+                "post_id": ObjectId(),
+                "creation_date": datetime.now(),
+                "author": CURRENT_USER.username,
+                "space": None,
+            }
+        )
+
+        report = feed_manager.check_consistency()
+        self.assertEqual(report["missing_entries"], 1)
+        self.assertEqual(report["stale_entries"], 1)
+        self.assertEqual(
+            sorted(report["inconsistent_users"]),
+            sorted([CURRENT_ADMIN.username, CURRENT_USER.username]),
+        )
+
+        feed_manager.rebuild_all()
+
+        report = feed_manager.check_consistency()
+        self.assertEqual(report["missing_entries"], 0)
+        self.assertEqual(report["stale_entries"], 0)
+        self.assertEqual(report["inconsistent_users"], [])
+        self.assertEqual(self._get_feed_usernames(self.post_id), [CURRENT_ADMIN.username])
+
+    def test_feed_backfill_if_empty(self):
+        """
+        expect: the feeds are backfilled only if there are no feed entries at all
+        """
+
+        feed_manager = Feeds(self.db)
+        feed_manager.backfill_if_empty()
+        self.assertEqual(self._get_feed_usernames(self.post_id), [CURRENT_ADMIN.username])
+
+        # feeds exist now, so a directly inserted post is not backfilled
+        post = self._create_feed_test_post(CURRENT_ADMIN.username)
+        post_id = self.db.posts.insert_one(post).inserted_id
+        feed_manager.backfill_if_empty()
+        self.assertEqual(self._get_feed_usernames(post_id), [])
+
+
 
 class ProfileResourceTest(BaseResourceTestCase):
     def setUp(self) -> None:
@@ -3590,6 +3903,7 @@ class ProfileResourceTest(BaseResourceTestCase):
                     None,
                 ),
                 "profile_pic": self.default_profile["profile_pic"],
+                "profile_pic_url": sign_file_url(self.default_profile["profile_pic"]),
                 "chosen_achievement": self.default_profile["chosen_achievement"],
                 "ve_ready": self.default_profile["ve_ready"],
             },
@@ -3602,6 +3916,7 @@ class ProfileResourceTest(BaseResourceTestCase):
                 "last_name": profile1["last_name"],
                 "institution": "",
                 "profile_pic": profile1["profile_pic"],
+                "profile_pic_url": sign_file_url(profile1["profile_pic"]),
                 "chosen_achievement": profile1["chosen_achievement"],
                 "ve_ready": self.default_profile["ve_ready"],
             },
@@ -3628,6 +3943,7 @@ class ProfileResourceTest(BaseResourceTestCase):
                     None,
                 ),
                 "profile_pic": self.default_profile["profile_pic"],
+                "profile_pic_url": sign_file_url(self.default_profile["profile_pic"]),
                 "chosen_achievement": self.default_profile["chosen_achievement"],
                 "ve_ready": self.default_profile["ve_ready"],
             },
@@ -5592,6 +5908,48 @@ class SpaceResourceTest(BaseResourceTestCase):
             CURRENT_ADMIN.username,
         )
 
+    def test_attach_repo_file(self):
+        """
+        expect: successfully add a file that is already stored in gridfs
+        to the space repo
+        """
+
+        fs = gridfs.GridFS(self.db)
+        _id = fs.put(b"test", filename="test_file")
+
+        space_manager = Spaces(self.db)
+        space_manager.attach_repo_file(
+            self.space_id, _id, "test_file", CURRENT_ADMIN.username
+        )
+
+        space = self.db.spaces.find_one({"_id": self.space_id})
+        self.assertEqual(
+            space["files"],
+            [
+                {
+                    "author": CURRENT_ADMIN.username,
+                    "file_id": _id,
+                    "file_name": "test_file",
+                    "manually_uploaded": True,
+                }
+            ],
+        )
+
+    def test_attach_repo_file_error_space_doesnt_exist(self):
+        """
+        expect: SpaceDoesntExistError is raised because no space with this _id exists
+        """
+
+        space_manager = Spaces(self.db)
+        self.assertRaises(
+            SpaceDoesntExistError,
+            space_manager.attach_repo_file,
+            ObjectId(),
+            ObjectId(),
+            "test_file",
+            CURRENT_ADMIN.username,
+        )
+
     def test_remove_file(self):
         """
         expect: successfully remove file from space repo
@@ -5609,12 +5967,18 @@ class SpaceResourceTest(BaseResourceTestCase):
             {"$push": {"files": file_obj}},
         )
 
+        # a derivative of the file
+        derivative_id = gridfs.GridFS(self.db).put(
+            b"derivative", metadata={"derivative_of": file_id}
+        )
+
         space_manager = Spaces(self.db)
         space_manager.remove_file(self.space_id, file_id)
 
         space = self.db.spaces.find_one({"_id": self.space_id})
         self.assertEqual(space["files"], [])
         self.assertFalse(gridfs.GridFS(self.db).exists(file_id))
+        self.assertFalse(gridfs.GridFS(self.db).exists(derivative_id))
 
     def test_remove_file_error_space_doesnt_exist(self):
         """
@@ -7320,6 +7684,26 @@ class PlanResourceTest(BaseResourceTestCase):
         fs = gridfs.GridFS(self.db)
         self.assertEqual(fs.get(file_id).read(), b"test")
 
+    def test_attach_evaluation_file(self):
+        """
+        expect: successfully attach a file that is already stored in gridfs
+        as the evaluation file of the plan
+        """
+
+        fs = gridfs.GridFS(self.db)
+        file_id = fs.put(b"test", filename="test_file")
+
+        self.planner.attach_evaluation_file(self.plan_id, file_id, "test_file", None)
+
+        db_state = self.db.plans.find_one({"_id": self.plan_id})
+        self.assertEqual(
+            db_state["evaluation_file"],
+            {
+                "file_id": file_id,
+                "file_name": "test_file",
+            },
+        )
+
     def test_put_evaluation_file_with_user(self):
         """
         expect: successfully put evaluation file into the plan and passing access checks
@@ -7371,6 +7755,35 @@ class PlanResourceTest(BaseResourceTestCase):
             "user_with_no_access_rights",
         )
 
+    def test_put_evaluation_file_error_nothing_stored(self):
+        """
+        expect: the file is not even stored in gridfs if the plan _id is invalid
+        or the user has no write access
+        """
+
+        self.assertRaises(
+            InvalidId,
+            self.planner.put_evaluation_file,
+            "invalid_id",
+            "rejected_file",
+            b"test",
+            "image/jpg",
+            None,
+        )
+        self.assertRaises(
+            NoWriteAccessError,
+            self.planner.put_evaluation_file,
+            self.plan_id,
+            "rejected_file",
+            b"test",
+            "image/jpg",
+            "user_with_no_access_rights",
+        )
+        self.assertEqual(self.db.fs.chunks.count_documents({}), 0)
+        self.assertIsNone(
+            gridfs.GridFS(self.db).find_one({"filename": "rejected_file"})
+        )
+
     def test_remove_evaluation_file(self):
         """
         expect: successfully remove an evaluation file from the plan
@@ -7570,6 +7983,36 @@ class PlanResourceTest(BaseResourceTestCase):
             None,
         )
 
+    def test_put_literature_file_error_max_files_reached_file_removed(self):
+        """
+        expect: the file is not left behind in gridfs if it can't be attached
+        to the plan
+        """
+
+        self.db.plans.update_one(
+            {"_id": self.plan_id},
+            {
+                "$set": {
+                    "literature_files": [
+                        {"file_id": ObjectId(), "file_name": "test_file"}
+                        for _ in range(5)
+                    ]
+                }
+            },
+        )
+
+        self.assertRaises(
+            MaximumFilesExceededError,
+            self.planner.put_literature_file,
+            self.plan_id,
+            "exceeding_file",
+            b"test",
+            "image/jpg",
+            None,
+        )
+        fs = gridfs.GridFS(self.db)
+        self.assertIsNone(fs.find_one({"filename": "exceeding_file"}))
+
     def test_remove_literature_file(self):
         """
         expect: successfully remove a literature file from the plan's list
@@ -8110,16 +8553,63 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
             "_id": self.room_id,
             "name": "test_room",
             "members": [CURRENT_ADMIN.username, CURRENT_USER.username],
-            "messages": [self.default_message],
+            "last_message": self.default_message,
         }
         self.db.chatrooms.insert_one(self.default_room)
+        self.db.messages.insert_one({**self.default_message, "room_id": self.room_id})
+        self.chat_manager.rebuild_unread_counters()
 
     def tearDown(self) -> None:
         self.db.chatrooms.delete_many({})
+        self.db.messages.delete_many({})
+        self.db.chat_unread.delete_many({})
         self.chat_manager = None
 
         super().tearDown()
 
+    def insert_room_with_messages(self, room: dict) -> None:
+        """
+        helper to insert a room given with its messages embedded as a list
+        (`room["messages"]`) into the db, i.e. the messages into the messages collection
+        and the room with the last message
+        """
+
+        messages = room["messages"]
+        self.db.chatrooms.insert_one(
+            {
+                **{key: value for key, value in room.items() if key != "messages"},
+                "last_message": messages[-1] if messages else None,
+            }
+        )
+        if messages:
+            self.db.messages.insert_many(
+                [{**message, "room_id": room["_id"]} for message in messages]
+            )
+            self.chat_manager.rebuild_unread_counters([room["_id"]])
+
+    def get_unread_count_from_db(self, room_id: ObjectId, username: str) -> int:
+        """
+        helper to get the unread counter of a user in a room from the db
+        """
+
+        counter = self.db.chat_unread.find_one(
+            {"room_id": room_id, "username": username}
+        )
+        return counter["unread_count"] if counter else 0
+
+    def get_messages_of_room_from_db(self, room_id: ObjectId) -> List[dict]:
+        """
+        helper to get the messages of a room from the db in the order they were sent
+        """
+
+        return list(
+            self.db.messages.find(
+                {"room_id": room_id},
+                projection={"room_id": False},
+                sort=[("creation_date", 1), ("_id", 1)],
+            )
+        )
+
     def test_get_or_create_room_id(self):
         """
         expect: - successfully get room id if room exists
@@ -8145,7 +8635,8 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
         self.assertEqual(
             db_state["members"], [CURRENT_ADMIN.username, CURRENT_USER.username]
         )
-        self.assertEqual(db_state["messages"], [])
+        self.assertEqual(db_state["last_message"], None)
+        self.assertEqual(self.get_messages_of_room_from_db(room_id), [])
 
         # also try creating a new room with the same users, but no name, which should
         # be just another room as well
@@ -8161,7 +8652,8 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
         self.assertEqual(
             db_state["members"], [CURRENT_ADMIN.username, CURRENT_USER.username]
         )
-        self.assertEqual(db_state["messages"], [])
+        self.assertEqual(db_state["last_message"], None)
+        self.assertEqual(self.get_messages_of_room_from_db(room_id), [])
 
     def test_get_room_snippets_for_user(self):
         """
@@ -8173,13 +8665,13 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
             "_id": ObjectId(),
             "name": "room1",
             "members": [CURRENT_ADMIN.username, CURRENT_USER.username],
-            "messages": [],
+            "last_message": None,
         }
         room2 = {
             "_id": ObjectId(),
             "name": "room2",
             "members": [CURRENT_USER.username, "some_other_user"],
-            "messages": [],
+            "last_message": None,
         }
         self.db.chatrooms.insert_many([room1, room2])
 
@@ -8249,9 +8741,7 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
                 {"username": CURRENT_USER.username, "send_state": "acknowledged"},
             ],
         }
-        self.db.chatrooms.update_one(
-            {"_id": self.room_id}, {"$push": {"messages": message}}
-        )
+        self.db.messages.insert_one({**message, "room_id": self.room_id})
 
         # expect both messages to be returned
         messages = self.chat_manager.get_all_messages_of_room(self.room_id)
@@ -8286,10 +8776,19 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
 
         self.chat_manager.store_message(self.room_id, message)
 
-        # expect the message to be in the db
+        # expect the message to be in the db and to be the last message of the room
+        self.assertIn(message, self.get_messages_of_room_from_db(self.room_id))
         db_state = self.db.chatrooms.find_one({"_id": self.room_id})
         self.assertIsNotNone(db_state)
-        self.assertIn(message, db_state["messages"])
+        self.assertEqual(db_state["last_message"], message)
+
+        # expect the message to be counted as unread only for the admin
+        self.assertEqual(
+            self.get_unread_count_from_db(self.room_id, CURRENT_ADMIN.username), 1
+        )
+        self.assertEqual(
+            self.get_unread_count_from_db(self.room_id, CURRENT_USER.username), 1
+        )
 
     def test_store_message_error_malformed_message(self):
         """
@@ -8349,20 +8848,22 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
         )
 
         # expect the message to be in the db
-        db_state = self.db.chatrooms.find_one({"_id": self.room_id})
-        self.assertIsNotNone(db_state)
-        self.assertIn(
-            message_content, [message["message"] for message in db_state["messages"]]
-        )
+        messages = self.get_messages_of_room_from_db(self.room_id)
+        self.assertIn(message_content, [message["message"] for message in messages])
         self.assertIn(
             {"username": CURRENT_ADMIN.username, "send_state": "acknowledged"},
-            db_state["messages"][1]["send_states"],
+            messages[1]["send_states"],
         )
         self.assertIn(
             {"username": CURRENT_USER.username, "send_state": "pending"},
-            db_state["messages"][1]["send_states"],
+            messages[1]["send_states"],
         )
 
+        # expect the message to be the last message of the room
+        db_state = self.db.chatrooms.find_one({"_id": self.room_id})
+        self.assertIsNotNone(db_state)
+        self.assertEqual(db_state["last_message"]["message"], message_content)
+
     @gen_test
     async def test_send_message_error_room_doesnt_exist(self):
         """
@@ -8396,11 +8897,34 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
         )
 
         # expect the send_state to be acknowledged now (was "sent" before)
+        self.assertIn(
+            {"username": CURRENT_USER.username, "send_state": "acknowledged"},
+            self.get_messages_of_room_from_db(self.room_id)[0]["send_states"],
+        )
+
+        # expect the last message of the room to be in sync
         db_state = self.db.chatrooms.find_one({"_id": self.room_id})
         self.assertIsNotNone(db_state)
         self.assertIn(
             {"username": CURRENT_USER.username, "send_state": "acknowledged"},
-            db_state["messages"][0]["send_states"],
+            db_state["last_message"]["send_states"],
+        )
+
+        # expect the message not to be counted as unread anymore
+        self.assertEqual(
+            self.get_unread_count_from_db(self.room_id, CURRENT_USER.username), 0
+        )
+
+        # acknowledging it again fails and doesn't change the counter
+        self.assertRaises(
+            MessageDoesntExistError,
+            self.chat_manager.acknowledge_message,
+            self.room_id,
+            self.message_id,
+            CURRENT_USER.username,
+        )
+        self.assertEqual(
+            self.get_unread_count_from_db(self.room_id, CURRENT_USER.username), 0
         )
 
     def test_acknowledge_message_error_room_doesnt_exist(self):
@@ -8492,7 +9016,8 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
                 }
             ],
         }
-        self.db.chatrooms.insert_many([room1, room2])
+        self.insert_room_with_messages(room1)
+        self.insert_room_with_messages(room2)
 
         # also add one more acknowledged message to the default room
         # that should not be included in the result
@@ -8506,9 +9031,7 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
                 {"username": CURRENT_USER.username, "send_state": "acknowledged"},
             ],
         }
-        self.db.chatrooms.update_one(
-            {"_id": self.room_id}, {"$push": {"messages": message}}
-        )
+        self.db.messages.insert_one({**message, "room_id": self.room_id})
 
         # expect only the default room to be returned
         rooms = self.chat_manager.get_rooms_with_unacknowledged_messages_for_user(
@@ -8534,9 +9057,7 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
                 {"username": CURRENT_USER.username, "send_state": "acknowledged"},
             ],
         }
-        self.db.chatrooms.update_one(
-            {"_id": self.room_id}, {"$push": {"messages": message}}
-        )
+        self.db.messages.insert_one({**message, "room_id": self.room_id})
 
         # add one more room with two messages, one acknowledged and one pending
         room1 = {
@@ -8575,7 +9096,7 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
                 },
             ],
         }
-        self.db.chatrooms.insert_one(room1)
+        self.insert_room_with_messages(room1)
 
         self.chat_manager.bulk_set_message_sent_state(
             [self.room_id, room1["_id"]],
@@ -8585,33 +9106,272 @@ class ChatResourceTest(BaseResourceTestCase, AsyncTestCase):
 
         # expect the new message in the default room and the 2nd message in room1 to be updated
         # to sent
-        db_state = self.db.chatrooms.find_one({"_id": self.room_id})
-        self.assertIsNotNone(db_state)
-
         self.assertIn(
             {"username": CURRENT_ADMIN.username, "send_state": "sent"},
-            list(filter(lambda m: m["_id"] == message["_id"], db_state["messages"]))[0][
+            self.db.messages.find_one({"_id": message["_id"]})["send_states"],
+        )
+        self.assertIn(
+            {"username": CURRENT_ADMIN.username, "send_state": "sent"},
+            self.db.messages.find_one({"_id": room1["messages"][1]["_id"]})[
                 "send_states"
             ],
         )
+
+        # expect the last message of room1 to be in sync
         other_room = self.db.chatrooms.find_one({"_id": room1["_id"]})
         self.assertIsNotNone(other_room)
         self.assertIn(
             {"username": CURRENT_ADMIN.username, "send_state": "sent"},
-            list(
-                filter(
-                    lambda m: m["_id"] == room1["messages"][1]["_id"],
-                    other_room["messages"],
-                )
-            )[0]["send_states"],
+            other_room["last_message"]["send_states"],
+        )
+
+
+    def test_get_messages_of_room(self):
+        """
+        expect: successfully get the messages of the room page by page, oldest first
+        """
+
+        # add 4 more messages to the default room
+        messages = [
+            {
+                "_id": ObjectId(),
+                "message": "test{}".format(i),
+                "sender": CURRENT_USER.username,
+                "creation_date": datetime(2023, 1, 1, 9, i, 0),
+                "send_states": [],
+            }
+            for i in range(4)
+        ]
+        self.db.messages.insert_many(
+            [{**message, "room_id": self.room_id} for message in messages]
+        )
+
+        # the newest page
+        page = self.chat_manager.get_messages_of_room(self.room_id, limit=2)
+        self.assertEqual(
+            [message["_id"] for message in page],
+            [messages[2]["_id"], messages[3]["_id"]],
+        )
+        self.assertNotIn("room_id", page[0])
+
+        # the next page, using the oldest message as the cursor
+        page = self.chat_manager.get_messages_of_room(
+            self.room_id, before=page[0]["_id"], limit=2
+        )
+        self.assertEqual(
+            [message["_id"] for message in page],
+            [messages[0]["_id"], messages[1]["_id"]],
+        )
+
+        # the last page only contains the default message
+        page = self.chat_manager.get_messages_of_room(
+            self.room_id, before=str(page[0]["_id"]), limit=2
+        )
+        self.assertEqual(page, [self.default_message])
+
+    def test_get_messages_of_room_error_room_doesnt_exist(self):
+        """
+        expect: RoomDoesntExistError is raised because no room with this _id exists
+        """
+
+        self.assertRaises(
+            RoomDoesntExistError, self.chat_manager.get_messages_of_room, ObjectId()
+        )
+
+    def test_get_messages_of_room_error_message_doesnt_exist(self):
+        """
+        expect: MessageDoesntExistError is raised because the cursor message
+        doesn't exist in the room
+        """
+
+        self.assertRaises(
+            MessageDoesntExistError,
+            self.chat_manager.get_messages_of_room,
+            self.room_id,
+            ObjectId(),
+        )
+
+    def test_refresh_last_message(self):
+        """
+        expect: the last message of the room is re-determined from the messages
+        """
+
+        self.db.messages.delete_many({"_id": self.message_id})
+        self.chat_manager.refresh_last_message(self.room_id)
+
+        db_state = self.db.chatrooms.find_one({"_id": self.room_id})
+        self.assertIsNone(db_state["last_message"])
+
+    def test_migrate_embedded_messages(self):
+        """
+        expect: messages that are embedded in their room are moved into the messages
+        collection and the last message of the room is set
+        """
+
+        message = {
+            "_id": ObjectId(),
+            "message": "test2",
+            "sender": CURRENT_USER.username,
+            "creation_date": datetime(2023, 1, 1, 9, 0, 0),
+            "send_states": [],
+        }
+        old_room = {
+            "_id": ObjectId(),
+            "name": "old_room",
+            "members": [CURRENT_ADMIN.username, CURRENT_USER.username],
+            "messages": [self.default_message | {"_id": ObjectId()}, message],
+        }
+        empty_old_room = {
+            "_id": ObjectId(),
+            "name": "empty_old_room",
+            "members": [CURRENT_ADMIN.username, CURRENT_USER.username],
+            "messages": [],
+        }
+        self.db.chatrooms.insert_many([old_room, empty_old_room])
+
+        # simulate an interrupted previous run that already copied one message
+        self.db.messages.insert_one({**message, "room_id": old_room["_id"]})
+
+        self.assertEqual(self.chat_manager.migrate_embedded_messages(), 2)
+
+        db_state = self.db.chatrooms.find_one({"_id": old_room["_id"]})
+        self.assertNotIn("messages", db_state)
+        self.assertEqual(db_state["last_message"], message)
+        self.assertEqual(
+            self.get_messages_of_room_from_db(old_room["_id"]), old_room["messages"]
+        )
+
+        db_state = self.db.chatrooms.find_one({"_id": empty_old_room["_id"]})
+        self.assertNotIn("messages", db_state)
+        self.assertIsNone(db_state["last_message"])
+
+        # nothing left to migrate
+        self.assertEqual(self.chat_manager.migrate_embedded_messages(), 0)
+
+    def test_get_unread_counts_for_user(self):
+        """
+        expect: successfully get the number of unread messages per room of the user
+        """
+
+        room = {
+            "_id": ObjectId(),
+            "name": "room1",
+            "members": [CURRENT_ADMIN.username, CURRENT_USER.username],
+            "messages": [
+                {
+                    "_id": ObjectId(),
+                    "message": "test{}".format(i),
+                    "sender": CURRENT_ADMIN.username,
+                    "creation_date": datetime(2023, 1, 1, 9, i, 0),
+                    "send_states": [
+                        {"username": CURRENT_ADMIN.username, "send_state": "acknowledged"},
+                        {"username": CURRENT_USER.username, "send_state": "pending"},
+                    ],
+                }
+                for i in range(3)
+            ],
+        }
+        self.insert_room_with_messages(room)
+
+        self.assertEqual(
+            self.chat_manager.get_unread_counts_for_user(CURRENT_USER.username),
+            {self.room_id: 1, room["_id"]: 3},
+        )
+        self.assertEqual(
+            self.chat_manager.get_unread_counts_for_user(CURRENT_ADMIN.username), {}
         )
 
+        # expect the counts to be included in the room snippets as well
+        snippets = self.chat_manager.get_room_snippets_for_user(CURRENT_USER.username)
+        self.assertEqual(
+            {snippet["_id"]: snippet["unread_count"] for snippet in snippets},
+            {self.room_id: 1, room["_id"]: 3},
+        )
+
+    def test_get_unread_counts_since(self):
+        """
+        expect: successfully get the number of unread messages and rooms per user,
+        but only for users with unread messages since the given date
+        """
+
+        room = {
+            "_id": ObjectId(),
+            "name": "room1",
+            "members": [CURRENT_ADMIN.username, CURRENT_USER.username, "other_user"],
+            "messages": [
+                {
+                    "_id": ObjectId(),
+                    "message": "test",
+                    "sender": CURRENT_ADMIN.username,
+                    "creation_date": datetime(2023, 1, 2, 9, 0, 0),
+                    "send_states": [
+                        {"username": CURRENT_ADMIN.username, "send_state": "acknowledged"},
+                        {"username": CURRENT_USER.username, "send_state": "sent"},
+                        {"username": "other_user", "send_state": "acknowledged"},
+                    ],
+                }
+            ],
+        }
+        self.insert_room_with_messages(room)
+
+        self.assertEqual(
+            self.chat_manager.get_unread_counts_since(datetime(2023, 1, 1)),
+            {CURRENT_USER.username: {"messages": 2, "rooms": 2}},
+        )
+
+        # the message of the default room is older
+        self.assertEqual(
+            self.chat_manager.get_unread_counts_since(datetime(2023, 1, 2)),
+            {CURRENT_USER.username: {"messages": 1, "rooms": 1}},
+        )
+
+        self.assertEqual(
+            self.chat_manager.get_unread_counts_since(datetime(2023, 1, 3)), {}
+        )
+
+    def test_rebuild_unread_counters(self):
+        """
+        expect: the unread counters are re-determined from the send states
+        of the messages
+        """
+
+        # simulate a drifted counter and a message deleted behind the back of the counters
+        other_room_id = ObjectId()
+        self.db.chat_unread.insert_one(
+            {
+                "room_id": other_room_id,
+                "username": CURRENT_USER.username,
+                "unread_count": 5,
+                "last_unread_date": datetime(2023, 1, 1),
+            }
+        )
+        self.db.messages.delete_many({"_id": self.message_id})
+
+        # rebuilding only the default room leaves the other one untouched
+        self.assertEqual(self.chat_manager.rebuild_unread_counters([self.room_id]), 0)
+        self.assertEqual(
+            self.get_unread_count_from_db(self.room_id, CURRENT_USER.username), 0
+        )
+        self.assertEqual(
+            self.get_unread_count_from_db(other_room_id, CURRENT_USER.username), 5
+        )
+
+        # rebuilding all rooms
+        self.db.messages.insert_one({**self.default_message, "room_id": self.room_id})
+        self.assertEqual(self.chat_manager.rebuild_unread_counters(), 1)
+        self.assertEqual(
+            self.get_unread_count_from_db(self.room_id, CURRENT_USER.username), 1
+        )
+        self.assertEqual(
+            self.get_unread_count_from_db(other_room_id, CURRENT_USER.username), 0
+        )
 
 class ElasticsearchIntegrationTest(BaseResourceTestCase):
     def setUp(self) -> None:
         return super().setUp()
 
     def tearDown(self) -> None:
+        self.db.elasticsearch_outbox.delete_many({})
         super().tearDown()
 
         # clean elasticsearch index, if there is one
@@ -8646,6 +9406,17 @@ class ElasticsearchIntegrationTest(BaseResourceTestCase):
         l = ["value1", {"key1": "value1", "key2": "value2"}]
         self.assertEqual(es._dict_or_list_values_to_str(l), "value1 value1 value2")
 
+        # deeply nested, None and empty values are skipped
+        l = ["value1", [None, "", {"key1": [["value2"], 3]}], []]
+        self.assertEqual(es._dict_or_list_values_to_str(l), "value1 value2 3")
+
+        # values nested deeper than the limit are skipped
+        nested = "too deep"
+        for _ in range(es.MAX_FLATTEN_DEPTH):
+            nested = [nested]
+        self.assertEqual(es._dict_or_list_values_to_str(["value1", nested]), "value1")
+        self.assertEqual(es._dict_or_list_values_to_str(nested[0]), "too deep")
+
     def test_on_insert(self):
         """
         expect: successfully replicate profile document to elasticsearch
@@ -8898,98 +9669,545 @@ class ElasticsearchIntegrationTest(BaseResourceTestCase):
         )
         self.assertEqual(response.status_code, 404)
 
-    def test_search_profile_match(self):
-        pass
+    def test_flush(self):
+        """
+        expect: successfully replicate the enqueued changes with one bulk request
+        """
+
+        doc_id = ObjectId()
+        deleted_doc_id = ObjectId()
+        ElasticsearchOutbox(self.db).enqueue("test", doc_id, "index", document={"name": "test"})
+        ElasticsearchOutbox(self.db).enqueue("test", deleted_doc_id, "delete")
 
+        self.assertEqual(ElasticsearchReplicationQueue().flush(self.db), 2)
+        self.assertEqual(self.db.elasticsearch_outbox.count_documents({}), 0)
+
+        response = requests.get(
+            "{}/{}/_doc/{}".format(global_vars.elasticsearch_base_url, "test", doc_id),
+            auth=(
+                global_vars.elasticsearch_username,
+                global_vars.elasticsearch_password,
+            ),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["_source"], {"name": "test"})
 
-class NotificationIntegrationTest(BaseResourceTestCase):
-    pass
+    def test_search_profile_match(self):
+        pass
 
 
-class MailInvitationResourceTest(BaseResourceTestCase):
+class ElasticsearchOutboxTest(BaseResourceTestCase):
     def setUp(self) -> None:
         super().setUp()
 
-        # create default invitation:
-        self.default_invitation = {
-            "_id": ObjectId(),
-            "sender": CURRENT_ADMIN.username,
-            "recipient_name": "invitation_receiver",
-            "recipient_mail": "invitation_receiver@mail.com",
-            "message": "test",
-            "timestamp": datetime.now(),
-        }
-        self.db.mail_invitations.insert_one(self.default_invitation)
-
-        self.invitation_manager = MailInvitation(self.db)
+        self.outbox = ElasticsearchOutbox(self.db)
 
     def tearDown(self) -> None:
+        self.db.elasticsearch_outbox.delete_many({})
+        self.outbox = None
+
         super().tearDown()
 
-        self.db.mail_invitations.delete_many({})
+    def test_enqueue(self):
+        """
+        expect: successfully enqueue changes, coalescing the changes of the same document
+        """
 
-    def test_check_within_rate_limit(self):
+        doc_id = ObjectId()
+        self.outbox.enqueue("test", doc_id, "index", document={"name": "first"})
+        first_entry = self.db.elasticsearch_outbox.find_one({"doc_id": str(doc_id)})
+
+        self.outbox.enqueue("test", doc_id, "index", document={"name": "second"})
+        self.outbox.enqueue("test", ObjectId(), "delete")
+
+        self.assertEqual(self.db.elasticsearch_outbox.count_documents({}), 2)
+        entry = self.db.elasticsearch_outbox.find_one({"doc_id": str(doc_id)})
+        self.assertEqual(entry["action"], "index")
+        self.assertEqual(entry["document"], {"name": "second"})
+        self.assertGreater(entry["version"], first_entry["version"])
+        # the lag counts from the first change that has not been replicated
+        self.assertEqual(entry["enqueued_at"], first_entry["enqueued_at"])
+
+    def test_claim(self):
         """
-        expect: successfully check if the user is within the rate limit
+        expect: due entries are claimed once, until their lease expires
         """
 
-        # expect True because the user has sent less than 10 invitations in the last 24 hours
-        self.assertTrue(
-            self.invitation_manager.check_within_rate_limit(CURRENT_ADMIN.username)
-        )
+        for _ in range(3):
+            self.outbox.enqueue("test", ObjectId(), "delete")
 
-        # add 10 more invitations
-        for i in range(10):
-            self.db.mail_invitations.insert_one(
-                {
-                    "_id": ObjectId(),
-                    "sender": CURRENT_ADMIN.username,
-                    "recipient_name": "invitation_receiver",
-                    "recipient_mail": "invitation_receiver@mail.com",
-                    "message": "test",
-                    "timestamp": datetime.now() - timedelta(hours=i),
-                }
-            )
+        self.assertEqual(len(self.outbox.claim(2, 60)), 2)
+        self.assertEqual(len(self.outbox.claim(2, 60)), 1)
+        self.assertEqual(self.outbox.claim(2, 60), [])
 
-        # expect False because the user has now sent more than 10 invitations in the last 24 hours
-        self.assertFalse(
-            self.invitation_manager.check_within_rate_limit(CURRENT_ADMIN.username)
+        # expired leases are claimed again
+        self.db.elasticsearch_outbox.update_many(
+            {}, {"$set": {"next_attempt_at": datetime.now() - timedelta(seconds=1)}}
         )
+        self.assertEqual(len(self.outbox.claim(5, 60)), 3)
 
-    def test_insert_invitation(self):
+    def test_acknowledge(self):
         """
-        expect: successfully insert an invitation
+        expect: acknowledged entries are removed, unless the document
+        was changed again in the meantime
         """
 
-        invitation = {
-            "sender": CURRENT_ADMIN.username,
-            "recipient_name": "invitation_receiver",
-            "recipient_mail": "invitation_receiver@mail.com",
-            "message": "test",
-            "plan_id": None,
-            "replied": False,
-            "timestamp": datetime.now(),
-        }
+        doc_id = ObjectId()
+        self.outbox.enqueue("test", doc_id, "index", document={"name": "first"})
+        entry = self.outbox.claim(1, 60)[0]
 
-        inserted_id = self.invitation_manager.insert_invitation(invitation)
+        self.outbox.enqueue("test", doc_id, "index", document={"name": "second"})
+        self.outbox.acknowledge(entry)
+        self.assertEqual(self.db.elasticsearch_outbox.count_documents({}), 1)
 
-        # expect the invitation to be in the db
-        db_state = self.db.mail_invitations.find_one({"_id": inserted_id})
-        self.assertIsNotNone(db_state)
-        self.assertEqual(db_state["sender"], invitation["sender"])
-        self.assertEqual(db_state["recipient_name"], invitation["recipient_name"])
-        self.assertEqual(db_state["recipient_mail"], invitation["recipient_mail"])
-        self.assertEqual(db_state["message"], invitation["message"])
-        self.assertIsNotNone(db_state["timestamp"])
+        entry = self.outbox.claim(1, 60)[0]
+        self.assertEqual(entry["document"], {"name": "second"})
+        self.outbox.acknowledge(entry)
+        self.assertEqual(self.db.elasticsearch_outbox.count_documents({}), 0)
 
-    def test_insert_invitation_error_missing_attributes(self):
+    def test_retry(self):
         """
-        expect: ValueError is raised because the invitation is missing required attributes
+        expect: failed entries are retried with exponential backoff and
+        are given up after the maximum number of attempts
         """
 
-        # recipient_name missing
-        invitation = {
-            "sender": CURRENT_ADMIN.username,
+        self.outbox.enqueue("test", ObjectId(), "delete")
+
+        entry = self.outbox.claim(1, 60)[0]
+        self.outbox.retry(entry, "error", 2, 10, 300)
+        entry = self.db.elasticsearch_outbox.find_one({})
+        self.assertEqual(entry["attempts"], 1)
+        self.assertEqual(entry["last_error"], "error")
+        self.assertFalse(entry["failed"])
+        self.assertGreater(entry["next_attempt_at"], datetime.now() + timedelta(seconds=5))
+
+        # not due yet
+        self.assertEqual(self.outbox.claim(1, 60), [])
+
+        self.outbox.retry(entry, "error", 2, 10, 300)
+        entry = self.db.elasticsearch_outbox.find_one({})
+        self.assertEqual(entry["attempts"], 2)
+        self.assertTrue(entry["failed"])
+
+        # failed entries are not claimed anymore
+        self.db.elasticsearch_outbox.update_many(
+            {}, {"$set": {"next_attempt_at": datetime.now() - timedelta(seconds=1)}}
+        )
+        self.assertEqual(self.outbox.claim(1, 60), [])
+
+        metrics = self.outbox.get_metrics()
+        self.assertEqual(metrics["depth"], 0)
+        self.assertEqual(metrics["failed"], 1)
+        self.assertEqual(metrics["lag_seconds"], 0.0)
+
+    def test_get_metrics(self):
+        """
+        expect: successfully get the depth and lag of the queue
+        """
+
+        self.outbox.enqueue("test", ObjectId(), "delete")
+        self.outbox.enqueue("test", ObjectId(), "delete")
+        self.db.elasticsearch_outbox.update_one(
+            {}, {"$set": {"enqueued_at": datetime.now() - timedelta(seconds=30)}}
+        )
+
+        metrics = self.outbox.get_metrics()
+        self.assertEqual(metrics["depth"], 2)
+        self.assertEqual(metrics["failed"], 0)
+        self.assertGreaterEqual(metrics["lag_seconds"], 30)
+
+
+class ElasticsearchMirrorTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.mirror = ElasticsearchMirror(self.db)
+
+        self.space_ids = [ObjectId() for _ in range(3)]
+        self.db.spaces.insert_many(
+            [
+                {
+                    "_id": space_id,
+                    "name": "test{}".format(i),
+                    "members": [CURRENT_ADMIN.username],
+                    "space_description": "test",
+                    "joinable": True,
+                }
+                for i, space_id in enumerate(self.space_ids)
+            ]
+        )
+
+    def tearDown(self) -> None:
+        self.db.spaces.delete_many({})
+        self.db.elasticsearch_outbox.delete_many({})
+
+        # clean the versioned indexes behind the test alias, if there are any
+        response = requests.get(
+            "{}/_alias/test".format(global_vars.elasticsearch_base_url),
+            auth=(
+                global_vars.elasticsearch_username,
+                global_vars.elasticsearch_password,
+            ),
+        )
+        indexes = list(response.json().keys()) if response.status_code == 200 else []
+        for index in indexes + ["test"]:
+            requests.delete(
+                "{}/{}?ignore_unavailable=true".format(
+                    global_vars.elasticsearch_base_url, index
+                ),
+                auth=(
+                    global_vars.elasticsearch_username,
+                    global_vars.elasticsearch_password,
+                ),
+            )
+
+        self.mirror = None
+        super().tearDown()
+
+    def test_checksum(self):
+        """
+        expect: the checksum only depends on the content, not on the order of the keys
+        """
+
+        self.assertEqual(
+            ElasticsearchMirror.checksum({"a": "1", "b": 2}),
+            ElasticsearchMirror.checksum({"b": 2, "a": "1"}),
+        )
+        self.assertNotEqual(
+            ElasticsearchMirror.checksum({"a": "1", "b": 2}),
+            ElasticsearchMirror.checksum({"a": "1", "b": 3}),
+        )
+
+    def test_reindex_and_diff(self):
+        """
+        expect: successfully reindex the spaces into a versioned index behind the alias
+        and detect as well as repair the drift afterwards
+        """
+
+        report = self.mirror.reindex("spaces", alias="test")
+        self.assertEqual(report["indexed"], 3)
+        self.assertEqual(report["failed"], 0)
+        self.assertTrue(report["index"].startswith("test_"))
+        self.assertEqual(report["diff"]["missing"], [])
+
+        # let the mirror drift
+        self.db.spaces.update_one(
+            {"_id": self.space_ids[0]}, {"$set": {"name": "changed"}}
+        )
+        self.db.spaces.delete_one({"_id": self.space_ids[1]})
+        new_space_id = self.db.spaces.insert_one(
+            {"name": "new", "members": [], "space_description": "", "joinable": True}
+        ).inserted_id
+
+        report = self.mirror.diff("spaces", alias="test")
+        self.assertEqual(report["mongodb_count"], 3)
+        self.assertEqual(report["elasticsearch_count"], 3)
+        self.assertEqual(report["differing"], [str(self.space_ids[0])])
+        self.assertEqual(report["stale"], [str(self.space_ids[1])])
+        self.assertEqual(report["missing"], [str(new_space_id)])
+
+        self.mirror.diff("spaces", alias="test", repair=True)
+        requests.post(
+            "{}/test/_refresh".format(global_vars.elasticsearch_base_url),
+            auth=(
+                global_vars.elasticsearch_username,
+                global_vars.elasticsearch_password,
+            ),
+        )
+
+        report = self.mirror.diff("spaces", alias="test")
+        self.assertEqual(report["differing"], [])
+        self.assertEqual(report["stale"], [])
+        self.assertEqual(report["missing"], [])
+
+
+class NotificationIntegrationTest(BaseResourceTestCase, AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        load_email_templates()
+        self.sessions = []
+
+        def smtp_factory():
+            self.sessions.append(FakeSMTP())
+            return self.sessions[-1]
+
+        self.mail_queue = global_vars.mail_queue
+        global_vars.mail_queue = MailQueue(smtp_factory, max_per_minute=0)
+
+        # users 0-5 with alternating notification settings,
+        # starting with one that doesn't want any notifications
+        self.settings = ["none", "push", "email"] * 2
+        self.usernames = ["dispatch_user{}".format(i) for i in range(6)]
+        self.db.profiles.insert_many(
+            [
+                {
+                    "username": username,
+                    "first_name": "Test",
+                    "last_name": "User",
+                    "notification_settings": {"system": setting},
+                }
+                for username, setting in zip(self.usernames, self.settings)
+            ]
+        )
+        UserDirectory(self.db).store(
+            [
+                {
+                    "username": username,
+                    "user_id": username,
+                    "email": "{}@mail.de".format(username),
+                    "first_name": "",
+                    "last_name": "",
+                }
+                for username in self.usernames
+            ]
+        )
+
+    def tearDown(self) -> None:
+        global_vars.mail_queue = self.mail_queue
+        self.db.profiles.delete_many({"username": {"$in": self.usernames}})
+        self.db.user_directory.delete_many({})
+        self.db.notifications.delete_many({})
+        self.db.notification_dispatches.delete_many({})
+        self.db.mail_outbox.delete_many({})
+
+        super().tearDown()
+
+    def get_dispatched(self, dispatch_id: str) -> tuple:
+        """
+        Returns the recipients of the notifications and emails of the dispatch
+        that are dispatch test users
+        """
+
+        notified = sorted(
+            notification["to"]
+            for notification in self.db.notifications.find({"dispatch_id": dispatch_id})
+            if notification["to"] in self.usernames
+        )
+        emailed = sorted(
+            msg["To"].addresses[0].username
+            for session in self.sessions
+            for msg in session.messages
+            if msg["To"].addresses[0].username in self.usernames
+        )
+        return notified, emailed
+
+    @gen_test
+    async def test_bulk_send_notifications(self):
+        """
+        expect: all users are notified according to their settings, in batches
+        """
+
+        notification_resource = NotificationResource(self.db)
+        notification_resource.DISPATCH_BATCH_SIZE = 2
+
+        checkpoint = await notification_resource.bulk_send_notifications(
+            "reminder_icebreaker",
+            {"material_link": "https://ve-collab.org"},
+            "Test",
+            dispatch_id="test",
+        )
+
+        notified, emailed = self.get_dispatched("test")
+        # users after one without any notifications are still notified
+        self.assertEqual(notified, self.usernames[1:3] + self.usernames[4:6])
+        self.assertEqual(emailed, [self.usernames[2], self.usernames[5]])
+        self.assertIsNotNone(checkpoint["finished_at"])
+        self.assertGreaterEqual(checkpoint["batches"], 3)
+
+        # a finished dispatch is not repeated
+        await notification_resource.bulk_send_notifications(
+            "reminder_icebreaker",
+            {"material_link": "https://ve-collab.org"},
+            "Test",
+            dispatch_id="test",
+        )
+        self.assertEqual(self.get_dispatched("test"), (notified, emailed))
+
+    def insert_interrupted_dispatch(self, emailed_through: str) -> None:
+        """
+        a dispatch that was interrupted after the first batch of dispatch users,
+        while the push notifications of the second one were partially written
+        and its emails have been queued up to `emailed_through`
+        """
+
+        self.db.notification_dispatches.insert_one(
+            {
+                "_id": "test",
+                "notification_type": "reminder_icebreaker",
+                "payload": {"material_link": "https://ve-collab.org"},
+                "email_subject": "Test",
+                "started_at": datetime.now(),
+                "finished_at": None,
+                "last_username": self.usernames[1],
+                "emailed_through": emailed_through,
+                "batches": 1,
+                "recipients": 2,
+                "push": 1,
+                "email": 0,
+            }
+        )
+        self.db.notifications.insert_one(
+            {
+                "type": "reminder_icebreaker",
+                "to": self.usernames[2],
+                "receive_state": "pending",
+                "creation_timestamp": datetime.now(),
+                "payload": {"material_link": "https://ve-collab.org"},
+                "dispatch_id": "test",
+            }
+        )
+
+    @gen_test
+    async def test_bulk_send_notifications_resume(self):
+        """
+        expect: an interrupted dispatch resumes after its checkpoint without
+        notifying users twice, emails of the interrupted batch that have not
+        been queued yet are still sent
+        """
+
+        notification_resource = NotificationResource(self.db)
+        notification_resource.DISPATCH_BATCH_SIZE = 2
+
+        self.insert_interrupted_dispatch(emailed_through=self.usernames[1])
+
+        await resume_notification_dispatches()
+
+        notified, emailed = self.get_dispatched("test")
+        self.assertEqual(notified, [self.usernames[2]] + self.usernames[4:6])
+        self.assertEqual(emailed, [self.usernames[2], self.usernames[5]])
+        checkpoint = self.db.notification_dispatches.find_one({"_id": "test"})
+        self.assertIsNotNone(checkpoint["finished_at"])
+        self.assertEqual(checkpoint["email"], 2)
+
+    @gen_test
+    async def test_bulk_send_notifications_resume_emails_queued(self):
+        """
+        expect: emails of the interrupted batch that have already been
+        queued are not sent twice
+        """
+
+        notification_resource = NotificationResource(self.db)
+        notification_resource.DISPATCH_BATCH_SIZE = 2
+
+        self.insert_interrupted_dispatch(emailed_through=self.usernames[3])
+
+        await resume_notification_dispatches()
+
+        notified, emailed = self.get_dispatched("test")
+        self.assertEqual(notified, [self.usernames[2]] + self.usernames[4:6])
+        self.assertEqual(emailed, [self.usernames[5]])
+
+    @gen_test
+    async def test_bulk_send_notifications_email_count(self):
+        """
+        expect: only emails that have actually been queued are counted,
+        users without an email address are not
+        """
+
+        self.db.user_directory.update_one(
+            {"username": self.usernames[2]}, {"$set": {"email": ""}}
+        )
+
+        notification_resource = NotificationResource(self.db)
+        notification_resource.DISPATCH_BATCH_SIZE = 2
+
+        checkpoint = await notification_resource.bulk_send_notifications(
+            "reminder_icebreaker",
+            {"material_link": "https://ve-collab.org"},
+            "Test",
+            dispatch_id="test",
+        )
+
+        _, emailed = self.get_dispatched("test")
+        self.assertEqual(emailed, [self.usernames[5]])
+        self.assertEqual(checkpoint["email"], len(emailed))
+
+
+class MailInvitationResourceTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        # create default invitation:
+        self.default_invitation = {
+            "_id": ObjectId(),
+            "sender": CURRENT_ADMIN.username,
+            "recipient_name": "invitation_receiver",
+            "recipient_mail": "invitation_receiver@mail.com",
+            "message": "test",
+            "timestamp": datetime.now(),
+        }
+        self.db.mail_invitations.insert_one(self.default_invitation)
+
+        self.invitation_manager = MailInvitation(self.db)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+
+        self.db.mail_invitations.delete_many({})
+
+    def test_check_within_rate_limit(self):
+        """
+        expect: successfully check if the user is within the rate limit
+        """
+
+        # expect True because the user has sent less than 10 invitations in the last 24 hours
+        self.assertTrue(
+            self.invitation_manager.check_within_rate_limit(CURRENT_ADMIN.username)
+        )
+
+        # add 10 more invitations
+        for i in range(10):
+            self.db.mail_invitations.insert_one(
+                {
+                    "_id": ObjectId(),
+                    "sender": CURRENT_ADMIN.username,
+                    "recipient_name": "invitation_receiver",
+                    "recipient_mail": "invitation_receiver@mail.com",
+                    "message": "test",
+                    "timestamp": datetime.now() - timedelta(hours=i),
+                }
+            )
+
+        # expect False because the user has now sent more than 10 invitations in the last 24 hours
+        self.assertFalse(
+            self.invitation_manager.check_within_rate_limit(CURRENT_ADMIN.username)
+        )
+
+    def test_insert_invitation(self):
+        """
+        expect: successfully insert an invitation
+        """
+
+        invitation = {
+            "sender": CURRENT_ADMIN.username,
+            "recipient_name": "invitation_receiver",
+            "recipient_mail": "invitation_receiver@mail.com",
+            "message": "test",
+            "plan_id": None,
+            "replied": False,
+            "timestamp": datetime.now(),
+        }
+
+        inserted_id = self.invitation_manager.insert_invitation(invitation)
+
+        # expect the invitation to be in the db
+        db_state = self.db.mail_invitations.find_one({"_id": inserted_id})
+        self.assertIsNotNone(db_state)
+        self.assertEqual(db_state["sender"], invitation["sender"])
+        self.assertEqual(db_state["recipient_name"], invitation["recipient_name"])
+        self.assertEqual(db_state["recipient_mail"], invitation["recipient_mail"])
+        self.assertEqual(db_state["message"], invitation["message"])
+        self.assertIsNotNone(db_state["timestamp"])
+
+    def test_insert_invitation_error_missing_attributes(self):
+        """
+        expect: ValueError is raised because the invitation is missing required attributes
+        """
+
+        # recipient_name missing
+        invitation = {
+            "sender": CURRENT_ADMIN.username,
             "recipient_mail": "invitation_receiver@mail.com",
             "message": "test",
             "timestamp": datetime.now(),
@@ -9376,3 +10594,1623 @@ class ReportResourceTest(BaseResourceTestCase, AsyncTestCase):
 
         with self.assertRaises(ReportDoesntExistError):
             await self.report_manager.delete_reported_item(ObjectId())
+
+
+class AsyncResourceTest(BaseResourceTestCase, AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.post_id = ObjectId()
+        self.db.posts.insert_one(
+            {
+                "_id": self.post_id,
+                "author": CURRENT_ADMIN.username,
+                "creation_date": datetime(2023, 1, 1, 8, 0, 0),
+                "text": "test",
+                "space": None,
+                "pinned": False,
+                "wordpress_post_id": None,
+                "tags": ["async"],
+                "plans": [],
+                "files": [],
+                "comments": [],
+                "likers": [],
+            }
+        )
+
+    def tearDown(self) -> None:
+        self.db.posts.delete_many({})
+        super().tearDown()
+
+    @gen_test
+    async def test_async_variant_matches_sync_result(self):
+        """
+        expect: the async variant returns the same result as the sync resource
+        """
+
+        post_manager = AsyncPosts(self.db)
+        async_result = await post_manager.get_posts_by_tags(["async"])
+        sync_result = Posts(self.db).get_posts_by_tags(["async"])
+
+        self.assertEqual(async_result, sync_result)
+        self.assertEqual(len(async_result), 1)
+        self.assertEqual(async_result[0]["_id"], self.post_id)
+
+    @gen_test
+    async def test_async_variant_raises_exceptions(self):
+        """
+        expect: exceptions of the sync resource are propagated to the awaiting caller
+        """
+
+        post_manager = AsyncPosts(self.db)
+        with self.assertRaises(PostNotExistingException):
+            await post_manager.get_post(ObjectId())
+
+    def test_async_variant_passes_attributes_through(self):
+        """
+        expect: non-callable attributes of the sync resource are handed out unchanged
+        """
+
+        post_manager = AsyncPosts(self.db)
+        self.assertEqual(post_manager.db, self.db)
+        self.assertEqual(
+            post_manager.post_attributes, Posts(self.db).post_attributes
+        )
+
+
+class IndexRegistryTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        # start with no indexes at all (except the mandatory _id index)
+        for collection_name in self.db.list_collection_names():
+            self.db[collection_name].drop_indexes()
+
+    def tearDown(self) -> None:
+        for collection_name in self.db.list_collection_names():
+            self.db.drop_collection(collection_name)
+        super().tearDown()
+
+    def test_reconcile_indexes_builds_missing(self):
+        """
+        expect: all declared indexes are built and reported as missing
+        """
+
+        report = reconcile_indexes(self.db)
+
+        registered = get_registered_indexes()
+        self.assertEqual(len(report["missing"]), len(registered))
+        self.assertEqual(report["rebuilt"], [])
+        self.assertEqual(report["failed"], [])
+        for index in registered:
+            self.assertIn(index.name, self.db[index.collection].index_information())
+
+        # a second run has nothing left to do
+        report = reconcile_indexes(self.db)
+        self.assertEqual(report["missing"], [])
+        self.assertEqual(report["rebuilt"], [])
+        self.assertEqual(report["redundant"], [])
+
+    def test_reconcile_indexes_rebuilds_changed(self):
+        """
+        expect: an index whose definition differs from the declaration is rebuilt,
+        and all declared indexes are rebuilt if forced
+        """
+
+        self.db.feeds.create_index("username", name="feeds_post_id")
+
+        report = reconcile_indexes(self.db)
+        self.assertIn({"collection": "feeds", "name": "feeds_post_id"}, report["rebuilt"])
+        self.assertEqual(
+            self.db.feeds.index_information()["feeds_post_id"]["key"],
+            [("post_id", 1)],
+        )
+
+        report = reconcile_indexes(self.db, force_rebuild=True)
+        self.assertEqual(len(report["rebuilt"]), len(get_registered_indexes()))
+
+    def test_reconcile_indexes_restores_previous_on_failure(self):
+        """
+        expect: if rebuilding an index fails, the previous index is restored
+        """
+
+        # duplicates that violate the declared unique index
+        file_id = ObjectId()
+        self.db.fs.chunks.insert_many(
+            [{"files_id": file_id, "n": 0}, {"files_id": file_id, "n": 0}]
+        )
+        self.db.fs.chunks.create_index(
+            [("files_id", 1), ("n", 1)], name="files_id_1_n_1"
+        )
+
+        report = reconcile_indexes(self.db)
+        self.assertIn("files_id_1_n_1", [entry["name"] for entry in report["failed"]])
+        index_info = self.db.fs.chunks.index_information()
+        self.assertIn("files_id_1_n_1", index_info)
+        self.assertNotIn("unique", index_info["files_id_1_n_1"])
+
+    def test_reconcile_indexes_reports_redundant(self):
+        """
+        expect: indexes that are not declared are reported as redundant, but not dropped
+        """
+
+        self.db.posts.create_index("space", name="posts_space")
+
+        report = reconcile_indexes(self.db)
+        self.assertIn(
+            {"collection": "posts", "name": "posts_space", "reason": "not_registered"},
+            report["redundant"],
+        )
+        self.assertIn("posts_space", self.db.posts.index_information())
+
+
+class JsonSerializationTest(TestCase):
+    def setUp(self) -> None:
+        self.object_ids = [ObjectId() for _ in range(3)]
+        self.now = datetime.now()
+        self.response = {
+            "success": True,
+            "_id": self.object_ids[0],
+            "likers": self.object_ids + [self.object_ids[0]],
+            "creation_date": self.now,
+            "duration": timedelta(minutes=2),
+            "comments": [{"_id": self.object_ids[1], "creation_date": self.now}],
+        }
+        self.expected = {
+            "success": True,
+            "_id": str(self.object_ids[0]),
+            "likers": [str(_id) for _id in self.object_ids + [self.object_ids[0]]],
+            "creation_date": self.now.isoformat(),
+            "duration": 120.0,
+            "comments": [
+                {"_id": str(self.object_ids[1]), "creation_date": self.now.isoformat()}
+            ],
+        }
+
+    def test_json_dumps(self):
+        """
+        expect: successfully encode ObjectIds, datetimes and timedeltas on the fly
+        without modifying the response
+        """
+
+        self.assertEqual(json.loads(util.json_dumps(self.response)), self.expected)
+        self.assertIsInstance(self.response["likers"][0], ObjectId)
+
+    def test_json_dumps_standard_library(self):
+        """
+        expect: the standard library json encodes the same way, if orjson is unavailable
+        """
+
+        orjson = util.orjson
+        util.orjson = None
+        try:
+            self.assertEqual(json.loads(util.json_dumps(self.response)), self.expected)
+        finally:
+            util.orjson = orjson
+
+    def test_json_dumps_error_unknown_type(self):
+        """
+        expect: TypeError is raised for objects that can't be encoded
+        """
+
+        self.assertRaises(TypeError, util.json_dumps, {"set": {1, 2}})
+
+    def test_json_serialize_response(self):
+        """
+        expect: successfully transform ObjectIds and datetimes in place,
+        including duplicate ObjectIds in lists
+        """
+
+        del self.response["duration"]
+        del self.expected["duration"]
+        self.assertEqual(util.json_serialize_response(self.response), self.expected)
+
+
+class FakeKeycloakOpenID:
+    """
+    stand-in for `keycloak.KeycloakOpenID` that serves the JWKS of local keys
+    """
+
+    def __init__(self, keys: List[jwk.JWK]):
+        self.keys = keys
+        self.certs_calls = 0
+
+    def certs(self) -> dict:
+        self.certs_calls += 1
+        key_set = jwk.JWKSet()
+        for key in self.keys:
+            key_set.add(key)
+        return json.loads(key_set.export(private_keys=False))
+
+
+class TokenVerifierTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.key = jwk.JWK.generate(
+            kty="RSA", size=2048, kid="key1", alg="RS256", use="sig"
+        )
+        self.keycloak = FakeKeycloakOpenID([self.key])
+        self.verifier = TokenVerifier(self.keycloak)
+
+    def make_token(self, key: jwk.JWK, expires_in: int = 300, **claims) -> str:
+        token = jwt.JWT(
+            header={"alg": "RS256", "kid": key.key_id},
+            claims={
+                "exp": int(time.time()) + expires_in,
+                "preferred_username": CURRENT_ADMIN.username,
+                **claims,
+            },
+        )
+        token.make_signed_token(key)
+        return token.serialize()
+
+    @gen_test
+    async def test_verify(self):
+        """
+        expect: successfully verify the token, fetching the keys only once and
+        verifying the signature only once
+        """
+
+        token = self.make_token(self.key)
+        for _ in range(3):
+            token_info = await self.verifier.verify(token)
+            self.assertEqual(token_info["preferred_username"], CURRENT_ADMIN.username)
+
+        self.assertEqual(self.keycloak.certs_calls, 1)
+        self.assertEqual(self.verifier.verifications, 1)
+        self.assertEqual(self.verifier.cache.hits, 2)
+
+    @gen_test
+    async def test_verify_key_rotation(self):
+        """
+        expect: successfully verify a token signed by a new key after refreshing the keys
+        """
+
+        await self.verifier.verify(self.make_token(self.key))
+
+        new_key = jwk.JWK.generate(
+            kty="RSA", size=2048, kid="key2", alg="RS256", use="sig"
+        )
+        self.keycloak.keys = [new_key]
+        self.verifier.keys.fetched_at -= JWKSCache.MIN_REFRESH_INTERVAL
+
+        token_info = await self.verifier.verify(self.make_token(new_key))
+        self.assertEqual(token_info["preferred_username"], CURRENT_ADMIN.username)
+        self.assertEqual(self.keycloak.certs_calls, 2)
+
+        # unknown keys don't trigger another refresh right away
+        unknown_key = jwk.JWK.generate(
+            kty="RSA", size=2048, kid="key3", alg="RS256", use="sig"
+        )
+        with self.assertRaises(InvalidTokenError):
+            await self.verifier.verify(self.make_token(unknown_key))
+        self.assertEqual(self.keycloak.certs_calls, 2)
+
+    @gen_test
+    async def test_verify_error_invalid_token(self):
+        """
+        expect: InvalidTokenError is raised for malformed, expired and tampered tokens
+        """
+
+        with self.assertRaises(InvalidTokenError):
+            await self.verifier.verify("not_a_token")
+
+        with self.assertRaises(InvalidTokenError):
+            await self.verifier.verify(
+                self.make_token(self.key, expires_in=-TokenVerifier.LEEWAY - 10)
+            )
+
+        header, claims, signature = self.make_token(self.key).split(".")
+        tampered_claims = self.make_token(self.key, preferred_username="x").split(".")[1]
+        with self.assertRaises(InvalidTokenError):
+            await self.verifier.verify(
+                ".".join([header, tampered_claims, signature[::-1]])
+            )
+
+    def test_verified_token_cache(self):
+        """
+        expect: entries expire with their token and the least recently used
+        entries are evicted
+        """
+
+        cache = VerifiedTokenCache(max_size=2)
+        cache.put("a", {"exp": time.time() + 60})
+        cache.put("b", {"exp": time.time() - 1})
+        cache.put("c", {"sub": "no expiry"})
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNone(cache.get("c"))
+
+        cache.put("d", {"exp": time.time() + 60})
+        cache.put("e", {"exp": time.time() + 60})
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 2)
+
+
+class FakeKeycloakAdmin:
+    """
+    stand-in for `keycloak.KeycloakAdmin` that serves a fixed list of users
+    """
+
+    def __init__(self, users: List[dict]):
+        self.users = users
+        self.get_users_calls = 0
+
+    def get_users(self, query: dict = None) -> List[dict]:
+        self.get_users_calls += 1
+        query = query or {}
+        users = self.users
+        if "username" in query:
+            users = [user for user in users if user["username"] == query["username"]]
+        first = query.get("first", 0)
+        return users[first : first + query.get("max", len(users))]
+
+
+class UserDirectoryTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.keycloak_users = [
+            {
+                "id": str(i),
+                "username": "user{}".format(i),
+                "email": "user{}@mail.de".format(i),
+                "firstName": "Test",
+                "lastName": str(i),
+            }
+            for i in range(5)
+        ]
+        self.keycloak_admin = global_vars.keycloak_admin
+        global_vars.keycloak_admin = FakeKeycloakAdmin(self.keycloak_users)
+
+    def tearDown(self) -> None:
+        global_vars.keycloak_admin = self.keycloak_admin
+        self.db.user_directory.delete_many({})
+        super().tearDown()
+
+    def test_store(self):
+        """
+        expect: only new or changed entries are written
+        """
+
+        directory = UserDirectory(self.db)
+        entries = [
+            UserDirectory.entry_from_keycloak_user(user) for user in self.keycloak_users
+        ]
+        self.assertEqual(directory.store(entries), 5)
+        self.assertEqual(directory.store(entries), 0)
+
+        entries[0]["email"] = "changed@mail.de"
+        self.assertEqual(directory.store(entries), 1)
+        self.assertEqual(directory.get_user("user0")["email"], "changed@mail.de")
+        self.assertEqual(
+            set(directory.get_users(["user0", "user1", "unknown"])), {"user0", "user1"}
+        )
+
+    def test_lookup(self):
+        """
+        expect: unknown users are loaded from keycloak once, users that don't exist
+        in keycloak either yield None
+        """
+
+        directory = UserDirectory(self.db)
+        self.assertEqual(directory.get_email("user1"), "user1@mail.de")
+        self.assertEqual(directory.get_email("user1"), "user1@mail.de")
+        self.assertEqual(global_vars.keycloak_admin.get_users_calls, 1)
+
+        self.assertIsNone(directory.lookup("unknown"))
+        self.assertIsNone(directory.get_email("unknown"))
+
+    def test_refresh_from_keycloak(self):
+        """
+        expect: all users are paged in from keycloak, users that were deleted
+        in keycloak are removed
+        """
+
+        directory = UserDirectory(self.db)
+        directory.PAGE_SIZE = 2
+        directory.store(
+            [
+                {
+                    "username": "deleted",
+                    "user_id": "x",
+                    "email": "",
+                    "first_name": "",
+                    "last_name": "",
+                }
+            ]
+        )
+
+        result = directory.refresh_from_keycloak()
+        self.assertEqual(result, {"fetched": 5, "written": 5, "removed": 1})
+        self.assertEqual(global_vars.keycloak_admin.get_users_calls, 3)
+        self.assertEqual(self.db.user_directory.count_documents({}), 5)
+
+        result = directory.refresh_from_keycloak()
+        self.assertEqual(result, {"fetched": 5, "written": 0, "removed": 0})
+
+    def test_sync_user_from_token(self):
+        """
+        expect: the account information of the token is stored in the directory
+        """
+
+        token_info = {
+            "preferred_username": "token_user",
+            "sub": "abc",
+            "email": "token_user@mail.de",
+            "given_name": "Token",
+            "family_name": "User",
+        }
+        sync_user_from_token(token_info)
+
+        entry = UserDirectory(self.db).get_user("token_user")
+        self.assertEqual(entry["user_id"], "abc")
+        self.assertEqual(entry["email"], "token_user@mail.de")
+        self.assertEqual(entry["first_name"], "Token")
+        self.assertEqual(entry["last_name"], "User")
+
+
+class FakeSMTP:
+    """
+    stand-in for `smtplib.SMTP` that records the sent messages instead of
+    talking to a mail server. Recipients listed in `refused` are rejected with
+    the given reply code and the session drops after `disconnect_after` messages.
+    """
+
+    def __init__(self, refused: dict = None, disconnect_after: int = None):
+        self.refused = refused or {}
+        self.disconnect_after = disconnect_after
+        self.messages = []
+        self.closed = False
+
+    def send_message(self, msg):
+        if self.closed or (
+            self.disconnect_after is not None
+            and len(self.messages) >= self.disconnect_after
+        ):
+            self.closed = True
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+        recipient = msg["To"].addresses[0].addr_spec
+        if recipient in self.refused:
+            code = self.refused[recipient]
+            raise smtplib.SMTPRecipientsRefused({recipient: (code, b"rejected")})
+        self.messages.append(msg)
+        return {}
+
+    def noop(self):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return (250, b"OK")
+
+    def quit(self):
+        self.closed = True
+
+
+class MailQueueTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        load_email_templates()
+        self.sessions = []
+        self.refused = {}
+        self.disconnect_after = None
+
+        def smtp_factory():
+            session = FakeSMTP(self.refused, self.disconnect_after)
+            self.sessions.append(session)
+            return session
+
+        self.smtp_factory = smtp_factory
+        self.outbox = MailOutbox(self.db)
+
+    def tearDown(self) -> None:
+        self.db.mail_outbox.delete_many({})
+        self.outbox = None
+
+        super().tearDown()
+
+    def enqueue(self, count: int, prefix: str = "user") -> None:
+        for i in range(count):
+            self.outbox.enqueue(
+                "{}{}".format(prefix, i),
+                "{}{}@mail.de".format(prefix, i),
+                "Test",
+                "reminder_icebreaker.html",
+                {"material_link": "https://ve-collab.org"},
+            )
+
+    def test_flush(self):
+        """
+        expect: all emails of a batch are sent over the same session, which is
+        reused for the next batch, and sent emails are removed from the outbox
+        """
+
+        self.db.profiles.insert_one(
+            {"username": "user0", "first_name": "Test", "last_name": "Name"}
+        )
+        queue = MailQueue(self.smtp_factory, max_per_minute=0)
+        queue.BATCH_SIZE = 3
+        self.enqueue(5)
+
+        self.assertEqual(queue.flush(self.db), 3)
+        self.assertEqual(queue.flush(self.db), 2)
+        self.assertEqual(queue.flush(self.db), 0)
+
+        self.assertEqual(len(self.sessions), 1)
+        self.assertEqual(len(self.sessions[0].messages), 5)
+        self.assertEqual(self.db.mail_outbox.count_documents({}), 0)
+        self.assertEqual(queue.sent, 5)
+
+        # display name from the profile, html alternative with the inline images
+        msg = self.sessions[0].messages[0]
+        self.assertEqual(msg["To"], "Test Name <user0@mail.de>")
+        self.assertEqual(len(msg.get_payload()[1].get_payload()), 4)
+
+        queue.close_session()
+        self.db.profiles.delete_many({})
+
+    def test_flush_rate_limit(self):
+        """
+        expect: no more than `max_per_minute` emails are sent per minute,
+        the rest stays queued
+        """
+
+        queue = MailQueue(self.smtp_factory, max_per_minute=4)
+        self.enqueue(6)
+
+        self.assertEqual(queue.flush(self.db), 4)
+        self.assertEqual(queue.flush(self.db), 0)
+        self.assertEqual(self.outbox.get_metrics()["depth"], 2)
+
+        # a minute later, the rest is sent
+        queue._sent_times = deque(t - 60 for t in queue._sent_times)
+        self.assertEqual(queue.flush(self.db), 2)
+        self.assertEqual(self.outbox.get_metrics()["depth"], 0)
+
+        queue.close_session()
+
+    def test_flush_rejected(self):
+        """
+        expect: permanently rejected emails are failed, temporarily rejected ones
+        are retried later
+        """
+
+        self.refused.update({"user0@mail.de": 550, "user1@mail.de": 450})
+        queue = MailQueue(self.smtp_factory, max_per_minute=0)
+        self.enqueue(3)
+
+        self.assertEqual(queue.flush(self.db), 3)
+        self.assertEqual(len(self.sessions[0].messages), 1)
+
+        rejected = self.db.mail_outbox.find_one({"recipient_username": "user0"})
+        self.assertTrue(rejected["failed"])
+        retried = self.db.mail_outbox.find_one({"recipient_username": "user1"})
+        self.assertFalse(retried["failed"])
+        self.assertEqual(retried["attempts"], 1)
+        self.assertGreater(retried["next_attempt_at"], datetime.now())
+
+        metrics = queue.get_metrics(self.db)
+        self.assertEqual(metrics["depth"], 1)
+        self.assertEqual(metrics["failed"], 1)
+        self.assertEqual(metrics["sent"], 1)
+        self.assertEqual(metrics["rejected"], 1)
+        self.assertEqual(metrics["retried"], 1)
+
+        queue.close_session()
+
+    def test_flush_reconnect(self):
+        """
+        expect: a session dropped by the mail server is reopened, an unreachable
+        mail server defers the whole batch
+        """
+
+        self.disconnect_after = 2
+        queue = MailQueue(self.smtp_factory, max_per_minute=0)
+        self.enqueue(3)
+
+        self.assertEqual(queue.flush(self.db), 3)
+        self.assertEqual(len(self.sessions), 2)
+        self.assertEqual(self.db.mail_outbox.count_documents({}), 0)
+        queue.close_session()
+
+        def unreachable():
+            raise ConnectionRefusedError("Connection refused")
+
+        queue = MailQueue(unreachable, max_per_minute=0)
+        self.enqueue(3)
+        self.assertEqual(queue.flush(self.db), 3)
+        self.assertEqual(
+            self.db.mail_outbox.count_documents({"attempts": 1, "failed": False}), 3
+        )
+        self.assertEqual(self.outbox.claim(3, 60), [])
+
+
+class SharedStateTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.username_sid_map = global_vars.username_sid_map
+        global_vars.username_sid_map = {}
+
+    def tearDown(self) -> None:
+        global_vars.username_sid_map = self.username_sid_map
+        self.db.socket_presence.delete_many({})
+
+        super().tearDown()
+
+    def _test_presence(self, backend: StateBackend):
+        self.assertEqual(backend.count_user_sessions("user1"), 0)
+        backend.add_user_session("user1", "sid1")
+        backend.add_user_session("user1", "sid2")
+        backend.add_user_session("user1", "sid2")
+        self.assertEqual(backend.count_user_sessions("user1"), 2)
+        self.assertEqual(backend.get_online_users(["user1", "user2"]), {"user1"})
+        backend.refresh()
+
+        # the user stays online until the last session is removed
+        self.assertEqual(backend.remove_user_session("user1", "sid1"), 1)
+        self.assertEqual(backend.remove_user_session("user1", "sid1"), 1)
+        self.assertEqual(backend.remove_user_session("user1", "sid2"), 0)
+        self.assertEqual(backend.get_online_users(["user1", "user2"]), set())
+
+    def test_memory_backend(self):
+        """
+        expect: the presence is kept in the dict in global_vars
+        """
+
+        backend = MemoryStateBackend()
+        self._test_presence(backend)
+
+        backend.add_user_session("user1", "sid1")
+        self.assertEqual(global_vars.username_sid_map, {"user1": {"sid1"}})
+
+    def test_mongo_backend(self):
+        """
+        expect: the presence is kept in the db, presence entries of other
+        processes aren't refreshed and are treated as offline once expired
+        """
+
+        backend = MongoStateBackend()
+        self._test_presence(backend)
+
+        other_backend = MongoStateBackend()
+        other_backend.add_user_session("user2", "sid3")
+        self.assertEqual(backend.count_user_sessions("user2"), 1)
+        self.db.socket_presence.update_one(
+            {"_id": "sid3"},
+            {"$set": {"expires_at": datetime.now() - timedelta(seconds=1)}},
+        )
+        backend.refresh()
+        self.assertEqual(backend.count_user_sessions("user2"), 0)
+
+
+class PlanLockTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.plan_locks = PlanLocks(self.db)
+        self.plan_id = ObjectId()
+
+    def tearDown(self) -> None:
+        self.db.plan_locks.delete_many({})
+        self.plan_locks = None
+
+        super().tearDown()
+
+    def test_acquire_and_extend(self):
+        """
+        expect: the lock is acquired and extended by the same user, other users
+        are rejected with the lock holder
+        """
+
+        self.assertIsNone(self.plan_locks.try_acquire_or_extend(self.plan_id, "user1"))
+        expires = self.plan_locks.get_lock(self.plan_id)["expires"]
+        self.assertIsNone(self.plan_locks.try_acquire_or_extend(self.plan_id, "user1"))
+        self.assertGreaterEqual(
+            self.plan_locks.get_lock(self.plan_id)["expires"], expires
+        )
+
+        self.assertEqual(
+            self.plan_locks.try_acquire_or_extend(self.plan_id, "user2"), "user1"
+        )
+        self.assertTrue(self.plan_locks.is_held_by(self.plan_id, "user1"))
+        self.assertFalse(self.plan_locks.is_held_by(self.plan_id, "user2"))
+
+        self.assertTrue(self.plan_locks.extend(self.plan_id, "user1"))
+        self.assertFalse(self.plan_locks.extend(self.plan_id, "user2"))
+
+    def test_expired_lock(self):
+        """
+        expect: an expired lock is ignored and can be taken over by another user
+        """
+
+        self.db.plan_locks.insert_one(
+            {
+                "_id": self.plan_id,
+                "username": "user1",
+                "expires": datetime.now() - timedelta(seconds=1),
+            }
+        )
+
+        self.assertIsNone(self.plan_locks.get_lock(self.plan_id))
+        self.assertIsNotNone(
+            self.plan_locks.get_lock(self.plan_id, include_expired=True)
+        )
+        self.assertFalse(self.plan_locks.extend(self.plan_id, "user1"))
+        self.assertFalse(self.plan_locks.release(self.plan_id, "user1"))
+
+        self.assertIsNone(self.plan_locks.try_acquire_or_extend(self.plan_id, "user2"))
+        self.assertEqual(self.plan_locks.get_lock_holder(self.plan_id), "user2")
+
+    def test_release(self):
+        """
+        expect: locks are only released by their holder, all locks of a user
+        can be released at once
+        """
+
+        other_plan_id = ObjectId()
+        self.plan_locks.try_acquire_or_extend(self.plan_id, "user1")
+        self.plan_locks.try_acquire_or_extend(other_plan_id, "user1")
+
+        self.assertFalse(self.plan_locks.release(self.plan_id, "user2"))
+        self.assertTrue(self.plan_locks.release(self.plan_id, "user1"))
+        self.assertIsNone(self.plan_locks.get_lock(self.plan_id))
+
+        self.plan_locks.try_acquire_or_extend(self.plan_id, "user2")
+        self.assertEqual(self.plan_locks.release_all_of_user("user1"), 1)
+        self.assertEqual(
+            self.plan_locks.get_lock_holders([self.plan_id, other_plan_id]),
+            {self.plan_id: "user2"},
+        )
+
+
+class HydrationTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.db.profiles.insert_many(
+            [
+                {
+                    "username": username,
+                    "first_name": username,
+                    "last_name": "test",
+                    "institutions": [],
+                    "chosen_institution_id": None,
+                    "profile_pic": "default_profile_pic.jpg",
+                    "chosen_achievement": None,
+                    "ve_ready": True,
+                }
+                for username in ["user1", "user2"]
+            ]
+        )
+        self.plan_id = VEPlanResource(self.db).insert_plan(VEPlan(name="test"))
+
+        # count the queries of every loader
+        self.loaders = Loaders()
+        self.fetches = []
+        for loader in [self.loaders.profiles, self.loaders.plans]:
+            loader._fetch = self._counting_fetch(loader._fetch)
+
+    def tearDown(self) -> None:
+        self.db.profiles.delete_many({})
+        self.db.plans.delete_many({})
+        self.loaders = None
+
+        super().tearDown()
+
+    def _counting_fetch(self, fetch):
+        def wrapper(db, keys):
+            self.fetches.append(sorted(str(key) for key in keys))
+            return fetch(db, keys)
+
+        return wrapper
+
+    def test_load_batches_keys(self):
+        """
+        expect: all keys registered before a load are fetched with a single query
+        per loader, duplicates and str/ObjectId representations of plan ids collapse
+        """
+
+        self.loaders.profiles.want(["user1", "user2"])
+        self.loaders.profiles.want(["user1"])
+        self.loaders.plans.want([self.plan_id, str(self.plan_id)])
+        self.loaders.load(self.db)
+
+        self.assertEqual(self.fetches, [["user1", "user2"], [str(self.plan_id)]])
+        self.assertEqual(self.loaders.profiles.get("user1")["first_name"], "user1")
+        self.assertEqual(self.loaders.profiles.get("user2")["first_name"], "user2")
+        self.assertEqual(self.loaders.plans.get(str(self.plan_id))._id, self.plan_id)
+
+    def test_load_caches_entities(self):
+        """
+        expect: loaded keys, including missing ones, are not fetched again,
+        loading without new keys doesn't query at all
+        """
+
+        self.loaders.profiles.want(["user1", "non_existing_user"])
+        self.loaders.load(self.db)
+        self.loaders.profiles.want(["user1", "non_existing_user", "user2"])
+        self.loaders.load(self.db)
+        self.loaders.load(self.db)
+
+        self.assertEqual(self.fetches, [["non_existing_user", "user1"], ["user2"]])
+
+    def test_get_missing(self):
+        """
+        expect: keys without an entity yield the default, invalid plan ids
+        are not fetched
+        """
+
+        self.loaders.profiles.want(["non_existing_user"])
+        self.loaders.plans.want([ObjectId(), "invalid_id"])
+        self.loaders.load(self.db)
+
+        self.assertIsNone(self.loaders.profiles.get("non_existing_user"))
+        self.assertEqual(self.loaders.profiles.get("non_existing_user", [None]), [None])
+        self.assertIsNone(self.loaders.plans.get("invalid_id"))
+        self.assertIsNone(self.loaders.profiles.get("never_requested_user"))
+
+
+class ProfileSnippetCacheTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        global_vars.profile_snippet_cache = ProfileSnippetCache()
+        self.cache = global_vars.profile_snippet_cache
+        self.profile_manager = Profiles(self.db)
+
+        self.institution_id = ObjectId()
+        self.db.profiles.insert_one(
+            {
+                "username": "user1",
+                "first_name": "first",
+                "last_name": "test",
+                "institutions": [{"_id": self.institution_id, "name": "inst"}],
+                "chosen_institution_id": self.institution_id,
+                "profile_pic": "default_profile_pic.jpg",
+                "chosen_achievement": None,
+                "ve_ready": True,
+            }
+        )
+
+    def tearDown(self) -> None:
+        self.db.profiles.delete_many({})
+        global_vars.profile_snippet_cache = None
+        self.cache = None
+
+        super().tearDown()
+
+    def test_get_profile_snippets_cached(self):
+        """
+        expect: the snippet is served from the cache on the second request,
+        unknown users are not cached
+        """
+
+        first = self.profile_manager.get_profile_snippets(["user1", "unknown"])
+        second = self.profile_manager.get_profile_snippets(["user1", "unknown"])
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(first[0]["institution"], "inst")
+        self.assertNotIn("_id", first[0])
+        self.assertNotIn("snippet_version", first[0])
+        metrics = self.cache.get_metrics()
+        self.assertEqual(metrics["cached_snippets"], 1)
+        self.assertEqual(metrics["hits"], 1)
+        self.assertEqual(metrics["misses"], 3)
+
+        # modifying the returned snippet doesn't alter the cache
+        second[0]["first_name"] = "modified"
+        self.assertEqual(
+            self.profile_manager.get_profile_snippets(["user1"])[0]["first_name"],
+            "first",
+        )
+
+    def test_get_profile_snippets_write_through(self):
+        """
+        expect: an update of the profile is written through to the cache
+        """
+
+        self.profile_manager.get_profile_snippets(["user1"])
+        self.profile_manager.update_profile_information(
+            "user1", {"first_name": "updated"}
+        )
+
+        snippets = self.profile_manager.get_profile_snippets(["user1"])
+        self.assertEqual(snippets[0]["first_name"], "updated")
+        self.assertEqual(self.cache.get_metrics()["stale"], 0)
+        self.assertEqual(self.cache.get_metrics()["hits"], 1)
+
+    def test_get_profile_snippets_changed_elsewhere(self):
+        """
+        expect: a profile that was changed by another process or deleted and
+        created again is not served from the cache
+        """
+
+        self.profile_manager.get_profile_snippets(["user1"])
+
+        # another process updates the profile
+        self.db.profiles.update_one(
+            {"username": "user1"},
+            {"$set": {"first_name": "updated"}, "$inc": {"snippet_version": 1}},
+        )
+        snippets = self.profile_manager.get_profile_snippets(["user1"])
+        self.assertEqual(snippets[0]["first_name"], "updated")
+        self.assertEqual(self.cache.get_metrics()["stale"], 1)
+
+        # the profile is deleted and created again
+        profile = self.db.profiles.find_one_and_delete({"username": "user1"})
+        del profile["_id"]
+        profile["first_name"] = "recreated"
+        self.db.profiles.insert_one(profile)
+        snippets = self.profile_manager.get_profile_snippets(["user1"])
+        self.assertEqual(snippets[0]["first_name"], "recreated")
+        self.assertEqual(self.cache.get_metrics()["stale"], 2)
+
+        # the profile is deleted
+        self.db.profiles.delete_one({"username": "user1"})
+        self.assertEqual(self.profile_manager.get_profile_snippets(["user1"]), [])
+
+    def test_cache_bounds(self):
+        """
+        expect: the least recently used entry is evicted once the cache is full,
+        expired entries are dropped
+        """
+
+        cache = ProfileSnippetCache(max_size=2, ttl=60)
+        cache.put("user1", ObjectId(), 0, {"username": "user1"})
+        cache.put("user2", ObjectId(), 0, {"username": "user2"})
+        cache.get_many(["user1"])
+        cache.put("user3", ObjectId(), 0, {"username": "user3"})
+
+        self.assertEqual(
+            set(cache.get_many(["user1", "user2", "user3"])), {"user1", "user3"}
+        )
+        self.assertEqual(cache.get_metrics()["evictions"], 1)
+
+        cache.ttl = -1
+        cache.put("user1", ObjectId(), 0, {"username": "user1"})
+        self.assertNotIn("user1", cache.get_many(["user1"]))
+
+
+class ACLCacheTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.acl = ACL(self.db)
+        self.cache = get_acl_cache()
+        self.space_ids = [ObjectId(), ObjectId(), ObjectId()]
+        for space_id in self.space_ids[:2]:
+            self.acl.space_acl.insert_default("user1", space_id)
+        self.acl.global_acl.insert_default("guest")
+        self.db.profiles.insert_one({"username": "user1", "role": "guest"})
+
+    def tearDown(self) -> None:
+        self.db.space_acl.delete_many({})
+        self.db.global_acl.delete_many({})
+        self.db.profiles.delete_many({})
+        self.db.acl_version.delete_many({})
+
+        super().tearDown()
+
+    def test_ask_cached(self):
+        """
+        expect: repeated questions are answered from the cache,
+        changes through the ACL are visible right away
+        """
+
+        self.assertTrue(self.acl.global_acl.ask("guest", "create_space"))
+        self.assertTrue(self.acl.global_acl.ask("guest", "create_space"))
+        self.assertFalse(
+            self.acl.space_acl.ask("user1", self.space_ids[0], "join_space")
+        )
+        self.assertFalse(
+            self.acl.space_acl.ask("user1", self.space_ids[0], "join_space")
+        )
+        self.assertEqual(self.cache.get_metrics()["hits"], 2)
+        self.assertEqual(self.cache.get_metrics()["misses"], 2)
+
+        self.acl.global_acl.set("guest", "create_space", False)
+        self.acl.space_acl.set("user1", self.space_ids[0], "join_space", True)
+        self.assertFalse(self.acl.global_acl.ask("guest", "create_space"))
+        self.assertTrue(
+            self.acl.space_acl.ask("user1", self.space_ids[0], "join_space")
+        )
+
+        self.acl.space_acl.delete(space_id=self.space_ids[0])
+        with self.assertRaises(ValueError):
+            self.acl.space_acl.ask("user1", self.space_ids[0], "join_space")
+
+    def test_ask_many(self):
+        """
+        expect: all permissions are answered with a single lookup,
+        spaces without entry are denied, unknown keys are rejected
+        """
+
+        result = self.acl.space_acl.ask_many(
+            "user1",
+            [
+                (self.space_ids[0], "read_timeline"),
+                (str(self.space_ids[1]), "write_wiki"),
+                (self.space_ids[2], "read_timeline"),
+                (self.space_ids[0], "write_files"),
+            ],
+        )
+
+        self.assertEqual(result, [True, False, False, False])
+        self.assertEqual(self.cache.get_metrics()["misses"], 3)
+
+        with self.assertRaises(KeyError):
+            self.acl.space_acl.ask_many("user1", [(self.space_ids[0], "invalid")])
+
+    def test_changed_by_other_process(self):
+        """
+        expect: once another process has incremented the version, the whole
+        cache is dropped
+        """
+
+        self.assertTrue(self.acl.global_acl.ask("guest", "create_space"))
+
+        # another process changes the rule
+        self.db.global_acl.update_one(
+            {"role": "guest"}, {"$set": {"create_space": False}}
+        )
+        self.db.acl_version.update_one({"_id": "acl"}, {"$inc": {"version": 1}})
+        self.cache.VERSION_CHECK_INTERVAL = 0
+
+        self.assertFalse(self.acl.global_acl.ask("guest", "create_space"))
+
+    def test_get_role(self):
+        """
+        expect: the role is cached and invalidated when it is changed,
+        users without profile have no role
+        """
+
+        self.assertEqual(self.cache.get_role(self.db, "user1"), "guest")
+        Profiles(self.db).set_role("user1", "admin")
+        self.assertEqual(self.cache.get_role(self.db, "user1"), "admin")
+        self.assertIsNone(self.cache.get_role(self.db, "unknown_user"))
+
+
+class ACLCleanupTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.space_id = ObjectId()
+        self.db.spaces.insert_one({"_id": self.space_id, "name": "test"})
+        self.db.profiles.insert_many(
+            [
+                {"username": "user1", "role": "guest"},
+                {"username": "user2", "role": "guest"},
+            ]
+        )
+        self.db.global_acl.insert_many(
+            [
+                {"role": "guest", "create_space": True},
+                {"role": "orphaned_role", "create_space": True},
+            ]
+        )
+        # entries of existing users in the existing space are kept
+        self.db.space_acl.insert_many(
+            [
+                {"username": "user1", "space": self.space_id},
+                {"username": "deleted_user", "space": self.space_id},
+                {"username": "user2", "space": self.space_id},
+                {"username": "user1", "space": ObjectId()},
+                {"username": "deleted_user", "space": ObjectId()},
+            ]
+        )
+
+        self.batch_size = acl_module.CLEANUP_BATCH_SIZE
+        acl_module.CLEANUP_BATCH_SIZE = 2
+
+    def tearDown(self) -> None:
+        acl_module.CLEANUP_BATCH_SIZE = self.batch_size
+        self.db.spaces.delete_many({})
+        self.db.profiles.delete_many({})
+        self.db.global_acl.delete_many({})
+        self.db.space_acl.delete_many({})
+        self.db.acl_cleanup.delete_many({})
+        self.db.acl_version.delete_many({})
+
+        super().tearDown()
+
+    def test_cleanup_unused_rules(self):
+        """
+        expect: all orphaned entries are removed in one run
+        """
+
+        report = cleanup_unused_rules()
+
+        self.assertEqual(report["global_acl"], {"scanned": 2, "removed": 1})
+        self.assertEqual(
+            report["space_acl"],
+            {"scanned": 5, "removed": 3, "completed": True, "high_water_mark": None},
+        )
+        self.assertEqual(
+            [rule["role"] for rule in self.db.global_acl.find()], ["guest"]
+        )
+        self.assertEqual(
+            sorted(entry["username"] for entry in self.db.space_acl.find()),
+            ["user1", "user2"],
+        )
+
+    def test_cleanup_unused_rules_incremental(self):
+        """
+        expect: every run continues after the high-water mark of the previous one,
+        once the end is reached, the next run starts over
+        """
+
+        first_ids = [entry["_id"] for entry in self.db.space_acl.find().sort("_id")]
+
+        report = cleanup_unused_rules(max_batches=1)
+        self.assertEqual(report["space_acl"]["scanned"], 2)
+        self.assertEqual(report["space_acl"]["removed"], 1)
+        self.assertFalse(report["space_acl"]["completed"])
+        self.assertEqual(report["space_acl"]["high_water_mark"], first_ids[1])
+
+        report = cleanup_unused_rules(max_batches=1)
+        self.assertEqual(report["space_acl"]["scanned"], 2)
+        self.assertEqual(report["space_acl"]["removed"], 1)
+        self.assertEqual(report["space_acl"]["high_water_mark"], first_ids[3])
+
+        report = cleanup_unused_rules(max_batches=1)
+        self.assertEqual(report["space_acl"]["scanned"], 1)
+        self.assertEqual(report["space_acl"]["removed"], 1)
+        self.assertTrue(report["space_acl"]["completed"])
+        self.assertIsNone(
+            self.db.acl_cleanup.find_one({"_id": "space_acl"})["high_water_mark"]
+        )
+
+        # starts over, nothing left to remove
+        report = cleanup_unused_rules(max_batches=1)
+        self.assertEqual(report["space_acl"]["scanned"], 2)
+        self.assertEqual(report["space_acl"]["removed"], 0)
+
+
+class UploadCacheTest(BaseResourceTestCase):
+    def test_get_reuploaded(self):
+        """
+        expect: an entry is only served for the same upload date, i.e. a file that
+        has been uploaded again under the same _id is a miss
+        """
+
+        cache = UploadCache()
+        upload_date = datetime(2024, 1, 1)
+        cache.put("logo.png", upload_date, b"old")
+
+        self.assertEqual(cache.get("logo.png", upload_date), b"old")
+        self.assertIsNone(cache.get("logo.png", datetime(2024, 1, 2)))
+        self.assertEqual(cache.get_metrics()["hits"], 1)
+        self.assertEqual(cache.get_metrics()["misses"], 1)
+
+    def test_cache_bounds(self):
+        """
+        expect: files above the size limit are not cached, the least recently used
+        files are evicted once the cached files exceed the limit in total
+        """
+
+        cache = UploadCache(max_bytes=10, max_file_size=4)
+        upload_date = datetime(2024, 1, 1)
+        cache.put("big", upload_date, b"12345")
+        self.assertIsNone(cache.get("big", upload_date))
+
+        cache.put("a", upload_date, b"aaaa")
+        cache.put("b", upload_date, b"bbbb")
+        cache.get("a", upload_date)
+        cache.put("c", upload_date, b"cccc")
+
+        self.assertEqual(cache.get("a", upload_date), b"aaaa")
+        self.assertIsNone(cache.get("b", upload_date))
+        self.assertEqual(cache.get("c", upload_date), b"cccc")
+        self.assertEqual(cache.get_metrics()["cached_bytes"], 8)
+        self.assertEqual(cache.get_metrics()["evictions"], 1)
+
+
+class UploadURLTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self._cookie_secret = global_vars.cookie_secret
+        global_vars.cookie_secret = "unittest_secret"
+
+    def tearDown(self) -> None:
+        global_vars.cookie_secret = self._cookie_secret
+        super().tearDown()
+
+    def _parse(self, url: str) -> Dict:
+        path, query = url.split("?")
+        params = dict(parse_qsl(query))
+        params["file_id"] = path.rsplit("/", 1)[1]
+        params["expires"] = int(params["expires"])
+        return params
+
+    def test_sign_file_url(self):
+        """
+        expect: a signed URL is valid until it expires, URLs signed within the
+        same period are identical
+        """
+
+        file_id = ObjectId()
+        now = time.time()
+        url = sign_file_url(file_id, now=now)
+        self.assertTrue(url.startswith("/uploads/signed/{}?".format(file_id)))
+        self.assertEqual(url, sign_file_url(file_id, now=now + 1))
+
+        params = self._parse(url)
+        self.assertGreater(params["expires"], now)
+        self.assertTrue(
+            verify_file_url(
+                str(file_id), params["expires"], params["signature"], now=now
+            )
+        )
+        self.assertFalse(
+            verify_file_url(
+                str(file_id),
+                params["expires"],
+                params["signature"],
+                now=params["expires"],
+            )
+        )
+
+    def test_sign_file_url_viewer(self):
+        """
+        expect: the viewer is part of the signature
+        """
+
+        url = sign_file_url("default_profile_pic.jpg", viewer="test_user")
+        params = self._parse(url)
+        self.assertEqual(params["viewer"], "test_user")
+        self.assertTrue(
+            verify_file_url(
+                params["file_id"],
+                params["expires"],
+                params["signature"],
+                viewer="test_user",
+            )
+        )
+        self.assertFalse(
+            verify_file_url(
+                params["file_id"],
+                params["expires"],
+                params["signature"],
+                viewer="test_admin",
+            )
+        )
+        self.assertFalse(
+            verify_file_url(params["file_id"], params["expires"], params["signature"])
+        )
+
+    def test_verify_file_url_tampered(self):
+        """
+        expect: URLs with a modified file_id, expiry or signature are invalid
+        """
+
+        params = self._parse(sign_file_url("default_profile_pic.jpg"))
+        self.assertFalse(
+            verify_file_url("logo.png", params["expires"], params["signature"])
+        )
+        self.assertFalse(
+            verify_file_url(
+                params["file_id"], params["expires"] + 1, params["signature"]
+            )
+        )
+        self.assertFalse(verify_file_url(params["file_id"], params["expires"], "äöü"))
+
+    def test_signed_urls_disabled(self):
+        """
+        expect: without a cookie secret, no URLs are signed and none are valid
+        """
+
+        params = self._parse(sign_file_url("default_profile_pic.jpg"))
+
+        global_vars.cookie_secret = ""
+        self.assertIsNone(sign_file_url("default_profile_pic.jpg"))
+        self.assertFalse(
+            verify_file_url(params["file_id"], params["expires"], params["signature"])
+        )
+
+
+class ImageDerivativesTest(BaseResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.fs = gridfs.GridFS(self.db)
+        image = Image.new("RGBA", (500, 300), (255, 0, 0, 128))
+        output = io.BytesIO()
+        image.save(output, "PNG")
+        self.image_id = self.fs.put(
+            output.getvalue(),
+            filename="test.png",
+            content_type="image/png",
+            metadata={"uploader": CURRENT_ADMIN.username},
+        )
+
+    def tearDown(self) -> None:
+        self.db.drop_collection("fs.files")
+        self.db.drop_collection("fs.chunks")
+        super().tearDown()
+
+    def test_create_derivatives(self):
+        """
+        expect: derivatives are generated in all sizes and formats, but only once
+        """
+
+        self.assertEqual(
+            create_derivatives(self.image_id),
+            len(DERIVATIVE_SIZES) * len(DERIVATIVE_FORMATS),
+        )
+        self.assertEqual(create_derivatives(self.image_id), 0)
+
+        original = self.fs.get(self.image_id)
+        derivative = find_derivative(self.db, original, 40, "webp")
+        self.assertEqual(derivative.content_type, "image/webp")
+        with Image.open(io.BytesIO(derivative.read())) as image:
+            self.assertEqual(image.format, "WEBP")
+            self.assertEqual(image.size, (40, 24))
+
+        derivative = find_derivative(self.db, original, 320, "jpeg")
+        self.assertEqual(derivative.content_type, "image/jpeg")
+        with Image.open(io.BytesIO(derivative.read())) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.size, (320, 192))
+
+    def test_get_or_create_derivative(self):
+        """
+        expect: a missing derivative is generated on demand and reused afterwards
+        """
+
+        original = self.fs.get(self.image_id)
+        self.assertIsNone(find_derivative(self.db, original, 80, "webp"))
+
+        derivative = get_or_create_derivative(original, 80, "webp")
+        self.assertEqual(derivative.metadata["derivative_of"], self.image_id)
+        self.assertEqual(
+            get_or_create_derivative(original, 80, "webp")._id, derivative._id
+        )
+        self.assertEqual(
+            self.db.fs.files.count_documents({"metadata.derivative_of": self.image_id}),
+            1,
+        )
+
+    def test_get_or_create_derivative_no_image(self):
+        """
+        expect: files that claim to be images, but aren't, have no derivatives
+        and are marked as such
+        """
+
+        file_id = self.fs.put(
+            b"no image", content_type="image/png", metadata={"uploader": "test"}
+        )
+
+        self.assertIsNone(get_or_create_derivative(self.fs.get(file_id), 40, "webp"))
+        original = self.fs.get(file_id)
+        self.assertTrue(is_no_image(original))
+        self.assertIsNone(find_derivative(self.db, original, 40, "webp"))
+        self.assertEqual(create_derivatives(file_id), 0)
+
+    def test_get_or_create_derivative_not_attempted(self):
+        """
+        expect: no derivatives are attempted of files that are no images by their
+        content type or that are too large, they aren't even marked
+        """
+
+        file_id = self.fs.put(
+            b"%PDF-1.4", content_type="application/pdf", metadata={"uploader": "test"}
+        )
+        self.assertIsNone(get_or_create_derivative(self.fs.get(file_id), 40, "webp"))
+        self.assertEqual(create_derivatives(file_id), 0)
+        self.assertFalse(is_no_image(self.fs.get(file_id)))
+
+        max_original_size = image_derivatives_module.MAX_ORIGINAL_SIZE
+        image_derivatives_module.MAX_ORIGINAL_SIZE = 100
+        try:
+            original = self.fs.get(self.image_id)
+            self.assertIsNone(get_or_create_derivative(original, 40, "webp"))
+            self.assertEqual(create_derivatives(self.image_id), 0)
+        finally:
+            image_derivatives_module.MAX_ORIGINAL_SIZE = max_original_size
+        self.assertEqual(
+            self.db.fs.files.count_documents({"metadata.derivative_of": file_id}), 0
+        )
+        self.assertEqual(
+            self.db.fs.files.count_documents({"metadata.derivative_of": self.image_id}),
+            0,
+        )
+
+    def test_store_derivative_concurrently(self):
+        """
+        expect: a derivative that is generated concurrently is only stored once
+        """
+
+        for index in DERIVATIVE_INDEXES:
+            index.create(self.db)
+
+        original = self.fs.get(self.image_id)
+        content = original.read()
+        first = image_derivatives_module._store_derivative(
+            self.db, original, content, 40, "webp"
+        )
+        second = image_derivatives_module._store_derivative(
+            self.db, original, content, 40, "webp"
+        )
+
+        self.assertEqual(first, second)
+        self.assertEqual(
+            self.db.fs.files.count_documents({"metadata.derivative_of": self.image_id}),
+            1,
+        )
+        # no chunks of the rejected copy are left behind
+        self.assertEqual(
+            set(self.db.fs.chunks.distinct("files_id")), {self.image_id, first}
+        )
+
+    def test_delete_derivatives(self):
+        """
+        expect: all derivatives of a file are deleted, those of other files are kept
+        """
+
+        create_derivatives(self.image_id)
+        other_id = self.fs.put(
+            self.fs.get(self.image_id).read(),
+            content_type="image/png",
+            metadata={"uploader": "test"},
+        )
+        create_derivatives(other_id)
+
+        delete_derivatives(self.db, self.image_id)
+        self.assertEqual(
+            self.db.fs.files.count_documents({"metadata.derivative_of": self.image_id}),
+            0,
+        )
+        self.assertEqual(
+            self.db.fs.files.count_documents({"metadata.derivative_of": other_id}),
+            len(DERIVATIVE_SIZES) * len(DERIVATIVE_FORMATS),
+        )
+
+    def test_find_derivative_reuploaded(self):
+        """
+        expect: derivatives of a file that has been uploaded again
+        under the same _id are outdated
+        """
+
+        original = self.fs.get(self.image_id)
+        get_or_create_derivative(original, 40, "jpeg")
+        content = original.read()
+
+        self.fs.delete(self.image_id)
+        self.fs.put(
+            content,
+            _id=self.image_id,
+            content_type="image/png",
+            metadata={"uploader": "test"},
+        )
+        self.assertIsNone(
+            find_derivative(self.db, self.fs.get(self.image_id), 40, "jpeg")
+        )
+
+
+class StreamingUploadTest(BaseResourceTestCase):
+    BOUNDARY = b"----testboundary"
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.fs = gridfs.GridFS(self.db)
+
+    def tearDown(self) -> None:
+        self.db.drop_collection("fs.files")
+        self.db.drop_collection("fs.chunks")
+        super().tearDown()
+
+    def encode(self, fields: Dict) -> bytes:
+        """
+        encode the fields (name -> value, or (filename, content) for files)
+        as a multipart/form-data body
+        """
+
+        body = b""
+        for name, value in fields.items():
+            body += b"--" + self.BOUNDARY + b"\r\n"
+            if isinstance(value, tuple):
+                body += (
+                    'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                    "Content-Type: application/octet-stream\r\n\r\n".format(
+                        name, value[0]
+                    ).encode()
+                )
+                body += value[1] + b"\r\n"
+            else:
+                body += 'Content-Disposition: form-data; name="{}"\r\n\r\n'.format(
+                    name
+                ).encode()
+                body += value + b"\r\n"
+        return body + b"--" + self.BOUNDARY + b"--\r\n"
+
+    def feed_in_chunks(self, upload: GridFSMultipartUpload, body: bytes, size: int):
+        for i in range(0, len(body), size):
+            upload.feed(body[i : i + size])
+
+    def test_upload(self):
+        """
+        expect: the file is stored in gridfs and the other fields are parsed,
+        regardless of how the body is split into chunks
+        """
+
+        content = os.urandom(300 * 1024)
+        # the content contains the beginning of a delimiter, which must not end it
+        content += b"\r\n--" + self.BOUNDARY[:5] + os.urandom(100)
+        body = self.encode(
+            {
+                "description": b"test",
+                "file": ("test.bin", content),
+                "other": ("other.bin", b"skipped"),
+            }
+        )
+
+        for chunk_size in (1, 7, 4096, 65536, len(body)):
+            upload = GridFSMultipartUpload(
+                self.db,
+                self.BOUNDARY,
+                ["file"],
+                1024 * 1024,
+                {"uploader": CURRENT_ADMIN.username},
+            )
+            self.feed_in_chunks(upload, body, chunk_size)
+            upload.close()
+
+            self.assertEqual(list(upload.files), ["file"])
+            self.assertEqual(upload.arguments, {"description": [b"test"]})
+            self.assertEqual(upload.bytes_received, len(body))
+
+            file = self.fs.get(upload.files["file"][0]._id)
+            self.assertEqual(file.read(), content)
+            self.assertEqual(file.filename, "test.bin")
+            self.assertEqual(file.metadata, {"uploader": CURRENT_ADMIN.username})
+
+        # the file of the field that is not stored is skipped
+        self.assertIsNone(self.fs.find_one({"filename": "other.bin"}))
+
+    def test_upload_error_too_large(self):
+        """
+        expect: UploadTooLargeError is raised as soon as the file exceeds
+        the maximum size, and abort() removes everything that has been stored
+        """
+
+        body = self.encode({"file": ("test.bin", os.urandom(3 * 1024 * 1024))})
+        upload = GridFSMultipartUpload(
+            self.db, self.BOUNDARY, ["file"], 2 * 1024 * 1024
+        )
+
+        with self.assertRaises(UploadTooLargeError):
+            self.feed_in_chunks(upload, body, 65536)
+
+        # some chunks have already been written
+        self.assertGreater(self.db.fs.chunks.count_documents({}), 0)
+        upload.abort()
+        self.assertEqual(self.db.fs.files.count_documents({}), 0)
+        self.assertEqual(self.db.fs.chunks.count_documents({}), 0)
+
+        # the rest of the body is ignored
+        upload.feed(body)
+        upload.close()
+        self.assertEqual(upload.files, {})
+
+    def test_upload_error_malformed(self):
+        """
+        expect: MalformedUploadError is raised if the body ends before its final
+        boundary or the parts are invalid
+        """
+
+        body = self.encode({"file": ("test.bin", b"test")})
+        upload = GridFSMultipartUpload(self.db, self.BOUNDARY, ["file"], 1024)
+        upload.feed(body[:-10])
+        self.assertRaises(MalformedUploadError, upload.close)
+
+        upload = GridFSMultipartUpload(self.db, self.BOUNDARY, ["file"], 1024)
+        self.assertRaises(
+            MalformedUploadError,
+            upload.feed,
+            b"--" + self.BOUNDARY + b"\r\nContent-Type: text/plain\r\n\r\ntest",
+        )
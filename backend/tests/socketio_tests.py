@@ -1,7 +1,9 @@
 import asyncio
+from datetime import datetime, timedelta
 import logging
 import os
 
+from bson import ObjectId
 from dotenv import load_dotenv
 import pymongo
 import socketio
@@ -160,9 +162,9 @@ class SocketIOHandlerTest(AsyncHTTPTestCase):
 
                 # check that server side session was created
                 self.assertIn(CURRENT_ADMIN.username, global_vars.username_sid_map)
-                self.assertEqual(
-                    global_vars.username_sid_map[CURRENT_ADMIN.username],
+                self.assertIn(
                     socketio_client.get_sid(),
+                    global_vars.username_sid_map[CURRENT_ADMIN.username],
                 )
                 self.assertIsNotNone(
                     await global_vars.socket_io.get_session(socketio_client.get_sid())
@@ -220,9 +222,77 @@ class SocketIOHandlerTest(AsyncHTTPTestCase):
                 release_event.clear()
                 await socketio_client.disconnect()
 
+        async def test_multiple_sessions(self):
+            """
+            expect: a user authenticated with two sessions receives an event emitted
+            to their room in both, and keeps their plan locks until the last
+            session is closed
+            """
+
+            # the handlers can only be imported once the app is set up
+            from handlers.socket_io import recipient_online, user_room
+
+            async def wait_until(condition):
+                for _ in range(50):
+                    if condition():
+                        return
+                    await asyncio.sleep(0.1)
+                self.fail("condition not met in time")
+
+            clients = [socketio.AsyncClient(), socketio.AsyncClient()]
+            received = []
+            for client in clients:
+                client.on("test_event", lambda data: received.append(data))
+                await self.socketio_connect(client)
+                response = await client.call(
+                    "authenticate", data={"token": "usually_valid_jwt_token"}
+                )
+                self.assert_success(response)
+
+            plan_id = ObjectId()
+            self.db.plan_locks.insert_one(
+                {
+                    "_id": plan_id,
+                    "username": CURRENT_ADMIN.username,
+                    "expires": datetime.now() + timedelta(hours=1),
+                }
+            )
+
+            try:
+                self.assertEqual(
+                    global_vars.username_sid_map[CURRENT_ADMIN.username],
+                    {client.get_sid() for client in clients},
+                )
+
+                await global_vars.socket_io.emit(
+                    "test_event", {"a": 1}, room=user_room(CURRENT_ADMIN.username)
+                )
+                await wait_until(lambda: len(received) == 2)
+
+                # the second session keeps the user online
+                await clients[0].disconnect()
+                await wait_until(
+                    lambda: len(global_vars.username_sid_map[CURRENT_ADMIN.username])
+                    == 1
+                )
+                self.assertTrue(recipient_online(CURRENT_ADMIN.username))
+                self.assertIsNotNone(self.db.plan_locks.find_one({"_id": plan_id}))
+
+                await clients[1].disconnect()
+                await wait_until(
+                    lambda: CURRENT_ADMIN.username not in global_vars.username_sid_map
+                )
+                self.assertFalse(recipient_online(CURRENT_ADMIN.username))
+                self.assertIsNone(self.db.plan_locks.find_one({"_id": plan_id}))
+            finally:
+                self.db.plan_locks.delete_one({"_id": plan_id})
+                for client in clients:
+                    await client.disconnect()
+
         #################################################################################
         # run all tests                                                                 #
         #################################################################################
         await test_connect(self)
         await test_authenticate(self)
+        await test_multiple_sessions(self)
         await test_authenticate_error_missing_token(self)
\ No newline at end of file
@@ -1,37 +1,254 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from email.message import EmailMessage
 from datetime import datetime, timedelta
 from email.utils import make_msgid
 import logging
 import mimetypes
-import smtplib
-from typing import Dict, Literal, Optional
+import functools
+import json
+import threading
+from typing import Any, Callable, Dict, Literal, Optional
 
 from bson import ObjectId
 import dateutil.parser
-from jinja2 import TemplateNotFound
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 from pymongo.database import Database
 
 from exceptions import ProfileDoesntExistException
 import global_vars
 from resources.network.profile import Profiles
+from resources.token_verification import get_token_verifier
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library json is used otherwise
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
 
-@contextmanager
-def get_mongodb():
-    client = MongoClient(
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener that keeps track of how the pool of the process-wide
+    MongoClient is used, i.e. how many connections are currently checked out
+    and how long requests had to wait to get one. Use `snapshot()` to read the
+    current values, e.g. to size `MONGODB_MAX_POOL_SIZE` accordingly.
+
+    The callbacks are invoked by pymongo from arbitrary threads, so all
+    counters are guarded by a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open_connections = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _record_wait(self, duration: Optional[float]) -> None:
+        if duration is None:
+            return
+        self.total_wait_time += duration
+        if duration > self.max_wait_time:
+            self.max_wait_time = duration
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_time_ms": (
+                    (self.total_wait_time / self.checkouts) * 1000
+                    if self.checkouts
+                    else 0.0
+                ),
+                "max_wait_time_ms": self.max_wait_time * 1000,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+            self._record_wait(event.duration)
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            if self.checked_out > self.max_checked_out:
+                self.max_checked_out = self.checked_out
+            self._record_wait(event.duration)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+
+def init_mongodb_client() -> MongoClient:
+    """
+    Create the process-wide pooled `MongoClient` according to the configuration
+    in `global_vars` and store it (as well as its pool metrics) there.
+    An already existing client is closed and replaced.
+
+    Since pymongo clients are not fork-safe, call this only after the process
+    has been forked (if at all).
+
+    Returns the new client.
+    """
+
+    close_mongodb_client()
+
+    pool_metrics = MongoPoolMetrics()
+    global_vars.mongodb_client = MongoClient(
         global_vars.mongodb_host,
         global_vars.mongodb_port,
         username=global_vars.mongodb_username,
         password=global_vars.mongodb_password,
+        maxPoolSize=global_vars.mongodb_max_pool_size,
+        minPoolSize=global_vars.mongodb_min_pool_size,
+        maxIdleTimeMS=global_vars.mongodb_max_idle_time_ms,
+        waitQueueTimeoutMS=global_vars.mongodb_wait_queue_timeout_ms,
+        event_listeners=[pool_metrics],
     )
+    global_vars.mongodb_pool_metrics = pool_metrics
+
+    return global_vars.mongodb_client
+
+
+def close_mongodb_client() -> None:
+    """
+    Close the process-wide `MongoClient` (if there is one) and release
+    all of its pooled connections.
+    """
+
+    if global_vars.mongodb_client is not None:
+        global_vars.mongodb_client.close()
+        global_vars.mongodb_client = None
+        global_vars.mongodb_pool_metrics = None
+
+
+def get_mongodb_client() -> MongoClient:
+    """
+    Returns the process-wide pooled `MongoClient`. Normally it is created
+    in `main.main()`, but if that didn't happen (e.g. in scripts or unit tests),
+    it is lazily created on first use.
+    """
+
+    if global_vars.mongodb_client is None:
+        init_mongodb_client()
+    return global_vars.mongodb_client
+
+
+@contextmanager
+def get_mongodb():
+    """
+    Hand out the database handle of the process-wide pooled `MongoClient`.
+    Connections are checked out of the pool per operation, so there is nothing
+    to close after the block, the context manager is kept for API compatibility.
+
+    Usage::
+
+        with util.get_mongodb() as db:
+            ...
+    """
+
+    yield get_mongodb_client()[global_vars.mongodb_db_name]
+
+
+def get_mongodb_pool_metrics() -> Dict:
+    """
+    Returns a snapshot of the metrics of the process-wide connection pool
+    (see `MongoPoolMetrics`), or an empty dict if no client has been created yet.
+    """
+
+    if global_vars.mongodb_pool_metrics is None:
+        return {}
+    return global_vars.mongodb_pool_metrics.snapshot()
+
+
+def get_mongodb_executor() -> ThreadPoolExecutor:
+    """
+    Returns the process-wide thread pool that runs the blocking pymongo calls
+    of the async resource variants (see `resources.async_resource.AsyncResource`),
+    so they don't stall the IOLoop. It is lazily created on first use.
+    """
+
+    if global_vars.mongodb_executor is None:
+        global_vars.mongodb_executor = ThreadPoolExecutor(
+            max_workers=global_vars.mongodb_executor_workers,
+            thread_name_prefix="mongodb",
+        )
+    return global_vars.mongodb_executor
+
+
+def _run_with_event_loop(
+    loop: asyncio.AbstractEventLoop, func: Callable, *args, **kwargs
+) -> Any:
+    """
+    run `func` in a worker thread, but with the event loop of the calling thread
+    set as the current event loop. That way, code that schedules callbacks via
+    `tornado.ioloop.IOLoop.current().add_callback()` (e.g. achievement
+    notifications) still hands them to the IOLoop of the server instead of
+    a new loop that is never run (`add_callback` is thread-safe).
+    """
+
+    asyncio.set_event_loop(loop)
     try:
-        yield client[global_vars.mongodb_db_name]
+        return func(*args, **kwargs)
     finally:
-        client.close()
+        asyncio.set_event_loop(None)
+
+
+async def run_in_mongodb_executor(func: Callable, *args, **kwargs) -> Any:
+    """
+    Run the blocking `func` with the given arguments in the mongodb executor and
+    await its result without blocking the IOLoop.
+
+    Usage::
+
+        posts = await util.run_in_mongodb_executor(
+            post_manager.get_personal_timeline, username, time_to, limit
+        )
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_mongodb_executor(),
+        functools.partial(_run_with_event_loop, loop, func, *args, **kwargs),
+    )
 
 
 def parse_object_id(obj_id: str | ObjectId) -> ObjectId:
@@ -94,25 +311,19 @@ def seconds_to_timedelta(seconds: float | int) -> timedelta:
     return timedelta(seconds=seconds)
 
 
-def validate_keycloak_jwt(jwt_token: str) -> Dict:
+async def validate_keycloak_jwt(jwt_token: str) -> Dict:
     """
-    Decodes and validates the JWT access token issued by Keycloak.
+    Decodes and validates the JWT access token issued by Keycloak against the cached
+    signing keys of the realm (see `resources.token_verification.TokenVerifier`).
 
     Returns the decoded token info as a dict if it is valid, raises one of the following
     errors otherwise:
 
-        - `keycloak.KeycloakGetError` : could not retrieve the public key of keycloak
-        - `jose.exceptions.JWTError` : token did not validate
+        - `keycloak.KeycloakError` : could not retrieve the signing keys of keycloak
+        - `exceptions.InvalidTokenError` : token did not validate
     """
 
-    # try to decode the JWT, if any error is thrown, re-raise it to signal
-    # to the caller that the token is invalid
-    try:
-        token_info = global_vars.keycloak.decode_token(jwt_token)
-    except Exception:
-        raise
-
-    return token_info
+    return await get_token_verifier().verify(jwt_token)
 
 
 def json_serialize_response(dictionary: dict) -> dict:
@@ -123,37 +334,128 @@ def json_serialize_response(dictionary: dict) -> dict:
     and `datetime.datetime`.
     Parse those values using the `str()` function (for ObjectId's),
     or the `.isoformat()` function (for datetimes).
+
+    The dict is transformed in place. Responses that are only written out should
+    rather be encoded directly by `json_dumps()`, which doesn't have to
+    traverse and mutate them beforehand.
     """
 
-    for key in dictionary:
+    for key, value in dictionary.items():
         # check for keys whose values need to be transformed
-        if isinstance(dictionary[key], ObjectId):
-            dictionary[key] = str(dictionary[key])
-        elif isinstance(dictionary[key], datetime):
-            dictionary[key] = dictionary[key].isoformat()
+        if isinstance(value, ObjectId):
+            dictionary[key] = str(value)
+        elif isinstance(value, datetime):
+            dictionary[key] = value.isoformat()
 
         # if it is a nested dict, recursively run on subdict
-        # and reassemble it
-        elif isinstance(dictionary[key], dict):
-            dictionary[key] = json_serialize_response(dictionary[key])
-
-        # if it is a list, there are two options:
-        # either the entries in the list are ObjectIds themselves, in that
-        # case transform them as str's and reassemble the list,
-        # or the list contains dicts again, in which case we run recursively
-        # on each of those subdicts again.
-        # This can be seen as an exclusive-or, meaning mixed-lists may cause
-        # strange or undesired behaviour.
-        elif isinstance(dictionary[key], list):
-            for elem in dictionary[key]:
+        elif isinstance(value, dict):
+            json_serialize_response(value)
+
+        # if it is a list, the entries are either ObjectIds themselves, in that
+        # case transform them as str's in place, or the list contains dicts again,
+        # in which case we run recursively on each of those subdicts again.
+        elif isinstance(value, list):
+            for i, elem in enumerate(value):
                 if isinstance(elem, ObjectId):
-                    dictionary[key][dictionary[key].index(elem)] = str(elem)
+                    value[i] = str(elem)
                 elif isinstance(elem, dict):
-                    elem = json_serialize_response(elem)
+                    json_serialize_response(elem)
 
     return dictionary
 
 
+def _json_default(obj: Any) -> Any:
+    """
+    transformation of the values that JSON can't represent natively,
+    in the same way as `json_serialize_response()`
+    """
+
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(type(obj).__name__)
+    )
+
+
+class ResponseEncoder(json.JSONEncoder):
+    """
+    JSON encoder that serializes `ObjectId`s as str, datetimes in ISO format and
+    timedeltas as their number of seconds while encoding, i.e. without traversing
+    and copying the whole object beforehand.
+    """
+
+    def default(self, obj: Any) -> Any:
+        return _json_default(obj)
+
+
+def json_dumps(obj: Any) -> str:
+    """
+    encode the (variably) nested `obj` as JSON, transforming `ObjectId`s,
+    datetimes and timedeltas on the fly (see `ResponseEncoder`).
+    orjson is used if it is installed, falling back to the standard library json
+    for objects it can't encode (e.g. ints exceeding 64 bits).
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj,
+                default=_json_default,
+                # datetimes have to go through the default as well to keep the
+                # format of `datetime.isoformat()`
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+            ).decode("utf-8")
+        except TypeError:
+            pass
+
+    return json.dumps(obj, cls=ResponseEncoder, separators=(",", ":"))
+
+
+class SocketIOJSON:
+    """
+    drop-in for the `json` module that python-socketio encodes its packets with,
+    see `json_dumps()`.
+    """
+
+    @staticmethod
+    def dumps(obj: Any, *args, **kwargs) -> str:
+        return json_dumps(obj)
+
+    @staticmethod
+    def loads(s: str | bytes, *args, **kwargs) -> Any:
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(s, *args, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_text_template(name: str) -> str:
+    """
+    Returns the content of the plain text email template `name` from the
+    `assets/email_templates` directory, read from disk only once.
+    """
+
+    with open("assets/email_templates/{}".format(name), "r") as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def _read_inline_image(name: str) -> tuple[bytes, str, str]:
+    """
+    Returns the content, maintype and subtype of the image `name` from the
+    `assets/images` directory, read from disk only once.
+    """
+
+    path = "assets/images/{}".format(name)
+    maintype, subtype = mimetypes.guess_type(path)[0].split("/")
+    with open(path, "rb") as f:
+        return f.read(), maintype, subtype
+
+
 def _construct_email_header(
     recipient_name: str | None, recipient_email: str, subject: str | None
 ) -> EmailMessage:
@@ -237,23 +539,18 @@ def _append_msg_text(
     # set text according to the chosen template
     text = ""
     if template == "reminder_evaluation.html":
-        with open("assets/email_templates/reminder_evaluation.txt", "r") as f:
-            text = f.read()
-            text = text.format(display_name, payload["material_link"])
+        text = _read_text_template("reminder_evaluation.txt")
+        text = text.format(display_name, payload["material_link"])
 
     elif template == "reminder_good_practise_examples.html":
-        with open(
-            "assets/email_templates/reminder_good_practise_examples.txt", "r"
-        ) as f:
-            text = f.read()
-            text = text.format(
-                display_name, payload["material_link"], payload["designer_dashboard"]
-            )
+        text = _read_text_template("reminder_good_practise_examples.txt")
+        text = text.format(
+            display_name, payload["material_link"], payload["designer_dashboard"]
+        )
 
     elif template == "reminder_icebreaker.html":
-        with open("assets/email_templates/reminder_icebreaker.txt", "r") as f:
-            text = f.read()
-            text = text.format(display_name, payload["material_link"])
+        text = _read_text_template("reminder_icebreaker.txt")
+        text = text.format(display_name, payload["material_link"])
 
     elif template == "space_invitation.html":
         sender_display_name = _exchange_username_for_display_name(
@@ -265,13 +562,12 @@ def _append_msg_text(
 
         payload["invitation_sender"] = sender_display_name
 
-        with open("assets/email_templates/space_invitation.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=(display_name),
-                invitation_sender=(sender_display_name),
-                space_name=payload["space_name"],
-            )
+        text = _read_text_template("space_invitation.txt")
+        text = text.format(
+            recipient_name=(display_name),
+            invitation_sender=(sender_display_name),
+            space_name=payload["space_name"],
+        )
 
     elif template == "space_join_request.html":
         sender_display_name = _exchange_username_for_display_name(
@@ -283,14 +579,13 @@ def _append_msg_text(
 
         payload["join_request_sender"] = sender_display_name
 
-        with open("assets/email_templates/space_join_request.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=(display_name),
-                join_request_sender=(sender_display_name),
-                space_name=payload["space_name"],
-                space_id=payload["space_id"],
-            )
+        text = _read_text_template("space_join_request.txt")
+        text = text.format(
+            recipient_name=(display_name),
+            join_request_sender=(sender_display_name),
+            space_name=payload["space_name"],
+            space_id=payload["space_id"],
+        )
 
     elif template == "ve_invitation.html":
         sender_display_name = _exchange_username_for_display_name(payload["from"], db)
@@ -306,13 +601,12 @@ def _append_msg_text(
         if payload["message"] is None or payload["message"] == "":
             del payload["message"]
 
-        with open("assets/email_templates/ve_invitation.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=(display_name),
-                invitation_sender_name=(sender_display_name),
-                message=payload["message"] if "message" in payload else "",
-            )
+        text = _read_text_template("ve_invitation.txt")
+        text = text.format(
+            recipient_name=(display_name),
+            invitation_sender_name=(sender_display_name),
+            message=payload["message"] if "message" in payload else "",
+        )
 
     elif template == "ve_invitation_reply.html":
         invitation_recipient_name = _exchange_username_for_display_name(
@@ -326,96 +620,80 @@ def _append_msg_text(
 
         # depending on the accepted flag, the alternative text is different
         if payload["accepted"]:
-            with open(
-                "assets/email_templates/ve_invitation_reply_success.txt", "r"
-            ) as f:
-                text = f.read()
-                text = text.format(
-                    recipient_name=(display_name),
-                    invitation_recipient_name=invitation_recipient_name,
-                )
+            text = _read_text_template("ve_invitation_reply_success.txt")
+            text = text.format(
+                recipient_name=(display_name),
+                invitation_recipient_name=invitation_recipient_name,
+            )
         else:
-            with open(
-                "assets/email_templates/ve_invitation_reply_failure.txt", "r"
-            ) as f:
-                text = f.read()
-                text = text.format(
-                    recipient_name=(display_name),
-                    invitation_recipient_name=invitation_recipient_name,
-                )
-
-    elif template == "new_messages.html":
-        with open("assets/email_templates/new_messages.txt", "r") as f:
-            text = f.read()
+            text = _read_text_template("ve_invitation_reply_failure.txt")
             text = text.format(
-                recipient_name=display_name,
-                unread_messages_amount=payload["unread_messages_amount"],
-                unread_rooms_amount=payload["unread_rooms_amount"],
+                recipient_name=(display_name),
+                invitation_recipient_name=invitation_recipient_name,
             )
 
+    elif template == "new_messages.html":
+        text = _read_text_template("new_messages.txt")
+        text = text.format(
+            recipient_name=display_name,
+            unread_messages_amount=payload["unread_messages_amount"],
+            unread_rooms_amount=payload["unread_rooms_amount"],
+        )
+
     elif template == "achievement_level_up.html":
-        with open("assets/email_templates/achievement_level_up.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=display_name,
-                achievement_type=(
-                    "Social" if payload["achievement_type"] == "social" else "VE"
-                ),
-                level=payload["level"],
-                edit_profile_link="https://ve-collab.org/profile/edit",
-            )
+        text = _read_text_template("achievement_level_up.txt")
+        text = text.format(
+            recipient_name=display_name,
+            achievement_type=(
+                "Social" if payload["achievement_type"] == "social" else "VE"
+            ),
+            level=payload["level"],
+            edit_profile_link="https://ve-collab.org/profile/edit",
+        )
 
     elif template == "plan_access_granted.html":
-        with open("assets/email_templates/plan_access_granted.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=display_name,
-                plan_name=payload["plan_name"],
-                plan_id=payload["plan_id"],
-                author=payload["author"],
-                read=payload["read"],
-                write=payload["write"],
-            )
+        text = _read_text_template("plan_access_granted.txt")
+        text = text.format(
+            recipient_name=display_name,
+            plan_name=payload["plan_name"],
+            plan_id=payload["plan_id"],
+            author=payload["author"],
+            read=payload["read"],
+            write=payload["write"],
+        )
 
     elif template == "plan_added_as_partner.html":
-        with open("assets/email_templates/plan_added_as_partner.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=display_name,
-                plan_name=payload["plan_name"],
-                plan_id=payload["plan_id"],
-                author=payload["author"],
-            )
+        text = _read_text_template("plan_added_as_partner.txt")
+        text = text.format(
+            recipient_name=display_name,
+            plan_name=payload["plan_name"],
+            plan_id=payload["plan_id"],
+            author=payload["author"],
+        )
 
     elif template == "email_invitation_with_plan.html":
-        with open("assets/email_templates/email_invitation_with_plan.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=display_name,
-                sender=payload["sender"],
-                message=payload["message"],
-                invitation_id=payload["invitation_id"],
-                plan_name=payload["plan_name"]
-            )
+        text = _read_text_template("email_invitation_with_plan.txt")
+        text = text.format(
+            recipient_name=display_name,
+            sender=payload["sender"],
+            message=payload["message"],
+            invitation_id=payload["invitation_id"],
+            plan_name=payload["plan_name"]
+        )
 
     elif template == "email_invitation_with_plan.html":
-        with open("assets/email_templates/email_invitation_with_plan.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=display_name,
-                sender=payload["sender"],
-                message=payload["message"],
-            )
+        text = _read_text_template("email_invitation_with_plan.txt")
+        text = text.format(
+            recipient_name=display_name,
+            sender=payload["sender"],
+            message=payload["message"],
+        )
     elif template == "report_submitted.html":
-        with open("assets/email_templates/report_submitted.txt", "r") as f:
-            text = f.read()
+        text = _read_text_template("report_submitted.txt")
 
     elif template == "content_deleted_due_to_report.html":
-        with open("assets/email_templates/content_deleted_due_to_report.txt", "r") as f:
-            text = f.read()
-            text = text.format(
-                recipient_name=display_name, content_type=payload["type"]
-            )
+        text = _read_text_template("content_deleted_due_to_report.txt")
+        text = text.format(recipient_name=display_name, content_type=payload["type"])
 
     else:
         raise ValueError("Invalid template name: {}".format(template))
@@ -425,8 +703,9 @@ def _append_msg_text(
     return msg
 
 
-def send_email(
-    recipient_username: str,
+def build_email(
+    db: Database,
+    recipient_username: str | None,
     recipient_email: str,
     subject: str | None,
     template: Literal[
@@ -447,14 +726,16 @@ def send_email(
         "content_deleted_due_to_report.html",
     ],
     payload: Dict,
-) -> None:
+    display_name: str | None = None,
+) -> EmailMessage:
     """
-    Send an Email to the recipient with the given username and email address.
+    Construct the Email to the recipient with the given username and email address,
+    consisting of a plain text and a html alternative with the vecollab logo and the
+    funding icons as inline images.
 
     The email is constructed based on the given template, which is chosen from a
     set of predefined templates in the `assets/email_templates` directory.
-    If the template does not exist, an error is logged and the function returns without
-    sending an email, i.e. a valid, existing `template` is always required.
+    Raises `jinja2.TemplateNotFound` if the template does not exist.
 
     The payload is a dictionary containing arbitrary information that is used to fill
     the placeholders in the email template. The keys in the payload are specific to the
@@ -462,35 +743,30 @@ def send_email(
 
     Optionally a `subject` can be set for the email. If None is given, instead a generic
     default is used.
+    The `display_name` of the recipient is looked up from their profile if it is not
+    given, falling back to the username.
 
-    Returns nothing
-    """
+    Sending the email is up to the caller, usually the mail queue
+    (see `resources.mail_outbox.send_email()`).
 
-    # sanity check: email template exists
-    try:
-        global_vars.email_template_env.get_template(template)
-    except TemplateNotFound:
-        logger.error("Email template not found: {}".format(template))
-        return
+    Returns the `EmailMessage` object.
+    """
 
-    # setup shenanigans
-    mailserver = smtplib.SMTP(global_vars.smtp_host, global_vars.smtp_port)
-    mailserver.starttls()
-    mailserver.login(global_vars.smtp_username, global_vars.smtp_password)
+    html_template = global_vars.email_template_env.get_template(template)
 
     # set header and alternative text for the email
-    with get_mongodb() as db:
+    if display_name is None:
         display_name = _exchange_username_for_display_name(recipient_username, db)
-        if display_name is None:
-            if recipient_username is None:
-                display_name = "Nutzer:in"
-            else:
-                display_name = recipient_username
+    if display_name is None:
+        if recipient_username is None:
+            display_name = "Nutzer:in"
+        else:
+            display_name = recipient_username
 
-        msg = _construct_email_header(display_name, recipient_email, subject)
+    msg = _construct_email_header(display_name, recipient_email, subject)
 
-        # alt text is used in case clients dont want to render the html
-        msg = _append_msg_text(db, msg, display_name, template, payload)
+    # alt text is used in case clients dont want to render the html
+    msg = _append_msg_text(db, msg, display_name, template, payload)
 
     # image cid's for vecollab logo and funding icons
     logo_cid = make_msgid(domain="ve-collab.org")
@@ -501,8 +777,7 @@ def send_email(
     eu_cid_bare = eu_cid.strip("<>")
 
     # set html mail content based on the chosen template
-    template = global_vars.email_template_env.get_template(template)
-    rendered = template.render(
+    rendered = html_template.render(
         logo_cid=logo_cid_bare,
         bmbf_cid=bmbf_cid_bare,
         eu_cid=eu_cid_bare,
@@ -512,22 +787,14 @@ def send_email(
     msg.add_alternative(rendered, subtype="html")
 
     # add images for pre-created cids
-    with open("assets/images/logo.png", "rb") as logo:
-        maintype, subtype = mimetypes.guess_type(logo.name)[0].split("/")
-        msg.get_payload()[1].add_related(
-            logo.read(), maintype=maintype, subtype=subtype, cid=logo_cid
-        )
-    with open("assets/images/bmbf_logo.png", "rb") as bmbf:
-        maintype, subtype = mimetypes.guess_type(bmbf.name)[0].split("/")
-        msg.get_payload()[1].add_related(
-            bmbf.read(), maintype=maintype, subtype=subtype, cid=bmbf_cid
-        )
-    with open("assets/images/eu_funding.png", "rb") as eu:
-        maintype, subtype = mimetypes.guess_type(eu.name)[0].split("/")
+    for image, cid in [
+        ("logo.png", logo_cid),
+        ("bmbf_logo.png", bmbf_cid),
+        ("eu_funding.png", eu_cid),
+    ]:
+        content, maintype, subtype = _read_inline_image(image)
         msg.get_payload()[1].add_related(
-            eu.read(), maintype=maintype, subtype=subtype, cid=eu_cid
+            content, maintype=maintype, subtype=subtype, cid=cid
         )
 
-    mailserver.send_message(msg)
-
-    mailserver.quit()
+    return msg